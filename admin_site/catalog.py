@@ -0,0 +1,511 @@
+"""
+Clinical catalog search index.
+
+Every drug, lab test template, scan template, service and service item has
+one CatalogEntry row holding what ordering screens show (name, price, cost
+price, stock, active flag, kind-specific fields in data) and a set of
+CatalogSearchToken rows, one per normalized search key, stored as
+"<kind>:<value>" in a single indexed column:
+
+    n:  word of the item's name; for drugs the brand name, generic name and strength
+    c:  code (lab/scan template code, drug SKU), alphanumerics only
+    g:  word of the item's group (service category)
+    d:  word of the description (services and service items)
+    t:  name trigram, for typo-tolerant matching
+
+A search term matches an entry when one of its tokens starts with the term,
+which the token index answers as a range scan. Multi-word queries must match
+every word. When nothing matches, names sharing enough trigrams with the
+query are returned instead.
+
+Entries are rewritten by post_save/post_delete receivers when an item, or a
+record whose name or price it shows (generic drug, formulation,
+manufacturer, drug stock entry, service category), is saved or deleted (see
+admin_site.signals). Records changed with QuerySet.update() do not fire
+signals: the code making such changes calls index_items(), or
+reindex_items() for many items at once, or run manage.py
+rebuild_catalog_index afterwards.
+
+JSON contract of catalog_search_view (catalog/search/?q=&type=drug,lab_test):
+
+    {"results": [<entry>, ...]}   # see serialize_entry()
+"""
+import re
+from collections import namedtuple
+
+from django.apps import apps as global_apps
+from django.db import transaction
+from django.db.models import Q, Count, OuterRef, Subquery
+from django.db.models.signals import post_save, post_delete
+
+from patient.search import normalize_text, name_words, trigrams
+
+NAME = 'n:'
+CODE = 'c:'
+GROUP = 'g:'
+DESCRIPTION = 'd:'
+TRIGRAM = 't:'
+
+# Score of a term matching a token of each kind; an exact match counts double
+KIND_WEIGHTS = {
+    CODE: 100,
+    NAME: 40,
+    GROUP: 15,
+    DESCRIPTION: 5,
+}
+# Highest score of a fuzzy (trigram) match, kept below any prefix match
+FUZZY_WEIGHT = 4
+# Share of the query's trigrams a name must contain to be a fuzzy match
+FUZZY_MIN_SIMILARITY = 0.4
+
+DEFAULT_LIMIT = 15
+MAX_LIMIT = 50
+# Shortest query searched
+MIN_QUERY_LENGTH = 2
+# Most entries ranked per search
+CANDIDATE_LIMIT = 200
+
+TOKEN_MAX_LENGTH = 120
+
+# model: (app label, model name)
+# fields: values read to build the entry
+# annotate: callable(apps) returning extra annotations for the values, or None
+# describe: callable(row) returning (entry fields, searchable text by token kind)
+Source = namedtuple('Source', 'kind model fields annotate describe')
+
+
+def _drug_cost_price(apps):
+    stock = apps.get_model('pharmacy', 'DrugStockModel')
+    latest = stock.objects.filter(drug=OuterRef('pk')).order_by('-id').values('unit_cost_price')[:1]
+    return {'last_cost_price': Subquery(latest)}
+
+
+def _drug(row):
+    generic = row['formulation__generic_drug__generic_name'] or ''
+    formulation = f"{generic} {row['formulation__strength']} {row['formulation__form_type']}"
+    name = f"{row['brand_name']} ({formulation})" if row['brand_name'] else formulation
+    if row['manufacturer__name']:
+        name += f" - {row['manufacturer__name']}"
+    entry = {
+        'name': name,
+        'detail': generic,
+        'category_id': None,
+        'price': row['selling_price'],
+        'cost_price': row['last_cost_price'] or 0,
+        'stock': row['pharmacy_quantity'],
+        'is_active': row['is_active'],
+        'data': {
+            'brand_name': row['brand_name'],
+            'generic_name': generic,
+            'formulation': formulation,
+            'manufacturer': row['manufacturer__name'] or '',
+            'pack_size': row['pack_size'],
+            'unit': row['formulation__form_type'],
+            'store_quantity': row['store_quantity'],
+            'is_prescription_only': row['formulation__generic_drug__is_prescription_only'],
+        },
+    }
+    searchable = {
+        NAME: f"{row['brand_name']} {generic} {row['formulation__strength']}",
+        CODE: row['sku'],
+    }
+    return entry, searchable
+
+
+def _template(row):
+    entry = {
+        'name': row['name'],
+        'detail': row['category__name'] or '',
+        'category_id': row['category_id'],
+        'price': row['price'],
+        'cost_price': None,
+        'stock': None,
+        'is_active': row['is_active'],
+        'data': {'code': row['code']},
+    }
+    return entry, {NAME: row['name'], CODE: row['code']}
+
+
+def _service(row):
+    entry = {
+        'name': row['name'],
+        'detail': row['category__name'] or '',
+        'category_id': row['category_id'],
+        'price': row['price'],
+        'cost_price': None,
+        'stock': None,
+        'is_active': row['is_active'],
+        'data': {'has_results': row['has_results']},
+    }
+    searchable = {NAME: row['name'], GROUP: row['category__name'], DESCRIPTION: row['description']}
+    return entry, searchable
+
+
+def _service_item(row):
+    entry = {
+        'name': row['name'],
+        'detail': row['category__name'] or '',
+        'category_id': row['category_id'],
+        'price': row['price'],
+        'cost_price': row['cost_price'],
+        'stock': row['stock_quantity'],
+        'is_active': row['is_active'],
+        'data': {'unit_of_measure': row['unit_of_measure'], 'expiry_date': row['expiry_date']},
+    }
+    searchable = {NAME: row['name'], GROUP: row['category__name'], DESCRIPTION: row['description']}
+    return entry, searchable
+
+
+TEMPLATE_FIELDS = ('name', 'code', 'category_id', 'category__name', 'price', 'is_active')
+
+SOURCES = [
+    Source('drug', ('pharmacy', 'DrugModel'),
+           ('brand_name', 'sku', 'formulation__generic_drug__generic_name',
+            'formulation__generic_drug__is_prescription_only', 'formulation__strength', 'formulation__form_type',
+            'manufacturer__name', 'selling_price', 'pharmacy_quantity', 'store_quantity', 'pack_size',
+            'is_active', 'last_cost_price'),
+           _drug_cost_price, _drug),
+    Source('lab_test', ('laboratory', 'LabTestTemplateModel'), TEMPLATE_FIELDS, None, _template),
+    Source('scan', ('scan', 'ScanTemplateModel'), TEMPLATE_FIELDS, None, _template),
+    Source('service', ('service', 'Service'),
+           ('name', 'description', 'category_id', 'category__name', 'price', 'has_results', 'is_active'),
+           None, _service),
+    Source('service_item', ('service', 'ServiceItem'),
+           ('name', 'description', 'category_id', 'category__name', 'price', 'cost_price', 'stock_quantity',
+            'unit_of_measure', 'expiry_date', 'is_active'),
+           None, _service_item),
+]
+
+SOURCES_BY_KIND = {source.kind: source for source in SOURCES}
+
+# Records whose changes alter the entries of other items:
+# model: (app label, model name); the entries of kind whose items match
+# {lookup: <the record's attribute>} are rewritten when the record is saved or deleted
+Dependency = namedtuple('Dependency', 'model kind lookup attribute')
+
+DEPENDENCIES = [
+    Dependency(('pharmacy', 'GenericDrugModel'), 'drug', 'formulation__generic_drug_id', 'pk'),
+    Dependency(('pharmacy', 'DrugFormulationModel'), 'drug', 'formulation_id', 'pk'),
+    Dependency(('pharmacy', 'ManufacturerModel'), 'drug', 'manufacturer_id', 'pk'),
+    Dependency(('pharmacy', 'DrugStockModel'), 'drug', 'pk', 'drug_id'),
+    Dependency(('service', 'ServiceCategory'), 'service', 'category_id', 'pk'),
+    Dependency(('service', 'ServiceCategory'), 'service_item', 'category_id', 'pk'),
+]
+
+
+# ---------------------------------------------------------------------------
+# Building entries
+# ---------------------------------------------------------------------------
+
+def _truncate(value, length):
+    value = ' '.join(str(value or '').split())
+    return value if len(value) <= length else value[:length - 3] + '...'
+
+
+def _compact(value):
+    return re.sub(r'[^a-z0-9]', '', normalize_text(value))
+
+
+def entry_tokens(searchable):
+    """The set of search tokens for an entry's searchable text"""
+    tokens = set()
+    for kind, text in searchable.items():
+        if kind == CODE:
+            code = _compact(text)
+            if code:
+                tokens.add(CODE + code)
+            continue
+        for word in name_words(text):
+            tokens.add(kind + word)
+            if kind == NAME:
+                tokens.update(TRIGRAM + gram for gram in trigrams(word))
+    return {token[:TOKEN_MAX_LENGTH] for token in tokens}
+
+
+def build_entries(source, queryset, apps=global_apps):
+    """{object id: (CatalogEntry field values, tokens)} for the items of queryset"""
+    if source.annotate:
+        queryset = queryset.annotate(**source.annotate(apps))
+    entries = {}
+    for row in queryset.order_by().values('pk', *source.fields):
+        fields, searchable = source.describe(row)
+        fields['name'] = _truncate(fields['name'], 255)
+        fields['detail'] = _truncate(fields['detail'], 255)
+        fields['data'] = {key: value.isoformat() if hasattr(value, 'isoformat') else value
+                          for key, value in fields['data'].items()}
+        entries[row['pk']] = (fields, entry_tokens(searchable))
+    return entries
+
+
+def _write_entries(kind, built, CatalogEntry, CatalogSearchToken):
+    """bulk_create the entries and tokens of build_entries() output; returns the number of entries"""
+    CatalogEntry.objects.bulk_create([
+        CatalogEntry(kind=kind, object_id=object_id, **fields)
+        for object_id, (fields, _) in built.items()
+    ])
+    # Read the ids back rather than rely on bulk_create setting them on every backend
+    entry_ids = dict(CatalogEntry.objects.filter(
+        kind=kind, object_id__in=list(built)
+    ).values_list('object_id', 'id'))
+    CatalogSearchToken.objects.bulk_create(
+        [CatalogSearchToken(entry_id=entry_ids[object_id], token=token)
+         for object_id, (_, tokens) in built.items() for token in tokens],
+        batch_size=5000,
+    )
+    return len(built)
+
+
+@transaction.atomic
+def index_items(kind, object_ids):
+    """Rewrite the entries of the given items of a kind; entries of items that no longer exist are removed"""
+    from admin_site.models import CatalogEntry, CatalogSearchToken
+
+    source = SOURCES_BY_KIND[kind]
+    model = global_apps.get_model(*source.model)
+    object_ids = set(object_ids)
+    built = build_entries(source, model.objects.filter(pk__in=object_ids))
+    CatalogEntry.objects.filter(kind=kind, object_id__in=object_ids - set(built)).delete()
+
+    for object_id, (fields, tokens) in built.items():
+        entry, _ = CatalogEntry.objects.update_or_create(kind=kind, object_id=object_id, defaults=fields)
+        existing = set(CatalogSearchToken.objects.filter(entry=entry).values_list('token', flat=True))
+        if existing == tokens:
+            continue
+        CatalogSearchToken.objects.filter(entry=entry).exclude(token__in=tokens).delete()
+        CatalogSearchToken.objects.bulk_create(
+            [CatalogSearchToken(entry=entry, token=token) for token in tokens - existing]
+        )
+
+
+def rebuild(apps=global_apps, kinds=None, batch_size=1000):
+    """
+    Rewrite the entries of every item, or only of the given kinds. Returns the
+    number of entries written. Pass the migration's apps registry to run it
+    from a data migration.
+    """
+    CatalogEntry = apps.get_model('admin_site', 'CatalogEntry')
+    CatalogSearchToken = apps.get_model('admin_site', 'CatalogSearchToken')
+    written = 0
+    for source in SOURCES:
+        if kinds and source.kind not in kinds:
+            continue
+        model = apps.get_model(*source.model)
+        with transaction.atomic():
+            CatalogEntry.objects.filter(kind=source.kind).delete()
+            last_pk = None
+            while True:
+                batch = model.objects.order_by('pk')
+                if last_pk is not None:
+                    batch = batch.filter(pk__gt=last_pk)
+                pks = list(batch.values_list('pk', flat=True)[:batch_size])
+                if not pks:
+                    break
+                built = build_entries(source, model.objects.filter(pk__in=pks), apps)
+                written += _write_entries(source.kind, built, CatalogEntry, CatalogSearchToken)
+                last_pk = pks[-1]
+    return written
+
+
+@transaction.atomic
+def reindex_items(kind, object_ids, batch_size=1000):
+    """
+    Rewrite the entries of many items of a kind with bulk inserts, batch_size
+    items at a time, instead of index_items()'s per-item update. For bulk
+    writes such as a drug import.
+    """
+    from admin_site.models import CatalogEntry, CatalogSearchToken
+
+    source = SOURCES_BY_KIND[kind]
+    model = global_apps.get_model(*source.model)
+    object_ids = sorted(set(object_ids))
+    written = 0
+    for start in range(0, len(object_ids), batch_size):
+        batch = object_ids[start:start + batch_size]
+        CatalogEntry.objects.filter(kind=kind, object_id__in=batch).delete()
+        built = build_entries(source, model.objects.filter(pk__in=batch))
+        written += _write_entries(kind, built, CatalogEntry, CatalogSearchToken)
+    return written
+
+
+# ---------------------------------------------------------------------------
+# Keeping entries in step with their items
+# ---------------------------------------------------------------------------
+
+_SOURCES_BY_MODEL = {}
+_DEPENDENCIES_BY_MODEL = {}
+
+
+def index_item(sender, instance, raw=False, **kwargs):
+    """Rewrite the entry of a saved or deleted item (post_save/post_delete receiver)"""
+    source = _SOURCES_BY_MODEL.get(sender._meta.label_lower)
+    if raw or source is None:
+        return
+    index_items(source.kind, [instance.pk])
+
+
+def index_dependents(sender, instance, raw=False, **kwargs):
+    """Rewrite the entries of the items that show a saved or deleted record (post_save/post_delete receiver)"""
+    if raw:
+        return
+    for dependency in _DEPENDENCIES_BY_MODEL.get(sender._meta.label_lower, []):
+        value = getattr(instance, dependency.attribute)
+        if value is None:
+            continue
+        if dependency.lookup == 'pk':
+            object_ids = [value]
+        else:
+            model = global_apps.get_model(*SOURCES_BY_KIND[dependency.kind].model)
+            object_ids = list(model.objects.filter(**{dependency.lookup: value}).values_list('pk', flat=True))
+        if object_ids:
+            index_items(dependency.kind, object_ids)
+
+
+def connect():
+    """Register the catalog receivers (called from admin_site.signals)"""
+    for source in SOURCES:
+        model = global_apps.get_model(*source.model)
+        _SOURCES_BY_MODEL[model._meta.label_lower] = source
+        post_save.connect(index_item, sender=model, dispatch_uid=f'catalog_save_{source.kind}')
+        post_delete.connect(index_item, sender=model, dispatch_uid=f'catalog_delete_{source.kind}')
+    for dependency in DEPENDENCIES:
+        model = global_apps.get_model(*dependency.model)
+        label = model._meta.label_lower
+        if label not in _DEPENDENCIES_BY_MODEL:
+            post_save.connect(index_dependents, sender=model, dispatch_uid=f'catalog_save_{label}')
+            post_delete.connect(index_dependents, sender=model, dispatch_uid=f'catalog_delete_{label}')
+        _DEPENDENCIES_BY_MODEL.setdefault(label, []).append(dependency)
+
+
+# ---------------------------------------------------------------------------
+# Searching
+# ---------------------------------------------------------------------------
+
+def catalog_entries(kinds=None, category_id=None, active_only=True, in_stock=False):
+    """Entries of the given kinds, optionally of one category, only active or only in stock ones"""
+    from admin_site.models import CatalogEntry
+
+    entries = CatalogEntry.objects.all()
+    if kinds:
+        entries = entries.filter(kind__in=kinds)
+    if category_id:
+        entries = entries.filter(category_id=category_id)
+    if active_only:
+        entries = entries.filter(is_active=True)
+    if in_stock:
+        entries = entries.filter(stock__gt=0)
+    return entries
+
+
+def parse_query(query):
+    """Split a query into terms, each the list of token prefixes it may match"""
+    terms = []
+    for word in (query or '').split():
+        term = _compact(word)
+        if term:
+            terms.append([kind + term for kind in KIND_WEIGHTS])
+    return terms
+
+
+def _starts_with_any(prefixes):
+    condition = Q()
+    for prefix in prefixes:
+        condition |= Q(token__startswith=prefix)
+    return condition
+
+
+def _filter_terms(entries, terms, exact=False):
+    from admin_site.models import CatalogSearchToken
+
+    for prefixes in terms:
+        condition = Q(token__in=prefixes) if exact else _starts_with_any(prefixes)
+        entries = entries.filter(id__in=CatalogSearchToken.objects.filter(condition).values('entry_id'))
+    return entries
+
+
+def _fuzzy_scores(query, entries, limit):
+    """{entry id: similarity} of entries whose names share enough trigrams with the query"""
+    from admin_site.models import CatalogSearchToken
+
+    grams = set()
+    for word in name_words(query):
+        grams.update(trigrams(word))
+    if not grams:
+        return {}
+
+    min_hits = max(1, round(len(grams) * FUZZY_MIN_SIMILARITY))
+    rows = CatalogSearchToken.objects.filter(
+        token__in=[TRIGRAM + gram for gram in grams],
+        entry_id__in=entries.values('id'),
+    ).values('entry_id').annotate(hits=Count('id')).filter(hits__gte=min_hits).order_by('-hits')[:limit]
+    return {row['entry_id']: row['hits'] / len(grams) for row in rows}
+
+
+def _term_score(prefixes, tokens):
+    best = 0
+    for prefix in prefixes:
+        weight = KIND_WEIGHTS[prefix[:2]]
+        for token in tokens:
+            if token == prefix:
+                best = max(best, weight * 2)
+            elif token.startswith(prefix):
+                best = max(best, weight)
+    return best
+
+
+def search_catalog(query, kinds=None, category_id=None, active_only=True, in_stock=False, limit=DEFAULT_LIMIT):
+    """
+    Best matches for the query as a list of (entry, score), highest score first.
+
+    Entries matching every word exactly are gathered before prefix matches so
+    they are ranked even when a short prefix matches thousands of items.
+    """
+    from admin_site.models import CatalogEntry, CatalogSearchToken
+
+    terms = parse_query(query)
+    if not terms:
+        return []
+    entries = catalog_entries(kinds, category_id, active_only, in_stock)
+
+    candidates = list(_filter_terms(entries, terms, exact=True).values_list('id', flat=True)[:CANDIDATE_LIMIT])
+    if len(candidates) < CANDIDATE_LIMIT:
+        prefix_matches = _filter_terms(entries, terms).exclude(id__in=candidates)
+        candidates.extend(prefix_matches.values_list('id', flat=True)[:CANDIDATE_LIMIT - len(candidates)])
+
+    if candidates:
+        tokens = {}
+        rows = CatalogSearchToken.objects.filter(entry_id__in=candidates).exclude(token__startswith=TRIGRAM)
+        for entry_id, token in rows.values_list('entry_id', 'token'):
+            tokens.setdefault(entry_id, []).append(token)
+        scores = {
+            entry_id: sum(_term_score(prefixes, tokens.get(entry_id, [])) for prefixes in terms)
+            for entry_id in candidates
+        }
+    else:
+        scores = {
+            entry_id: similarity * FUZZY_WEIGHT
+            for entry_id, similarity in _fuzzy_scores(query, entries, limit).items()
+        }
+
+    found = CatalogEntry.objects.in_bulk(list(scores))
+    ranked = sorted(found.values(), key=lambda entry: (-scores[entry.id], entry.name.lower(), entry.id))
+    return [(entry, scores[entry.id]) for entry in ranked[:limit]]
+
+
+def _number(value):
+    return float(value) if value is not None else None
+
+
+def serialize_entry(entry, score=None):
+    return {
+        **entry.data,
+        'type': entry.kind,
+        'id': entry.object_id,
+        'name': entry.name,
+        'detail': entry.detail,
+        'category_id': entry.category_id,
+        'price': _number(entry.price),
+        'cost_price': _number(entry.cost_price),
+        'stock': entry.stock,
+        'is_active': entry.is_active,
+        'score': score,
+    }
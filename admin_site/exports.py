@@ -0,0 +1,185 @@
+"""
+Streaming spreadsheet exports shared by the report views.
+
+Views describe their output as one or more ExportSheet objects whose rows are
+plain iterables (usually generators over queryset.iterator()). The rows are
+written straight through openpyxl's write-only mode into a temporary file, or
+through csv.writer, so memory use stays flat no matter how many rows a report
+has. Pass ?format=csv to any export built with export_response to get CSV.
+"""
+import csv
+import tempfile
+
+from django.http import FileResponse, StreamingHttpResponse
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Font, PatternFill, Alignment, Border, Side
+from openpyxl.utils import get_column_letter
+
+XLSX_CONTENT_TYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+EXPORT_CHUNK_SIZE = 2000
+
+HEADER_FONT = Font(bold=True, size=11, color="FFFFFF")
+HEADER_FILL = PatternFill(start_color="4472C4", end_color="4472C4", fill_type="solid")
+THIN_BORDER = Border(left=Side(style='thin'), right=Side(style='thin'), top=Side(style='thin'),
+                     bottom=Side(style='thin'))
+MONEY_FORMAT = '#,##0.00'
+RIGHT = Alignment(horizontal='right')
+CENTER = Alignment(horizontal='center')
+
+
+class Styled:
+    """A cell value with formatting. merge_across spans the cell over that many columns."""
+
+    def __init__(self, value=None, font=None, fill=None, number_format=None, alignment=None, border=None,
+                 merge_across=1):
+        self.value = value
+        self.font = font
+        self.fill = fill
+        self.number_format = number_format
+        self.alignment = alignment
+        self.border = border
+        self.merge_across = merge_across
+
+
+def money(value, **style):
+    """Right aligned #,##0.00 cell"""
+    style.setdefault('number_format', MONEY_FORMAT)
+    style.setdefault('alignment', RIGHT)
+    return Styled(value, **style)
+
+
+class ExportSheet:
+    """
+    One worksheet (or CSV section).
+
+    Args:
+        title: Worksheet title
+        rows: Iterable of row lists; values may be plain or Styled. Consumed once.
+        headers: Optional header row, styled with header_font/header_fill
+        column_widths: Optional list of widths for columns A, B, ...
+        header_border: Optional border for header cells
+    """
+
+    def __init__(self, title, rows, headers=None, column_widths=None, header_font=HEADER_FONT,
+                 header_fill=HEADER_FILL, header_alignment=None, header_border=None):
+        self.title = title
+        self.rows = rows
+        self.headers = headers
+        self.column_widths = column_widths or []
+        self.header_font = header_font
+        self.header_fill = header_fill
+        self.header_alignment = header_alignment
+        self.header_border = header_border
+
+    def header_row(self):
+        return [
+            Styled(header, font=self.header_font, fill=self.header_fill, alignment=self.header_alignment,
+                   border=self.header_border)
+            for header in self.headers
+        ]
+
+
+def iterate(queryset, chunk_size=EXPORT_CHUNK_SIZE):
+    """Server-side iteration over a queryset without caching results"""
+    return queryset.iterator(chunk_size=chunk_size)
+
+
+def _plain(value):
+    return value.value if isinstance(value, Styled) else value
+
+
+def _write_sheet(workbook, sheet):
+    ws = workbook.create_sheet(sheet.title[:31])
+
+    # Column widths must be set before the first row is written
+    for index, width in enumerate(sheet.column_widths, start=1):
+        if width:
+            ws.column_dimensions[get_column_letter(index)].width = width
+
+    row_index = 0
+    rows = sheet.rows
+    if sheet.headers:
+        rows = _chain_header(sheet.header_row(), rows)
+
+    for values in rows:
+        row_index += 1
+        cells = []
+        for column_index, value in enumerate(values or [], start=1):
+            if not isinstance(value, Styled):
+                cells.append(value)
+                continue
+            cell = WriteOnlyCell(ws, value=value.value)
+            if value.font:
+                cell.font = value.font
+            if value.fill:
+                cell.fill = value.fill
+            if value.number_format:
+                cell.number_format = value.number_format
+            if value.alignment:
+                cell.alignment = value.alignment
+            if value.border:
+                cell.border = value.border
+            cells.append(cell)
+            if value.merge_across > 1:
+                ws.merged_cells.add(
+                    f'{get_column_letter(column_index)}{row_index}:'
+                    f'{get_column_letter(column_index + value.merge_across - 1)}{row_index}'
+                )
+        ws.append(cells)
+
+
+def _chain_header(header, rows):
+    yield header
+    yield from rows
+
+
+def xlsx_response(filename, sheets):
+    """
+    Write sheets through a write-only workbook and stream the file back.
+
+    Rows are flushed to disk as they are appended, so only one row is held in memory at a time.
+    """
+    workbook = Workbook(write_only=True)
+    for sheet in sheets:
+        _write_sheet(workbook, sheet)
+
+    output = tempfile.TemporaryFile()
+    workbook.save(output)
+    output.seek(0)
+
+    return FileResponse(output, as_attachment=True, filename=f'{filename}.xlsx', content_type=XLSX_CONTENT_TYPE)
+
+
+class _Echo:
+    """File-like object that hands back what csv.writer writes to it"""
+
+    def write(self, value):
+        return value
+
+
+def _csv_rows(sheets):
+    writer = csv.writer(_Echo())
+    for index, sheet in enumerate(sheets):
+        if len(sheets) > 1:
+            if index:
+                yield writer.writerow([])
+            yield writer.writerow([sheet.title])
+        if sheet.headers:
+            yield writer.writerow(sheet.headers)
+        for values in sheet.rows:
+            yield writer.writerow([_plain(value) for value in values or []])
+
+
+def csv_response(filename, sheets):
+    """Stream sheets as CSV; multiple sheets are written one after another under their titles"""
+    response = StreamingHttpResponse(_csv_rows(list(sheets)), content_type='text/csv')
+    response['Content-Disposition'] = f'attachment; filename="{filename}.csv"'
+    return response
+
+
+def export_response(request, filename, sheets):
+    """Return an XLSX export, or CSV when the request asks for ?format=csv"""
+    if request.GET.get('format') == 'csv':
+        return csv_response(filename, sheets)
+    return xlsx_response(filename, sheets)
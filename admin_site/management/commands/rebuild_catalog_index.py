@@ -0,0 +1,26 @@
+# admin_site/management/commands/rebuild_catalog_index.py
+
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from admin_site.catalog import rebuild, SOURCES_BY_KIND
+
+
+class Command(BaseCommand):
+    help = 'Rewrite the catalog search index from drugs, lab/scan templates, services and service items'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--kind', action='append', dest='kinds', choices=list(SOURCES_BY_KIND),
+                            help='Only rebuild this kind of item (repeat for more)')
+        parser.add_argument('--batch-size', type=int, default=1000, help='Items read per query')
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size must be positive')
+
+        started = time.perf_counter()
+        count = rebuild(kinds=options['kinds'], batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(
+            f'Indexed {count} catalog items in {time.perf_counter() - started:.1f} s'
+        ))
@@ -0,0 +1,62 @@
+# admin_site/management/commands/run_report_worker.py
+
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from admin_site.report_jobs import claim_next_job, run_job, requeue_stale_jobs, purge_jobs
+
+
+class Command(BaseCommand):
+    help = 'Run queued report jobs (PDF exports) and background tasks (drug imports)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Process the jobs currently queued and exit')
+        parser.add_argument('--sleep', type=float, default=2, help='Seconds to wait when the queue is empty')
+        parser.add_argument(
+            '--stale-minutes', type=int, default=30,
+            help='Re-queue jobs that have been running longer than this (worker died mid-job)'
+        )
+        parser.add_argument(
+            '--purge-days', type=int, default=7,
+            help='Delete finished jobs and their files older than this many days (0 to keep everything)'
+        )
+
+    def handle(self, *args, **options):
+        if options['sleep'] <= 0 or options['stale_minutes'] < 1 or options['purge_days'] < 0:
+            raise CommandError('--sleep and --stale-minutes must be positive, --purge-days cannot be negative')
+
+        stale_after = timedelta(minutes=options['stale_minutes'])
+        self.housekeeping(stale_after, options['purge_days'])
+        self.stdout.write('Report worker started')
+
+        try:
+            while True:
+                job = claim_next_job()
+                if job is None:
+                    if options['once']:
+                        break
+                    # Don't hold a connection open while idle
+                    connection.close()
+                    time.sleep(options['sleep'])
+                    self.housekeeping(stale_after, options['purge_days'])
+                    continue
+
+                started = time.perf_counter()
+                job = run_job(job)
+                elapsed = time.perf_counter() - started
+                if job.status == 'completed':
+                    self.stdout.write(self.style.SUCCESS(f'{job} finished in {elapsed:.1f}s'))
+                else:
+                    self.stdout.write(self.style.ERROR(f'{job} failed: {job.error}'))
+        except KeyboardInterrupt:
+            self.stdout.write('Report worker stopped')
+
+    def housekeeping(self, stale_after, purge_days):
+        requeued = requeue_stale_jobs(stale_after)
+        if requeued:
+            self.stdout.write(self.style.WARNING(f'Re-queued {requeued} stale jobs'))
+        if purge_days:
+            purge_jobs(timedelta(days=purge_days))
@@ -0,0 +1,272 @@
+# Generated by Django 5.0 on 2026-10-16 18:00
+
+import re
+import unicodedata
+from collections import namedtuple
+
+import django.db.models.deletion
+from django.db.models import OuterRef, Subquery
+from django.db import migrations, models
+
+
+# The catalog sources and tokenizer as of this migration (see admin_site.catalog
+# and patient.search), copied so the migration keeps working when the live
+# modules change
+
+NAME = 'n:'
+CODE = 'c:'
+GROUP = 'g:'
+DESCRIPTION = 'd:'
+TRIGRAM = 't:'
+
+TOKEN_MAX_LENGTH = 120
+
+
+def normalize_text(value):
+    """Lowercase and strip accents"""
+    decomposed = unicodedata.normalize('NFKD', value or '')
+    return ''.join(char for char in decomposed if not unicodedata.combining(char)).lower()
+
+
+def name_words(value):
+    """
+    Searchable words of a name: each alphanumeric run, plus the joined form of
+    hyphenated or apostrophed words ("Ade-Bayo" -> ade, bayo, adebayo).
+    """
+    words = []
+    for chunk in normalize_text(value).split():
+        parts = re.findall(r'[a-z0-9]+', chunk)
+        words.extend(parts)
+        if len(parts) > 1:
+            words.append(''.join(parts))
+    return words
+
+
+def trigrams(word):
+    if len(word) < 3:
+        return set()
+    padded = f'${word}$'
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+# model: (app label, model name)
+# fields: values read to build the entry
+# annotate: callable(apps) returning extra annotations for the values, or None
+# describe: callable(row) returning (entry fields, searchable text by token kind)
+Source = namedtuple('Source', 'kind model fields annotate describe')
+
+
+def _drug_cost_price(apps):
+    stock = apps.get_model('pharmacy', 'DrugStockModel')
+    latest = stock.objects.filter(drug=OuterRef('pk')).order_by('-id').values('unit_cost_price')[:1]
+    return {'last_cost_price': Subquery(latest)}
+
+
+def _drug(row):
+    generic = row['formulation__generic_drug__generic_name'] or ''
+    formulation = f"{generic} {row['formulation__strength']} {row['formulation__form_type']}"
+    name = f"{row['brand_name']} ({formulation})" if row['brand_name'] else formulation
+    if row['manufacturer__name']:
+        name += f" - {row['manufacturer__name']}"
+    entry = {
+        'name': name,
+        'detail': generic,
+        'category_id': None,
+        'price': row['selling_price'],
+        'cost_price': row['last_cost_price'] or 0,
+        'stock': row['pharmacy_quantity'],
+        'is_active': row['is_active'],
+        'data': {
+            'brand_name': row['brand_name'],
+            'generic_name': generic,
+            'formulation': formulation,
+            'manufacturer': row['manufacturer__name'] or '',
+            'pack_size': row['pack_size'],
+            'unit': row['formulation__form_type'],
+            'store_quantity': row['store_quantity'],
+            'is_prescription_only': row['formulation__generic_drug__is_prescription_only'],
+        },
+    }
+    searchable = {
+        NAME: f"{row['brand_name']} {generic} {row['formulation__strength']}",
+        CODE: row['sku'],
+    }
+    return entry, searchable
+
+
+def _template(row):
+    entry = {
+        'name': row['name'],
+        'detail': row['category__name'] or '',
+        'category_id': row['category_id'],
+        'price': row['price'],
+        'cost_price': None,
+        'stock': None,
+        'is_active': row['is_active'],
+        'data': {'code': row['code']},
+    }
+    return entry, {NAME: row['name'], CODE: row['code']}
+
+
+def _service(row):
+    entry = {
+        'name': row['name'],
+        'detail': row['category__name'] or '',
+        'category_id': row['category_id'],
+        'price': row['price'],
+        'cost_price': None,
+        'stock': None,
+        'is_active': row['is_active'],
+        'data': {'has_results': row['has_results']},
+    }
+    searchable = {NAME: row['name'], GROUP: row['category__name'], DESCRIPTION: row['description']}
+    return entry, searchable
+
+
+def _service_item(row):
+    entry = {
+        'name': row['name'],
+        'detail': row['category__name'] or '',
+        'category_id': row['category_id'],
+        'price': row['price'],
+        'cost_price': row['cost_price'],
+        'stock': row['stock_quantity'],
+        'is_active': row['is_active'],
+        'data': {'unit_of_measure': row['unit_of_measure'], 'expiry_date': row['expiry_date']},
+    }
+    searchable = {NAME: row['name'], GROUP: row['category__name'], DESCRIPTION: row['description']}
+    return entry, searchable
+
+
+TEMPLATE_FIELDS = ('name', 'code', 'category_id', 'category__name', 'price', 'is_active')
+
+SOURCES = [
+    Source('drug', ('pharmacy', 'DrugModel'),
+           ('brand_name', 'sku', 'formulation__generic_drug__generic_name',
+            'formulation__generic_drug__is_prescription_only', 'formulation__strength', 'formulation__form_type',
+            'manufacturer__name', 'selling_price', 'pharmacy_quantity', 'store_quantity', 'pack_size',
+            'is_active', 'last_cost_price'),
+           _drug_cost_price, _drug),
+    Source('lab_test', ('laboratory', 'LabTestTemplateModel'), TEMPLATE_FIELDS, None, _template),
+    Source('scan', ('scan', 'ScanTemplateModel'), TEMPLATE_FIELDS, None, _template),
+    Source('service', ('service', 'Service'),
+           ('name', 'description', 'category_id', 'category__name', 'price', 'has_results', 'is_active'),
+           None, _service),
+    Source('service_item', ('service', 'ServiceItem'),
+           ('name', 'description', 'category_id', 'category__name', 'price', 'cost_price', 'stock_quantity',
+            'unit_of_measure', 'expiry_date', 'is_active'),
+           None, _service_item),
+]
+
+def _truncate(value, length):
+    value = ' '.join(str(value or '').split())
+    return value if len(value) <= length else value[:length - 3] + '...'
+
+
+def _compact(value):
+    return re.sub(r'[^a-z0-9]', '', normalize_text(value))
+
+
+def entry_tokens(searchable):
+    """The set of search tokens for an entry's searchable text"""
+    tokens = set()
+    for kind, text in searchable.items():
+        if kind == CODE:
+            code = _compact(text)
+            if code:
+                tokens.add(CODE + code)
+            continue
+        for word in name_words(text):
+            tokens.add(kind + word)
+            if kind == NAME:
+                tokens.update(TRIGRAM + gram for gram in trigrams(word))
+    return {token[:TOKEN_MAX_LENGTH] for token in tokens}
+
+
+def build_entries(source, queryset, apps):
+    """{object id: (CatalogEntry field values, tokens)} for the items of queryset"""
+    if source.annotate:
+        queryset = queryset.annotate(**source.annotate(apps))
+    entries = {}
+    for row in queryset.order_by().values('pk', *source.fields):
+        fields, searchable = source.describe(row)
+        fields['name'] = _truncate(fields['name'], 255)
+        fields['detail'] = _truncate(fields['detail'], 255)
+        fields['data'] = {key: value.isoformat() if hasattr(value, 'isoformat') else value
+                          for key, value in fields['data'].items()}
+        entries[row['pk']] = (fields, entry_tokens(searchable))
+    return entries
+
+
+def build_catalog(apps, schema_editor):
+    """Index every existing drug, lab test, scan, service and service item"""
+    CatalogEntry = apps.get_model('admin_site', 'CatalogEntry')
+    CatalogSearchToken = apps.get_model('admin_site', 'CatalogSearchToken')
+    for source in SOURCES:
+        model = apps.get_model(*source.model)
+        last_pk = None
+        while True:
+            batch = model.objects.order_by('pk')
+            if last_pk is not None:
+                batch = batch.filter(pk__gt=last_pk)
+            pks = list(batch.values_list('pk', flat=True)[:1000])
+            if not pks:
+                break
+            built = build_entries(source, model.objects.filter(pk__in=pks), apps)
+            CatalogEntry.objects.bulk_create([
+                CatalogEntry(kind=source.kind, object_id=object_id, **fields)
+                for object_id, (fields, _) in built.items()
+            ])
+            entry_ids = dict(CatalogEntry.objects.filter(
+                kind=source.kind, object_id__in=list(built)
+            ).values_list('object_id', 'id'))
+            CatalogSearchToken.objects.bulk_create(
+                [CatalogSearchToken(entry_id=entry_ids[object_id], token=token)
+                 for object_id, (_, tokens) in built.items() for token in tokens],
+                batch_size=5000,
+            )
+            last_pk = pks[-1]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('admin_site', '0003_reportjob'),
+        ('laboratory', '0006_labtestordermodel_customer_name_and_more'),
+        ('pharmacy', '0004_drugordermodel_customer_name_drugordermodel_source_and_more'),
+        ('scan', '0006_alter_scanordermodel_source'),
+        ('service', '0005_alter_patientservicetransaction_admission_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CatalogEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('drug', 'DRUG'), ('lab_test', 'LAB TEST'), ('scan', 'SCAN'), ('service', 'SERVICE'), ('service_item', 'SERVICE ITEM')], max_length=20)),
+                ('object_id', models.PositiveBigIntegerField()),
+                ('name', models.CharField(max_length=255)),
+                ('detail', models.CharField(blank=True, default='', help_text='Generic name or category', max_length=255)),
+                ('category_id', models.PositiveBigIntegerField(blank=True, null=True)),
+                ('price', models.DecimalField(decimal_places=2, default=0, max_digits=12)),
+                ('cost_price', models.DecimalField(blank=True, decimal_places=2, max_digits=12, null=True)),
+                ('stock', models.FloatField(blank=True, help_text='Empty for items that are not stocked', null=True)),
+                ('is_active', models.BooleanField(default=True)),
+                ('data', models.JSONField(blank=True, default=dict, help_text='Fields only some kinds have')),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['kind', 'category_id', 'name'], name='admin_site__kind_47bfb3_idx')],
+                'constraints': [models.UniqueConstraint(fields=('kind', 'object_id'), name='unique_catalog_entry')],
+            },
+        ),
+        migrations.CreateModel(
+            name='CatalogSearchToken',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('token', models.CharField(db_index=True, max_length=120)),
+                ('entry', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='tokens', to='admin_site.catalogentry')),
+            ],
+        ),
+        migrations.RunPython(build_catalog, migrations.RunPython.noop),
+    ]
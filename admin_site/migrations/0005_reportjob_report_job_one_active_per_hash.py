@@ -0,0 +1,33 @@
+# Generated by Django 5.0 on 2026-10-16 20:10
+
+from django.db import migrations, models
+
+
+def fail_duplicate_active_jobs(apps, schema_editor):
+    """Keep the oldest queued or running job of each request; fail the duplicates so the constraint can be added"""
+    ReportJob = apps.get_model('admin_site', 'ReportJob')
+    seen = {}
+    duplicates = []
+    for pk, params_hash in ReportJob.objects.filter(
+        status__in=['pending', 'running']
+    ).order_by('created_at', 'pk').values_list('pk', 'params_hash'):
+        if params_hash in seen:
+            duplicates.append(pk)
+        else:
+            seen[params_hash] = pk
+    ReportJob.objects.filter(pk__in=duplicates).update(status='failed', error='Duplicate of an identical queued job')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('admin_site', '0004_catalogentry_catalogsearchtoken'),
+    ]
+
+    operations = [
+        migrations.RunPython(fail_duplicate_active_jobs, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='reportjob',
+            constraint=models.UniqueConstraint(condition=models.Q(('status__in', ['pending', 'running'])), fields=('params_hash',), name='report_job_one_active_per_hash'),
+        ),
+    ]
@@ -37,3 +37,115 @@ class ActivityLogModel(models.Model):
     keywords = models.CharField(max_length=200, blank=True, null=True)
     created_at = models.DateTimeField(auto_now_add=True, blank=True)
     user = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True)
+
+
+class SequenceCounterModel(models.Model):
+    """Last number handed out for a document number sequence (e.g. trn-20250101, Q20250101, batch-)"""
+    prefix = models.CharField(max_length=50)
+    period = models.CharField(max_length=20, blank=True, default='', help_text="e.g. YYYYMMDD for daily sequences")
+    last_value = models.PositiveBigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ('prefix', 'period')
+
+    def __str__(self):
+        return f"{self.prefix}{self.period}: {self.last_value}"
+
+
+class ReportJob(models.Model):
+    """A report export or background task run by the report worker instead of inside the request"""
+    STATUS_CHOICES = [
+        ('pending', 'Pending'),
+        ('running', 'Running'),
+        ('completed', 'Completed'),
+        ('failed', 'Failed'),
+    ]
+
+    report = models.CharField(max_length=100)
+    params = models.JSONField(default=dict, blank=True)
+    params_hash = models.CharField(max_length=64, help_text="Identifies identical report requests for reuse")
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending')
+
+    file = models.FileField(upload_to='reports/%Y/%m/', null=True, blank=True)
+    filename = models.CharField(max_length=255, blank=True, default='')
+    content_type = models.CharField(max_length=100, blank=True, default='')
+    error = models.TextField(blank=True, default='')
+    attempts = models.PositiveIntegerField(default=0)
+
+    requested_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True,
+                                     related_name='report_jobs')
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    completed_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['params_hash', 'status']),
+            models.Index(fields=['status', 'created_at']),
+        ]
+        constraints = [
+            # At most one queued or running job per identical request (see admin_site.report_jobs.queue_report)
+            models.UniqueConstraint(
+                fields=['params_hash'], condition=models.Q(status__in=['pending', 'running']),
+                name='report_job_one_active_per_hash',
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.report} #{self.pk} ({self.status})"
+
+    @property
+    def is_finished(self):
+        return self.status in ('completed', 'failed')
+
+
+class CatalogEntry(models.Model):
+    """
+    One orderable catalog item (drug, lab test, scan, service or service item), written by
+    admin_site.catalog whenever the item is saved so ordering screens search a single table.
+    price, cost_price and stock are a snapshot of the item taken at its last save.
+    """
+    KIND = (
+        ('drug', 'DRUG'),
+        ('lab_test', 'LAB TEST'),
+        ('scan', 'SCAN'),
+        ('service', 'SERVICE'),
+        ('service_item', 'SERVICE ITEM'),
+    )
+
+    kind = models.CharField(max_length=20, choices=KIND)
+    object_id = models.PositiveBigIntegerField()
+    name = models.CharField(max_length=255)
+    detail = models.CharField(max_length=255, blank=True, default='', help_text="Generic name or category")
+    category_id = models.PositiveBigIntegerField(null=True, blank=True)
+    price = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    cost_price = models.DecimalField(max_digits=12, decimal_places=2, null=True, blank=True)
+    stock = models.FloatField(null=True, blank=True, help_text="Empty for items that are not stocked")
+    is_active = models.BooleanField(default=True)
+    data = models.JSONField(default=dict, blank=True, help_text="Fields only some kinds have")
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['kind', 'object_id'], name='unique_catalog_entry'),
+        ]
+        indexes = [
+            models.Index(fields=['kind', 'category_id', 'name']),
+        ]
+
+    def __str__(self):
+        return f"{self.get_kind_display()}: {self.name}"
+
+
+class CatalogSearchToken(models.Model):
+    """
+    Normalized search keys of a catalog entry, rebuilt by admin_site.catalog with the entry.
+    token is "<kind>:<value>" (see admin_site.catalog for the kinds) so one index serves every lookup.
+    """
+    entry = models.ForeignKey(CatalogEntry, on_delete=models.CASCADE, related_name='tokens')
+    token = models.CharField(max_length=120, db_index=True)
+
+    def __str__(self):
+        return f"{self.entry_id}: {self.token}"
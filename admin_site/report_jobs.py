@@ -0,0 +1,287 @@
+"""
+Background report jobs.
+
+Heavy PDF exports are queued as ReportJob rows and rendered by the report worker
+(manage.py run_report_worker) instead of inside the web request. The worker
+calls the existing export view with a request rebuilt from the stored
+parameters, so each report keeps a single implementation and its permission
+checks.
+
+Other slow work is queued the same way as a task (TASKS): the worker calls
+the task's function with the stored parameters instead of rendering a view,
+and the task records its own outcome (the drug import updates its
+DrugImportLogModel, which the import page polls). Tasks are queued by the
+views that own them with queue_task(), never through the report URLs.
+
+Identical requests (same report, parameters and day) share one job: while it is
+pending or running the caller polls the same job, and once finished the file is
+reused for REPORT_JOB_REUSE_MINUTES (default 60). A partial unique constraint
+allows one pending or running job per request, so two identical requests
+arriving together still queue a single job.
+"""
+import hashlib
+import json
+import re
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import IntegrityError, transaction
+from django.http import HttpRequest, QueryDict
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from admin_site.models import ReportJob
+
+
+class ReportSpec:
+    """
+    A report that can be rendered by the worker.
+
+    Args:
+        view: Dotted path to the export view (function or class based)
+        method: HTTP method the view reads its parameters from
+        url_kwargs: Parameter names passed to the view as URL kwargs
+        per_user: Output depends on the requesting user, so jobs are never shared
+    """
+
+    def __init__(self, view, method='GET', url_kwargs=(), per_user=False):
+        self.view = view
+        self.method = method
+        self.url_kwargs = url_kwargs
+        self.per_user = per_user
+
+    def get_view(self):
+        view = import_string(self.view)
+        if hasattr(view, 'as_view'):
+            return view.as_view()
+        return view
+
+    def get_permissions(self):
+        view = import_string(self.view)
+        permissions = getattr(view, 'permission_required', None) or ()
+        if isinstance(permissions, str):
+            permissions = (permissions,)
+        return permissions
+
+
+class TaskSpec:
+    """
+    Background work run by the worker that produces no file.
+
+    Args:
+        task: Dotted path to a function called with the job's parameters as keyword arguments
+        per_user: Jobs of different users are never shared
+    """
+
+    def __init__(self, task, per_user=False):
+        self.task = task
+        self.per_user = per_user
+
+    def get_task(self):
+        return import_string(self.task)
+
+
+REPORTS = {
+    'staff_transaction_history': ReportSpec('finance.views.StaffTransactionHistoryPDFView', per_user=True),
+    'all_staff_collections': ReportSpec('finance.views.AllStaffCollectionsPDFView'),
+    'consultation_report': ReportSpec('admin_site.views.ConsultationReportExportPDFView'),
+    'lab_report': ReportSpec('laboratory.views.LabReportExportPDFView'),
+    'insurance_claim': ReportSpec('insurance.views.download_claim_pdf', method='POST', url_kwargs=('pk',),
+                                  per_user=True),
+}
+
+TASKS = {
+    'drug_import': TaskSpec('pharmacy.drug_import.run_import_job'),
+}
+
+# Form fields that are not report parameters
+IGNORED_PARAMS = ('csrfmiddlewaretoken',)
+
+
+def get_reuse_window():
+    return timedelta(minutes=getattr(settings, 'REPORT_JOB_REUSE_MINUTES', 60))
+
+
+def clean_params(querydict):
+    """Turn request GET/POST data into a sorted plain dict (lists only for repeated keys)"""
+    params = {}
+    for key in sorted(querydict.keys()):
+        if key in IGNORED_PARAMS:
+            continue
+        values = querydict.getlist(key)
+        params[key] = values if len(values) > 1 else values[0]
+    return params
+
+
+def get_spec(report):
+    """The ReportSpec or TaskSpec named report, or None"""
+    return REPORTS.get(report) or TASKS.get(report)
+
+
+def get_params_hash(report, params, user=None):
+    spec = get_spec(report)
+    key = {
+        'report': report,
+        'params': params,
+        # Reports default to "today" when dates are left out
+        'day': timezone.localdate().isoformat(),
+        'user': user.pk if spec.per_user and user else None,
+    }
+    return hashlib.sha256(json.dumps(key, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def user_can_run(report, user):
+    return user.is_authenticated and user.has_perms(REPORTS[report].get_permissions())
+
+
+def queue_report(report, params, user):
+    """
+    Return (job, created) for the report, reusing a queued, running or recently
+    finished job with the same parameters.
+    """
+    params_hash = get_params_hash(report, params, user)
+
+    existing = _reusable_job(params_hash)
+    if existing:
+        return existing, False
+
+    try:
+        with transaction.atomic():
+            job = ReportJob.objects.create(report=report, params=params, params_hash=params_hash, requested_by=user)
+    except IntegrityError:
+        # An identical request queued its job between the lookup and the insert
+        # (the constraint allows one pending or running job per hash): share it
+        existing = _reusable_job(params_hash)
+        if existing is None:
+            raise
+        return existing, False
+    return job, True
+
+
+def queue_task(task, params, user=None):
+    """Return (job, created) for a task in TASKS; params must be JSON serializable"""
+    if task not in TASKS:
+        raise ValueError(f'Unknown task "{task}"')
+    return queue_report(task, params, user)
+
+
+def _reusable_job(params_hash):
+    return ReportJob.objects.filter(
+        params_hash=params_hash,
+        status__in=['pending', 'running', 'completed'],
+        created_at__gte=timezone.now() - get_reuse_window()
+    ).order_by('-created_at').first()
+
+
+def claim_next_job():
+    """
+    Mark the oldest pending job as running and return it (None when the queue is empty).
+
+    The claim is a conditional UPDATE, so parallel workers never pick up the same job.
+    """
+    while True:
+        job = ReportJob.objects.filter(status='pending').order_by('created_at').first()
+        if job is None:
+            return None
+        claimed = ReportJob.objects.filter(pk=job.pk, status='pending').update(
+            status='running', started_at=timezone.now(), attempts=job.attempts + 1
+        )
+        if claimed:
+            job.refresh_from_db()
+            return job
+
+
+def requeue_stale_jobs(older_than):
+    """Put jobs left running by a worker that died back in the queue"""
+    return ReportJob.objects.filter(
+        status='running', started_at__lt=timezone.now() - older_than
+    ).update(status='pending')
+
+
+def build_request(job, spec):
+    request = HttpRequest()
+    request.method = spec.method
+    request.path = f'/reports/jobs/{job.pk}/'
+    request.META['SERVER_NAME'] = getattr(settings, 'REPORT_JOB_SERVER_NAME', 'localhost')
+    request.META['SERVER_PORT'] = '80'
+
+    data = QueryDict(mutable=True)
+    for key, value in job.params.items():
+        if key in spec.url_kwargs:
+            continue
+        if isinstance(value, list):
+            data.setlist(key, value)
+        else:
+            data[key] = value
+    if spec.method == 'POST':
+        request.POST = data
+        request._dont_enforce_csrf_checks = True
+    else:
+        request.GET = data
+
+    request.user = job.requested_by
+    request.report_job = job
+    return request
+
+
+def _response_filename(response, job):
+    disposition = response.get('Content-Disposition', '')
+    match = re.search(r'filename="?([^";]+)"?', disposition)
+    if match:
+        return match.group(1)
+    return f'{job.report}_{job.pk}.pdf'
+
+
+def run_job(job):
+    """Render a claimed job through its export view and store the file on the job, or run its task"""
+    spec = get_spec(job.report)
+    try:
+        if spec is None:
+            raise ValueError(f'Unknown report "{job.report}"')
+        if isinstance(spec, TaskSpec):
+            spec.get_task()(**job.params)
+        else:
+            _render_report(job, spec)
+        job.status = 'completed'
+        job.error = ''
+    except Exception as e:
+        job.status = 'failed'
+        job.error = str(e) or e.__class__.__name__
+
+    job.completed_at = timezone.now()
+    job.save()
+    return job
+
+
+def _render_report(job, spec):
+    if job.requested_by is None:
+        raise ValueError('The user who requested this report no longer exists')
+
+    kwargs = {name: job.params[name] for name in spec.url_kwargs}
+    response = spec.get_view()(build_request(job, spec), **kwargs)
+    if response.status_code != 200:
+        raise ValueError(f'Report view returned status {response.status_code}')
+
+    if getattr(response, 'streaming', False):
+        content = b''.join(response.streaming_content)
+    else:
+        content = response.content
+
+    job.filename = _response_filename(response, job)
+    job.content_type = response.get('Content-Type', 'application/pdf')
+    job.file.save(job.filename, ContentFile(content), save=False)
+
+
+def purge_jobs(older_than):
+    """Delete finished jobs (and their files) created before now - older_than"""
+    jobs = ReportJob.objects.filter(
+        status__in=['completed', 'failed'], created_at__lt=timezone.now() - older_than
+    )
+    count = 0
+    for job in jobs.iterator():
+        if job.file:
+            job.file.delete(save=False)
+        job.delete()
+        count += 1
+    return count
@@ -0,0 +1,174 @@
+"""
+Shared sequence allocator for document numbers.
+
+Every sequence is a (prefix, period) counter row in SequenceCounterModel that is
+advanced with a single atomic UPDATE, so parallel writers never see the same
+number and nobody has to scan the target table for "last row + 1".
+
+The UPDATE locks the counter row until its transaction ends. Saves run
+inside atomic views, so a reservation made in the caller's transaction would
+hold that lock until the whole view commits and every other save of the same
+sequence would queue behind it. When the caller is inside a transaction the
+reservation therefore runs on a connection of its own in autocommit mode (one
+reserving thread per process) and the lock is held for that single statement.
+A reserved number the caller then rolls back is a gap, never a duplicate.
+SQLite locks the whole database for a write, so a second connection would
+wait on the caller forever; there the reservation stays in the caller's
+transaction.
+
+Workers can optionally reserve a small block of numbers at a time (settings
+SEQUENCE_BLOCK_SIZE, default 1) and hand them out from memory. Blocks are only
+cached once the caller's transaction has committed, so a rollback can never
+cause a number to be reused; at worst it leaves a gap.
+
+The same hi/lo scheme serves counters kept on other single-row models (patient
+and staff card numbers) through reserve_row_block() and next_block_value().
+"""
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import IntegrityError, connections, router, transaction
+from django.db.models import F
+
+from admin_site.models import SequenceCounterModel
+
+_block_cache = {}
+_block_cache_lock = threading.Lock()
+
+_reserver = None
+_reserver_lock = threading.Lock()
+
+
+def get_block_size(setting='SEQUENCE_BLOCK_SIZE', default=1):
+    return max(int(getattr(settings, setting, default) or default), 1)
+
+
+def max_sequence_suffix(queryset, field, prefix, digits=None):
+    """
+    Highest numeric suffix after prefix among existing values of field.
+
+    Used once per (prefix, period) to seed a new counter from numbers that were
+    issued before the counter existed. Suffixes longer than digits are ignored
+    (e.g. old timestamp fallback IDs).
+    """
+    highest = 0
+    values = queryset.filter(**{f'{field}__startswith': prefix}).values_list(field, flat=True).iterator()
+    for value in values:
+        suffix = value[len(prefix):]
+        if not suffix.isdigit() or (digits and len(suffix) > digits):
+            continue
+        highest = max(highest, int(suffix))
+    return highest
+
+
+def _reserve_in_autocommit(reserve):
+    # The reserving thread keeps its connection between calls; drop it when broken or past CONN_MAX_AGE
+    for connection in connections.all(initialized_only=True):
+        connection.close_if_unusable_or_obsolete()
+    return reserve()
+
+
+def run_outside_transaction(reserve, using=None):
+    """
+    Call reserve() on the reserving thread's own autocommit connection when
+    the caller is inside a transaction (except on SQLite), else directly.
+    """
+    connection = transaction.get_connection(using)
+    if not connection.in_atomic_block or connection.vendor == 'sqlite':
+        return reserve()
+
+    global _reserver
+    if _reserver is None:
+        with _reserver_lock:
+            if _reserver is None:
+                _reserver = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sequence-reserver')
+    return _reserver.submit(_reserve_in_autocommit, reserve).result()
+
+
+def reserve_row_block(counter, field, size, create):
+    """
+    Atomically add size to field of the single counter row selected by the
+    counter queryset and return the reserved (first, last).
+
+    create is called to make the row when it does not exist yet. The row is
+    locked only for the reservation's own transaction, not the caller's (see
+    run_outside_transaction()).
+    """
+    using = router.db_for_write(counter.model)
+    return run_outside_transaction(lambda: _reserve_row_block(counter, field, size, create, using), using)
+
+
+def _reserve_row_block(counter, field, size, create, using):
+    with transaction.atomic(using=using):
+        if not counter.update(**{field: F(field) + size}):
+            try:
+                with transaction.atomic(using=using):
+                    create()
+            except IntegrityError:
+                # Another writer created it first
+                pass
+            counter.update(**{field: F(field) + size})
+        last = counter.values_list(field, flat=True).get()
+    return last - size + 1, last
+
+
+def reserve_sequence_block(prefix, period='', size=1, seed=None):
+    """
+    Atomically reserve size numbers and return (first, last).
+
+    seed is an optional callable returning the highest number already in use;
+    it is only called when the counter row does not exist yet.
+    """
+    def create():
+        SequenceCounterModel.objects.create(prefix=prefix, period=period, last_value=seed() if seed else 0)
+
+    counter = SequenceCounterModel.objects.filter(prefix=prefix, period=period)
+    return reserve_row_block(counter, 'last_value', size, create)
+
+
+def _cache_block(key, first, last):
+    with _block_cache_lock:
+        # Drop leftovers from earlier periods of the same sequence (e.g. yesterday)
+        for cached_key in [k for k in _block_cache if k[0] == key[0] and k != key]:
+            del _block_cache[cached_key]
+        _block_cache[key] = [first, last]
+
+
+def next_sequence_value(prefix, period='', seed=None, block_size=None):
+    """
+    Return the next number in the (prefix, period) sequence.
+
+    Args:
+        prefix: Sequence name, e.g. 'trn-' or 'LAB'
+        period: Optional period key, e.g. '20250101' for sequences that restart daily
+        seed: Optional callable returning the highest number already issued
+        block_size: Numbers to reserve per database round trip (defaults to SEQUENCE_BLOCK_SIZE)
+    """
+    return next_block_value(
+        (prefix, period),
+        lambda size: reserve_sequence_block(prefix, period, size, seed),
+        block_size or get_block_size(),
+    )
+
+
+def next_block_value(key, reserve, block_size):
+    """
+    Return the next number of the sequence identified by key (a (name, period) tuple).
+
+    Numbers come from this process's cached block; when it runs out, reserve(size)
+    is called to reserve a new block of block_size numbers and must return (first, last).
+    """
+    if block_size > 1:
+        with _block_cache_lock:
+            block = _block_cache.get(key)
+            if block and block[0] <= block[1]:
+                value = block[0]
+                block[0] += 1
+                return value
+
+    first, last = reserve(block_size)
+    if last > first:
+        # Only hand out the rest of the block once the reservation is durable
+        transaction.on_commit(lambda: _cache_block(key, first + 1, last))
+    return first
@@ -0,0 +1,3 @@
+from admin_site import catalog
+
+catalog.connect()
@@ -1,3 +1,76 @@
-from django.test import TestCase
+import threading
+from unittest import skipIf
 
-# Create your tests here.
+from django.db import connection, transaction
+from django.test import TransactionTestCase
+
+from admin_site import sequences
+from admin_site.models import SequenceCounterModel
+from admin_site.sequences import next_sequence_value
+
+
+class SequenceAllocatorTests(TransactionTestCase):
+    """Numbers handed out by admin_site.sequences.next_sequence_value"""
+
+    def setUp(self):
+        # Blocks cached by earlier tests belong to counter rows that have since been flushed
+        with sequences._block_cache_lock:
+            sequences._block_cache.clear()
+
+    def allocate(self, count, prefix='TST', atomic=False, block_size=1):
+        values = []
+        for _ in range(count):
+            if atomic:
+                # Like a model save inside an atomic view: the reservation runs outside this transaction
+                with transaction.atomic():
+                    values.append(next_sequence_value(prefix, block_size=block_size))
+            else:
+                values.append(next_sequence_value(prefix, block_size=block_size))
+        return values
+
+    def test_numbers_follow_on(self):
+        self.assertEqual(self.allocate(3), [1, 2, 3])
+        self.assertEqual(self.allocate(3, atomic=True), [4, 5, 6])
+        self.assertEqual(self.allocate(7, atomic=True, block_size=3), list(range(7, 14)))
+        self.assertEqual(SequenceCounterModel.objects.get(prefix='TST').last_value, 15)
+
+    def test_new_counter_starts_after_seed(self):
+        self.assertEqual(next_sequence_value('SEED', '20261016', seed=lambda: 41), 42)
+
+    def assertUniqueUnderParallelWriters(self, atomic, block_size=1):
+        writers, per_writer = 8, 40
+        results = [[] for _ in range(writers)]
+        errors = []
+        start_gate = threading.Barrier(writers)
+
+        def writer(index):
+            try:
+                start_gate.wait()
+                results[index] = self.allocate(per_writer, atomic=atomic, block_size=block_size)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=writer, args=(i,)) for i in range(writers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        values = [value for writer_values in results for value in writer_values]
+        self.assertEqual(len(values), writers * per_writer)
+        self.assertEqual(len(set(values)), len(values))
+
+    @skipIf(connection.vendor == 'sqlite', 'SQLite allows a single writer at a time')
+    def test_unique_under_parallel_writers(self):
+        self.assertUniqueUnderParallelWriters(atomic=False)
+
+    @skipIf(connection.vendor == 'sqlite', 'SQLite allows a single writer at a time')
+    def test_unique_under_parallel_writers_inside_transactions(self):
+        self.assertUniqueUnderParallelWriters(atomic=True)
+
+    @skipIf(connection.vendor == 'sqlite', 'SQLite allows a single writer at a time')
+    def test_unique_under_parallel_writers_with_blocks(self):
+        self.assertUniqueUnderParallelWriters(atomic=True, block_size=5)
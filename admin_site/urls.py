@@ -31,6 +31,13 @@ urlpatterns = [
     path('reports/general-financial/export/excel/', GeneralFinancialReportExcelView.as_view(), name='general_financial_export_excel'),
     path('reports/general-financial/export/pdf/', GeneralFinancialReportPDFView.as_view(), name='general_financial_export_pdf'),
 
+    path('reports/jobs/<str:report>/queue/', report_job_create_view, name='report_job_create'),
+    path('reports/jobs/<int:pk>/', report_job_detail_view, name='report_job_detail'),
+    path('reports/jobs/<int:pk>/status/', report_job_status_view, name='report_job_status'),
+    path('reports/jobs/<int:pk>/download/', report_job_download_view, name='report_job_download'),
+
+    path('catalog/search/', catalog_search_view, name='catalog_search'),
+
 
 ]
 
@@ -1,6 +1,5 @@
 import datetime
 from datetime import timedelta
-import json
 from django.contrib.auth.decorators import login_required
 from django.db.models import Sum, DecimalField, F
 from django.views import View
@@ -24,20 +23,24 @@ from django.views.generic.edit import CreateView, UpdateView, DeleteView
 from django.views.generic.list import ListView
 from django.views.generic.detail import DetailView
 from django.contrib.auth.mixins import LoginRequiredMixin, PermissionRequiredMixin
-from django.utils import timezone
+from admin_site.exports import ExportSheet, Styled, money, export_response, CENTER, RIGHT, HEADER_FONT, \
+    HEADER_FILL
+from admin_site.catalog import search_catalog, serialize_entry, SOURCES_BY_KIND, DEFAULT_LIMIT, MAX_LIMIT, \
+    MIN_QUERY_LENGTH
 from admin_site.forms import SiteInfoForm
-from admin_site.models import SiteInfoModel, ActivityLogModel
+from admin_site.models import SiteInfoModel, ActivityLogModel, ReportJob
+from admin_site.report_jobs import REPORTS, clean_params, queue_report, user_can_run
 from consultation.models import SpecializationModel, ConsultationSessionModel
-from finance.models import PatientTransactionModel
+from finance.period_close import get_general_report, get_order_report, get_stale_periods
 from human_resource.models import StaffProfileModel
 from inpatient.models import Surgery
-from laboratory.models import LabSettingModel, LabTestOrderModel
-from patient.models import PatientModel, RegistrationPaymentModel
-from patient.views import calculate_growth_percentage, calculate_age_groups, get_monthly_trends, \
-    get_registration_chart_data
+from laboratory.models import LabSettingModel
+from patient.demographics import get_demographics
+from patient.views import build_dashboard_context
 
-from django.shortcuts import render, redirect
-from django.http import HttpResponse
+from django.shortcuts import render, redirect, get_object_or_404
+from django.http import HttpResponse, JsonResponse, FileResponse, Http404, HttpResponseBadRequest
+from django.core.exceptions import PermissionDenied
 from django.urls import reverse
 from django.contrib.auth.models import User
 from django.contrib.auth import authenticate, login, logout, update_session_auth_hash
@@ -45,7 +48,7 @@ from django.views.decorators.cache import never_cache
 import logging
 
 from pharmacy.models import DrugOrderModel
-from scan.models import ScanOrderModel, ScanSettingModel
+from scan.models import ScanSettingModel
 from service.models import ServiceCategory, PatientServiceTransaction
 
 logger = logging.getLogger(__name__)
@@ -65,135 +68,7 @@ def get_patient_dashboard_context(request):
     """
     Get the context data for patient dashboard
     """
-    # Get current date and time periods
-    today = timezone.now().date()
-    week_start = today - timedelta(days=today.weekday())
-    month_start = today.replace(day=1)
-    year_start = today.replace(month=1, day=1)
-
-    # Basic patient statistics
-    total_patients = PatientModel.objects.count()
-    male_patients = PatientModel.objects.filter(gender='male').count()
-    female_patients = PatientModel.objects.filter(gender='female').count()
-
-    # Registration status statistics
-    pending_registrations = RegistrationPaymentModel.objects.filter(
-        registration_status='pending', status='confirmed',
-    ).count()
-
-    # Old vs New patients (based on registration fee type)
-    old_patients_total = RegistrationPaymentModel.objects.filter(
-        registration_fee__patient_type='old', status='confirmed',
-    ).count()
-    new_patients_total = RegistrationPaymentModel.objects.filter(
-        registration_fee__patient_type='new', status='confirmed',
-    ).count()
-
-    # Time-based statistics for old patients
-    old_patients_today = RegistrationPaymentModel.objects.filter(
-        registration_fee__patient_type='old', status='confirmed',
-        date=today
-    ).count()
-
-    old_patients_week = RegistrationPaymentModel.objects.filter(
-        registration_fee__patient_type='old', status='confirmed',
-        date__gte=week_start
-    ).count()
-
-    old_patients_month = RegistrationPaymentModel.objects.filter(
-        registration_fee__patient_type='old', status='confirmed',
-        date__gte=month_start
-    ).count()
-
-    # Time-based statistics for new patients
-    new_patients_today = RegistrationPaymentModel.objects.filter(
-        registration_fee__patient_type='new', status='confirmed',
-        date=today
-    ).count()
-
-    new_patients_week = RegistrationPaymentModel.objects.filter(
-        registration_fee__patient_type='new', status='confirmed',
-        date__gte=week_start
-    ).count()
-
-    new_patients_month = RegistrationPaymentModel.objects.filter(
-        registration_fee__patient_type='new', status='confirmed',
-        date__gte=month_start
-    ).count()
-
-    # Calculate growth percentages (comparing this month to last month)
-    last_month_start = (month_start - timedelta(days=1)).replace(day=1)
-    last_month_end = month_start - timedelta(days=1)
-
-    old_patients_last_month = RegistrationPaymentModel.objects.filter(
-        registration_fee__patient_type='old', status='confirmed',
-        date__gte=last_month_start,
-        date__lte=last_month_end
-    ).count()
-
-    new_patients_last_month = RegistrationPaymentModel.objects.filter(
-        registration_fee__patient_type='new', status='confirmed',
-        date__gte=last_month_start,
-        date__lte=last_month_end
-    ).count()
-
-    # Calculate growth percentages
-    old_patients_growth = calculate_growth_percentage(old_patients_month, old_patients_last_month)
-    new_patients_growth = calculate_growth_percentage(new_patients_month, new_patients_last_month)
-
-    # Age group statistics
-    age_groups = calculate_age_groups()
-
-    # Recent registrations for chart data (last 7 days)
-    registration_chart_data = get_registration_chart_data()
-
-    # Monthly registration trends (last 12 months)
-    monthly_trends = get_monthly_trends()
-
-    # Gender distribution for pie chart
-    gender_distribution = [
-        {'name': 'Male', 'value': male_patients},
-        {'name': 'Female', 'value': female_patients}
-    ]
-
-    # Revenue statistics
-    total_revenue = RegistrationPaymentModel.objects.filter(
-        registration_status='completed', status='confirmed',
-    ).aggregate(Sum('amount'))['amount__sum'] or 0
-
-    revenue_today = RegistrationPaymentModel.objects.filter(
-        registration_status='completed', status='confirmed',
-        date=today
-    ).aggregate(Sum('amount'))['amount__sum'] or 0
-
-    revenue_month = RegistrationPaymentModel.objects.filter(
-        registration_status='completed', status='confirmed',
-        date__gte=month_start
-    ).aggregate(Sum('amount'))['amount__sum'] or 0
-
-    return {
-        'total_patients': total_patients,
-        'male_patients': male_patients,
-        'female_patients': female_patients,
-        'pending_registrations': pending_registrations,
-        'old_patients_total': old_patients_total,
-        'new_patients_total': new_patients_total,
-        'old_patients_today': old_patients_today,
-        'old_patients_week': old_patients_week,
-        'old_patients_month': old_patients_month,
-        'new_patients_today': new_patients_today,
-        'new_patients_week': new_patients_week,
-        'new_patients_month': new_patients_month,
-        'old_patients_growth': old_patients_growth,
-        'new_patients_growth': new_patients_growth,
-        'age_groups': age_groups,
-        'registration_chart_data': json.dumps(registration_chart_data),
-        'monthly_trends': json.dumps(monthly_trends),
-        'gender_distribution': json.dumps(gender_distribution),
-        'total_revenue': total_revenue,
-        'revenue_today': revenue_today,
-        'revenue_month': revenue_month,
-    }
+    return build_dashboard_context(get_demographics(confirmed_only=True))
 
 
 @login_required
@@ -476,38 +351,10 @@ class LabFinancialReportView(LoginRequiredMixin, PermissionRequiredMixin, Templa
         default_title = f'Laboratory Financial Report for {month_year}'
         report_title = self.request.GET.get('title', default_title)
 
-        # === Query ===
-        # We only care about orders that are not pending or cancelled
-        orders = LabTestOrderModel.objects.filter(
-            ordered_at__date__range=[from_date, to_date]
-        ).exclude(status__in=['pending', 'cancelled'])
-
-        # Get order by parameter
+        # === Figures ===
+        # Closed months come from their period snapshots, the rest is computed live
         order_by = self.request.GET.get('order_by', 'name')
-
-        # === Breakdown Query ===
-        test_breakdown = orders.values(
-            'template__name',
-            'template__id',
-            'template__price'  # Get the CURRENT unit price
-        ).annotate(
-            total_orders=Count('id'),
-            total_amount=Sum('amount_charged')  # SUM of what was ACTUALLY charged
-        )
-
-        # Apply ordering
-        if order_by == 'total':
-            test_breakdown = test_breakdown.order_by('-total_orders', 'template__name')
-        elif order_by == 'amount':
-            test_breakdown = test_breakdown.order_by('-total_amount', 'template__name')
-        else:  # default to name
-            test_breakdown = test_breakdown.order_by('template__name')
-
-        # === Summary Statistics ===
-        grand_total = orders.aggregate(
-            total=Sum('amount_charged'),
-            total_count=Count('id')
-        )
+        test_breakdown, grand_total = get_order_report('lab', from_date, to_date, order_by)
 
         context.update({
             'from_date': from_date,
@@ -515,6 +362,7 @@ class LabFinancialReportView(LoginRequiredMixin, PermissionRequiredMixin, Templa
             'report_title': report_title,
             'test_breakdown': test_breakdown,
             'order_by': order_by,
+            'stale_periods': get_stale_periods(from_date, to_date),
 
             # Summary stats
             'grand_total_amount': grand_total['total'] or Decimal('0.00'),
@@ -551,28 +399,7 @@ class LabFinancialReportExportExcelView(LoginRequiredMixin, PermissionRequiredMi
         lab_setting = LabSettingModel.objects.first()
         site_info = SiteInfoModel.objects.first()
 
-        # Query data
-        orders = LabTestOrderModel.objects.filter(
-            ordered_at__date__range=[from_date, to_date]
-        ).exclude(status__in=['pending', 'cancelled'])
-
-        test_breakdown = orders.values(
-            'template__name', 'template__id', 'template__price'
-        ).annotate(
-            total_orders=Count('id'),
-            total_amount=Sum('amount_charged')
-        )
-
-        # Apply ordering
-        if order_by == 'total':
-            test_breakdown = test_breakdown.order_by('-total_orders', 'template__name')
-        elif order_by == 'amount':
-            test_breakdown = test_breakdown.order_by('-total_amount', 'template__name')
-        else:
-            test_breakdown = test_breakdown.order_by('template__name')
-
-        # Totals
-        grand_total = orders.aggregate(total=Sum('amount_charged'), total_count=Count('id'))
+        test_breakdown, grand_total = get_order_report('lab', from_date, to_date, order_by)
 
         # Create workbook
         wb = Workbook()
@@ -695,27 +522,7 @@ class LabFinancialReportExportPDFView(LoginRequiredMixin, PermissionRequiredMixi
         lab_setting = LabSettingModel.objects.first()
         site_info = SiteInfoModel.objects.first()
 
-        # Query data
-        orders = LabTestOrderModel.objects.filter(
-            ordered_at__date__range=[from_date, to_date]
-        ).exclude(status__in=['pending', 'cancelled'])
-
-        test_breakdown = orders.values(
-            'template__name', 'template__id', 'template__price'
-        ).annotate(
-            total_orders=Count('id'),
-            total_amount=Sum('amount_charged')
-        )
-
-        if order_by == 'total':
-            test_breakdown = test_breakdown.order_by('-total_orders', 'template__name')
-        elif order_by == 'amount':
-            test_breakdown = test_breakdown.order_by('-total_amount', 'template__name')
-        else:
-            test_breakdown = test_breakdown.order_by('template__name')
-
-        # Totals
-        grand_total = orders.aggregate(total=Sum('amount_charged'), total_count=Count('id'))
+        test_breakdown, grand_total = get_order_report('lab', from_date, to_date, order_by)
 
         # Create PDF
         buffer = BytesIO()
@@ -854,32 +661,10 @@ class ScanFinancialReportView(LoginRequiredMixin, PermissionRequiredMixin, Templ
         default_title = f'Scan Financial Report for {month_year}'
         report_title = self.request.GET.get('title', default_title)
 
-        orders = ScanOrderModel.objects.filter(
-            ordered_at__date__range=[from_date, to_date]
-        ).exclude(status__in=['pending', 'cancelled'])
-
+        # === Figures ===
+        # Closed months come from their period snapshots, the rest is computed live
         order_by = self.request.GET.get('order_by', 'name')
-
-        test_breakdown = orders.values(
-            'template__name',
-            'template__id',
-            'template__price'  # Get the CURRENT unit price
-        ).annotate(
-            total_orders=Count('id'),
-            total_amount=Sum('amount_charged')  # SUM of what was ACTUALLY charged
-        )
-
-        if order_by == 'total':
-            test_breakdown = test_breakdown.order_by('-total_orders', 'template__name')
-        elif order_by == 'amount':
-            test_breakdown = test_breakdown.order_by('-total_amount', 'template__name')
-        else:
-            test_breakdown = test_breakdown.order_by('template__name')
-
-        grand_total = orders.aggregate(
-            total=Sum('amount_charged'),
-            total_count=Count('id')
-        )
+        test_breakdown, grand_total = get_order_report('scan', from_date, to_date, order_by)
 
         context.update({
             'from_date': from_date,
@@ -887,6 +672,7 @@ class ScanFinancialReportView(LoginRequiredMixin, PermissionRequiredMixin, Templ
             'report_title': report_title,
             'test_breakdown': test_breakdown,
             'order_by': order_by,
+            'stale_periods': get_stale_periods(from_date, to_date),
             'grand_total_amount': grand_total['total'] or Decimal('0.00'),
             'grand_total_orders': grand_total['total_count'] or 0,
         })
@@ -918,25 +704,7 @@ class ScanFinancialReportExportExcelView(LoginRequiredMixin, PermissionRequiredM
         scan_setting = ScanSettingModel.objects.first()
         site_info = SiteInfoModel.objects.first()
 
-        orders = ScanOrderModel.objects.filter(
-            ordered_at__date__range=[from_date, to_date]
-        ).exclude(status__in=['pending', 'cancelled'])
-
-        test_breakdown = orders.values(
-            'template__name', 'template__id', 'template__price'
-        ).annotate(
-            total_orders=Count('id'),
-            total_amount=Sum('amount_charged')
-        )
-
-        if order_by == 'total':
-            test_breakdown = test_breakdown.order_by('-total_orders', 'template__name')
-        elif order_by == 'amount':
-            test_breakdown = test_breakdown.order_by('-total_amount', 'template__name')
-        else:
-            test_breakdown = test_breakdown.order_by('template__name')
-
-        grand_total = orders.aggregate(total=Sum('amount_charged'), total_count=Count('id'))
+        test_breakdown, grand_total = get_order_report('scan', from_date, to_date, order_by)
 
         wb = Workbook()
         ws = wb.active
@@ -1049,25 +817,7 @@ class ScanFinancialReportExportPDFView(LoginRequiredMixin, PermissionRequiredMix
         scan_setting = ScanSettingModel.objects.first()
         site_info = SiteInfoModel.objects.first()
 
-        orders = ScanOrderModel.objects.filter(
-            ordered_at__date__range=[from_date, to_date]
-        ).exclude(status__in=['pending', 'cancelled'])
-
-        test_breakdown = orders.values(
-            'template__name', 'template__id', 'template__price'
-        ).annotate(
-            total_orders=Count('id'),
-            total_amount=Sum('amount_charged')
-        )
-
-        if order_by == 'total':
-            test_breakdown = test_breakdown.order_by('-total_orders', 'template__name')
-        elif order_by == 'amount':
-            test_breakdown = test_breakdown.order_by('-total_amount', 'template__name')
-        else:
-            test_breakdown = test_breakdown.order_by('template__name')
-
-        grand_total = orders.aggregate(total=Sum('amount_charged'), total_count=Count('id'))
+        test_breakdown, grand_total = get_order_report('scan', from_date, to_date, order_by)
 
         buffer = BytesIO()
         doc = SimpleDocTemplate(buffer, pagesize=A4, rightMargin=30, leftMargin=30, topMargin=30, bottomMargin=30)
@@ -1940,118 +1690,8 @@ class GeneralFinancialReportView(LoginRequiredMixin, PermissionRequiredMixin, Te
         default_title = f'General Financial Report for {month_year}'
         report_title = self.request.GET.get('title', default_title)
 
-        # Build vertical table data
-        financial_data = []
-
-        # 1. CARD (Registration)
-        card_total = RegistrationPaymentModel.objects.filter(
-            date__range=[from_date, to_date], status='confirmed'
-        ).aggregate(total=Sum('amount'))['total'] or Decimal('0.00')
-
-        financial_data.append({
-            'category': 'Card (Registration)',
-            'amount': card_total
-        })
-
-        # 2. CONS (Consultation)
-        cons_total = PatientTransactionModel.objects.filter(
-            date__range=[from_date, to_date],
-            transaction_type='consultation_payment',
-            status='completed'
-        ).aggregate(total=Sum('direct_payment_amount'))['total'] or Decimal('0.00')
-
-        financial_data.append({
-            'category': 'Consultation',
-            'amount': cons_total
-        })
-
-        # 3. LAB
-        lab_total = PatientTransactionModel.objects.filter(
-            date__range=[from_date, to_date],
-            transaction_type='lab_payment',
-            status='completed'
-        ).aggregate(total=Sum('direct_payment_amount'))['total'] or Decimal('0.00')
-
-        financial_data.append({
-            'category': 'Laboratory',
-            'amount': lab_total
-        })
-
-        # 4. DRUGS
-        drugs_total = PatientTransactionModel.objects.filter(
-            date__range=[from_date, to_date],
-            transaction_type='drug_payment',
-            status='completed'
-        ).aggregate(total=Sum('direct_payment_amount'))['total'] or Decimal('0.00')
-
-        financial_data.append({
-            'category': 'Drugs',
-            'amount': drugs_total
-        })
-
-        # 5. SCAN
-        scan_total = PatientTransactionModel.objects.filter(
-            date__range=[from_date, to_date],
-            transaction_type='scan_payment',
-            status='completed'
-        ).aggregate(total=Sum('direct_payment_amount'))['total'] or Decimal('0.00')
-
-        financial_data.append({
-            'category': 'Scan/Imaging',
-            'amount': scan_total
-        })
-
-        # 6. Service Categories (Dynamic)
-        service_categories = ServiceCategory.objects.filter(
-            show_as_record_column=True,
-            is_active=True
-        ).order_by('name')
-
-        for category in service_categories:
-            category_total = PatientTransactionModel.objects.filter(
-                date__range=[from_date, to_date],
-                transaction_type__in=['service', 'item'],
-                status='completed'
-            ).filter(
-                Q(service__service__category=category) |
-                Q(service__service_item__category=category)
-            ).aggregate(total=Sum('direct_payment_amount'))['total'] or Decimal('0.00')
-
-            if category_total > 0:  # Only add if there are transactions
-                financial_data.append({
-                    'category': category.name,
-                    'amount': category_total
-                })
-
-        # 7. SURGERY
-        surgery_total = PatientTransactionModel.objects.filter(
-            date__range=[from_date, to_date],
-            transaction_type='surgery_payment',
-            status='completed'
-        ).aggregate(total=Sum('direct_payment_amount'))['total'] or Decimal('0.00')
-
-        financial_data.append({
-            'category': 'Surgery',
-            'amount': surgery_total
-        })
-
-        # 8. Other Payments (Dynamic by service name)
-        other_payments = PatientTransactionModel.objects.filter(
-            date__range=[from_date, to_date],
-            transaction_type='other_payment',
-            status='completed'
-        ).values('other_service__name').annotate(
-            total=Sum('direct_payment_amount')
-        ).order_by('other_service__name')
-
-        for item in other_payments:
-            if item['total']:
-                financial_data.append({
-                    'category': item['other_service__name'] or 'Other Payment',
-                    'amount': item['total']
-                })
-
-        # Calculate grand total
+        # Closed months come from their period snapshots, the rest is computed live
+        financial_data = get_general_report(from_date, to_date)
         grand_total = sum(item['amount'] for item in financial_data)
 
         context.update({
@@ -2060,6 +1700,7 @@ class GeneralFinancialReportView(LoginRequiredMixin, PermissionRequiredMixin, Te
             'report_title': report_title,
             'financial_data': financial_data,
             'grand_total': grand_total,
+            'stale_periods': get_stale_periods(from_date, to_date),
         })
 
         return context
@@ -2096,168 +1737,38 @@ class GeneralFinancialReportExcelView(LoginRequiredMixin, PermissionRequiredMixi
             month_year = from_date.strftime('%B %Y')
             report_title = f'General Financial Report for {month_year}'
 
-        # Build financial data (same logic as view)
-        financial_data = []
-
-        # 1. CARD (Registration)
-        card_total = RegistrationPaymentModel.objects.filter(
-            date__range=[from_date, to_date], status='confirmed'
-        ).aggregate(total=Sum('amount'))['total'] or Decimal('0.00')
-
-        financial_data.append(('Card (Registration)', card_total))
-
-        # 2. CONS (Consultation)
-        cons_total = PatientTransactionModel.objects.filter(
-            date__range=[from_date, to_date],
-            transaction_type='consultation_payment',
-            status='completed'
-        ).aggregate(total=Sum('direct_payment_amount'))['total'] or Decimal('0.00')
-
-        financial_data.append(('Consultation', cons_total))
-
-        # 3. LAB
-        lab_total = PatientTransactionModel.objects.filter(
-            date__range=[from_date, to_date],
-            transaction_type='lab_payment',
-            status='completed'
-        ).aggregate(total=Sum('direct_payment_amount'))['total'] or Decimal('0.00')
-
-        financial_data.append(('Laboratory', lab_total))
-
-        # 4. DRUGS
-        drugs_total = PatientTransactionModel.objects.filter(
-            date__range=[from_date, to_date],
-            transaction_type='drug_payment',
-            status='completed'
-        ).aggregate(total=Sum('direct_payment_amount'))['total'] or Decimal('0.00')
-
-        financial_data.append(('Drugs', drugs_total))
-
-        # 5. SCAN
-        scan_total = PatientTransactionModel.objects.filter(
-            date__range=[from_date, to_date],
-            transaction_type='scan_payment',
-            status='completed'
-        ).aggregate(total=Sum('direct_payment_amount'))['total'] or Decimal('0.00')
-
-        financial_data.append(('Scan/Imaging', scan_total))
-
-        # 6. Service Categories (Dynamic)
-        service_categories = ServiceCategory.objects.filter(
-            show_as_record_column=True,
-            is_active=True
-        ).order_by('name')
-
-        for category in service_categories:
-            category_total = PatientTransactionModel.objects.filter(
-                date__range=[from_date, to_date],
-                transaction_type__in=['service', 'item'],
-                status='completed'
-            ).filter(
-                Q(service__service__category=category) |
-                Q(service__service_item__category=category)
-            ).aggregate(total=Sum('direct_payment_amount'))['total'] or Decimal('0.00')
-
-            if category_total > 0:
-                financial_data.append((category.name, category_total))
-
-        # 7. SURGERY
-        surgery_total = PatientTransactionModel.objects.filter(
-            date__range=[from_date, to_date],
-            transaction_type='surgery_payment',
-            status='completed'
-        ).aggregate(total=Sum('direct_payment_amount'))['total'] or Decimal('0.00')
-
-        financial_data.append(('Surgery', surgery_total))
-
-        # 8. Other Payments (Dynamic)
-        other_payments = PatientTransactionModel.objects.filter(
-            date__range=[from_date, to_date],
-            transaction_type='other_payment',
-            status='completed'
-        ).values('other_service__name').annotate(
-            total=Sum('direct_payment_amount')
-        ).order_by('other_service__name')
-
-        for item in other_payments:
-            if item['total']:
-                financial_data.append((item['other_service__name'] or 'Other Payment', item['total']))
-
-        # Calculate grand total
+        financial_data = [(item['category'], item['amount']) for item in get_general_report(from_date, to_date)]
         grand_total = sum(amount for _, amount in financial_data)
 
-        # Create workbook
-        wb = Workbook()
-        ws = wb.active
-        ws.title = "Financial Report"
-
         # Styles
         header_font = Font(bold=True, size=14)
-        section_font = Font(bold=True, size=11, color="FFFFFF")
-        section_fill = PatternFill(start_color="4472C4", end_color="4472C4", fill_type="solid")
         total_font = Font(bold=True, size=12, color="FFFFFF")
         total_fill = PatternFill(start_color="28A745", end_color="28A745", fill_type="solid")
-        border = Border(
-            left=Side(style='thin'),
-            right=Side(style='thin'),
-            top=Side(style='thin'),
-            bottom=Side(style='thin')
-        )
-
-        row = 1
-
-        # Header
-        ws.merge_cells(f'A{row}:B{row}')
-        cell = ws[f'A{row}']
-        cell.value = report_title
-        cell.font = header_font
-        cell.alignment = Alignment(horizontal='center')
-        row += 1
-
-        ws.merge_cells(f'A{row}:B{row}')
-        cell = ws[f'A{row}']
-        cell.value = f"Period: {from_date.strftime('%B %d, %Y')} to {to_date.strftime('%B %d, %Y')}"
-        cell.alignment = Alignment(horizontal='center')
-        row += 2
 
-        # Column headers
-        ws[f'A{row}'] = "Category"
-        ws[f'A{row}'].font = section_font
-        ws[f'A{row}'].fill = section_fill
-        ws[f'B{row}'] = "Amount"
-        ws[f'B{row}'].font = section_font
-        ws[f'B{row}'].fill = section_fill
-        ws[f'B{row}'].alignment = Alignment(horizontal='right')
-        row += 1
+        rows = [
+            [Styled(report_title, font=header_font, alignment=CENTER, merge_across=2)],
+            [Styled(f"Period: {from_date.strftime('%B %d, %Y')} to {to_date.strftime('%B %d, %Y')}",
+                    alignment=CENTER, merge_across=2)],
+            [],
+            # Column headers
+            [Styled("Category", font=HEADER_FONT, fill=HEADER_FILL),
+             Styled("Amount", font=HEADER_FONT, fill=HEADER_FILL, alignment=RIGHT)],
+        ]
 
         # Data rows
         for category, amount in financial_data:
-            ws.cell(row=row, column=1, value=category)
-            ws.cell(row=row, column=2, value=float(amount))
-            ws.cell(row=row, column=2).number_format = '#,##0.00'
-            ws.cell(row=row, column=2).alignment = Alignment(horizontal='right')
-            row += 1
+            rows.append([category, money(float(amount))])
 
         # Grand total
-        ws.cell(row=row, column=1, value="GRAND TOTAL").font = total_font
-        ws.cell(row=row, column=1).fill = total_fill
-        ws.cell(row=row, column=2, value=float(grand_total)).font = total_font
-        ws.cell(row=row, column=2).fill = total_fill
-        ws.cell(row=row, column=2).number_format = '#,##0.00'
-        ws.cell(row=row, column=2).alignment = Alignment(horizontal='right')
-
-        # Column widths
-        ws.column_dimensions['A'].width = 35
-        ws.column_dimensions['B'].width = 18
-
-        # Response
-        response = HttpResponse(
-            content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
-        )
-        filename = f"financial_report_{from_date.strftime('%Y%m%d')}.xlsx"
-        response['Content-Disposition'] = f'attachment; filename="{filename}"'
-        wb.save(response)
-        return response
+        rows.append([
+            Styled("GRAND TOTAL", font=total_font, fill=total_fill),
+            money(float(grand_total), font=total_font, fill=total_fill),
+        ])
+
+        filename = f"financial_report_{from_date.strftime('%Y%m%d')}"
+        return export_response(request, filename, [
+            ExportSheet("Financial Report", rows, column_widths=[35, 18])
+        ])
 
 
 # ============================================================================
@@ -2291,94 +1802,7 @@ class GeneralFinancialReportPDFView(LoginRequiredMixin, PermissionRequiredMixin,
             month_year = from_date.strftime('%B %Y')
             report_title = f'General Financial Report for {month_year}'
 
-        # Build financial data (same logic as view)
-        financial_data = []
-
-        # 1. CARD (Registration)
-        card_total = RegistrationPaymentModel.objects.filter(
-            date__range=[from_date, to_date], status='confirmed'
-        ).aggregate(total=Sum('amount'))['total'] or Decimal('0.00')
-
-        financial_data.append(('Card (Registration)', card_total))
-
-        # 2. CONS (Consultation)
-        cons_total = PatientTransactionModel.objects.filter(
-            date__range=[from_date, to_date],
-            transaction_type='consultation_payment',
-            status='completed'
-        ).aggregate(total=Sum('direct_payment_amount'))['total'] or Decimal('0.00')
-
-        financial_data.append(('Consultation', cons_total))
-
-        # 3. LAB
-        lab_total = PatientTransactionModel.objects.filter(
-            date__range=[from_date, to_date],
-            transaction_type='lab_payment',
-            status='completed'
-        ).aggregate(total=Sum('direct_payment_amount'))['total'] or Decimal('0.00')
-
-        financial_data.append(('Laboratory', lab_total))
-
-        # 4. DRUGS
-        drugs_total = PatientTransactionModel.objects.filter(
-            date__range=[from_date, to_date],
-            transaction_type='drug_payment',
-            status='completed'
-        ).aggregate(total=Sum('direct_payment_amount'))['total'] or Decimal('0.00')
-
-        financial_data.append(('Drugs', drugs_total))
-
-        # 5. SCAN
-        scan_total = PatientTransactionModel.objects.filter(
-            date__range=[from_date, to_date],
-            transaction_type='scan_payment',
-            status='completed'
-        ).aggregate(total=Sum('direct_payment_amount'))['total'] or Decimal('0.00')
-
-        financial_data.append(('Scan/Imaging', scan_total))
-
-        # 6. Service Categories (Dynamic)
-        service_categories = ServiceCategory.objects.filter(
-            show_as_record_column=True,
-            is_active=True
-        ).order_by('name')
-
-        for category in service_categories:
-            category_total = PatientTransactionModel.objects.filter(
-                date__range=[from_date, to_date],
-                transaction_type__in=['service', 'item'],
-                status='completed'
-            ).filter(
-                Q(service__service__category=category) |
-                Q(service__service_item__category=category)
-            ).aggregate(total=Sum('direct_payment_amount'))['total'] or Decimal('0.00')
-
-            if category_total > 0:
-                financial_data.append((category.name, category_total))
-
-        # 7. SURGERY
-        surgery_total = PatientTransactionModel.objects.filter(
-            date__range=[from_date, to_date],
-            transaction_type='surgery_payment',
-            status='completed'
-        ).aggregate(total=Sum('direct_payment_amount'))['total'] or Decimal('0.00')
-
-        financial_data.append(('Surgery', surgery_total))
-
-        # 8. Other Payments (Dynamic)
-        other_payments = PatientTransactionModel.objects.filter(
-            date__range=[from_date, to_date],
-            transaction_type='other_payment',
-            status='completed'
-        ).values('other_service__name').annotate(
-            total=Sum('direct_payment_amount')
-        ).order_by('other_service__name')
-
-        for item in other_payments:
-            if item['total']:
-                financial_data.append((item['other_service__name'] or 'Other Payment', item['total']))
-
-        # Calculate grand total
+        financial_data = [(item['category'], item['amount']) for item in get_general_report(from_date, to_date)]
         grand_total = sum(amount for _, amount in financial_data)
 
         # Create PDF
@@ -2463,4 +1887,110 @@ class GeneralFinancialReportPDFView(LoginRequiredMixin, PermissionRequiredMixin,
         response = HttpResponse(buffer, content_type='application/pdf')
         filename = f"financial_report_{from_date.strftime('%Y%m%d')}.pdf"
         response['Content-Disposition'] = f'attachment; filename="{filename}"'
-        return response
\ No newline at end of file
+        return response
+
+# ============================================================================
+# BACKGROUND REPORT JOBS
+# ============================================================================
+
+def _report_job_data(job):
+    return {
+        'job_id': job.pk,
+        'report': job.report,
+        'status': job.status,
+        'error': job.error,
+        'created_at': job.created_at.isoformat(),
+        'completed_at': job.completed_at.isoformat() if job.completed_at else None,
+        'status_url': reverse('report_job_status', kwargs={'pk': job.pk}),
+        'download_url': reverse('report_job_download', kwargs={'pk': job.pk}) if job.status == 'completed' else None,
+    }
+
+
+def _get_report_job_for_user(request, pk):
+    job = get_object_or_404(ReportJob, pk=pk)
+    if job.report not in REPORTS or not user_can_run(job.report, request.user):
+        raise PermissionDenied
+    # Per-user reports may only be fetched by whoever requested them
+    if REPORTS[job.report].per_user and job.requested_by_id != request.user.id:
+        raise PermissionDenied
+    return job
+
+
+@login_required
+@require_http_methods(["GET", "POST"])
+def report_job_create_view(request, report):
+    """
+    Queue a report export (or reuse an identical one) and send the user to the job page.
+    Parameters are the same GET/POST data the export view itself takes.
+    """
+    if report not in REPORTS:
+        raise Http404('Unknown report')
+    if not user_can_run(report, request.user):
+        raise PermissionDenied
+
+    spec = REPORTS[report]
+    params = clean_params(request.POST if spec.method == 'POST' else request.GET)
+    for name in spec.url_kwargs:
+        if name not in params:
+            return HttpResponseBadRequest(f'Missing parameter: {name}')
+
+    job, created = queue_report(report, params, request.user)
+
+    if request.headers.get('x-requested-with') == 'XMLHttpRequest':
+        return JsonResponse({'created': created, **_report_job_data(job)}, status=201 if created else 200)
+    return redirect('report_job_detail', pk=job.pk)
+
+
+@login_required
+def report_job_detail_view(request, pk):
+    job = _get_report_job_for_user(request, pk)
+    return render(request, 'admin_site/reports/report_job.html', {'job': job})
+
+
+@login_required
+def report_job_status_view(request, pk):
+    job = _get_report_job_for_user(request, pk)
+    return JsonResponse(_report_job_data(job))
+
+
+@login_required
+def report_job_download_view(request, pk):
+    job = _get_report_job_for_user(request, pk)
+    if job.status != 'completed' or not job.file:
+        raise Http404('Report is not ready')
+    return FileResponse(job.file.open('rb'), as_attachment=True, filename=job.filename,
+                        content_type=job.content_type or None)
+
+
+@login_required
+@require_http_methods(["GET"])
+def catalog_search_view(request):
+    """
+    Ranked drugs, lab tests, scans, services and service items matching the query (AJAX endpoint).
+    ?type= (comma separated or repeated) limits the kinds, ?category_id= the category,
+    ?in_stock=1 keeps items with stock, ?include_inactive=1 adds inactive ones.
+    """
+    query = request.GET.get('q', '').strip()
+    kinds = [kind for value in request.GET.getlist('type') for kind in value.split(',') if kind]
+    unknown = [kind for kind in kinds if kind not in SOURCES_BY_KIND]
+    if unknown:
+        return JsonResponse({'error': f"Unknown catalog type: {', '.join(unknown)}"}, status=400)
+    category_id = request.GET.get('category_id') or None
+    if category_id and not category_id.isdigit():
+        return JsonResponse({'error': 'Invalid category_id'}, status=400)
+    try:
+        limit = int(request.GET.get('limit') or DEFAULT_LIMIT)
+    except ValueError:
+        limit = DEFAULT_LIMIT
+    limit = max(1, min(limit, MAX_LIMIT))
+
+    if len(query) < MIN_QUERY_LENGTH:
+        return JsonResponse({'results': []})
+
+    matches = search_catalog(
+        query, kinds, category_id,
+        active_only=request.GET.get('include_inactive') != '1',
+        in_stock=request.GET.get('in_stock') == '1',
+        limit=limit,
+    )
+    return JsonResponse({'results': [serialize_entry(entry, score) for entry, score in matches]})
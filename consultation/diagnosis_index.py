@@ -0,0 +1,191 @@
+"""
+In-process diagnosis index.
+
+Diagnosis search runs on every keystroke of a consultation, so each process
+keeps every DiagnosisOption (id, name, ICD code, specialization ids, active
+flag) in memory and answers searches and lookups without a query:
+
+    search('mala', specialization_id=3)   # ranked DiagnosisEntry list
+    resolve(['Malaria', 'B54', 'a01.0'])  # {value: DiagnosisEntry or None}
+    get_entry(12)
+
+Saving or deleting a DiagnosisOption, or changing its specializations, bumps
+a version number in the cache (see consultation.signals); every process
+compares it with the version its index was built from on each use, so an
+edit made in one worker is seen by all of them on their next request. The
+index is also rebuilt after INDEX_SECONDS, which covers changes made with
+QuerySet.update().
+"""
+import bisect
+import re
+import threading
+import time
+from collections import namedtuple
+
+from django.core.cache import cache
+
+from consultation.diagnosis_matching import normalize
+
+VERSION_KEY = 'diagnosis-index:version'
+INDEX_SECONDS = 600
+
+SEARCH_LIMIT = 20
+MAX_RESOLVE_VALUES = 500
+
+DiagnosisEntry = namedtuple('DiagnosisEntry', 'id name icd_code specialization_ids is_active')
+
+
+def normalize_code(value):
+    """ICD codes compared without case, spaces or dots ("a01.0" -> "A010")"""
+    return re.sub(r'[\s.]', '', value or '').upper()
+
+
+class DiagnosisIndex:
+    def __init__(self, entries):
+        self.entries = sorted(entries, key=lambda entry: (entry.name.lower(), entry.id))
+        self.by_id = {entry.id: entry for entry in self.entries}
+        self._positions = {entry.id: position for position, entry in enumerate(self.entries)}
+        self.by_name = {}
+        self.by_code = {}
+        words = []
+        codes = []
+        for position, entry in enumerate(self.entries):
+            normalized = normalize(entry.name)
+            self.by_name.setdefault(normalized, entry)
+            for word in set(normalized.split()):
+                words.append((word, position))
+            code = normalize_code(entry.icd_code)
+            if code:
+                self.by_code.setdefault(code, entry)
+                codes.append((code, position))
+        self._words = sorted(words)
+        self._codes = sorted(codes)
+        self._normalized = [normalize(entry.name) for entry in self.entries]
+
+    @staticmethod
+    def _prefixed(pairs, prefix):
+        """Positions of the pairs whose key starts with prefix"""
+        start = bisect.bisect_left(pairs, (prefix,))
+        positions = set()
+        for key, position in pairs[start:]:
+            if not key.startswith(prefix):
+                break
+            positions.add(position)
+        return positions
+
+    def search(self, query, specialization_id=None, active_only=True, limit=SEARCH_LIMIT):
+        """
+        Entries matching the query, best first: ICD code matches, then names
+        equal to the query, names starting with it, names with a word starting
+        with every query word, and finally names merely containing the query.
+        """
+        normalized = normalize(query)
+        code = normalize_code(query)
+        if not normalized and not code:
+            return []
+
+        ranks = {}
+
+        def rank(positions, value):
+            for position in positions:
+                if value < ranks.get(position, value + 1):
+                    ranks[position] = value
+
+        if code:
+            rank(self._prefixed(self._codes, code), 1)
+            if code in self.by_code:
+                rank([self._positions[self.by_code[code].id]], 0)
+        words = normalized.split()
+        if words:
+            matching = self._prefixed(self._words, words[0])
+            for word in words[1:]:
+                matching &= self._prefixed(self._words, word)
+            rank([position for position in matching if self._normalized[position] == normalized], 2)
+            rank([position for position in matching if self._normalized[position].startswith(normalized)], 3)
+            rank(matching, 4)
+            rank([position for position, name in enumerate(self._normalized) if normalized in name], 5)
+
+        results = []
+        # Positions follow name order, so sorting on (rank, position) orders ties by name
+        for position in sorted(ranks, key=lambda position: (ranks[position], position)):
+            entry = self.entries[position]
+            if active_only and not entry.is_active:
+                continue
+            if specialization_id and int(specialization_id) not in entry.specialization_ids:
+                continue
+            results.append(entry)
+            if len(results) >= limit:
+                break
+        return results
+
+    def resolve(self, value):
+        """The entry whose ICD code or name equals value (ignoring case, accents and punctuation), or None"""
+        return self.by_code.get(normalize_code(value)) or self.by_name.get(normalize(value))
+
+
+_index = None
+_index_version = None
+_index_built_at = 0
+_lock = threading.Lock()
+
+
+def build_index():
+    from consultation.models import DiagnosisOption
+
+    specializations = {}
+    through = DiagnosisOption.specializations.through
+    for option_id, specialization_id in through.objects.values_list('diagnosisoption_id', 'specializationmodel_id'):
+        specializations.setdefault(option_id, set()).add(specialization_id)
+    return DiagnosisIndex([
+        DiagnosisEntry(option_id, name, icd_code or '', frozenset(specializations.get(option_id, ())), is_active)
+        for option_id, name, icd_code, is_active in DiagnosisOption.objects.values_list(
+            'id', 'name', 'icd_code', 'is_active'
+        )
+    ])
+
+
+def get_index():
+    """This process's index, rebuilt when a diagnosis changed anywhere or it is older than INDEX_SECONDS"""
+    global _index, _index_version, _index_built_at
+    version = cache.get(VERSION_KEY)
+    if version is None:
+        version = time.time_ns()
+        cache.add(VERSION_KEY, version, None)
+        version = cache.get(VERSION_KEY, version)
+    if _index is None or version != _index_version or time.monotonic() - _index_built_at > INDEX_SECONDS:
+        with _lock:
+            if _index is None or version != _index_version or time.monotonic() - _index_built_at > INDEX_SECONDS:
+                _index = build_index()
+                _index_version = version
+                _index_built_at = time.monotonic()
+    return _index
+
+
+def invalidate():
+    """Make every process rebuild its index on next use"""
+    cache.set(VERSION_KEY, time.time_ns(), None)
+
+
+def search(query, specialization_id=None, active_only=True, limit=SEARCH_LIMIT):
+    return get_index().search(query, specialization_id, active_only, limit)
+
+
+def resolve(values):
+    """{value: DiagnosisEntry or None} for names or ICD codes"""
+    index = get_index()
+    return {value: index.resolve(value) for value in values}
+
+
+def get_entry(diagnosis_id):
+    try:
+        return get_index().by_id.get(int(diagnosis_id))
+    except (TypeError, ValueError):
+        return None
+
+
+def serialize_entry(entry):
+    return {
+        'id': entry.id,
+        'name': entry.name,
+        'icd_code': entry.icd_code,
+    }
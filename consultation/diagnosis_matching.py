@@ -0,0 +1,159 @@
+"""
+Matching free-text diagnoses to DiagnosisOption names.
+
+Texts and names are compared in normalized form: lowercased, accents
+stripped and reduced to their alphanumeric words ("Malaria, severe." ->
+"malaria severe"). Equal normalized forms are an exact match; otherwise the
+most similar name whose difflib ratio reaches the cutoff is a fuzzy match,
+as with difflib.get_close_matches.
+
+Instead of comparing a text with every name, DiagnosisMatcher keeps a
+blocking index from keys to names:
+
+    t:  padded trigram of a word ("$ma", "mal", ..., "ia$")
+    s:  Soundex code of a word, so misspellings that sound alike still meet ("m460")
+
+and only scores the CANDIDATE_LIMIT names sharing the most keys with the
+text. The module uses no Django imports so matchers can run in worker
+processes (see match_texts()).
+"""
+import re
+import unicodedata
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from difflib import SequenceMatcher
+from itertools import repeat
+
+TRIGRAM = 't:'
+SOUNDEX = 's:'
+
+# Names scored with difflib per text
+CANDIDATE_LIMIT = 100
+# Texts sent to a worker process at a time
+WORKER_CHUNK_SIZE = 200
+
+_SOUNDEX_CODES = {
+    **dict.fromkeys('bfpv', '1'),
+    **dict.fromkeys('cgjkqsxz', '2'),
+    **dict.fromkeys('dt', '3'),
+    'l': '4',
+    **dict.fromkeys('mn', '5'),
+    'r': '6',
+}
+
+
+def normalize(text):
+    """Lowercase, strip accents and keep only the alphanumeric words"""
+    decomposed = unicodedata.normalize('NFKD', text or '')
+    plain = ''.join(char for char in decomposed if not unicodedata.combining(char)).lower()
+    return ' '.join(re.findall(r'[a-z0-9]+', plain))
+
+
+def soundex(word):
+    if not word.isalpha():
+        return ''
+    code = word[0]
+    previous = _SOUNDEX_CODES.get(word[0], '')
+    for char in word[1:]:
+        digit = _SOUNDEX_CODES.get(char, '')
+        if digit and digit != previous:
+            code += digit
+        if char not in 'hw':
+            previous = digit
+    return (code + '000')[:4]
+
+
+def blocking_keys(normalized):
+    keys = set()
+    for word in normalized.split():
+        padded = f'${word}$'
+        keys.update(TRIGRAM + padded[i:i + 3] for i in range(len(padded) - 2))
+        phonetic = soundex(word)
+        if phonetic:
+            keys.add(SOUNDEX + phonetic)
+    return keys
+
+
+class DiagnosisMatcher:
+    """Matches texts against a set of diagnosis names; built from (id, name) pairs"""
+
+    def __init__(self, options=()):
+        self._exact = {}
+        self._names = []
+        self._postings = defaultdict(list)
+        for option_id, name in options:
+            self.add(option_id, name)
+
+    def add(self, option_id, name):
+        normalized = normalize(name)
+        if not normalized or normalized in self._exact:
+            return
+        self._exact[normalized] = option_id
+        position = len(self._names)
+        self._names.append((option_id, normalized))
+        for key in blocking_keys(normalized):
+            self._postings[key].append(position)
+
+    def match(self, text, cutoff):
+        """
+        (option id, score, exact) of the best name for text, or (None, 0, False)
+        when no name reaches the cutoff.
+        """
+        normalized = normalize(text)
+        if normalized in self._exact:
+            return self._exact[normalized], 1.0, True
+
+        shared = Counter()
+        for key in blocking_keys(normalized):
+            shared.update(self._postings.get(key, ()))
+
+        best = (None, 0, False)
+        matcher = SequenceMatcher()
+        matcher.set_seq2(normalized)
+        for position, _ in shared.most_common(CANDIDATE_LIMIT):
+            option_id, name = self._names[position]
+            matcher.set_seq1(name)
+            if matcher.real_quick_ratio() < cutoff or matcher.quick_ratio() < cutoff:
+                continue
+            score = matcher.ratio()
+            if score >= cutoff and score > best[1]:
+                best = (option_id, score, False)
+        return best
+
+
+# ---------------------------------------------------------------------------
+# Worker processes
+# ---------------------------------------------------------------------------
+
+_worker_matcher = None
+
+
+def _start_worker(options):
+    global _worker_matcher
+    _worker_matcher = DiagnosisMatcher(options)
+
+
+def _match_chunk(texts, cutoff):
+    return [(text, *_worker_matcher.match(text, cutoff)) for text in texts]
+
+
+def _chunks(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def match_texts(options, texts, cutoff, workers=1):
+    """
+    Match texts against the (id, name) options, yielding lists of
+    (text, option id, score, exact) as each chunk of texts is done. With more
+    than one worker the chunks are matched in a process pool.
+    """
+    texts = list(texts)
+    if workers <= 1:
+        matcher = DiagnosisMatcher(options)
+        for chunk in _chunks(texts, WORKER_CHUNK_SIZE):
+            yield [(text, *matcher.match(text, cutoff)) for text in chunk]
+        return
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_start_worker, initargs=(list(options),)) as pool:
+        yield from pool.map(_match_chunk, _chunks(texts, WORKER_CHUNK_SIZE), repeat(cutoff))
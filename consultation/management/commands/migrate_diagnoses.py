@@ -1,9 +1,20 @@
 # Create this as: consultation/management/commands/migrate_diagnoses.py
 
-from django.core.management.base import BaseCommand
+import csv
+import json
+import os
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
 from django.db.models import Q
+from consultation import diagnosis_index
 from consultation.models import ConsultationSessionModel, DiagnosisOption
-from difflib import get_close_matches
+from consultation.diagnosis_matching import DiagnosisMatcher, match_texts, normalize
+from patient.timeline import refresh_events
+
+# The checkpoint is rewritten at most this often while matching
+CHECKPOINT_SECONDS = 10
 
 
 class Command(BaseCommand):
@@ -21,11 +32,38 @@ class Command(BaseCommand):
             default=0.8,
             help='Similarity threshold (0.0 to 1.0) for fuzzy matching',
         )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=1,
+            help='Processes matching diagnosis texts in parallel',
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=1000,
+            help='Consultations read and updated per query',
+        )
+        parser.add_argument(
+            '--checkpoint',
+            help='JSON file keeping the matches made so far; an interrupted run started again with it '
+                 'only matches the texts it had not reached',
+        )
+        parser.add_argument(
+            '--report',
+            help='CSV file listing every distinct diagnosis text with the diagnosis it was mapped to',
+        )
 
     def handle(self, *args, **options):
         dry_run = options['dry_run']
         threshold = options['threshold']
+        batch_size = options['batch_size']
+        if not 0 < threshold <= 1:
+            raise CommandError('--threshold must be between 0 and 1')
+        if batch_size < 1 or options['workers'] < 1:
+            raise CommandError('--batch-size and --workers must be positive')
 
+        run_started = time.perf_counter()
         self.stdout.write(self.style.WARNING(f'\n{"DRY RUN - " if dry_run else ""}Starting diagnosis migration...\n'))
 
         # Get all consultations with text diagnosis but no primary_diagnosis
@@ -35,96 +73,166 @@ class Command(BaseCommand):
             Q(diagnosis='') | Q(diagnosis__isnull=True)
         )
 
-        total = consultations.count()
-        self.stdout.write(f'Found {total} consultations to process\n')
-
-        # Get all existing diagnosis options
-        existing_diagnoses = {d.name.lower(): d for d in DiagnosisOption.objects.all()}
-
-        matched = 0
-        created = 0
-        skipped = 0
-
-        for consultation in consultations:
-            diagnosis_text = consultation.diagnosis.strip()
-
-            if not diagnosis_text:
-                skipped += 1
-                continue
-
-            # Try exact match (case-insensitive)
-            diagnosis_lower = diagnosis_text.lower()
-
-            if diagnosis_lower in existing_diagnoses:
-                if not dry_run:
-                    consultation.primary_diagnosis = existing_diagnoses[diagnosis_lower]
-                    consultation.save()
-                matched += 1
-                self.stdout.write(
-                    self.style.SUCCESS(
-                        f'✓ Exact match: "{diagnosis_text}" → {existing_diagnoses[diagnosis_lower].name}')
-                )
-                continue
-
-            # Try fuzzy matching
-            close_matches = get_close_matches(
-                diagnosis_lower,
-                existing_diagnoses.keys(),
-                n=1,
-                cutoff=threshold
-            )
-
-            if close_matches:
-                matched_diagnosis = existing_diagnoses[close_matches[0]]
-                if not dry_run:
-                    consultation.primary_diagnosis = matched_diagnosis
-                    consultation.save()
-                matched += 1
-                self.stdout.write(
-                    self.style.WARNING(f'≈ Fuzzy match: "{diagnosis_text}" → {matched_diagnosis.name}')
-                )
-                continue
-
-            # Create new diagnosis if no match found
-            if not dry_run:
-                # Normalize the name (title case)
-                normalized_name = diagnosis_text.title()
-
-                # Check if this normalized name already exists
-                diagnosis_obj, was_created = DiagnosisOption.objects.get_or_create(
-                    name=normalized_name,
-                    defaults={'is_active': True}
-                )
-
-                consultation.primary_diagnosis = diagnosis_obj
-                consultation.save()
-
-                if was_created:
-                    created += 1
-                    existing_diagnoses[normalized_name.lower()] = diagnosis_obj
-                    self.stdout.write(
-                        self.style.NOTICE(f'+ Created new: "{normalized_name}"')
-                    )
-                else:
-                    matched += 1
-                    self.stdout.write(
-                        self.style.SUCCESS(f'✓ Found existing: "{normalized_name}"')
-                    )
-            else:
-                created += 1
-                self.stdout.write(
-                    self.style.NOTICE(f'+ Would create: "{diagnosis_text.title()}"')
-                )
+        # Each distinct (normalized) text is matched once for all its consultations
+        texts, skipped, total = self.collect_texts(consultations, batch_size)
+        self.stdout.write(f'Found {total} consultations to process ({len(texts)} distinct diagnosis texts)\n')
+
+        existing = list(DiagnosisOption.objects.values_list('id', 'name'))
+        decisions = self.load_checkpoint(options['checkpoint'], threshold, {option_id for option_id, _ in existing})
+        pending = [text for text in texts if text not in decisions]
+        if decisions:
+            self.stdout.write(f'Resuming: {len(texts) - len(pending)} texts already matched\n')
+
+        started = saved = time.perf_counter()
+        done = 0
+        for results in match_texts(existing, pending, threshold, options['workers']):
+            for text, option_id, score, exact in results:
+                decisions[text] = [option_id, score, exact]
+            done += len(results)
+            if done == len(pending) or time.perf_counter() - saved >= CHECKPOINT_SECONDS:
+                self.save_checkpoint(options['checkpoint'], threshold, decisions)
+                saved = time.perf_counter()
+            self.progress('Matched', done, len(pending), started)
+
+        names = dict(existing)
+        new_diagnoses = self.create_unmatched(texts, decisions, threshold, dry_run)
+
+        matched = created_for = 0
+        for text, entry in texts.items():
+            option_id = decisions[text][0]
+            count = len(entry['ids'])
+            if text in new_diagnoses:
+                created_for += count
+            elif option_id is not None:
+                matched += count
+                how = 'Exact match' if decisions[text][2] else 'Fuzzy match'
+                style = self.style.SUCCESS if decisions[text][2] else self.style.WARNING
+                if options['verbosity'] >= 2:
+                    self.stdout.write(style(f'{how}: "{entry["text"]}" → {names[option_id]} ({count})'))
+
+        if not dry_run:
+            self.write_diagnoses(texts, decisions, new_diagnoses, batch_size)
+
+        if options['report']:
+            self.write_report(options['report'], texts, decisions, names, new_diagnoses)
 
         # Summary
         self.stdout.write('\n' + '=' * 60)
         self.stdout.write(self.style.SUCCESS(f'\nMigration {"Preview" if dry_run else "Complete"}!'))
         self.stdout.write(f'\nTotal consultations: {total}')
         self.stdout.write(self.style.SUCCESS(f'Matched to existing: {matched}'))
-        self.stdout.write(self.style.NOTICE(f'New diagnoses {"would be " if dry_run else ""}created: {created}'))
+        self.stdout.write(self.style.NOTICE(
+            f'New diagnoses {"would be " if dry_run else ""}created: {len(set(new_diagnoses.values()))} '
+            f'(for {created_for} consultations)'
+        ))
         self.stdout.write(self.style.WARNING(f'Skipped (empty): {skipped}'))
+        self.stdout.write(f'Time: {time.perf_counter() - run_started:.1f} s')
 
         if dry_run:
             self.stdout.write(self.style.WARNING('\n⚠ This was a DRY RUN. Run without --dry-run to apply changes.'))
         else:
-            self.stdout.write(self.style.SUCCESS('\n✓ Data successfully migrated!'))
\ No newline at end of file
+            if options['checkpoint'] and os.path.exists(options['checkpoint']):
+                os.remove(options['checkpoint'])
+            self.stdout.write(self.style.SUCCESS('\n✓ Data successfully migrated!'))
+
+    def progress(self, verb, done, total, started):
+        elapsed = time.perf_counter() - started
+        rate = done / elapsed if elapsed else 0
+        remaining = (total - done) / rate if rate else 0
+        self.stdout.write(f'{verb} {done}/{total} ({rate:.0f}/s, about {remaining:.0f} s left)')
+
+    def collect_texts(self, consultations, batch_size):
+        """({normalized text: {'text': first raw text, 'ids': [consultation ids]}}, skipped, total)"""
+        texts = {}
+        skipped = total = 0
+        rows = consultations.order_by('pk').values_list('pk', 'diagnosis')
+        for pk, diagnosis in rows.iterator(chunk_size=batch_size):
+            total += 1
+            key = normalize(diagnosis)
+            if not key:
+                skipped += 1
+                continue
+            entry = texts.setdefault(key, {'text': diagnosis.strip(), 'ids': []})
+            entry['ids'].append(pk)
+        return texts, skipped, total
+
+    def load_checkpoint(self, path, threshold, option_ids):
+        """Matches of an earlier run with the same threshold; matches to diagnoses since deleted are dropped"""
+        if not path or not os.path.exists(path):
+            return {}
+        with open(path) as checkpoint:
+            data = json.load(checkpoint)
+        if data.get('threshold') != threshold:
+            raise CommandError(f'{path} was written with --threshold {data.get("threshold")}')
+        return {
+            text: decision for text, decision in data['decisions'].items()
+            if decision[0] is None or decision[0] in option_ids
+        }
+
+    def save_checkpoint(self, path, threshold, decisions):
+        if not path:
+            return
+        # Written aside and renamed so an interruption never leaves half a file
+        partial = f'{path}.partial'
+        with open(partial, 'w') as checkpoint:
+            json.dump({'threshold': threshold, 'decisions': decisions}, checkpoint)
+        os.replace(partial, path)
+
+    def create_unmatched(self, texts, decisions, threshold, dry_run):
+        """
+        {text: name} for the texts no existing diagnosis matched. Texts close to
+        one created earlier in the run share it, like the one-by-one migration did.
+        """
+        created = DiagnosisMatcher()
+        new_diagnoses = {}
+        for text, entry in texts.items():
+            if decisions[text][0] is not None:
+                continue
+            option_name, _, _ = created.match(text, threshold)
+            if option_name is None:
+                # Normalize the name (title case)
+                option_name = entry['text'].title()
+                created.add(option_name, option_name)
+                self.stdout.write(self.style.NOTICE(
+                    f'{"+ Would create" if dry_run else "+ Creating"}: "{option_name}"'
+                ))
+            new_diagnoses[text] = option_name
+
+        if not dry_run and new_diagnoses:
+            names = set(new_diagnoses.values())
+            DiagnosisOption.objects.bulk_create(
+                [DiagnosisOption(name=name, is_active=True) for name in names], ignore_conflicts=True
+            )
+            # bulk_create sends no post_save: make every process rebuild its diagnosis index
+            transaction.on_commit(diagnosis_index.invalidate)
+            ids = dict(DiagnosisOption.objects.filter(name__in=names).values_list('name', 'id'))
+            for text, name in new_diagnoses.items():
+                decisions[text] = [ids[name], 1.0, True]
+        return new_diagnoses
+
+    def write_diagnoses(self, texts, decisions, new_diagnoses, batch_size):
+        updates = [
+            ConsultationSessionModel(pk=pk, primary_diagnosis_id=decisions[text][0])
+            for text, entry in texts.items() for pk in entry['ids']
+        ]
+        started = time.perf_counter()
+        for start in range(0, len(updates), batch_size):
+            batch = updates[start:start + batch_size]
+            with transaction.atomic():
+                ConsultationSessionModel.objects.bulk_update(batch, ['primary_diagnosis'])
+                # bulk_update sends no post_save, so refresh the consultations' timeline titles here
+                refresh_events('consultation', [consultation.pk for consultation in batch])
+            self.progress('Updated', start + len(batch), len(updates), started)
+
+    def write_report(self, path, texts, decisions, names, new_diagnoses):
+        with open(path, 'w', newline='') as report:
+            writer = csv.writer(report)
+            writer.writerow(['Diagnosis text', 'Consultations', 'Match', 'Score', 'Diagnosis ID', 'Diagnosis'])
+            for text, entry in sorted(texts.items(), key=lambda item: -len(item[1]['ids'])):
+                option_id, score, exact = decisions[text]
+                if text in new_diagnoses:
+                    match, name = 'new', new_diagnoses[text]
+                else:
+                    match, name = 'exact' if exact else 'fuzzy', names[option_id]
+                writer.writerow([entry['text'], len(entry['ids']), match, f'{score:.2f}', option_id or '', name])
+        self.stdout.write(f'Report written to {path}')
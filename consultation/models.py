@@ -7,6 +7,7 @@ from decimal import Decimal
 from django.db.models import Q
 from django.utils import timezone
 
+from admin_site.sequences import next_sequence_value, max_sequence_suffix
 from finance.models import PatientTransactionModel
 from insurance.models import PatientInsuranceModel, HMOCoveragePlanModel
 
@@ -220,24 +221,12 @@ class PatientQueueModel(models.Model):
             self.specialization = self.payment.fee_structure.specialization
 
         if not self.queue_number:
-            # Generate queue number: CSL20241225001
-
+            # Generate queue number: Q20241225001
             today = date.today().strftime('%Y%m%d')
-            last_queue = PatientQueueModel.objects.filter(
-                queue_number__startswith=f'Q{today}'
-            ).order_by('id').last()
-
-            if last_queue:
-                try:
-                    last_num = int(last_queue.queue_number[-3:])
-                    next_num = last_num + 1
-                except ValueError:
-                    next_num = 1
-            else:
-                next_num = 1
-
-            print(next_num)
-
+            next_num = next_sequence_value(
+                'Q', today,
+                seed=lambda: max_sequence_suffix(PatientQueueModel.objects, 'queue_number', f'Q{today}')
+            )
             self.queue_number = f'Q{today}{str(next_num).zfill(3)}'
 
         super().save(*args, **kwargs)
@@ -0,0 +1,298 @@
+"""
+Live patient queue updates.
+
+Every committed save of a PatientQueueModel publishes a delta to the queue
+broker (see consultation.signals):
+
+    {"id": 12, "queue_number": "Q20261016004", "date": "2026-10-16",
+     "status": "with_doctor", "previous_status": "vitals_done",
+     "consultant_id": 3, "previous_consultant_id": 3, "priority_level": 0}
+
+previous_status is null for a new entry and status is null for a deleted one.
+
+queue_event_stream (consultation/queue/stream/) sends the deltas to screens as
+server-sent events. A new connection first gets a "snapshot" event listing
+today's entries as [id, status, consultant_id], then one "queue" event per
+delta, so screens keep their counters current without querying again.
+Applying a delta replaces the entry's state, so deltas the snapshot already
+reflects are not sent after it: they would roll entries back to older
+statuses. A screen that falls too far behind is sent a new snapshot in the
+same way. Events carry ids: a browser that
+reconnects with Last-Event-ID gets the deltas it missed from the broker's
+replay buffer, or a fresh snapshot when they are no longer buffered.
+
+Event ids are "<broker token>:<number>". The token is made when a broker
+starts, so an id from another process (or from before a restart) never
+matches the numbering of the broker that receives it, and the screen is sent
+a snapshot instead of a replay of unrelated deltas.
+
+LocalBroker keeps subscribers in process memory, needs no Redis and is what
+tests use, but only reaches screens connected to the same process. To run
+several server processes, point QUEUE_EVENT_BROKER at a broker class with the
+same token/publish/subscribe/unsubscribe/replay interface backed by a shared
+channel, with one token and numbering shared by every process.
+"""
+import asyncio
+import json
+import logging
+import queue
+import threading
+import time
+import uuid
+from collections import deque
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BROKER = 'consultation.queue_events.LocalBroker'
+# Deltas kept for reconnecting screens
+REPLAY_BUFFER_SIZE = 500
+# Deltas a slow screen may fall behind by before it is sent a new snapshot
+SUBSCRIBER_QUEUE_SIZE = 1000
+# A comment line is sent this often so proxies keep idle streams open
+KEEPALIVE_SECONDS = 15
+# Streams end after this long and the browser reconnects, so no connection holds a worker forever
+STREAM_SECONDS = 300
+# Browser reconnect delay sent with the stream (milliseconds)
+RETRY_MILLISECONDS = 3000
+
+
+class Subscription:
+    """
+    Deltas waiting for one screen. Created with an event loop it is read with
+    aget() from that loop; without one it is read with get() from a thread.
+    """
+
+    def __init__(self, loop=None, maxsize=SUBSCRIBER_QUEUE_SIZE):
+        self.loop = loop
+        self.overflowed = False
+        self._queue = asyncio.Queue(maxsize) if loop else queue.Queue(maxsize)
+
+    def _put(self, event):
+        try:
+            self._queue.put_nowait(event)
+        except (asyncio.QueueFull, queue.Full):
+            self.overflowed = True
+
+    def put(self, event):
+        """Queue (event id, payload); safe to call from any thread"""
+        if self.loop is None:
+            self._put(event)
+            return
+        try:
+            self.loop.call_soon_threadsafe(self._put, event)
+        except RuntimeError:
+            # The screen's loop has already closed
+            pass
+
+    def get(self, timeout=None):
+        """The next (event id, payload), or None when nothing arrives within timeout seconds"""
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    async def aget(self, timeout=None):
+        try:
+            return await asyncio.wait_for(self._queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+
+class LocalBroker:
+    """In-process publish/subscribe for queue deltas"""
+
+    def __init__(self, buffer_size=REPLAY_BUFFER_SIZE):
+        # Identifies this broker's event numbering in event ids
+        self.token = uuid.uuid4().hex
+        self._lock = threading.Lock()
+        self._subscriptions = set()
+        self._buffer = deque(maxlen=buffer_size)
+        self.last_id = 0
+
+    def publish(self, payload):
+        """Send payload to every subscriber; returns its event id"""
+        with self._lock:
+            self.last_id += 1
+            event = (self.last_id, payload)
+            self._buffer.append(event)
+            subscriptions = list(self._subscriptions)
+        for subscription in subscriptions:
+            subscription.put(event)
+        return event[0]
+
+    def subscribe(self, loop=None):
+        subscription = Subscription(loop)
+        with self._lock:
+            self._subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscriptions.discard(subscription)
+
+    def replay(self, after_id):
+        """Buffered events after after_id, or None when some of them are no longer buffered"""
+        with self._lock:
+            if after_id > self.last_id:
+                return None
+            events = [event for event in self._buffer if event[0] > after_id]
+            if after_id < self.last_id and (not events or events[0][0] != after_id + 1):
+                return None
+            return events
+
+
+_broker = None
+_broker_lock = threading.Lock()
+
+
+def get_broker():
+    """The broker named by settings.QUEUE_EVENT_BROKER, created on first use"""
+    global _broker
+    if _broker is None:
+        with _broker_lock:
+            if _broker is None:
+                _broker = import_string(getattr(settings, 'QUEUE_EVENT_BROKER', DEFAULT_BROKER))()
+    return _broker
+
+
+# ---------------------------------------------------------------------------
+# Deltas
+# ---------------------------------------------------------------------------
+
+def _local_date(value):
+    return timezone.localtime(value).date() if timezone.is_aware(value) else value.date()
+
+
+def queue_delta(entry, previous_status=None, previous_consultant_id=None, deleted=False):
+    return {
+        'id': entry.id,
+        'queue_number': entry.queue_number,
+        'date': _local_date(entry.joined_queue_at).isoformat(),
+        'status': None if deleted else entry.status,
+        'previous_status': previous_status,
+        'consultant_id': None if deleted else entry.consultant_id,
+        'previous_consultant_id': previous_consultant_id,
+        'priority_level': entry.priority_level,
+    }
+
+
+def publish(payload):
+    """Publish a delta; a broker failure is logged and never breaks the queue change itself"""
+    try:
+        get_broker().publish(payload)
+    except Exception:
+        logger.exception('Failed to publish queue change %s', payload.get('id'))
+
+
+def queue_snapshot(day=None):
+    from consultation.models import PatientQueueModel
+
+    day = day or timezone.localdate()
+    entries = PatientQueueModel.objects.filter(joined_queue_at__date=day).order_by().values_list(
+        'id', 'status', 'consultant_id'
+    )
+    return {'date': day.isoformat(), 'entries': [list(entry) for entry in entries]}
+
+
+# ---------------------------------------------------------------------------
+# Server-sent events
+# ---------------------------------------------------------------------------
+
+def format_event_id(broker, number):
+    return f'{broker.token}:{number}'
+
+
+def parse_event_id(broker, value):
+    """The event number of a Last-Event-ID sent by a screen, or None when it is not one of this broker's ids"""
+    token, _, number = (value or '').partition(':')
+    if token != broker.token or not number.isdigit():
+        return None
+    return int(number)
+
+
+def format_event(event_type, payload, event_id=None):
+    lines = []
+    if event_id is not None:
+        lines.append(f'id: {event_id}')
+    lines.append(f'event: {event_type}')
+    lines.append(f'data: {json.dumps(payload, separators=(",", ":"))}')
+    return '\n'.join(lines) + '\n\n'
+
+
+def _snapshot_frame(broker):
+    """
+    (frame, last_id): a snapshot of today's queue and the id of the last delta
+    it reflects. The id is read before the queue is, so a delta published while
+    the snapshot is taken still counts as newer and is sent after it.
+    """
+    last_id = broker.last_id
+    return format_event('snapshot', queue_snapshot(), format_event_id(broker, last_id)), last_id
+
+
+def _opening_frames(broker, last_event_id):
+    """
+    (frames, last_id): the retry hint, then the missed deltas when they are
+    still buffered, else a snapshot; last_id is the last delta they cover.
+    """
+    frames = [f'retry: {RETRY_MILLISECONDS}\n\n']
+    after_id = parse_event_id(broker, last_event_id)
+    missed = broker.replay(after_id) if after_id is not None else None
+    if missed is None:
+        frame, last_id = _snapshot_frame(broker)
+        frames.append(frame)
+    else:
+        frames.extend(format_event('queue', payload, format_event_id(broker, number)) for number, payload in missed)
+        last_id = missed[-1][0] if missed else after_id
+    return frames, last_id
+
+
+def iter_events(last_event_id=None, broker=None, seconds=STREAM_SECONDS):
+    """Server-sent event frames for a WSGI worker thread, which the stream holds for up to `seconds`"""
+    broker = broker or get_broker()
+    subscription = broker.subscribe()
+    try:
+        frames, sent_id = _opening_frames(broker, last_event_id)
+        yield from frames
+        deadline = time.monotonic() + seconds
+        while (remaining := deadline - time.monotonic()) > 0:
+            event = subscription.get(timeout=min(KEEPALIVE_SECONDS, remaining))
+            if subscription.overflowed:
+                subscription.overflowed = False
+                frame, sent_id = _snapshot_frame(broker)
+                yield frame
+            elif event is None:
+                yield ': keepalive\n\n'
+            elif event[0] > sent_id:
+                # Deltas still queued from before the last snapshot or replay would roll entries back
+                yield format_event('queue', event[1], format_event_id(broker, event[0]))
+    finally:
+        broker.unsubscribe(subscription)
+
+
+async def aiter_events(last_event_id=None, broker=None, seconds=STREAM_SECONDS):
+    """Server-sent event frames for an ASGI server; waiting for deltas holds no thread"""
+    broker = broker or get_broker()
+    subscription = broker.subscribe(asyncio.get_running_loop())
+    try:
+        frames, sent_id = await sync_to_async(_opening_frames)(broker, last_event_id)
+        for frame in frames:
+            yield frame
+        deadline = time.monotonic() + seconds
+        while (remaining := deadline - time.monotonic()) > 0:
+            event = await subscription.aget(timeout=min(KEEPALIVE_SECONDS, remaining))
+            if subscription.overflowed:
+                subscription.overflowed = False
+                frame, sent_id = await sync_to_async(_snapshot_frame)(broker)
+                yield frame
+            elif event is None:
+                yield ': keepalive\n\n'
+            elif event[0] > sent_id:
+                # Deltas still queued from before the last snapshot or replay would roll entries back
+                yield format_event('queue', event[1], format_event_id(broker, event[0]))
+    finally:
+        broker.unsubscribe(subscription)
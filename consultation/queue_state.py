@@ -0,0 +1,151 @@
+"""
+Queue state board.
+
+Per-day queue counts by status, for the whole hospital and for each
+consultant, kept in the cache and updated as queue entries change
+(consultation.signals applies every committed queue delta, see
+consultation.queue_events). Dashboards read them in one cache round trip:
+
+    board = get_board(consultant_id)
+    board.hospital['vitals_done'], board.consultant['with_doctor']
+    total(board.hospital, exclude=['cancelled'])
+
+Counts missing from the cache (cold start, eviction, a new day) are seeded
+from a single grouped query. Counters expire after COUNTER_SECONDS, so a
+change the board could not see (QuerySet.update(), a save racing the seeding)
+is corrected by the next seeding.
+
+The counters are only correct when every server process shares one cache
+(Redis, Memcached, the database cache). With Django's default per-process
+LocMemCache a change applied in one worker never reaches the others, so
+there the board is counted from the database on every read instead, as it
+was before the counters existed.
+
+get_consultant() caches which consultant a user is, so views no longer join
+staff profiles every time they need the logged-in doctor.
+"""
+from collections import Counter, defaultdict, namedtuple
+from datetime import date
+
+from django.core.cache import DEFAULT_CACHE_ALIAS, cache, caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.db.models import Count
+from django.utils import timezone
+
+from consultation.models import PatientQueueModel, ConsultantModel
+
+STATUSES = [status for status, _ in PatientQueueModel.QUEUE_STATUS]
+
+COUNTER_KEY = 'queue:count:{day}:{scope}:{status}'
+COUNTER_SECONDS = 300
+HOSPITAL = 'all'
+
+CONSULTANT_KEY = 'queue:consultant-of-user:{}'
+CONSULTANT_SECONDS = 600
+# Cached for users who are not consultants, so they are not looked up again either
+NOT_A_CONSULTANT = 0
+
+QueueBoard = namedtuple('QueueBoard', 'day hospital consultant')
+
+
+def _keys(day, scope):
+    return {status: COUNTER_KEY.format(day=day.isoformat(), scope=scope, status=status) for status in STATUSES}
+
+
+def count_queue(day):
+    """{scope: Counter(status)} for the day from the database; scope is HOSPITAL or a consultant id"""
+    rows = PatientQueueModel.objects.filter(joined_queue_at__date=day).order_by().values_list(
+        'consultant_id', 'status'
+    ).annotate(count=Count('id'))
+    counts = defaultdict(Counter)
+    for consultant_id, status, count in rows:
+        counts[HOSPITAL][status] += count
+        if consultant_id:
+            counts[consultant_id][status] += count
+    return counts
+
+
+def _counters_shared():
+    """False when the cache lives in each process's memory, where one worker's counter updates miss the others"""
+    return not isinstance(caches[DEFAULT_CACHE_ALIAS], LocMemCache)
+
+
+def _read(day, scopes):
+    if not _counters_shared():
+        counts = count_queue(day)
+        return {scope: {status: counts[scope][status] for status in STATUSES} for scope in scopes}
+    keys = {scope: _keys(day, scope) for scope in scopes}
+    cached = cache.get_many([key for scope_keys in keys.values() for key in scope_keys.values()])
+    if len(cached) < len(scopes) * len(STATUSES):
+        counts = count_queue(day)
+        cached = {
+            key: counts[scope][status]
+            for scope in set(scopes) | set(counts)
+            for status, key in _keys(day, scope).items()
+        }
+        cache.set_many(cached, COUNTER_SECONDS)
+    return {scope: {status: cached.get(key, 0) for status, key in keys[scope].items()} for scope in scopes}
+
+
+def get_board(consultant_id=None, day=None):
+    """Counts by status for the day (today by default), hospital-wide and for consultant_id when given"""
+    day = day or timezone.localdate()
+    scopes = [HOSPITAL] + ([consultant_id] if consultant_id else [])
+    counts = _read(day, scopes)
+    return QueueBoard(day, counts[HOSPITAL], counts[consultant_id] if consultant_id else None)
+
+
+def total(counts, exclude=()):
+    return sum(count for status, count in counts.items() if status not in exclude)
+
+
+def _add(day, consultant_id, status, amount):
+    if not _counters_shared():
+        return
+    for scope in [HOSPITAL] + ([consultant_id] if consultant_id else []):
+        try:
+            cache.incr(COUNTER_KEY.format(day=day.isoformat(), scope=scope, status=status), amount)
+        except ValueError:
+            # Not cached; the next read seeds it from the database
+            pass
+
+
+def apply_change(delta):
+    """Move one entry between counters, from a queue_events.queue_delta() payload"""
+    day = date.fromisoformat(delta['date'])
+    if delta['previous_status']:
+        _add(day, delta['previous_consultant_id'], delta['previous_status'], -1)
+    if delta['status']:
+        _add(day, delta['consultant_id'], delta['status'], 1)
+
+
+# ---------------------------------------------------------------------------
+# Which consultant a user is
+# ---------------------------------------------------------------------------
+
+def get_consultant_id(user):
+    """Id of the user's consultant profile, or None; cached for CONSULTANT_SECONDS"""
+    if not user.is_authenticated:
+        return None
+    key = CONSULTANT_KEY.format(user.pk)
+    consultant_id = cache.get(key)
+    if consultant_id is None:
+        consultant_id = ConsultantModel.objects.filter(
+            staff__staff_profile__user=user
+        ).values_list('id', flat=True).first() or NOT_A_CONSULTANT
+        cache.set(key, consultant_id, CONSULTANT_SECONDS)
+    return consultant_id or None
+
+
+def get_consultant(request):
+    """The logged-in user's ConsultantModel (or None), loaded once per request"""
+    if not hasattr(request, '_consultant'):
+        consultant_id = get_consultant_id(request.user)
+        request._consultant = ConsultantModel.objects.select_related(
+            'staff', 'specialization', 'assigned_room'
+        ).filter(pk=consultant_id).first() if consultant_id else None
+    return request._consultant
+
+
+def forget_consultant(user_ids):
+    cache.delete_many([CONSULTANT_KEY.format(user_id) for user_id in user_ids])
@@ -0,0 +1,62 @@
+from django.db import transaction
+from django.db.models.signals import post_init, post_save, post_delete, m2m_changed
+from django.dispatch import receiver
+
+from consultation import diagnosis_index
+from consultation.models import PatientQueueModel, ConsultantModel, DiagnosisOption
+from consultation.queue_events import queue_delta, publish
+from consultation.queue_state import apply_change, forget_consultant
+from human_resource.models import StaffProfileModel
+
+
+def _broadcast(payload):
+    apply_change(payload)
+    publish(payload)
+
+
+@receiver(post_init, sender=PatientQueueModel)
+def remember_queue_state(sender, instance, **kwargs):
+    """Keep the loaded status and consultant so a save can report what it changed"""
+    # __dict__ so a deferred field is not fetched just for this
+    instance._published_state = (instance.__dict__.get('status'), instance.__dict__.get('consultant_id'))
+
+
+@receiver(post_save, sender=PatientQueueModel)
+def publish_queue_change(sender, instance, created, raw=False, **kwargs):
+    """Broadcast queue transitions (start_vitals, complete_vitals, start_consultation, pause, complete...)"""
+    if raw:
+        return
+    previous_status, previous_consultant_id = (None, None) if created else instance._published_state
+    if not created and (instance.status, instance.consultant_id) == (previous_status, previous_consultant_id):
+        return
+    instance._published_state = (instance.status, instance.consultant_id)
+    payload = queue_delta(instance, previous_status, previous_consultant_id)
+    transaction.on_commit(lambda: _broadcast(payload))
+
+
+@receiver(post_delete, sender=PatientQueueModel)
+def publish_queue_removal(sender, instance, **kwargs):
+    status, consultant_id = instance._published_state
+    payload = queue_delta(instance, status, consultant_id, deleted=True)
+    transaction.on_commit(lambda: _broadcast(payload))
+
+
+@receiver(post_save, sender=ConsultantModel)
+@receiver(post_delete, sender=ConsultantModel)
+def forget_consultant_users(sender, instance, **kwargs):
+    """Drop the cached consultant of the user behind this consultant's staff record"""
+    forget_consultant(StaffProfileModel.objects.filter(staff_id=instance.staff_id).values_list('user_id', flat=True))
+
+
+@receiver(post_save, sender=StaffProfileModel)
+@receiver(post_delete, sender=StaffProfileModel)
+def forget_staff_profile_user(sender, instance, **kwargs):
+    forget_consultant([instance.user_id])
+
+
+@receiver(post_save, sender=DiagnosisOption)
+@receiver(post_delete, sender=DiagnosisOption)
+@receiver(m2m_changed, sender=DiagnosisOption.specializations.through)
+def invalidate_diagnosis_index(sender, **kwargs):
+    """Rebuild the diagnosis search index in every process once the change is committed"""
+    transaction.on_commit(diagnosis_index.invalidate)
@@ -152,6 +152,7 @@ urlpatterns = [
     path('ajax/patient-vitals/<int:queue_pk>/create', create_vitals_view, name='create_patient_vitals_ajax'),
     path('ajax/patient-vitals/<int:queue_pk>/update', update_patient_vitals_ajax, name='update_patient_vitals_ajax'),  # NEW
     path('ajax/queue-status/', queue_status_ajax, name='queue_status_ajax'),
+    path('queue/stream/', queue_event_stream, name='queue_event_stream'),
     path('ajax/specialization-fee/', get_specialization_fee_ajax, name='get_specialization_fee_ajax'),
     path('ajax/search-patients/', search_patients_ajax, name='search_patients_ajax'),
     path('ajax/assign-consultant/<int:queue_pk>/', assign_consultant_ajax, name='assign_consultant_ajax'),
@@ -241,6 +242,7 @@ urlpatterns = [
     path('service-result/<int:result_id>/view/', view_service_result, name='view_service_result'),
 
     path('ajax/search-diagnoses/', ajax_search_diagnoses, name='ajax_search_diagnoses'),
+    path('ajax/resolve-diagnoses/', ajax_resolve_diagnoses, name='ajax_resolve_diagnoses'),
     path('ajax/save-diagnosis/', ajax_save_diagnosis, name='ajax_save_diagnosis'),
     path('bulk-diagnosis-update/', bulk_diagnosis_update, name='bulk_diagnosis_update'),
 
@@ -6,10 +6,11 @@ from django.contrib import messages
 from django.contrib.auth.decorators import login_required, permission_required
 from django.contrib.auth.mixins import LoginRequiredMixin, PermissionRequiredMixin
 from django.contrib.messages.views import SuccessMessageMixin
-from django.core.exceptions import ValidationError
+from django.core.exceptions import ValidationError, PermissionDenied
 from django.core.paginator import Paginator
 from django.db import IntegrityError, transaction
-from django.http import JsonResponse, HttpResponseBadRequest, HttpResponse, HttpResponseRedirect
+from django.core.handlers.asgi import ASGIRequest
+from django.http import JsonResponse, HttpResponseBadRequest, HttpResponse, HttpResponseRedirect, StreamingHttpResponse, Http404
 from django.shortcuts import render, redirect, get_object_or_404
 from django.template.loader import render_to_string
 from django.urls import reverse, reverse_lazy
@@ -27,7 +28,13 @@ from finance.forms import PatientTransactionForm
 from consultation.models import PatientTransactionModel
 from laboratory.models import LabTestOrderModel, LabTestCategoryModel, LabTestTemplateModel, LabSettingModel, \
     ExternalLabTestOrder
-from patient.models import PatientModel
+from patient.models import PatientModel, InsufficientWalletBalance
+from patient.search import get_patient_by_card
+from admin_site.catalog import search_catalog, catalog_entries
+from consultation import diagnosis_index
+from consultation.queue_events import iter_events, aiter_events
+from consultation.queue_state import get_board, get_consultant, get_consultant_id, total
+from patient.timeline import get_events, records_for, InvalidCursor as InvalidTimelineCursor
 from human_resource.models import StaffModel
 from pharmacy.models import DrugOrderModel, DrugModel, ExternalPrescription
 from scan.models import ScanOrderModel, ScanCategoryModel, ScanTemplateModel, ExternalScanOrder
@@ -959,9 +966,14 @@ class ConsultationPaymentCreateView(LoginRequiredMixin, PermissionRequiredMixin,
             transaction_record.save()
             self.object = transaction_record
 
-            # 3. Update the wallet balance
-            patient.wallet.amount -= amount_to_pay
-            patient.wallet.save()
+            # 3. Deduct from the wallet and record the balances it actually moved between
+            entry = patient.wallet.debit(amount_to_pay, 'payment', user=self.request.user,
+                                         description='Consultation payment')
+            PatientTransactionModel.objects.filter(pk=transaction_record.pk).update(
+                old_balance=entry.balance_before, new_balance=entry.balance_after
+            )
+            transaction_record.old_balance = entry.balance_before
+            transaction_record.new_balance = entry.balance_after
 
             specialization = fee_structure.specialization
 
@@ -979,7 +991,13 @@ class ConsultationPaymentCreateView(LoginRequiredMixin, PermissionRequiredMixin,
             )
             return redirect(self.get_success_url())
 
+        except InsufficientWalletBalance:
+            transaction.set_rollback(True)
+            messages.error(self.request, 'Insufficient wallet balance.')
+            return self.form_invalid(form)
         except Exception as e:
+            # Nothing from a failed payment may commit, least of all the wallet debit
+            transaction.set_rollback(True)
             messages.error(self.request, f"An unexpected error occurred: {str(e)}")
             return self.form_invalid(form)
 
@@ -995,7 +1013,7 @@ def verify_patient_ajax(request):
 
     try:
         # Look up patient by patient_id (card number)
-        patient = PatientModel.objects.get(card_number__iexact=card_number)
+        patient = get_patient_by_card(card_number)
 
         # Get wallet balance
         wallet_balance = 0
@@ -1539,7 +1557,7 @@ class PatientQueueListView(LoginRequiredMixin, PermissionRequiredMixin, ListView
     context_object_name = "queue_list"
 
     def get_queryset(self):
-        today = date.today()
+        today = timezone.localdate()
         return PatientQueueModel.objects.select_related(
             'patient', 'consultant__staff', 'consultant__specialization'
         ).filter(
@@ -1548,8 +1566,19 @@ class PatientQueueListView(LoginRequiredMixin, PermissionRequiredMixin, ListView
             status='consultation_completed'
         ).order_by('priority_level', 'joined_queue_at')
 
+    def rows_only(self):
+        """?partial=rows renders just the table rows, fetched by the page when an entry joins the queue"""
+        return self.request.GET.get('partial') == 'rows'
+
+    def get_template_names(self):
+        if self.rows_only():
+            return ['consultation/queue/partials/queue_rows.html']
+        return super().get_template_names()
+
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
+        if self.rows_only():
+            return context
         context.update({
             'queue_stats': self.get_queue_stats(),
             'consultants_status': self.get_consultants_status(),
@@ -1558,19 +1587,14 @@ class PatientQueueListView(LoginRequiredMixin, PermissionRequiredMixin, ListView
 
     def get_queue_stats(self):
         """Get queue statistics"""
-        try:
-            today = date.today()
-            queue_today = PatientQueueModel.objects.filter(joined_queue_at__date=today)
-
-            return {
-                'waiting_vitals': queue_today.filter(status='waiting_vitals').count(),
-                'vitals_done': queue_today.filter(status='vitals_done').count(),
-                'with_doctor': queue_today.filter(status='with_doctor').count(),
-                'completed': queue_today.filter(status='consultation_completed').count(),
-                'total': queue_today.count(),
-            }
-        except Exception:
-            return {'waiting_vitals': 0, 'vitals_done': 0, 'with_doctor': 0, 'completed': 0, 'total': 0}
+        counts = get_board().hospital
+        return {
+            'waiting_vitals': counts['waiting_vitals'],
+            'vitals_done': counts['vitals_done'],
+            'with_doctor': counts['with_doctor'],
+            'completed': counts['consultation_completed'],
+            'total': total(counts),
+        }
 
     def get_consultants_status(self):
         """Get consultant availability status"""
@@ -1838,11 +1862,15 @@ class DoctorQueueListView(LoginRequiredMixin, PermissionRequiredMixin, ListView)
     template_name = 'consultation/queue/doctor_index.html'
     context_object_name = "queue_list"
 
+    def get_consultant(self):
+        """Consultant profile of the current user if they are a doctor available for consultation"""
+        consultant = get_consultant(self.request)
+        return consultant if consultant and consultant.is_available_for_consultation else None
+
     def get_queryset(self):
         today = date.today()
-        # Get consultant profile for current user if they are a doctor
-        try:
-            consultant = ConsultantModel.objects.filter(staff__staff_profile__user=self.request.user, is_available_for_consultation=True).first()
+        consultant = self.get_consultant()
+        if consultant:
             return PatientQueueModel.objects.select_related(
                 'patient', 'consultant__staff', 'vitals'
             ).filter(
@@ -1850,60 +1878,48 @@ class DoctorQueueListView(LoginRequiredMixin, PermissionRequiredMixin, ListView)
                 consultant=consultant,
                 status__in=['vitals_done', 'consultation_paused']
             ).order_by('priority_level', 'joined_queue_at')
-        except ConsultantModel.DoesNotExist:
-            # If user is not a consultant, show all patients (for admin/nurses)
-            return PatientQueueModel.objects.select_related(
-                'patient', 'consultant__staff', 'vitals'
-            ).filter(
-                joined_queue_at__date=today,
-                status__in=['vitals_done', 'consultation_paused', 'with_doctor']
-            ).order_by('priority_level', 'joined_queue_at')
+
+        # If user is not a consultant, show all patients (for admin/nurses)
+        return PatientQueueModel.objects.select_related(
+            'patient', 'consultant__staff', 'vitals'
+        ).filter(
+            joined_queue_at__date=today,
+            status__in=['vitals_done', 'consultation_paused', 'with_doctor']
+        ).order_by('priority_level', 'joined_queue_at')
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        try:
-            consultant = ConsultantModel.objects.filter(staff__staff_profile__user=self.request.user,
-                                                        is_available_for_consultation=True).first()
-
-            context['is_consultant'] = True
+        consultant = self.get_consultant()
+        context['is_consultant'] = consultant is not None
+        if consultant:
             context['consultant'] = consultant
-        except ConsultantModel.DoesNotExist:
-            context['is_consultant'] = False
 
         context['queue_stats'] = self.get_doctor_queue_stats()
         return context
 
     def get_doctor_queue_stats(self):
         """Get doctor-specific queue statistics"""
-        try:
-            today = date.today()
-            consultant = ConsultantModel.objects.filter(staff__staff_profile__user=self.request.user,
-                                                        is_available_for_consultation=True).first()
-
-            queue_today = PatientQueueModel.objects.filter(
-                joined_queue_at__date=today,
-                consultant=consultant
-            )
-
-            return {
-                'waiting_for_me': queue_today.filter(status='vitals_done').count(),
-                'currently_with_me': queue_today.filter(status='with_doctor').count(),
-                'paused': queue_today.filter(status='consultation_paused').count(),
-                'completed_today': queue_today.filter(status='consultation_completed').count(),
-                'total_today': queue_today.count(),
-            }
-        except ConsultantModel.DoesNotExist:
-            # For non-consultants (admin/nurses)
-            today = date.today()
-            queue_today = PatientQueueModel.objects.filter(joined_queue_at__date=today)
+        consultant = self.get_consultant()
+        if consultant:
+            counts = get_board(consultant.id).consultant
             return {
-                'waiting_for_doctor': queue_today.filter(status='vitals_done').count(),
-                'with_doctors': queue_today.filter(status='with_doctor').count(),
-                'paused': queue_today.filter(status='consultation_paused').count(),
-                'completed_today': queue_today.filter(status='consultation_completed').count(),
-                'total_today': queue_today.count(),
+                'waiting_for_me': counts['vitals_done'],
+                'currently_with_me': counts['with_doctor'],
+                'paused': counts['consultation_paused'],
+                'completed_today': counts['consultation_completed'],
+                'total_today': total(counts),
             }
 
+        # For non-consultants (admin/nurses)
+        counts = get_board().hospital
+        return {
+            'waiting_for_doctor': counts['vitals_done'],
+            'with_doctors': counts['with_doctor'],
+            'paused': counts['consultation_paused'],
+            'completed_today': counts['consultation_completed'],
+            'total_today': total(counts),
+        }
+
 
 @login_required
 @permission_required('consultation.add_consultationsessionmodel')
@@ -2349,44 +2365,40 @@ class ConsultationDashboardView(LoginRequiredMixin, PermissionRequiredMixin, Tem
         today = date.today()
 
         # Get consultant-specific data if user is a consultant
-        try:
-            consultant = ConsultantModel.objects.get(staff__user=self.request.user)
+        consultant = get_consultant(self.request)
+        board = get_board(consultant.id if consultant else None)
+        if consultant:
             context.update({
                 'is_consultant': True,
                 'consultant': consultant,
-                'today_stats': self.get_consultant_today_stats(consultant),
+                'today_stats': self.get_consultant_today_stats(consultant, board.consultant),
                 'this_week_stats': self.get_consultant_week_stats(consultant),
                 'recent_consultations': self.get_recent_consultations(consultant),
             })
-        except ConsultantModel.DoesNotExist:
+        else:
             # Admin/general dashboard
             context.update({
                 'is_consultant': False,
-                'overall_stats': self.get_overall_stats(),
+                'overall_stats': self.get_overall_stats(board.hospital),
                 'consultant_performance': self.get_consultant_performance(),
                 'revenue_stats': self.get_revenue_stats(),
             })
 
         context.update({
-            'queue_overview': self.get_queue_overview(),
+            'queue_overview': self.get_queue_overview(board.hospital),
             'pending_payments': self.get_pending_payments_count(),
         })
 
         return context
 
-    def get_consultant_today_stats(self, consultant):
+    def get_consultant_today_stats(self, consultant, counts):
         """Get today's statistics for a specific consultant"""
         today = date.today()
-        queue_today = PatientQueueModel.objects.filter(
-            consultant=consultant,
-            joined_queue_at__date=today
-        )
-
         return {
-            'total_patients': queue_today.count(),
-            'completed': queue_today.filter(status='consultation_completed').count(),
-            'in_progress': queue_today.filter(status='with_doctor').count(),
-            'waiting': queue_today.filter(status='vitals_done').count(),
+            'total_patients': total(counts),
+            'completed': counts['consultation_completed'],
+            'in_progress': counts['with_doctor'],
+            'waiting': counts['vitals_done'],
             'revenue': PatientTransactionModel.objects.filter(
                 created_at__date=today,
                 transaction_type='consultation_payment',
@@ -2416,17 +2428,15 @@ class ConsultationDashboardView(LoginRequiredMixin, PermissionRequiredMixin, Tem
             status='completed'
         ).select_related('queue_entry__patient').order_by('-completed_at')[:5]
 
-    def get_overall_stats(self):
+    def get_overall_stats(self, counts):
         """Get overall hospital consultation statistics"""
         today = date.today()
         week_start = today - timedelta(days=7)
 
         return {
             'today': {
-                'total_patients': PatientQueueModel.objects.filter(joined_queue_at__date=today).count(),
-                'completed': PatientQueueModel.objects.filter(
-                    joined_queue_at__date=today, status='consultation_completed'
-                ).count(),
+                'total_patients': total(counts),
+                'completed': counts['consultation_completed'],
                 'revenue': PatientTransactionModel.objects.filter(
                     created_at__date=today,
                     status='completed',
@@ -2480,16 +2490,13 @@ class ConsultationDashboardView(LoginRequiredMixin, PermissionRequiredMixin, Tem
             ).aggregate(total=Sum('amount'))['total'] or 0,
         }
 
-    def get_queue_overview(self):
+    def get_queue_overview(self, counts):
         """Get current queue overview"""
-        today = date.today()
-        queue_today = PatientQueueModel.objects.filter(joined_queue_at__date=today)
-
         return {
-            'waiting_vitals': queue_today.filter(status='waiting_vitals').count(),
-            'vitals_done': queue_today.filter(status='vitals_done').count(),
-            'with_doctor': queue_today.filter(status='with_doctor').count(),
-            'completed': queue_today.filter(status='consultation_completed').count(),
+            'waiting_vitals': counts['waiting_vitals'],
+            'vitals_done': counts['vitals_done'],
+            'with_doctor': counts['with_doctor'],
+            'completed': counts['consultation_completed'],
         }
 
     def get_pending_payments_count(self):
@@ -2577,45 +2584,21 @@ def get_patient_vitals_ajax(request, queue_pk):
 def queue_status_ajax(request):
     """AJAX endpoint for live queue status updates"""
     try:
-        today = date.today()
+        board = get_board(get_consultant_id(request.user))
         queue_stats = {
-            'waiting_vitals': PatientQueueModel.objects.filter(
-                joined_queue_at__date=today, status='waiting_vitals'
-            ).count(),
-            'vitals_done': PatientQueueModel.objects.filter(
-                joined_queue_at__date=today, status='vitals_done'
-            ).count(),
-            'with_doctor': PatientQueueModel.objects.filter(
-                joined_queue_at__date=today, status='with_doctor'
-            ).count(),
-            'completed': PatientQueueModel.objects.filter(
-                joined_queue_at__date=today, status='consultation_completed'
-            ).count(),
+            'waiting_vitals': board.hospital['waiting_vitals'],
+            'vitals_done': board.hospital['vitals_done'],
+            'with_doctor': board.hospital['with_doctor'],
+            'completed': board.hospital['consultation_completed'],
         }
 
         # Get consultant-specific stats if user is a consultant
-        try:
-            consultant = ConsultantModel.objects.get(staff__user=request.user)
-            consultant_stats = {
-                'my_waiting': PatientQueueModel.objects.filter(
-                    joined_queue_at__date=today,
-                    consultant=consultant,
-                    status='vitals_done'
-                ).count(),
-                'my_current': PatientQueueModel.objects.filter(
-                    joined_queue_at__date=today,
-                    consultant=consultant,
-                    status='with_doctor'
-                ).count(),
-                'my_completed': PatientQueueModel.objects.filter(
-                    joined_queue_at__date=today,
-                    consultant=consultant,
-                    status='consultation_completed'
-                ).count(),
-            }
-            queue_stats.update(consultant_stats)
-        except ConsultantModel.DoesNotExist:
-            pass
+        if board.consultant is not None:
+            queue_stats.update({
+                'my_waiting': board.consultant['vitals_done'],
+                'my_current': board.consultant['with_doctor'],
+                'my_completed': board.consultant['consultation_completed'],
+            })
 
         return JsonResponse(queue_stats)
 
@@ -2623,6 +2606,25 @@ def queue_status_ajax(request):
         return JsonResponse({'error': str(e)}, status=500)
 
 
+@login_required
+def queue_event_stream(request):
+    """Server-sent events with live queue changes for nurse and doctor screens (see consultation.queue_events)"""
+    if not (request.user.has_perm('consultation.view_patientqueuemodel')
+            or request.user.has_perm('consultation.add_consultationsessionmodel')):
+        raise PermissionDenied
+
+    last_event_id = request.headers.get('Last-Event-ID')
+
+    # Under ASGI waiting for changes holds no worker thread. Under WSGI every open nurse or doctor
+    # screen holds one worker thread for up to STREAM_SECONDS (five minutes) per connection, so the
+    # WSGI server needs a thread per screen on top of its normal load; run ASGI for more than a few.
+    events = aiter_events(last_event_id) if isinstance(request, ASGIRequest) else iter_events(last_event_id)
+    response = StreamingHttpResponse(events, content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
 @login_required
 def get_specialization_fee_ajax(request):
     """AJAX endpoint to get consultation fee by specialization"""
@@ -3119,10 +3121,9 @@ def search_patients_ajax(request):
 def doctor_dashboard(request):
     """Doctor's main dashboard view"""
 
-    try:
-        # Get the consultant profile for the logged-in user
-        consultant = get_object_or_404(ConsultantModel, staff__staff_profile__user=request.user)
-    except Exception:
+    # Get the consultant profile for the logged-in user
+    consultant = get_consultant(request)
+    if consultant is None:
         messages.error(request, "You are not authorized to access the doctor dashboard.")
         fallback_url = reverse('admin_dashboard')
         redirect_url = request.META.get('HTTP_REFERER', fallback_url)
@@ -3141,11 +3142,12 @@ def doctor_dashboard(request):
         'consultation'  # <-- THIS IS THE FIX
     ).order_by('priority_level', 'joined_queue_at')
 
+    counts = get_board(consultant.id).consultant
     today_stats = {
-        'total_queue': my_queue.count(),
-        'completed': my_queue.filter(status='consultation_completed').count(),
-        'waiting': my_queue.filter(status='vitals_done').count(),
-        'in_consultation': my_queue.filter(status='with_doctor').count(),
+        'total_queue': total(counts, exclude=['cancelled']),
+        'completed': counts['consultation_completed'],
+        'waiting': counts['vitals_done'],
+        'in_consultation': counts['with_doctor'],
     }
 
     # Get current consultation (if any)
@@ -3398,27 +3400,31 @@ def consultation_history(request):
     return render(request, 'consultation/doctor/history.html', context)
 
 
-@login_required
-@permission_required('consultation.add_consultationsessionmodel', raise_exception=True)
-def patient_history_view(request, patient_id):
-    """Renders the initial patient history page."""
-    patient = get_object_or_404(PatientModel, id=patient_id)
+HISTORY_PAGE_SIZE = 6
+# Records per page of the doctor's prescription and test result lists
+TIMELINE_PAGE_SIZE = 50
 
-    all_consultations = ConsultationSessionModel.objects.filter(
-        Q(queue_entry__patient=patient) | Q(admission__patient=patient)
-    ).order_by('-created_at').prefetch_related(
+
+def get_consultation_history_page(patient, cursor=None):
+    """
+    A page of the patient's consultations, newest first, read from the clinical
+    timeline. Returns (consultations, next_cursor). Each consultation gets
+    all_lab_orders / all_scan_orders, which for ward rounds include the
+    admission's orders that were not placed from a consultation.
+    """
+    events, next_cursor = get_events(patient, kinds=['consultation'], cursor=cursor, limit=HISTORY_PAGE_SIZE)
+
+    consultations = records_for(events, ConsultationSessionModel.objects.select_related(
+        'queue_entry', 'queue_entry__vitals'
+    ).prefetch_related(
         'drug_consultation_order',
         'external_prescriptions',
         'lab_consultation_order',
         'scan_consultation_order'
-    )
-
-    # Collect admission IDs from inpatient consultations
-    admission_ids = [
-        c.admission_id for c in all_consultations if c.admission_id
-    ]
+    ))
 
-    # Fetch admission-linked orders that have no consultation set
+    # Fetch admission-linked orders that have no consultation set, for the admissions on this page only
+    admission_ids = {c.admission_id for c in consultations if c.admission_id}
     orphan_labs = defaultdict(list)
     orphan_scans = defaultdict(list)
 
@@ -3434,62 +3440,53 @@ def patient_history_view(request, patient_id):
             orphan_scans[order.admission_id].append(order)
 
     # Attach merged orders to each consultation to avoid extra queries in template
-    for consultation in all_consultations:
+    for consultation in consultations:
         consultation.all_lab_orders = list(consultation.lab_consultation_order.all())
         consultation.all_scan_orders = list(consultation.scan_consultation_order.all())
 
         if consultation.admission_id:
-            # Merge orphan orders, avoiding duplicates by ID
-            existing_lab_ids = {o.id for o in consultation.all_lab_orders}
-            existing_scan_ids = {o.id for o in consultation.all_scan_orders}
-
-            consultation.all_lab_orders += [
-                o for o in orphan_labs[consultation.admission_id]
-                if o.id not in existing_lab_ids
-            ]
-            consultation.all_scan_orders += [
-                o for o in orphan_scans[consultation.admission_id]
-                if o.id not in existing_scan_ids
-            ]
-
-    paginator = Paginator(all_consultations, 6)
-    page_obj = paginator.get_page(1)
+            consultation.all_lab_orders += orphan_labs[consultation.admission_id]
+            consultation.all_scan_orders += orphan_scans[consultation.admission_id]
+
+    return consultations, next_cursor
+
+
+@login_required
+@permission_required('consultation.add_consultationsessionmodel', raise_exception=True)
+def patient_history_view(request, patient_id):
+    """Renders the initial patient history page."""
+    patient = get_object_or_404(PatientModel, id=patient_id)
+    consultations, next_cursor = get_consultation_history_page(patient)
 
     context = {
         'patient': patient,
-        'consultations_page': page_obj,
+        'consultations_page': consultations,
+        'next_cursor': next_cursor,
     }
     return render(request, 'consultation/history/patient_history.html', context)
 
 
+@login_required
+@permission_required('consultation.add_consultationsessionmodel', raise_exception=True)
 def patient_history_ajax(request, patient_id):
-    """Handles AJAX requests for subsequent pages of patient history."""
+    """Handles AJAX requests for older pages of patient history (?cursor= from the previous page)."""
     patient = get_object_or_404(PatientModel, id=patient_id)
-    page_number = request.GET.get('page', 1)
-
-    all_consultations = ConsultationSessionModel.objects.filter(
-        queue_entry__patient=patient,
-        status='completed'
-    ).order_by('-created_at').prefetch_related(
-        'drug_consultation_order',
-        'external_prescriptions',
-        'lab_consultation_order',
-        'scan_consultation_order'
-    )
-
-    paginator = Paginator(all_consultations, 3)
-    page_obj = paginator.get_page(page_number)
+    try:
+        consultations, next_cursor = get_consultation_history_page(patient, request.GET.get('cursor') or None)
+    except InvalidTimelineCursor as e:
+        return JsonResponse({'error': str(e)}, status=400)
 
     # Render just the partial template with the new consultations
     html = render_to_string(
         'consultation/history/partials/consultation_block.html',
-        {'consultations_page': page_obj},
+        {'consultations_page': consultations},
         request=request
     )
 
     return JsonResponse({
         'html': html,
-        'has_next': page_obj.has_next()
+        'has_next': next_cursor is not None,
+        'next_cursor': next_cursor,
     })
 
 
@@ -3750,28 +3747,21 @@ def ajax_search_drugs(request):
         if len(query) < 2:
             return JsonResponse({'drugs': []})
 
-        # Ensure you select related all the way to the generic drug
-        drugs = DrugModel.objects.filter(
-            Q(brand_name__icontains=query) |
-            Q(formulation__generic_drug__generic_name__icontains=query),
-            is_active=True
-        ).select_related('formulation__generic_drug', 'manufacturer')[:20]
-
+        # The catalog index carries the names, stock and last cost price, so no drug rows are loaded
         drugs_data = []
-        for drug in drugs:
-
+        for entry, _ in search_catalog(query, ['drug'], limit=20):
             drugs_data.append({
-                'id': drug.id,
-                'brand_name': drug.__str__(),
-                'generic_name': drug.formulation.generic_drug.generic_name,
-                'pharmacy_quantity': drug.pharmacy_quantity,
-                'formulation': str(drug.formulation),
-                'manufacturer': drug.manufacturer.name if drug.manufacturer else '',
-                'last_cost_price': drug.last_cost_price if drug.last_cost_price else 0,
-                'pack_size': drug.pack_size,
-                'unit': drug.formulation.form_type,
-                'price': float(drug.selling_price),
-                'is_prescription_only': drug.formulation.generic_drug.is_prescription_only
+                'id': entry.object_id,
+                'brand_name': entry.name,
+                'generic_name': entry.data['generic_name'],
+                'pharmacy_quantity': entry.stock,
+                'formulation': entry.data['formulation'],
+                'manufacturer': entry.data['manufacturer'],
+                'last_cost_price': entry.cost_price or 0,
+                'pack_size': entry.data['pack_size'],
+                'unit': entry.data['unit'],
+                'price': float(entry.price),
+                'is_prescription_only': entry.data['is_prescription_only']
             })
 
         return JsonResponse({'drugs': drugs_data})
@@ -3811,21 +3801,15 @@ def ajax_drug_search_consult(request):
         if len(query) < 2:
             return JsonResponse({'drugs': []})
 
-        drugs = DrugModel.objects.filter(
-            Q(brand_name__icontains=query) | Q(formulation__generic_drug__generic_name__icontains=query),
-            is_active=True,
-            pharmacy_quantity__gt=0
-        ).select_related('formulation__generic_drug')[:15]
-
         drugs_data = [{
-            'id': drug.id,
-            'brand_name': drug.brand_name,
-            'generic_name': drug.generic_name,
-            'formulation': str(drug.formulation),
-            'pharmacy_quantity': float(drug.pharmacy_quantity),
-            'pack_size': drug.pack_size or 1,
-            'unit': drug.formulation.form_type if drug.formulation else 'tablet'
-        } for drug in drugs]
+            'id': entry.object_id,
+            'brand_name': entry.data['brand_name'],
+            'generic_name': entry.data['generic_name'],
+            'formulation': entry.data['formulation'],
+            'pharmacy_quantity': float(entry.stock),
+            'pack_size': entry.data['pack_size'] or 1,
+            'unit': entry.data['unit'] or 'tablet'
+        } for entry, _ in search_catalog(query, ['drug'], in_stock=True, limit=15)]
 
         return JsonResponse({'drugs': drugs_data})
 
@@ -4042,18 +4026,15 @@ def ajax_lab_templates_search(request):
         category_id = request.GET.get('category_id')
 
         # CHANGED: Remove is_active filter - show ALL templates
-        templates = LabTestTemplateModel.objects.all()
-
-        if category_id:
-            templates = templates.filter(category_id=category_id)
-
         if len(query) >= 2:
-            templates = templates.filter(name__icontains=query)
-
-        templates = templates.order_by('name')[:15]
+            templates = [entry for entry, _ in search_catalog(
+                query, ['lab_test'], category_id, active_only=False, limit=15
+            )]
+        else:
+            templates = catalog_entries(['lab_test'], category_id, active_only=False).order_by('name')[:15]
 
         templates_data = [{
-            'id': t.id,
+            'id': t.object_id,
             'name': t.name,
             'price': float(t.price),
             'is_active': t.is_active,  # NEW: Add is_active status
@@ -4073,18 +4054,15 @@ def ajax_imaging_templates_search(request):
         category_id = request.GET.get('category_id')
 
         # CHANGED: Remove is_active filter - show ALL templates
-        templates = ScanTemplateModel.objects.all()
-
-        if category_id:
-            templates = templates.filter(category_id=category_id)
-
         if len(query) >= 2:
-            templates = templates.filter(name__icontains=query)
-
-        templates = templates.order_by('name')[:15]
+            templates = [entry for entry, _ in search_catalog(
+                query, ['scan'], category_id, active_only=False, limit=15
+            )]
+        else:
+            templates = catalog_entries(['scan'], category_id, active_only=False).order_by('name')[:15]
 
         templates_data = [{
-            'id': t.id,
+            'id': t.object_id,
             'name': t.name,
             'price': float(t.price),
             'is_active': t.is_active,  # NEW: Add is_active status
@@ -4348,26 +4326,23 @@ def patient_history(request, patient_id):
         consultant = get_object_or_404(ConsultantModel, staff__user_staff_profile__user=request.user)
         patient = get_object_or_404(PatientModel, id=patient_id)
 
-        # Get all consultations for this patient
-        consultations = ConsultationSessionModel.objects.filter(
-            queue_entry__patient=patient,
-            status='completed'
-        ).select_related('queue_entry').order_by('-created_at')
+        # Latest records of each kind, read from the patient's clinical timeline
+        completed_consultations = ConsultationSessionModel.objects.filter(
+            queue_entry__isnull=False, status='completed'
+        )
+        consultation_events, _ = get_events(
+            patient, kinds=['consultation'], limit=TIMELINE_PAGE_SIZE, records=completed_consultations
+        )
+        consultations = records_for(consultation_events, completed_consultations.select_related('queue_entry'))
 
-        # Get prescriptions
-        prescriptions = DrugOrderModel.objects.filter(
-            patient=patient
-        ).select_related('drug').order_by('-ordered_at')[:20]
+        prescription_events, _ = get_events(patient, kinds=['drug_order'], limit=20)
+        prescriptions = records_for(prescription_events, DrugOrderModel.objects.select_related('drug'))
 
-        # Get lab tests
-        lab_tests = LabTestOrderModel.objects.filter(
-            patient=patient
-        ).select_related('template').order_by('-ordered_at')[:20]
+        lab_events, _ = get_events(patient, kinds=['lab_order'], limit=20)
+        lab_tests = records_for(lab_events, LabTestOrderModel.objects.select_related('template'))
 
-        # Get scans
-        scans = ScanOrderModel.objects.filter(
-            patient=patient
-        ).select_related('template').order_by('-ordered_at')[:20]
+        scan_events, _ = get_events(patient, kinds=['scan_order'], limit=20)
+        scans = records_for(scan_events, ScanOrderModel.objects.select_related('template'))
 
         context = {
             'consultant': consultant,
@@ -4392,14 +4367,16 @@ def patient_prescriptions(request, patient_id):
         consultant = get_object_or_404(ConsultantModel, staff__staff_profile__user=request.user)
         patient = get_object_or_404(PatientModel, id=patient_id)
 
-        prescriptions = DrugOrderModel.objects.filter(
-            patient=patient
-        ).select_related('drug', 'ordered_by').order_by('-ordered_at')
+        events, next_cursor = get_events(
+            patient, kinds=['drug_order'], cursor=request.GET.get('cursor') or None, limit=TIMELINE_PAGE_SIZE
+        )
+        prescriptions = records_for(events, DrugOrderModel.objects.select_related('drug', 'ordered_by'))
 
         context = {
             'consultant': consultant,
             'patient': patient,
             'prescriptions': prescriptions,
+            'next_cursor': next_cursor,
         }
 
         return render(request, 'consultation/doctor/patient_prescriptions.html', context)
@@ -4417,21 +4394,26 @@ def patient_test_results(request, patient_id):
         consultant = get_object_or_404(ConsultantModel, staff__user=request.user)
         patient = get_object_or_404(PatientModel, id=patient_id)
 
-        # Get lab tests with results
-        lab_tests = LabTestOrderModel.objects.filter(
-            patient=patient
-        ).select_related('template').prefetch_related('result').order_by('-ordered_at')
-
-        # Get scans with results
-        scans = ScanOrderModel.objects.filter(
-            patient=patient
-        ).select_related('template').prefetch_related('result').order_by('-ordered_at')
+        # Lab tests and scans share one page of the timeline, newest first
+        events, next_cursor = get_events(
+            patient, kinds=['lab_order', 'scan_order'], cursor=request.GET.get('cursor') or None,
+            limit=TIMELINE_PAGE_SIZE
+        )
+        lab_tests = records_for(
+            [event for event in events if event.kind == 'lab_order'],
+            LabTestOrderModel.objects.select_related('template', 'result')
+        )
+        scans = records_for(
+            [event for event in events if event.kind == 'scan_order'],
+            ScanOrderModel.objects.select_related('template', 'result')
+        )
 
         context = {
             'consultant': consultant,
             'patient': patient,
             'lab_tests': lab_tests,
             'scans': scans,
+            'next_cursor': next_cursor,
         }
 
         return render(request, 'doctor/patient_test_results.html', context)
@@ -5232,21 +5214,13 @@ def ajax_search_services(request):
     if len(query) < 2:
         return JsonResponse({'templates': []})  # Use 'templates' key for consistency
 
-    queryset = Service.objects.filter(
-        Q(name__icontains=query) | Q(description__icontains=query),
-        is_active=True
-    ).select_related('category')
-
-    if category_id:
-        queryset = queryset.filter(category_id=category_id)
-
     services = []
-    for service in queryset[:10]:
+    for entry, _ in search_catalog(query, ['service'], category_id, limit=10):
         services.append({
-            'id': service.id,
-            'name': f"{service.name} ({service.category.name})",
-            'price': service.price,
-            'has_results': service.has_results,
+            'id': entry.object_id,
+            'name': f"{entry.name} ({entry.detail})",
+            'price': entry.price,
+            'has_results': entry.data['has_results'],
             'is_active': True  # Mimics lab/scan template
         })
 
@@ -5264,20 +5238,12 @@ def ajax_search_service_items(request):
     if len(query) < 2:
         return JsonResponse({'templates': []})  # Use 'templates' key for consistency
 
-    queryset = ServiceItem.objects.filter(
-        Q(name__icontains=query) | Q(description__icontains=query),
-        is_active=True,
-    ).select_related('category')
-
-    if category_id:
-        queryset = queryset.filter(category_id=category_id)
-
     items = []
-    for item in queryset[:10]:
+    for entry, _ in search_catalog(query, ['service_item'], category_id, limit=10):
         items.append({
-            'id': item.id,
-            'name': f"{item.name} ({item.category.name}) - Stock: {item.stock_quantity}",
-            'price': item.price,
+            'id': entry.object_id,
+            'name': f"{entry.name} ({entry.detail}) - Stock: {entry.stock:g}",
+            'price': entry.price,
             'is_active': True  # Mimics lab/scan template
         })
 
@@ -5411,31 +5377,64 @@ def view_service_result(request, result_id):
 @login_required
 @require_http_methods(["GET"])
 def ajax_search_diagnoses(request):
-    """AJAX endpoint for diagnosis search"""
+    """AJAX endpoint for diagnosis search by name or ICD code, answered from the in-process diagnosis index"""
     query = request.GET.get('q', '').strip()
     specialization_id = request.GET.get('specialization_id', None)
 
     if len(query) < 2:
         return JsonResponse({'diagnoses': []})
 
-    diagnoses = DiagnosisOption.objects.filter(
-        is_active=True,
-        name__icontains=query
-    )
+    if specialization_id and not specialization_id.isdigit():
+        return JsonResponse({'error': 'Invalid specialization_id'}, status=400)
 
-    # Filter by specialization if provided
-    if specialization_id:
-        diagnoses = diagnoses.filter(specializations__id=specialization_id)
+    diagnoses = diagnosis_index.search(query, specialization_id)
+    return JsonResponse({'diagnoses': [diagnosis_index.serialize_entry(entry) for entry in diagnoses]})
 
-    diagnoses = diagnoses.distinct()[:20]  # Limit results
 
-    results = [{
-        'id': diag.id,
-        'name': diag.name,
-        'icd_code': diag.icd_code or ''
-    } for diag in diagnoses]
+@login_required
+@require_http_methods(["GET", "POST"])
+def ajax_resolve_diagnoses(request):
+    """
+    Map many diagnosis names or ICD codes to diagnoses in one call.
+    GET ?value= (repeatable) or POST {"values": [...]}; returns {"results": {value: diagnosis or null}}
+    """
+    if request.method == 'POST':
+        try:
+            values = json.loads(request.body).get('values')
+        except (ValueError, AttributeError):
+            return JsonResponse({'error': 'Invalid JSON body'}, status=400)
+    else:
+        values = request.GET.getlist('value')
 
-    return JsonResponse({'diagnoses': results})
+    if not isinstance(values, list) or not all(isinstance(value, str) for value in values):
+        return JsonResponse({'error': 'values must be a list of names or ICD codes'}, status=400)
+    if len(values) > diagnosis_index.MAX_RESOLVE_VALUES:
+        return JsonResponse(
+            {'error': f'At most {diagnosis_index.MAX_RESOLVE_VALUES} values can be resolved at once'}, status=400
+        )
+
+    resolved = diagnosis_index.resolve(values)
+    return JsonResponse({'results': {
+        value: diagnosis_index.serialize_entry(entry) if entry else None for value, entry in resolved.items()
+    }})
+
+
+def _diagnosis_id(diagnosis_id):
+    """
+    The id of the DiagnosisOption diagnosis_id, or Http404. The index can lag
+    behind the table, so the id is confirmed in the database before it is
+    written: a diagnosis deleted since the index was built is not found, and
+    one added since is.
+    """
+    entry = diagnosis_index.get_entry(diagnosis_id)
+    if entry is not None:
+        diagnosis_id = entry.id
+    try:
+        if DiagnosisOption.objects.filter(pk=int(diagnosis_id)).exists():
+            return int(diagnosis_id)
+    except (TypeError, ValueError):
+        pass
+    raise Http404('No DiagnosisOption matches the given query.')
 
 
 @login_required
@@ -5449,6 +5448,13 @@ def ajax_save_diagnosis(request):
         diagnosis_id = data.get('diagnosis_id')
         removed_id = data.get('removed_id')
 
+        # A diagnosis may also be given by name or ICD code
+        if not diagnosis_id and not removed_id and data.get('diagnosis'):
+            entry = diagnosis_index.resolve([data['diagnosis']])[data['diagnosis']]
+            if entry is None:
+                return JsonResponse({'success': False, 'error': 'Unknown diagnosis'}, status=404)
+            diagnosis_id = entry.id
+
         consultation = get_object_or_404(ConsultationSessionModel, id=consultation_id)
 
         # Check permissions (doctor owns this consultation)
@@ -5462,24 +5468,25 @@ def ajax_save_diagnosis(request):
                 consultation.secondary_diagnoses.clear()  # Clear all secondary when primary is removed
                 message = 'Primary diagnosis removed'
             else:
-                diagnosis = get_object_or_404(DiagnosisOption, id=removed_id)
-                consultation.secondary_diagnoses.remove(diagnosis)
+                consultation.secondary_diagnoses.remove(_diagnosis_id(removed_id))
                 message = 'Secondary diagnosis removed'
         else:
             # Add diagnosis
-            diagnosis = get_object_or_404(DiagnosisOption, id=diagnosis_id)
+            diagnosis_id = _diagnosis_id(diagnosis_id)
 
             if diag_type == 'primary':
-                consultation.primary_diagnosis = diagnosis
+                consultation.primary_diagnosis_id = diagnosis_id
                 message = 'Primary diagnosis saved'
             else:
-                consultation.secondary_diagnoses.add(diagnosis)
+                consultation.secondary_diagnoses.add(diagnosis_id)
                 message = 'Secondary diagnosis added'
 
         consultation.save()
 
         return JsonResponse({'success': True, 'message': message})
 
+    except Http404 as e:
+        return JsonResponse({'success': False, 'error': str(e)}, status=404)
     except Exception as e:
         return JsonResponse({'success': False, 'error': str(e)}, status=500)
 
@@ -5534,7 +5541,13 @@ def bulk_diagnosis_update(request):
     if not show_all:
         consultations = consultations.filter(primary_diagnosis__isnull=True)
 
-    consultations = consultations.order_by('-created_at')
+    consultations = list(consultations.order_by('-created_at'))
+
+    # Suggest the diagnosis whose name or ICD code the free-text diagnosis already is
+    suggestions = diagnosis_index.resolve({c.diagnosis.strip() for c in consultations if c.diagnosis})
+    for consultation in consultations:
+        suggested = suggestions.get((consultation.diagnosis or '').strip())
+        consultation.suggested_diagnosis = suggested if suggested and suggested.is_active else None
 
     # Get all specializations for filter dropdown
     specializations = SpecializationModel.objects.filter().order_by('name')
@@ -0,0 +1,66 @@
+# finance/management/commands/benchmark_transaction_browser.py
+
+import statistics
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from finance.transaction_browser import get_page, after_cursor, filter_transactions, FILTER_FIELDS, MAX_PAGE_SIZE
+
+
+class Command(BaseCommand):
+    help = 'Walk the transaction browser page by page and report how page latency changes with depth'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limit', type=int, default=20, help=f'Page size (max {MAX_PAGE_SIZE})')
+        parser.add_argument('--max-pages', type=int, default=0, help='Stop after this many pages (0 = walk to the end)')
+        parser.add_argument('--start-date', help='Only transactions on or after this date (YYYY-MM-DD)')
+        parser.add_argument('--end-date', help='Only transactions on or before this date (YYYY-MM-DD)')
+        parser.add_argument('--search', help='Search term, as typed in the transaction page')
+        for param in FILTER_FIELDS:
+            parser.add_argument(f'--{param.replace("_", "-")}', dest=param, help=f'Filter on {param}')
+        parser.add_argument('--explain', action='store_true', help='Print the query plan of the deepest page')
+
+    def handle(self, *args, **options):
+        params = {'limit': options['limit'], 'start_date': options['start_date'], 'end_date': options['end_date'],
+                  'search': options['search']}
+        for param in FILTER_FIELDS:
+            params[param] = options[param]
+        params = {key: value for key, value in params.items() if value}
+
+        if options['limit'] < 1 or options['max_pages'] < 0:
+            raise CommandError('--limit must be positive and --max-pages not negative')
+
+        timings = []
+        rows = 0
+        cursor = None
+        while True:
+            if cursor:
+                params['cursor'] = cursor
+            started = time.perf_counter()
+            transactions, next_cursor = get_page(params)
+            timings.append((time.perf_counter() - started) * 1000)
+            rows += len(transactions)
+
+            if not next_cursor or (options['max_pages'] and len(timings) >= options['max_pages']):
+                break
+            cursor = next_cursor
+
+        self.stdout.write(f'Walked {len(timings)} pages ({rows} transactions)')
+        if not timings:
+            return
+
+        self.stdout.write(f'First page: {timings[0]:.1f} ms')
+        self.stdout.write(f'Median page: {statistics.median(timings):.1f} ms')
+        self.stdout.write(f'Slowest page: {max(timings):.1f} ms (page {timings.index(max(timings)) + 1})')
+        self.stdout.write(f'Last page: {timings[-1]:.1f} ms')
+
+        if len(timings) >= 10:
+            tenth = max(1, len(timings) // 10)
+            head = statistics.mean(timings[:tenth])
+            tail = statistics.mean(timings[-tenth:])
+            self.stdout.write(f'Deepest 10% vs first 10%: {tail / head:.2f}x')
+
+        if options['explain'] and cursor:
+            qs = after_cursor(filter_transactions(params), cursor)[:options['limit'] + 1]
+            self.stdout.write(qs.explain())
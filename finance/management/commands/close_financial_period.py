@@ -0,0 +1,57 @@
+# finance/management/commands/close_financial_period.py
+
+from datetime import datetime, timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from finance.models import FinancialPeriod
+from finance.period_close import close_period
+
+
+class Command(BaseCommand):
+    help = 'Close a month for financial reporting, or re-close months changed after they were closed'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--month', help='Month to close (YYYY-MM). Defaults to last month.')
+        parser.add_argument(
+            '--stale',
+            action='store_true',
+            help='Re-close every closed month flagged with late changes instead of closing one month',
+        )
+        parser.add_argument(
+            '--force',
+            action='store_true',
+            help='Re-close --month even if it is already closed and has no late changes',
+        )
+
+    def handle(self, *args, **options):
+        if options['stale']:
+            periods = FinancialPeriod.objects.filter(status='closed', needs_reclose=True).order_by('start_date')
+            months = [period.start_date for period in periods]
+            if not months:
+                self.stdout.write('No closed months have late changes')
+        else:
+            months = [self._parse_month(options['month'])]
+
+        for month in months:
+            existing = FinancialPeriod.objects.filter(start_date=month).first()
+            if existing and existing.is_closed and not existing.needs_reclose and not options['force']:
+                self.stdout.write(f"{month.strftime('%B %Y')} is already closed (use --force to re-close)")
+                continue
+            try:
+                period = close_period(month)
+            except ValueError as e:
+                raise CommandError(str(e))
+            self.stdout.write(self.style.SUCCESS(
+                f"Closed {month.strftime('%B %Y')} (version {period.version}, "
+                f"{period.snapshots.filter(version=period.version).count()} figures)"
+            ))
+
+    def _parse_month(self, value):
+        if not value:
+            return (timezone.localdate().replace(day=1) - timedelta(days=1)).replace(day=1)
+        try:
+            return datetime.strptime(value, '%Y-%m').date()
+        except ValueError:
+            raise CommandError(f'Invalid month "{value}", expected YYYY-MM')
@@ -0,0 +1,42 @@
+# finance/management/commands/rebuild_finance_rollup.py
+
+from datetime import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+
+from finance.rollups import rebuild_daily_rollup
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the daily finance rollup table from patient transactions'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--from',
+            dest='from_date',
+            help='First date to rebuild (YYYY-MM-DD). Defaults to the earliest transaction.',
+        )
+        parser.add_argument(
+            '--to',
+            dest='to_date',
+            help='Last date to rebuild (YYYY-MM-DD). Defaults to the latest transaction.',
+        )
+
+    def _parse_date(self, value):
+        if not value:
+            return None
+        try:
+            return datetime.strptime(value, '%Y-%m-%d').date()
+        except ValueError:
+            raise CommandError(f'Invalid date "{value}". Use YYYY-MM-DD.')
+
+    def handle(self, *args, **options):
+        from_date = self._parse_date(options['from_date'])
+        to_date = self._parse_date(options['to_date'])
+
+        if from_date and to_date and from_date > to_date:
+            raise CommandError('--from must be on or before --to')
+
+        rows = rebuild_daily_rollup(from_date, to_date)
+
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt {rows} daily rollup rows'))
@@ -0,0 +1,64 @@
+# Generated by Django 5.0 on 2026-10-16 09:12
+
+import django.db.models.deletion
+from decimal import Decimal
+from django.conf import settings
+from django.db import migrations, models
+
+
+def populate_daily_rollup(apps, schema_editor):
+    PatientTransactionModel = apps.get_model('finance', 'PatientTransactionModel')
+    DailyFinanceRollup = apps.get_model('finance', 'DailyFinanceRollup')
+    from django.db.models import Count, Sum
+
+    grouped = {}
+    rows = PatientTransactionModel.objects.filter(status='completed').order_by().values(
+        'date', 'transaction_type', 'transaction_direction', 'payment_method', 'received_by_id'
+    ).annotate(total=Sum('amount'), count=Count('id'))
+    for row in rows:
+        key = (row['date'], row['transaction_type'], row['transaction_direction'],
+               row['payment_method'] or '', row['received_by_id'])
+        total, count = grouped.get(key, (Decimal('0.00'), 0))
+        grouped[key] = (total + (row['total'] or Decimal('0.00')), count + row['count'])
+
+    DailyFinanceRollup.objects.bulk_create(
+        [
+            DailyFinanceRollup(
+                date=key[0], transaction_type=key[1], transaction_direction=key[2],
+                payment_method=key[3], received_by_id=key[4], total_amount=total, transaction_count=count
+            )
+            for key, (total, count) in grouped.items()
+        ],
+        batch_size=1000
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('finance', '0014_alter_patienttransactionmodel_lab_structure'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyFinanceRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('transaction_type', models.CharField(choices=[('wallet_funding', 'WALLET FUNDING'), ('consultation_payment', 'CONSULTATION PAYMENT'), ('drug_payment', 'DRUG PAYMENT'), ('lab_payment', 'LAB PAYMENT'), ('scan_payment', 'SCAN PAYMENT'), ('admission_payment', 'ADMISSION PAYMENT'), ('surgery_payment', 'SURGERY PAYMENT'), ('service', 'SERVICE'), ('item', 'ITEM PURCHASE'), ('other_payment', 'OTHER PAYMENT'), ('drug_refund', 'DRUG REFUND'), ('lab_refund', 'LAB REFUND'), ('scan_refund', 'SCAN REFUND'), ('admission_refund', 'ADMISSION REFUND'), ('surgery_refund', 'SURGERY REFUND'), ('other_refund', 'OTHER REFUND'), ('wallet_withdrawal', 'WALLET WITHDRAWAL'), ('refund_to_wallet', 'REFUND TO WALLET'), ('wallet_correction', 'WALLET CORRECTION'), ('direct_payment', 'DIRECT PAYMENT')], max_length=20)),
+                ('transaction_direction', models.CharField(choices=[('in', 'IN'), ('out', 'OUT')], max_length=20)),
+                ('payment_method', models.CharField(blank=True, default='', max_length=50)),
+                ('total_amount', models.DecimalField(decimal_places=2, default=Decimal('0.00'), max_digits=14)),
+                ('transaction_count', models.IntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('received_by', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='finance_rollups', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['-date'],
+                'indexes': [models.Index(fields=['date', 'transaction_direction'], name='finance_dai_date_8f48f5_idx')],
+                'unique_together': {('date', 'transaction_type', 'transaction_direction', 'payment_method', 'received_by')},
+            },
+        ),
+        migrations.RunPython(populate_daily_rollup, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 5.0 on 2026-10-16 10:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('finance', '0015_dailyfinancerollup'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='patienttransactionmodel',
+            name='finance_pat_date_a7f767_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='patienttransactionmodel',
+            name='finance_pat_status_e9c11f_idx',
+        ),
+        migrations.AddIndex(
+            model_name='patienttransactionmodel',
+            index=models.Index(fields=['date', 'id'], name='finance_pat_date_23586d_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='patienttransactionmodel',
+            index=models.Index(fields=['status', 'date', 'id'], name='finance_pat_status_3a9f2a_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='patienttransactionmodel',
+            index=models.Index(fields=['transaction_type', 'date', 'id'], name='finance_pat_transac_1db65e_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='patienttransactionmodel',
+            index=models.Index(fields=['received_by', 'date', 'id'], name='finance_pat_receive_ff1622_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='patienttransactionmodel',
+            index=models.Index(fields=['payment_method', 'date', 'id'], name='finance_pat_payment_c29b85_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='patienttransactionmodel',
+            index=models.Index(fields=['patient', 'date', 'id'], name='finance_pat_patient_b3a180_idx'),
+        ),
+    ]
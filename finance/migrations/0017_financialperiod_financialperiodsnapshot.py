@@ -0,0 +1,62 @@
+# Generated by Django 5.0 on 2026-10-16 11:00
+
+import django.db.models.deletion
+from decimal import Decimal
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('finance', '0016_transaction_browser_indexes'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FinancialPeriod',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('start_date', models.DateField(unique=True)),
+                ('end_date', models.DateField()),
+                ('status', models.CharField(choices=[('open', 'OPEN'), ('closed', 'CLOSED')], default='open', max_length=10)),
+                ('version', models.PositiveIntegerField(default=0)),
+                ('closed_at', models.DateTimeField(blank=True, null=True)),
+                ('needs_reclose', models.BooleanField(default=False)),
+                ('late_change_at', models.DateTimeField(blank=True, null=True)),
+                ('late_change_note', models.CharField(blank=True, default='', max_length=255)),
+                ('closed_by', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='financial_periods_closed', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['-start_date'],
+                'permissions': [('close_financialperiod', 'Can close and re-close financial periods')],
+            },
+        ),
+        migrations.CreateModel(
+            name='FinancialPeriodSnapshot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('version', models.PositiveIntegerField()),
+                ('report', models.CharField(choices=[('general', 'General Financial Report'), ('lab', 'Laboratory Financial Report'), ('scan', 'Scan Financial Report'), ('staff', 'Staff Collections')], max_length=20)),
+                ('key', models.CharField(max_length=100)),
+                ('label', models.CharField(blank=True, default='', max_length=255)),
+                ('unit_price', models.DecimalField(blank=True, decimal_places=2, max_digits=12, null=True)),
+                ('count', models.IntegerField(default=0)),
+                ('amount', models.DecimalField(decimal_places=2, default=Decimal('0.00'), max_digits=14)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('period', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='snapshots', to='finance.financialperiod')),
+            ],
+            options={
+                'ordering': ['period', 'report', 'key'],
+            },
+        ),
+        migrations.AddIndex(
+            model_name='financialperiod',
+            index=models.Index(fields=['status', 'start_date'], name='finance_fin_status_be13c1_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='financialperiodsnapshot',
+            unique_together={('period', 'version', 'report', 'key')},
+        ),
+    ]
@@ -0,0 +1,51 @@
+# Generated by Django 5.0 on 2026-10-16 20:00
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+def fill_received_by_key(apps, schema_editor):
+    """Set received_by_key and merge rows that now share a key (duplicate NULL-receiver rows)"""
+    DailyFinanceRollup = apps.get_model('finance', 'DailyFinanceRollup')
+
+    kept = {}
+    duplicates = []
+    for row in DailyFinanceRollup.objects.order_by('pk'):
+        row.received_by_key = row.received_by_id or 0
+        key = (row.date, row.transaction_type, row.transaction_direction, row.payment_method, row.received_by_key)
+        if key in kept:
+            kept[key].total_amount += row.total_amount
+            kept[key].transaction_count += row.transaction_count
+            duplicates.append(row.pk)
+        else:
+            kept[key] = row
+
+    DailyFinanceRollup.objects.filter(pk__in=duplicates).delete()
+    DailyFinanceRollup.objects.bulk_update(
+        kept.values(), ['received_by_key', 'total_amount', 'transaction_count'], batch_size=1000
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('finance', '0017_financialperiod_financialperiodsnapshot'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AlterUniqueTogether(
+            name='dailyfinancerollup',
+            unique_together=set(),
+        ),
+        migrations.AddField(
+            model_name='dailyfinancerollup',
+            name='received_by_key',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(fill_received_by_key, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='dailyfinancerollup',
+            constraint=models.UniqueConstraint(fields=('date', 'transaction_type', 'transaction_direction', 'payment_method', 'received_by_key'), name='finance_rollup_unique_key'),
+        ),
+    ]
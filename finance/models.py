@@ -8,6 +8,7 @@ from django.db import models
 from django.utils.timezone import now
 
 from admin_site.model_info import TEMPORAL_STATUS, RECEIPT_FORMAT
+from admin_site.sequences import next_sequence_value, max_sequence_suffix
 from human_resource.models import StaffModel
 
 
@@ -269,65 +270,13 @@ class PatientTransactionModel(models.Model):
 
     def save(self, *args, **kwargs):
         if not self.transaction_id:
-            from django.db import transaction
-            from django.db.models import Max
-            from django.db.models.functions import Cast, Right
-            from django.db.models import IntegerField
-            import time
-            import random
-
             today_str = date.today().strftime('%Y%m%d')
-            max_retries = 5
-            retry_count = 0
-
-            while retry_count < max_retries:
-                try:
-                    with transaction.atomic():
-                        # Use select_for_update to lock the query and prevent race conditions
-                        # Alternative approach using Max aggregation for better performance
-                        last_transaction_data = PatientTransactionModel.objects.filter(
-                            transaction_id__startswith=f'trn-{today_str}'
-                        ).aggregate(
-                            max_id=Max(
-                                Cast(
-                                    Right('transaction_id', 4),
-                                    IntegerField()
-                                )
-                            )
-                        )
-
-                        last_number = last_transaction_data['max_id'] or 0
-                        new_number = last_number + 1
-
-                        # Format the number with leading zeros
-                        formatted_number = f"{new_number:04}"
-                        potential_transaction_id = f"trn-{today_str}{formatted_number}"
-
-                        # Double-check uniqueness (extra safety)
-                        if PatientTransactionModel.objects.filter(
-                                transaction_id=potential_transaction_id
-                        ).exists():
-                            # If somehow this ID exists, increment and try again
-                            new_number += 1
-                            formatted_number = f"{new_number:04}"
-                            potential_transaction_id = f"trn-{today_str}{formatted_number}"
-
-                        self.transaction_id = potential_transaction_id
-                        break
-
-                except Exception as e:
-                    retry_count += 1
-                    if retry_count >= max_retries:
-                        # Fallback: use timestamp with random suffix if all retries fail
-                        import uuid
-                        timestamp = int(time.time() * 1000)  # milliseconds
-                        random_suffix = str(uuid.uuid4())[:4]
-                        self.transaction_id = f"trn-{today_str}{timestamp}{random_suffix}"
-                        break
-                    else:
-                        # Wait briefly before retry with some jitter
-                        time.sleep(0.01 + random.uniform(0, 0.02))
-                        continue
+            prefix = f'trn-{today_str}'
+            next_number = next_sequence_value(
+                'trn-', today_str,
+                seed=lambda: max_sequence_suffix(PatientTransactionModel.objects, 'transaction_id', prefix, digits=6)
+            )
+            self.transaction_id = f"{prefix}{next_number:04}"
 
         super().save(*args, **kwargs)
 
@@ -395,9 +344,14 @@ class PatientTransactionModel(models.Model):
         ordering = ['-created_at']
         indexes = [
             models.Index(fields=['patient', 'transaction_type']),
-            models.Index(fields=['date']),
-            models.Index(fields=['status']),
             models.Index(fields=['parent_transaction']),  # NEW INDEX
+            # Transaction browser: keyset order (date, id) on its own and behind each filter
+            models.Index(fields=['date', 'id']),
+            models.Index(fields=['status', 'date', 'id']),
+            models.Index(fields=['transaction_type', 'date', 'id']),
+            models.Index(fields=['received_by', 'date', 'id']),
+            models.Index(fields=['payment_method', 'date', 'id']),
+            models.Index(fields=['patient', 'date', 'id']),
         ]
 
         permissions = [
@@ -408,6 +362,137 @@ class PatientTransactionModel(models.Model):
         ]
 
 
+class DailyFinanceRollup(models.Model):
+    """
+    Per-day totals of completed patient transactions.
+
+    One row per (date, transaction_type, transaction_direction, payment_method, received_by).
+    Kept up to date by the finance signals and rebuilt with the rebuild_finance_rollup command.
+
+    The unique key uses received_by_key (the receiver's id, 0 for none) rather than the
+    nullable received_by, since NULLs never conflict in a unique constraint. When a user is
+    deleted their rows are merged into the rows without a receiver (see finance.signals).
+    """
+    date = models.DateField()
+    transaction_type = models.CharField(max_length=20, choices=PatientTransactionModel.TRANSACTION_TYPE)
+    transaction_direction = models.CharField(max_length=20, choices=(('in', 'IN'), ('out', 'OUT')))
+    payment_method = models.CharField(max_length=50, blank=True, default='')
+    received_by = models.ForeignKey(
+        User,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name='finance_rollups'
+    )
+    received_by_key = models.PositiveIntegerField(default=0, editable=False)
+
+    total_amount = models.DecimalField(max_digits=14, decimal_places=2, default=Decimal('0.00'))
+    transaction_count = models.IntegerField(default=0)
+
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ['-date']
+        constraints = [
+            models.UniqueConstraint(
+                fields=['date', 'transaction_type', 'transaction_direction', 'payment_method', 'received_by_key'],
+                name='finance_rollup_unique_key',
+            ),
+        ]
+        indexes = [
+            models.Index(fields=['date', 'transaction_direction']),
+        ]
+
+    def __str__(self):
+        return f"{self.date} - {self.transaction_type} ({self.transaction_direction}): {self.total_amount}"
+
+
+class FinancialPeriod(models.Model):
+    """
+    A calendar month of the books.
+
+    Once closed, the month's report figures are frozen in FinancialPeriodSnapshot rows
+    and historical reports read them instead of raw transactions. Each (re-)close writes
+    a new snapshot version; the period points at the current one. A change to a record
+    dated inside a closed month sets needs_reclose until the month is closed again.
+    """
+    STATUS = (
+        ('open', 'OPEN'),
+        ('closed', 'CLOSED'),
+    )
+
+    start_date = models.DateField(unique=True)
+    end_date = models.DateField()
+    status = models.CharField(max_length=10, choices=STATUS, default='open')
+    version = models.PositiveIntegerField(default=0)
+
+    closed_at = models.DateTimeField(null=True, blank=True)
+    closed_by = models.ForeignKey(
+        User,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name='financial_periods_closed'
+    )
+
+    needs_reclose = models.BooleanField(default=False)
+    late_change_at = models.DateTimeField(null=True, blank=True)
+    late_change_note = models.CharField(max_length=255, blank=True, default='')
+
+    class Meta:
+        ordering = ['-start_date']
+        indexes = [
+            models.Index(fields=['status', 'start_date']),
+        ]
+        permissions = [
+            ("close_financialperiod", "Can close and re-close financial periods"),
+        ]
+
+    def __str__(self):
+        return f"{self.start_date.strftime('%B %Y')} ({self.get_status_display()})"
+
+    @property
+    def is_closed(self):
+        return self.status == 'closed'
+
+
+class FinancialPeriodSnapshot(models.Model):
+    """
+    One frozen figure of a closed period, e.g. the laboratory total of one test template.
+
+    Rows are written once by a (re-)close and never changed; a re-close writes a new version.
+    """
+    REPORTS = (
+        ('general', 'General Financial Report'),
+        ('lab', 'Laboratory Financial Report'),
+        ('scan', 'Scan Financial Report'),
+        ('staff', 'Staff Collections'),
+    )
+
+    period = models.ForeignKey(FinancialPeriod, on_delete=models.CASCADE, related_name='snapshots')
+    version = models.PositiveIntegerField()
+    report = models.CharField(max_length=20, choices=REPORTS)
+    # Category key, template id or "<user id>:<transaction type>" depending on the report
+    key = models.CharField(max_length=100)
+    label = models.CharField(max_length=255, blank=True, default='')
+    unit_price = models.DecimalField(max_digits=12, decimal_places=2, null=True, blank=True)
+    count = models.IntegerField(default=0)
+    amount = models.DecimalField(max_digits=14, decimal_places=2, default=Decimal('0.00'))
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['period', 'report', 'key']
+        unique_together = ('period', 'version', 'report', 'key')
+
+    def __str__(self):
+        return f"{self.period} v{self.version} {self.report} {self.key}: {self.amount}"
+
+    def save(self, *args, **kwargs):
+        if not self._state.adding:
+            raise ValueError('Period snapshots cannot be changed; re-close the period instead')
+        super().save(*args, **kwargs)
+
+
 class PatientRefundModel(models.Model):
     patient = models.ForeignKey('patient.PatientModel', on_delete=models.SET_NULL, null=True)
 
@@ -0,0 +1,339 @@
+"""
+Month-end close.
+
+Closing a month freezes the figures behind the general, laboratory and scan
+financial reports (plus staff collections per transaction type) in
+FinancialPeriodSnapshot rows. Reports ask this module for a date range: whole
+closed months inside the range are read from their snapshots and only the rest
+(the open month, or partial months at the edges of the range) is computed from
+raw records.
+
+Saving or deleting a record dated inside a closed month flags the period with
+needs_reclose (see finance.signals). The snapshots keep serving the closed
+figures until the month is closed again with close_period() or
+manage.py close_financial_period.
+"""
+import calendar
+import datetime
+from collections import defaultdict
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models import Sum, Count, F
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from finance.models import FinancialPeriod, FinancialPeriodSnapshot, PatientTransactionModel
+from laboratory.models import LabTestOrderModel
+from patient.models import RegistrationPaymentModel
+from scan.models import ScanOrderModel
+from service.models import ServiceCategory
+
+ZERO = Decimal('0.00')
+
+# Fixed rows of the general report, in report order: key -> label.
+# Keys other than 'card' are transaction types.
+GENERAL_HEAD_CATEGORIES = [
+    ('card', 'Card (Registration)'),
+    ('consultation_payment', 'Consultation'),
+    ('lab_payment', 'Laboratory'),
+    ('drug_payment', 'Drugs'),
+    ('scan_payment', 'Scan/Imaging'),
+]
+GENERAL_TAIL_CATEGORIES = [
+    ('surgery_payment', 'Surgery'),
+]
+GENERAL_TRANSACTION_TYPES = [key for key, _ in GENERAL_HEAD_CATEGORIES + GENERAL_TAIL_CATEGORIES if key != 'card']
+
+SERVICE_CATEGORY_PREFIX = 'service_category:'
+OTHER_PAYMENT_PREFIX = 'other:'
+
+# Orders that count towards the laboratory and scan reports
+EXCLUDED_ORDER_STATUSES = ['pending', 'cancelled']
+ORDER_MODELS = {
+    'lab': LabTestOrderModel,
+    'scan': ScanOrderModel,
+}
+
+
+def month_bounds(day):
+    """First and last day of the month containing day"""
+    start = day.replace(day=1)
+    return start, start.replace(day=calendar.monthrange(start.year, start.month)[1])
+
+
+def _figure(label='', amount=ZERO, count=0, unit_price=None):
+    return {'label': label, 'amount': amount or ZERO, 'count': count or 0, 'unit_price': unit_price}
+
+
+# ---------------------------------------------------------------------------
+# Live figures
+# ---------------------------------------------------------------------------
+
+def compute_general(start_date, end_date):
+    """General report figures for the range, keyed by category key"""
+    figures = {}
+
+    card = RegistrationPaymentModel.objects.filter(
+        date__range=[start_date, end_date], status='confirmed'
+    ).aggregate(total=Sum('amount'), count=Count('id'))
+    figures['card'] = _figure('Card (Registration)', card['total'], card['count'])
+
+    completed = PatientTransactionModel.objects.filter(
+        date__range=[start_date, end_date], status='completed'
+    ).order_by()
+
+    labels = dict(GENERAL_HEAD_CATEGORIES + GENERAL_TAIL_CATEGORIES)
+    rows = completed.filter(transaction_type__in=GENERAL_TRANSACTION_TYPES).values('transaction_type').annotate(
+        total=Sum('direct_payment_amount'), count=Count('id')
+    )
+    for row in rows:
+        figures[row['transaction_type']] = _figure(labels[row['transaction_type']], row['total'], row['count'])
+
+    rows = completed.filter(transaction_type__in=['service', 'item']).annotate(
+        category_id=Coalesce('service__service__category_id', 'service__service_item__category_id')
+    ).values('category_id').annotate(total=Sum('direct_payment_amount'), count=Count('id'))
+    names = dict(ServiceCategory.objects.values_list('id', 'name'))
+    for row in rows:
+        if row['category_id'] is not None:
+            figures[f"{SERVICE_CATEGORY_PREFIX}{row['category_id']}"] = _figure(
+                names.get(row['category_id'], ''), row['total'], row['count']
+            )
+
+    rows = completed.filter(transaction_type='other_payment').values('other_service__name').annotate(
+        total=Sum('direct_payment_amount'), count=Count('id')
+    )
+    for row in rows:
+        name = row['other_service__name'] or ''
+        figures[f'{OTHER_PAYMENT_PREFIX}{name}'] = _figure(name or 'Other Payment', row['total'], row['count'])
+
+    return figures
+
+
+def compute_orders(report, start_date, end_date):
+    """Laboratory or scan report figures for the range, keyed by template id"""
+    rows = ORDER_MODELS[report].objects.filter(
+        ordered_at__date__range=[start_date, end_date]
+    ).exclude(status__in=EXCLUDED_ORDER_STATUSES).order_by().values(
+        'template__id', 'template__name', 'template__price'
+    ).annotate(total=Sum('amount_charged'), count=Count('id'))
+
+    return {
+        str(row['template__id']): _figure(row['template__name'], row['total'], row['count'], row['template__price'])
+        for row in rows
+    }
+
+
+def compute_staff(start_date, end_date):
+    """Completed transaction totals per staff member and transaction type, keyed "<user id>:<type>" """
+    rows = PatientTransactionModel.objects.filter(
+        date__range=[start_date, end_date], status='completed'
+    ).order_by().values(
+        'received_by_id', 'received_by__first_name', 'received_by__last_name', 'received_by__username',
+        'transaction_type'
+    ).annotate(total=Sum('amount'), count=Count('id'))
+
+    figures = {}
+    for row in rows:
+        name = f"{row['received_by__first_name'] or ''} {row['received_by__last_name'] or ''}".strip()
+        figures[f"{row['received_by_id'] or ''}:{row['transaction_type']}"] = _figure(
+            name or row['received_by__username'] or 'System', row['total'], row['count']
+        )
+    return figures
+
+
+def compute(report, start_date, end_date):
+    if report == 'general':
+        return compute_general(start_date, end_date)
+    if report == 'staff':
+        return compute_staff(start_date, end_date)
+    return compute_orders(report, start_date, end_date)
+
+
+# ---------------------------------------------------------------------------
+# Closing
+# ---------------------------------------------------------------------------
+
+@transaction.atomic
+def close_period(day, user=None):
+    """
+    Close (or re-close) the month containing day and return its FinancialPeriod.
+
+    Writes a new snapshot version for every report; earlier versions are kept.
+    Only months that have ended can be closed.
+    """
+    start_date, end_date = month_bounds(day)
+    if end_date >= timezone.localdate():
+        raise ValueError(f"{start_date.strftime('%B %Y')} has not ended yet")
+
+    period, _ = FinancialPeriod.objects.select_for_update().get_or_create(
+        start_date=start_date, defaults={'end_date': end_date}
+    )
+    version = period.version + 1
+
+    snapshots = []
+    for report, _ in FinancialPeriodSnapshot.REPORTS:
+        for key, figure in compute(report, start_date, end_date).items():
+            snapshots.append(FinancialPeriodSnapshot(
+                period=period, version=version, report=report, key=key, label=figure['label'][:255],
+                unit_price=figure['unit_price'], count=figure['count'], amount=figure['amount']
+            ))
+    FinancialPeriodSnapshot.objects.bulk_create(snapshots, batch_size=1000)
+
+    period.version = version
+    period.status = 'closed'
+    period.closed_at = timezone.now()
+    period.closed_by = user
+    period.needs_reclose = False
+    period.late_change_at = None
+    period.late_change_note = ''
+    period.save()
+    return period
+
+
+def _as_date(value):
+    if isinstance(value, datetime.datetime):
+        return timezone.localdate(value) if timezone.is_aware(value) else value.date()
+    return value
+
+
+def flag_late_change(value, note=''):
+    """
+    Mark the closed period containing value (a date or datetime) as needing a re-close.
+
+    Returns the number of periods flagged (0 or 1).
+    """
+    day = _as_date(value)
+    # Only months that have ended can be closed, so records of this month never hit a closed period
+    if day is None or day >= timezone.localdate().replace(day=1):
+        return 0
+    return FinancialPeriod.objects.filter(
+        status='closed', start_date__lte=day, end_date__gte=day
+    ).update(needs_reclose=True, late_change_at=timezone.now(), late_change_note=note[:255])
+
+
+# ---------------------------------------------------------------------------
+# Reading
+# ---------------------------------------------------------------------------
+
+def split_range(start_date, end_date):
+    """
+    Return (closed_periods, live_ranges) for a date range: the closed months lying
+    wholly inside it, and the (start, end) pieces left over to compute live.
+    """
+    periods = list(FinancialPeriod.objects.filter(
+        status='closed', start_date__gte=start_date, end_date__lte=end_date
+    ).order_by('start_date'))
+
+    live_ranges = []
+    cursor = start_date
+    for period in periods:
+        if period.start_date > cursor:
+            live_ranges.append((cursor, period.start_date - datetime.timedelta(days=1)))
+        cursor = period.end_date + datetime.timedelta(days=1)
+    if cursor <= end_date:
+        live_ranges.append((cursor, end_date))
+    return periods, live_ranges
+
+
+def collect(report, start_date, end_date):
+    """
+    Figures of one report for the range, keyed like compute(), taken from
+    snapshots for closed months and computed live for the rest.
+    """
+    periods, live_ranges = split_range(start_date, end_date)
+
+    # Each piece is (start, figures); labels and prices are taken from the latest piece
+    pieces = [(start, compute(report, start, end)) for start, end in live_ranges]
+    if periods:
+        by_period = defaultdict(dict)
+        snapshots = FinancialPeriodSnapshot.objects.filter(
+            period__in=periods, report=report, version=F('period__version')
+        ).values('period__start_date', 'key', 'label', 'unit_price', 'count', 'amount')
+        for row in snapshots:
+            by_period[row['period__start_date']][row['key']] = _figure(
+                row['label'], row['amount'], row['count'], row['unit_price']
+            )
+        pieces.extend(by_period.items())
+
+    merged = {}
+    for _, figures in sorted(pieces, key=lambda piece: piece[0]):
+        for key, figure in figures.items():
+            total = merged.setdefault(key, _figure())
+            total['amount'] += figure['amount']
+            total['count'] += figure['count']
+            total['label'] = figure['label'] or total['label']
+            if figure['unit_price'] is not None:
+                total['unit_price'] = figure['unit_price']
+    return merged
+
+
+def get_stale_periods(start_date, end_date):
+    """Closed periods in the range with changes made after they were closed"""
+    return list(FinancialPeriod.objects.filter(
+        status='closed', needs_reclose=True, start_date__gte=start_date, end_date__lte=end_date
+    ).order_by('start_date'))
+
+
+def get_general_report(start_date, end_date):
+    """
+    Rows of the general financial report as [{'category', 'amount'}], in report order.
+
+    Service categories are listed when shown as record columns, active and non-zero;
+    other payments when non-zero.
+    """
+    figures = collect('general', start_date, end_date)
+
+    def amount(key):
+        return figures[key]['amount'] if key in figures else ZERO
+
+    rows = [{'category': label, 'amount': amount(key)} for key, label in GENERAL_HEAD_CATEGORIES]
+
+    categories = ServiceCategory.objects.filter(show_as_record_column=True, is_active=True).order_by('name')
+    for category in categories:
+        category_total = amount(f'{SERVICE_CATEGORY_PREFIX}{category.id}')
+        if category_total > 0:
+            rows.append({'category': category.name, 'amount': category_total})
+
+    rows.extend({'category': label, 'amount': amount(key)} for key, label in GENERAL_TAIL_CATEGORIES)
+
+    other_payments = sorted(
+        (figure for key, figure in figures.items() if key.startswith(OTHER_PAYMENT_PREFIX)),
+        key=lambda figure: figure['label']
+    )
+    rows.extend({'category': figure['label'], 'amount': figure['amount']} for figure in other_payments if figure['amount'])
+    return rows
+
+
+def get_order_report(report, start_date, end_date, order_by='name'):
+    """
+    Laboratory or scan report as (test_breakdown, grand_total).
+
+    test_breakdown rows carry the keys the report templates use (template__name,
+    template__id, template__price, total_orders, total_amount); grand_total is
+    {'total', 'total_count'}.
+    """
+    figures = collect(report, start_date, end_date)
+    breakdown = [
+        {
+            'template__id': int(key),
+            'template__name': figure['label'],
+            'template__price': figure['unit_price'],
+            'total_orders': figure['count'],
+            'total_amount': figure['amount'],
+        }
+        for key, figure in figures.items()
+    ]
+
+    if order_by == 'total':
+        breakdown.sort(key=lambda row: (-row['total_orders'], row['template__name']))
+    elif order_by == 'amount':
+        breakdown.sort(key=lambda row: (-row['total_amount'], row['template__name']))
+    else:
+        breakdown.sort(key=lambda row: row['template__name'])
+
+    grand_total = {
+        'total': sum((row['total_amount'] for row in breakdown), ZERO),
+        'total_count': sum(row['total_orders'] for row in breakdown),
+    }
+    return breakdown, grand_total
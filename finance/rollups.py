@@ -0,0 +1,176 @@
+"""
+Daily finance rollups.
+
+Keeps DailyFinanceRollup in step with completed PatientTransactionModel rows and
+provides the small read helpers the finance dashboard is built on.
+"""
+from collections import defaultdict
+from decimal import Decimal
+
+from django.db import IntegrityError, transaction
+from django.db.models import F, Sum, Count
+from django.db.models.functions import TruncMonth
+
+from finance.models import DailyFinanceRollup, PatientTransactionModel
+
+ROLLUP_FIELDS = ('date', 'transaction_type', 'transaction_direction', 'payment_method', 'received_by_id')
+TRACKED_FIELDS = ROLLUP_FIELDS + ('amount', 'status')
+
+
+def rollup_state(values):
+    """
+    Return (key, amount) for a transaction's tracked values, or None if it does not count.
+
+    Only completed transactions contribute to the rollup.
+    """
+    if not values or values.get('status') != 'completed' or values.get('date') is None:
+        return None
+    key = tuple(values[field] or '' if field == 'payment_method' else values[field] for field in ROLLUP_FIELDS)
+    return key, Decimal(values.get('amount') or 0)
+
+
+def transaction_rollup_state(instance):
+    """Rollup state for an in-memory PatientTransactionModel instance."""
+    return rollup_state({field: getattr(instance, field) for field in TRACKED_FIELDS})
+
+
+def rollup_row_fields(key):
+    """
+    Field values of the rollup row for key. The row is looked up by received_by_key,
+    which unlike the nullable received_by is covered by the unique constraint.
+    """
+    fields = dict(zip(ROLLUP_FIELDS, key))
+    fields['received_by_key'] = fields['received_by_id'] or 0
+    return fields
+
+
+def apply_rollup_delta(key, amount, count):
+    """Add amount/count to the rollup row for key, creating it if needed."""
+    fields = rollup_row_fields(key)
+    filters = {field: value for field, value in fields.items() if field != 'received_by_id'}
+    with transaction.atomic():
+        updated = DailyFinanceRollup.objects.filter(**filters).update(
+            total_amount=F('total_amount') + amount,
+            transaction_count=F('transaction_count') + count
+        )
+        if updated:
+            return
+        try:
+            with transaction.atomic():
+                DailyFinanceRollup.objects.create(total_amount=amount, transaction_count=count, **fields)
+        except IntegrityError:
+            # Another writer created the row first
+            DailyFinanceRollup.objects.filter(**filters).update(
+                total_amount=F('total_amount') + amount,
+                transaction_count=F('transaction_count') + count
+            )
+
+
+def move_rollup(old_state, new_state):
+    """Move a transaction's contribution from old_state to new_state."""
+    if old_state == new_state:
+        return
+    if old_state:
+        apply_rollup_delta(old_state[0], -old_state[1], -1)
+    if new_state:
+        apply_rollup_delta(new_state[0], new_state[1], 1)
+
+
+def merge_user_rollups(user_id):
+    """
+    Fold a user's rollup rows into the rows without a receiver, where their transactions
+    land once the user is deleted (received_by is SET_NULL), instead of nulling the rows.
+    """
+    with transaction.atomic():
+        rows = list(DailyFinanceRollup.objects.select_for_update().filter(received_by_key=user_id))
+        for row in rows:
+            key = (row.date, row.transaction_type, row.transaction_direction, row.payment_method, None)
+            apply_rollup_delta(key, row.total_amount, row.transaction_count)
+        DailyFinanceRollup.objects.filter(pk__in=[row.pk for row in rows]).delete()
+    return len(rows)
+
+
+def rebuild_daily_rollup(start_date=None, end_date=None):
+    """
+    Recompute rollup rows from PatientTransactionModel for the given date range.
+
+    Returns the number of rollup rows written.
+    """
+    source = PatientTransactionModel.objects.filter(status='completed')
+    existing = DailyFinanceRollup.objects.all()
+    if start_date:
+        source = source.filter(date__gte=start_date)
+        existing = existing.filter(date__gte=start_date)
+    if end_date:
+        source = source.filter(date__lte=end_date)
+        existing = existing.filter(date__lte=end_date)
+
+    grouped = defaultdict(lambda: [Decimal('0.00'), 0])
+    rows = source.order_by().values(*ROLLUP_FIELDS).annotate(total=Sum('amount'), count=Count('id'))
+    for row in rows:
+        # Blank and NULL payment methods share one rollup row
+        key = tuple(row[field] or '' if field == 'payment_method' else row[field] for field in ROLLUP_FIELDS)
+        grouped[key][0] += row['total'] or Decimal('0.00')
+        grouped[key][1] += row['count']
+
+    with transaction.atomic():
+        existing.delete()
+        DailyFinanceRollup.objects.bulk_create(
+            [
+                DailyFinanceRollup(total_amount=total, transaction_count=count, **rollup_row_fields(key))
+                for key, (total, count) in grouped.items()
+            ],
+            batch_size=1000
+        )
+    return len(grouped)
+
+
+def _rollups(start_date=None, end_date=None):
+    queryset = DailyFinanceRollup.objects.all()
+    if start_date:
+        queryset = queryset.filter(date__gte=start_date)
+    if end_date:
+        queryset = queryset.filter(date__lte=end_date)
+    return queryset.order_by()
+
+
+def get_direction_totals(start_date=None, end_date=None):
+    """Return {'in': {'total', 'count'}, 'out': {...}} for the range."""
+    totals = {direction: {'total': Decimal('0.00'), 'count': 0} for direction in ('in', 'out')}
+    rows = _rollups(start_date, end_date).values('transaction_direction').annotate(
+        total=Sum('total_amount'), count=Sum('transaction_count')
+    )
+    for row in rows:
+        totals[row['transaction_direction']] = {
+            'total': row['total'] or Decimal('0.00'),
+            'count': row['count'] or 0,
+        }
+    return totals
+
+
+def get_daily_totals(start_date, end_date):
+    """Return {(date, direction): {'total', 'count'}} for every day with activity in the range."""
+    rows = _rollups(start_date, end_date).values('date', 'transaction_direction').annotate(
+        total=Sum('total_amount'), count=Sum('transaction_count')
+    )
+    return {
+        (row['date'], row['transaction_direction']): {'total': row['total'] or Decimal('0.00'), 'count': row['count'] or 0}
+        for row in rows
+    }
+
+
+def get_monthly_totals(start_date, end_date):
+    """Return {(month_start, direction): total} for the range."""
+    rows = _rollups(start_date, end_date).annotate(month=TruncMonth('date')).values(
+        'month', 'transaction_direction'
+    ).annotate(total=Sum('total_amount'))
+    return {(row['month'], row['transaction_direction']): row['total'] or Decimal('0.00') for row in rows}
+
+
+def get_breakdown(field, start_date=None, end_date=None, limit=10):
+    """Totals and counts grouped by a rollup field, largest first."""
+    return list(
+        _rollups(start_date, end_date).values(field).annotate(
+            count=Sum('transaction_count'), total=Sum('total_amount')
+        ).filter(count__gt=0).order_by('-total')[:limit]
+    )
@@ -1,6 +1,73 @@
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, pre_save, post_delete, pre_delete
 from django.dispatch import receiver
 from finance.models import *
+from finance.period_close import flag_late_change
+from finance.rollups import TRACKED_FIELDS, rollup_state, transaction_rollup_state, move_rollup, merge_user_rollups
+from laboratory.models import LabTestOrderModel
+from patient.models import RegistrationPaymentModel
+from scan.models import ScanOrderModel
+
+
+@receiver(pre_save, sender=PatientTransactionModel)
+def capture_transaction_rollup_state(sender, instance, raw=False, update_fields=None, **kwargs):
+    """Remember what the stored row contributed to the daily rollup before it changes"""
+    instance._rollup_previous_state = None
+    instance._rollup_skip = False
+    if raw or not instance.pk:
+        return
+    if update_fields is not None and not set(update_fields) & set(TRACKED_FIELDS + ('received_by',)):
+        instance._rollup_skip = True
+        return
+    previous = sender.objects.filter(pk=instance.pk).values(*TRACKED_FIELDS).first()
+    instance._rollup_previous_state = rollup_state(previous)
+
+
+@receiver(post_save, sender=PatientTransactionModel)
+def update_daily_rollup_on_save(sender, instance, created, raw=False, **kwargs):
+    """Keep DailyFinanceRollup in step when a transaction is saved or changes status"""
+    if raw or getattr(instance, '_rollup_skip', False):
+        return
+    move_rollup(getattr(instance, '_rollup_previous_state', None), transaction_rollup_state(instance))
+
+
+@receiver(post_delete, sender=PatientTransactionModel)
+def update_daily_rollup_on_delete(sender, instance, **kwargs):
+    move_rollup(transaction_rollup_state(instance), None)
+
+
+@receiver(pre_delete, sender=User)
+def merge_deleted_user_rollups(sender, instance, **kwargs):
+    """Merge the user's rollup rows into the no-receiver rows before received_by is nulled"""
+    merge_user_rollups(instance.pk)
+
+
+@receiver(post_save, sender=PatientTransactionModel)
+@receiver(post_delete, sender=PatientTransactionModel)
+def flag_closed_period_on_transaction_change(sender, instance, raw=False, **kwargs):
+    """Flag a closed month for re-close when one of its transactions changes"""
+    if raw:
+        return
+    note = f'Transaction {instance.transaction_id} changed'
+    flag_late_change(instance.date, note)
+    previous = getattr(instance, '_rollup_previous_state', None)
+    if previous and previous[0][0] != instance.date:
+        flag_late_change(previous[0][0], note)
+
+
+@receiver(post_save, sender=RegistrationPaymentModel)
+@receiver(post_delete, sender=RegistrationPaymentModel)
+def flag_closed_period_on_registration_change(sender, instance, raw=False, **kwargs):
+    if not raw:
+        flag_late_change(instance.date, f'Registration payment {instance.transaction_id} changed')
+
+
+@receiver(post_save, sender=LabTestOrderModel)
+@receiver(post_delete, sender=LabTestOrderModel)
+@receiver(post_save, sender=ScanOrderModel)
+@receiver(post_delete, sender=ScanOrderModel)
+def flag_closed_period_on_order_change(sender, instance, raw=False, **kwargs):
+    if not raw:
+        flag_late_change(instance.ordered_at, f'{sender._meta.verbose_name.title()} {instance.order_number} changed')
 
 #
 # @receiver(post_save, sender=Expense)
@@ -0,0 +1,243 @@
+"""
+Staff collection engine.
+
+Builds the staff x category collection matrix used by the personal and all-staff
+collection reports with one grouped, conditionally aggregated query per source
+table instead of one aggregate per staff member per category.
+"""
+from collections import defaultdict
+from decimal import Decimal
+
+from django.contrib.auth.models import User
+from django.db.models import Q, Sum
+
+from finance.models import PatientTransactionModel, Expense, WalletWithdrawalRecord, MoneyRemittance
+from patient.models import RegistrationPaymentModel
+from service.models import ServiceCategory
+
+ZERO = Decimal('0.00')
+
+# Transaction types that count as collections (also used for the cash/transfer split)
+COLLECTION_TRANSACTION_TYPES = [
+    'consultation_payment', 'drug_payment', 'lab_payment',
+    'scan_payment', 'surgery_payment', 'service', 'item', 'other_payment'
+]
+
+# Column key -> transaction type for the fixed report columns
+FIXED_COLUMNS = {
+    'cons_total': 'consultation_payment',
+    'lab_total': 'lab_payment',
+    'drugs_total': 'drug_payment',
+    'scan_total': 'scan_payment',
+    'surgery_total': 'surgery_payment',
+}
+
+GRAND_TOTAL_KEYS = {
+    'card': 'card_total',
+    'cons': 'cons_total',
+    'lab': 'lab_total',
+    'drugs': 'drugs_total',
+    'scan': 'scan_total',
+    'services': 'services_total',
+    'surgery': 'surgery_total',
+    'other': 'other_total',
+    'collections': 'total_collections',
+    'expenses': 'cash_expenses',
+    'withdrawals': 'wallet_withdrawals',
+    'net': 'net_cash_to_remit',
+}
+
+
+def _staff_filter(field, staff_ids):
+    if staff_ids is None:
+        return Q(**{f'{field}__isnull': False})
+    return Q(**{f'{field}__in': staff_ids})
+
+
+def _sum(field, condition=None):
+    return Sum(field, filter=condition, default=ZERO)
+
+
+def get_staff_collection_matrix(from_date, to_date, staff_ids=None):
+    """
+    Calculate collection data for every staff member with activity in the period.
+
+    Args:
+        from_date, to_date: Inclusive date range
+        staff_ids: Optional iterable of user ids to restrict the report to
+
+    Returns:
+        dict of user_id -> data dict with the same keys as get_staff_collection_data
+    """
+    if staff_ids is not None:
+        staff_ids = [int(staff_id) for staff_id in staff_ids]
+
+    service_categories = list(ServiceCategory.objects.filter(
+        show_as_record_column=True,
+        is_active=True
+    ).order_by('name'))
+
+    # 1. Patient transactions: every column in one grouped query.
+    # Grouping by other service name gives the "other" breakdown from the same pass;
+    # rows are folded back per staff member below.
+    service_types = Q(transaction_type__in=['service', 'item'])
+    collection_types = Q(transaction_type__in=COLLECTION_TRANSACTION_TYPES)
+    aggregates = {
+        key: _sum('direct_payment_amount', Q(transaction_type=transaction_type))
+        for key, transaction_type in FIXED_COLUMNS.items()
+    }
+    aggregates['other_total'] = _sum('direct_payment_amount', Q(transaction_type='other_payment'))
+    aggregates['collection_total'] = _sum('direct_payment_amount', collection_types)
+    aggregates['transfer_total'] = _sum(
+        'direct_payment_amount', collection_types & Q(payment_method__icontains='transfer')
+    )
+    for category in service_categories:
+        aggregates[f'category_{category.id}'] = _sum(
+            'direct_payment_amount',
+            service_types & (Q(service__service__category=category) | Q(service__service_item__category=category))
+        )
+
+    transaction_rows = PatientTransactionModel.objects.filter(
+        _staff_filter('received_by', staff_ids),
+        date__range=[from_date, to_date],
+        status='completed'
+    ).order_by().values('received_by_id', 'other_service__name').annotate(**aggregates)
+
+    # 2. Registrations
+    registration_rows = RegistrationPaymentModel.objects.filter(
+        _staff_filter('created_by', staff_ids),
+        date__range=[from_date, to_date],
+        status='confirmed'
+    ).order_by().values('created_by_id').annotate(
+        total=_sum('amount'),
+        transfer=_sum('amount', Q(payment_method__icontains='transfer'))
+    )
+
+    # 3. Cash expenses
+    expense_rows = Expense.objects.filter(
+        _staff_filter('paid_by', staff_ids),
+        date__range=[from_date, to_date],
+        payment_method='cash'
+    ).order_by().values('paid_by_id').annotate(total=_sum('amount'))
+
+    # 4. Wallet withdrawals
+    withdrawal_rows = WalletWithdrawalRecord.objects.filter(
+        _staff_filter('withdrawn_by', staff_ids),
+        withdrawal_date__date__range=[from_date, to_date]
+    ).order_by().values('withdrawn_by_id').annotate(total=_sum('amount'))
+
+    # 5. Approved remittances
+    remittance_rows = MoneyRemittance.objects.filter(
+        _staff_filter('remitted_by', staff_ids),
+        created_at__date__range=[from_date, to_date],
+        status='APPROVED'
+    ).order_by().values('remitted_by_id').annotate(total=_sum('amount_remitted_cash'))
+
+    raw = defaultdict(lambda: defaultdict(lambda: ZERO))
+    other_breakdowns = defaultdict(list)
+
+    for row in transaction_rows:
+        totals = raw[row['received_by_id']]
+        for key in aggregates:
+            totals[key] += row[key]
+        if row['other_total']:
+            other_breakdowns[row['received_by_id']].append({
+                'name': row['other_service__name'] or 'Other Payment',
+                'amount': row['other_total']
+            })
+
+    for row in registration_rows:
+        raw[row['created_by_id']]['card_total'] += row['total']
+        raw[row['created_by_id']]['card_transfer'] += row['transfer']
+
+    for row in expense_rows:
+        raw[row['paid_by_id']]['cash_expenses'] += row['total']
+
+    for row in withdrawal_rows:
+        raw[row['withdrawn_by_id']]['wallet_withdrawals'] += row['total']
+
+    remitted = {row['remitted_by_id']: row['total'] for row in remittance_rows}
+
+    matrix = {}
+    staff_keys = set(raw) | (set(staff_ids) if staff_ids is not None else set())
+    for staff_id in staff_keys:
+        totals = raw[staff_id]
+        data = {'card_total': totals['card_total']}
+        for key in FIXED_COLUMNS:
+            data[key] = totals[key]
+
+        service_breakdown = []
+        for category in service_categories:
+            category_total = totals[f'category_{category.id}']
+            if category_total > 0:  # Only include if there are transactions
+                service_breakdown.append({'name': category.name, 'amount': category_total})
+        data['service_breakdown'] = service_breakdown
+        data['services_total'] = sum((item['amount'] for item in service_breakdown), ZERO)
+
+        other_breakdown = sorted(other_breakdowns[staff_id], key=lambda item: item['name'])
+        data['other_breakdown'] = other_breakdown
+        data['other_total'] = sum((item['amount'] for item in other_breakdown), ZERO)
+
+        data['total_collections'] = (
+                data['card_total'] +
+                data['cons_total'] +
+                data['lab_total'] +
+                data['drugs_total'] +
+                data['scan_total'] +
+                data['services_total'] +
+                data['surgery_total'] +
+                data['other_total']
+        )
+
+        data['cash_expenses'] = totals['cash_expenses']
+        data['wallet_withdrawals'] = totals['wallet_withdrawals']
+        data['total_cash_out'] = data['cash_expenses'] + data['wallet_withdrawals']
+
+        transfer_collections = totals['transfer_total'] + totals['card_transfer']
+        cash_collections = (totals['collection_total'] - totals['transfer_total']) + \
+                           (totals['card_total'] - totals['card_transfer'])
+        data['cash_collections'] = cash_collections
+        data['transfer_collections'] = transfer_collections
+
+        data['previous_cash_remitted'] = remitted.get(staff_id, ZERO)
+        data['net_cash_to_remit'] = (
+                cash_collections -
+                data['cash_expenses'] -
+                data['wallet_withdrawals'] -
+                data['previous_cash_remitted']
+        )
+        # Transfer collections don't need remittance (already in bank)
+        data['net_transfer'] = transfer_collections
+
+        matrix[staff_id] = data
+
+    return matrix
+
+
+def build_all_staff_collections(from_date, to_date, staff_filter=None):
+    """
+    Build the rows and grand totals shared by the all-staff collection views.
+
+    Returns:
+        (rows, grand_totals) where each row is the staff member's data dict plus 'staff'
+    """
+    matrix = get_staff_collection_matrix(
+        from_date, to_date, staff_ids=[staff_filter] if staff_filter else None
+    )
+
+    if staff_filter:
+        staff_list = User.objects.filter(id=staff_filter, is_active=True)
+    else:
+        staff_list = User.objects.filter(id__in=list(matrix), is_active=True).order_by('username')
+
+    rows = []
+    grand_totals = {key: ZERO for key in GRAND_TOTAL_KEYS}
+    for staff in staff_list:
+        data = matrix.get(staff.id)
+        if data is None:
+            continue
+        rows.append({'staff': staff, 'net_to_remit': data['net_cash_to_remit'], **data})
+        for total_key, data_key in GRAND_TOTAL_KEYS.items():
+            grand_totals[total_key] += data[data_key]
+
+    return rows, grand_totals
@@ -0,0 +1,166 @@
+"""
+Transaction browser.
+
+Pages through top-level patient transactions newest first with keyset (cursor)
+pagination on (date, id) instead of OFFSET, so a page deep into the history
+costs the same as the first one. Every filter has a matching
+(<filter>, date, id) index on PatientTransactionModel, which lets the database
+walk the index from the cursor and stop after one page.
+
+JSON contract of transaction_browser_api (finance/transactions/api/):
+
+    {
+        "results": [<transaction>, ...],   # see serialize_transaction()
+        "count": <rows in this page>,
+        "has_more": <bool>,
+        "next_cursor": <opaque string or null>
+    }
+
+Pass next_cursor back as ?cursor= to get the following page.
+"""
+import base64
+from datetime import date
+
+from django.db.models import Q
+from django.urls import reverse
+
+from finance.models import PatientTransactionModel
+from patient.models import PatientModel
+from patient.search import search_patients
+
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+# Most patients a search term may expand to before it is applied to transactions
+SEARCH_PATIENT_LIMIT = 200
+
+# Query parameter -> exact match field
+FILTER_FIELDS = {
+    'status': 'status',
+    'transaction_type': 'transaction_type',
+    'transaction_direction': 'transaction_direction',
+    'payment_method': 'payment_method',
+    'received_by': 'received_by_id',
+    'patient': 'patient_id',
+}
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(transaction):
+    value = f'{transaction.date.isoformat()}|{transaction.id}'
+    return base64.urlsafe_b64encode(value.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Return the (date, id) position encoded in a cursor"""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        day, pk = base64.urlsafe_b64decode(padded.encode()).decode().split('|')
+        return date.fromisoformat(day), int(pk)
+    except (ValueError, UnicodeDecodeError):
+        raise InvalidCursor('Invalid cursor')
+
+
+def after_cursor(qs, cursor):
+    """Rows of a (-date, -id) ordered queryset that come after the cursor position"""
+    cursor_date, cursor_id = decode_cursor(cursor)
+    return qs.filter(Q(date__lt=cursor_date) | Q(date=cursor_date, id__lt=cursor_id))
+
+
+def _search_filter(search):
+    """
+    Exact transaction ID, or transactions of patients found by the patient
+    search index, or walk-in sales by customer name prefix.
+    """
+    patient_ids = list(
+        search_patients(search, PatientModel.objects.all()).values_list('id', flat=True)[:SEARCH_PATIENT_LIMIT]
+    )
+    return (
+        Q(transaction_id=search) |
+        Q(patient_id__in=patient_ids) |
+        Q(patient__isnull=True, customer_name__istartswith=search)
+    )
+
+
+def filter_transactions(params):
+    """
+    Top-level transactions (child items of a multi-item payment are left out)
+    matching the filters in params (a QueryDict or dict), newest first.
+    """
+    qs = PatientTransactionModel.objects.filter(
+        parent_transaction__isnull=True
+    ).select_related('patient', 'received_by')
+
+    start_date = params.get('start_date')
+    end_date = params.get('end_date')
+    if start_date:
+        qs = qs.filter(date__gte=start_date)
+    if end_date:
+        qs = qs.filter(date__lte=end_date)
+
+    for param, field in FILTER_FIELDS.items():
+        value = params.get(param)
+        if value:
+            qs = qs.filter(**{field: value})
+
+    search = (params.get('search') or '').strip()
+    if search:
+        qs = qs.filter(_search_filter(search))
+
+    return qs.order_by('-date', '-id')
+
+
+def get_page_size(params):
+    try:
+        size = int(params.get('limit') or DEFAULT_PAGE_SIZE)
+    except (TypeError, ValueError):
+        size = DEFAULT_PAGE_SIZE
+    return max(1, min(size, MAX_PAGE_SIZE))
+
+
+def get_page(params):
+    """
+    Return (transactions, next_cursor) for the page after params['cursor']
+    (the first page when no cursor is given).
+
+    Raises:
+        InvalidCursor: the cursor could not be decoded
+    """
+    qs = filter_transactions(params)
+    page_size = get_page_size(params)
+
+    cursor = params.get('cursor')
+    if cursor:
+        qs = after_cursor(qs, cursor)
+
+    # One extra row tells us whether another page exists without a COUNT
+    rows = list(qs[:page_size + 1])
+    transactions = rows[:page_size]
+    next_cursor = encode_cursor(transactions[-1]) if len(rows) > page_size else None
+    return transactions, next_cursor
+
+
+def serialize_transaction(transaction):
+    received_by = transaction.received_by
+    return {
+        'id': transaction.id,
+        'transaction_id': transaction.transaction_id,
+        'date': transaction.date.isoformat(),
+        'created_at': transaction.created_at.isoformat(),
+        'transaction_type': transaction.transaction_type,
+        'transaction_type_display': transaction.get_transaction_type_display(),
+        'direction': transaction.transaction_direction,
+        'amount': str(transaction.amount),
+        'old_balance': str(transaction.old_balance),
+        'new_balance': str(transaction.new_balance),
+        'payment_method': transaction.payment_method,
+        'status': transaction.status,
+        'customer': transaction.customer_display,
+        'patient_id': transaction.patient_id,
+        'card_number': transaction.patient.card_number if transaction.patient else None,
+        'received_by': (received_by.get_full_name() or received_by.username) if received_by else None,
+        'detail_url': reverse('transaction_detail', args=[transaction.pk]),
+    }
@@ -69,14 +69,14 @@ from .views import (
     OtherPaymentServiceUpdateView, OtherPaymentServiceDeleteView, process_other_payment_ajax, OtherPaymentView,
     ajax_process_admission_funding, AdmissionSurgeryFundingView, staff_remittance_detail_view,
     finance_service_patient_payment, finance_wallet_tools_entry, finance_wallet_history, finance_wallet_withdrawal,
-    finance_process_refund, process_direct_payment, transaction_list, transaction_detail, wallet_funding_only_page,
+    finance_process_refund, process_direct_payment, transaction_browser_api, transaction_detail, wallet_funding_only_page,
     UnifiedPaymentView, ajax_process_consultation_payment, ajax_reuse_consultation_payment,
     ajax_get_admission_surgery_details, ajax_process_other_payment, StaffTransactionHistoryView,
     PersonalStaffCollectionExcelView, PersonalStaffCollectionView, AllStaffCollectionsView,
     AllStaffCollectionsExcelView,
     AllStaffCollectionsPDFView, StaffTransactionHistoryExcelView, PersonalStaffCollectionPDFView,
     StaffTransactionHistoryPDFView, RevertRegistrationPaymentView, direct_sales_page, verify_customer_for_sales,
-    add_order_item_ajax, process_direct_sales_payment,
+    add_order_item_ajax, process_direct_sales_payment, financial_period_index, financial_period_close,
 )
 
 urlpatterns = [
@@ -190,7 +190,7 @@ urlpatterns = [
     path('wallet-funding-only/', wallet_funding_only_page, name='wallet_funding_only'),
 
     # Transaction views
-    path('transactions/', transaction_list, name='patient_transaction_index'),
+    path('transactions/api/', transaction_browser_api, name='transaction_browser_api'),
     path('transactions/<int:transaction_id>/', transaction_detail, name='transaction_detail'),
 
     # Patient verification AJAX
@@ -236,5 +236,9 @@ urlpatterns = [
     path('api/add-order-item/', add_order_item_ajax, name='add_order_item_ajax'),
     path('api/process-direct-sales-payment/', process_direct_sales_payment, name='process_direct_sales_payment'),
 
+    # ==== MONTH-END CLOSE ====
+    path('periods/', financial_period_index, name='financial_period_index'),
+    path('periods/close/', financial_period_close, name='financial_period_close'),
+
 ]
 
@@ -1,5 +1,4 @@
 # views.py
-import calendar
 from datetime import timedelta, date, datetime
 from decimal import Decimal, ROUND_HALF_UP
 from io import BytesIO
@@ -8,6 +7,7 @@ from django.contrib.auth.decorators import login_required, permission_required
 from django.contrib.auth.models import User
 from django.contrib.messages.views import SuccessMessageMixin
 from django.core import serializers
+from django.core.exceptions import ValidationError
 from django.db import transaction
 from django import forms
 from django.db.models.functions import TruncMonth
@@ -25,7 +25,7 @@ from django.contrib import messages
 from django.http import HttpResponse, JsonResponse, HttpResponseBadRequest, HttpResponseRedirect
 from django.template.loader import render_to_string
 import openpyxl
-from openpyxl.styles import Font, Alignment, PatternFill, Side, Border
+from openpyxl.styles import Font, Alignment, PatternFill
 from openpyxl.workbook import Workbook
 from reportlab.lib import colors
 from reportlab.lib.enums import TA_CENTER
@@ -34,6 +34,7 @@ from reportlab.lib.styles import ParagraphStyle, getSampleStyleSheet
 from reportlab.lib.units import inch
 from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer
 
+from admin_site.exports import ExportSheet, Styled, money, iterate, export_response, CENTER
 from admin_site.models import SiteInfoModel
 from consultation.models import ConsultationFeeModel, SpecializationModel, PatientQueueModel
 from finance.forms import FinanceSettingForm, ExpenseCategoryForm, \
@@ -41,7 +42,12 @@ from finance.forms import FinanceSettingForm, ExpenseCategoryForm, \
     ExpenseForm, PaysheetRowForm, MoneyRemittanceForm, OtherPaymentServiceForm, OtherPaymentForm
 from finance.models import PatientTransactionModel, FinanceSettingModel, ExpenseCategory, SalaryStructure, \
     StaffBankDetail, SalaryRecord, Income, IncomeCategory, Expense, MoneyRemittance, OtherPaymentService, \
-    WalletWithdrawalRecord
+    WalletWithdrawalRecord, FinancialPeriod
+from finance.period_close import close_period
+from finance.rollups import get_direction_totals, get_daily_totals, get_monthly_totals, get_breakdown
+from finance.staff_collections import get_staff_collection_matrix, build_all_staff_collections
+from finance.transaction_browser import filter_transactions, get_page as get_transaction_page, \
+    serialize_transaction, InvalidCursor, DEFAULT_PAGE_SIZE
 from human_resource.models import DepartmentModel, StaffModel
 from human_resource.views import FlashFormErrorsMixin
 from inpatient.models import Admission, Surgery
@@ -49,7 +55,9 @@ from insurance.claim_helpers import get_orders_with_claim_info
 from insurance.models import PatientInsuranceModel
 from laboratory.models import LabTestOrderModel
 from patient.forms import RegistrationPaymentForm
-from patient.models import RegistrationPaymentModel, RegistrationFeeModel, PatientModel, PatientWalletModel
+from patient.models import RegistrationPaymentModel, RegistrationFeeModel, PatientModel, PatientWalletModel, \
+    WalletLedgerEntry, InsufficientWalletBalance, DuplicateWalletEntry
+from patient.search import get_patient_by_card
 
 import json
 from django.core.serializers.json import DjangoJSONEncoder
@@ -363,6 +371,8 @@ def patient_wallet_funding(request):
         # keep old behavior if anything goes wrong
         pass
 
+    # Sent back with the payment so a retried or double-submitted request is only applied once
+    context['idempotency_key'] = uuid.uuid4().hex
     return render(request, 'finance/wallet/funding.html', context)
 
 
@@ -378,7 +388,7 @@ def calculate_insurance_amount(base_amount, coverage_percentage):
 @login_required
 def verify_patient_ajax(request):
     """Verify patient by card number and return wallet details with pending payments"""
-    from insurance.claim_helpers import get_orders_with_claim_info, get_pending_claim_for_order
+    from insurance.claim_helpers import get_orders_with_claim_info, get_pending_claim_for_order, resolve_claims
 
     card_number = request.GET.get('card_number', '').strip()
 
@@ -387,7 +397,7 @@ def verify_patient_ajax(request):
 
     try:
         # Look up patient by card number
-        patient = PatientModel.objects.get(card_number__iexact=card_number)
+        patient = get_patient_by_card(card_number)
 
         # Get or create wallet
         wallet, created = PatientWalletModel.objects.get_or_create(
@@ -432,6 +442,14 @@ def verify_patient_ajax(request):
             ordered_at__gte=thirty_days_ago
         ).select_related('template')
 
+        pending_services_items = list(pending_services_items)
+        pending_drugs = list(pending_drugs)
+        pending_labs = list(pending_labs)
+        pending_scans = list(pending_scans)
+
+        # Approved and pending claims for every line item, one query per order type
+        claims = resolve_claims(pending_services_items + pending_drugs + pending_labs + pending_scans)
+
         # --- INSURANCE CHECK ---
         active_insurance = None
         if hasattr(patient, 'insurance_policies'):
@@ -461,7 +479,7 @@ def verify_patient_ajax(request):
             base_amount = transaction.total_amount
 
             # Get claim info
-            pending_claim = get_pending_claim_for_order(transaction)
+            pending_claim = get_pending_claim_for_order(transaction, claims=claims)
 
             # For services, use base amount (no auto claims yet in your system)
             patient_amount = base_amount
@@ -485,7 +503,7 @@ def verify_patient_ajax(request):
             service_total += patient_amount
 
         # 2. Process drug orders with claim-based logic
-        drug_results = get_orders_with_claim_info(pending_drugs, 'drug')
+        drug_results = get_orders_with_claim_info(pending_drugs, 'drug', claims=claims)
         drug_items = []
         drug_total = Decimal('0.00')
 
@@ -511,7 +529,7 @@ def verify_patient_ajax(request):
             drug_total += result['patient_amount']
 
         # 3. Process lab orders with claim-based logic
-        lab_results = get_orders_with_claim_info(pending_labs, 'lab')
+        lab_results = get_orders_with_claim_info(pending_labs, 'lab', claims=claims)
         lab_items = []
         lab_total = Decimal('0.00')
 
@@ -536,7 +554,7 @@ def verify_patient_ajax(request):
             lab_total += result['patient_amount']
 
         # 4. Process scan orders with claim-based logic
-        scan_results = get_orders_with_claim_info(pending_scans, 'scan')
+        scan_results = get_orders_with_claim_info(pending_scans, 'scan', claims=claims)
         scan_items = []
         scan_total = Decimal('0.00')
 
@@ -660,14 +678,14 @@ def process_wallet_funding(request):
             defaults={'amount': Decimal('0.00')}
         )
 
-        patient_old_balance = wallet.amount
-
         with transaction.atomic():
             # Add funds to wallet
-            wallet.amount += funding_amount
-            wallet.save()
-
-            patient_new_balance = wallet.amount
+            entry = wallet.credit(
+                funding_amount, 'funding', user=request.user, description=f'Wallet funding ({payment_method})',
+                idempotency_key=request.POST.get('idempotency_key')
+            )
+            patient_old_balance = entry.balance_before
+            patient_new_balance = entry.balance_after
 
             PatientTransactionModel.objects.create(
                 patient=patient,
@@ -723,6 +741,8 @@ def process_wallet_funding(request):
 
     except PatientModel.DoesNotExist:
         return JsonResponse({'error': 'Patient not found'}, status=404)
+    except DuplicateWalletEntry as e:
+        return _duplicate_wallet_response(e, reverse('patient_wallet_dashboard', args=[patient.id]))
     except ValueError:
         return JsonResponse({'error': 'Invalid funding amount'}, status=400)
     except Exception as e:
@@ -732,7 +752,7 @@ def process_wallet_funding(request):
 @login_required
 def calculate_payment_total_ajax(request):
     """Calculate total based on selected items - CLAIM-BASED VERSION"""
-    from insurance.claim_helpers import calculate_patient_amount_with_claim
+    from insurance.claim_helpers import calculate_patient_amount_with_claim, resolve_claims
 
     try:
         patient_id = request.GET.get('patient_id')
@@ -767,6 +787,7 @@ def calculate_payment_total_ajax(request):
                 patient=patient
             ).select_related('drug')
 
+            claims = resolve_claims(drug_orders)
             for order in drug_orders:
                 base_amount = (
                     order.drug.selling_price * Decimal(str(order.quantity_ordered))
@@ -775,7 +796,7 @@ def calculate_payment_total_ajax(request):
                 )
 
                 # Use claim-based calculation
-                claim_info = calculate_patient_amount_with_claim(order, base_amount)
+                claim_info = calculate_patient_amount_with_claim(order, base_amount, claims=claims)
                 patient_amount = claim_info['patient_amount']
 
                 total_amount += patient_amount
@@ -795,11 +816,12 @@ def calculate_payment_total_ajax(request):
                 patient=patient
             ).select_related('template')
 
+            claims = resolve_claims(lab_orders)
             for order in lab_orders:
                 base_amount = order.amount_charged or order.template.price
 
                 # Use claim-based calculation
-                claim_info = calculate_patient_amount_with_claim(order, base_amount)
+                claim_info = calculate_patient_amount_with_claim(order, base_amount, claims=claims)
                 patient_amount = claim_info['patient_amount']
 
                 total_amount += patient_amount
@@ -819,11 +841,12 @@ def calculate_payment_total_ajax(request):
                 patient=patient
             ).select_related('template')
 
+            claims = resolve_claims(scan_orders)
             for order in scan_orders:
                 base_amount = order.amount_charged or order.template.price
 
                 # Use claim-based calculation
-                claim_info = calculate_patient_amount_with_claim(order, base_amount)
+                claim_info = calculate_patient_amount_with_claim(order, base_amount, claims=claims)
                 patient_amount = claim_info['patient_amount']
 
                 total_amount += patient_amount
@@ -1027,8 +1050,10 @@ def process_wallet_payment(request):
                 }, status=400)
 
             # Process payment
-            wallet.amount -= total_to_pay
-            wallet.save()
+            wallet.debit(
+                total_to_pay, 'payment', user=request.user, description=f'{payment_type.title()} payment',
+                idempotency_key=request.POST.get('idempotency_key')
+            )
 
             # Update order statuses
             for item in payment_items:
@@ -1066,6 +1091,10 @@ def process_wallet_payment(request):
             'redirect_url': reverse('wallet:patient_dashboard', args=[patient.id])
         })
 
+    except DuplicateWalletEntry as e:
+        return _duplicate_wallet_response(e)
+    except InsufficientWalletBalance as e:
+        return JsonResponse({'error': str(e)}, status=400)
     except Exception as e:
         return JsonResponse({
             'error': f'Error processing payment: {str(e)}'
@@ -1088,6 +1117,21 @@ def _quantize_money(d: Decimal) -> Decimal:
     return d.quantize(Decimal('0.01'), rounding=ROUND_HALF_UP)
 
 
+def _duplicate_wallet_response(error, redirect_url=None):
+    """Response for a retried wallet operation whose idempotency key was already applied"""
+    wallet = PatientWalletModel.objects.get(pk=error.entry.wallet_id)
+    response = {
+        'success': True,
+        'duplicate': True,
+        'message': str(error),
+        'new_balance': float(wallet.amount),
+        'formatted_new_balance': f'₦{wallet.amount:,.2f}',
+    }
+    if redirect_url:
+        response['redirect_url'] = redirect_url
+    return JsonResponse(response)
+
+
 @login_required
 @permission_required('finance.add_patienttransactionmodel', raise_exception=True)
 def finance_payment_select(request):
@@ -1247,16 +1291,15 @@ def process_other_payment_ajax(request):
 
             try:
                 with transaction.atomic():
-                    old_balance = wallet.amount
-                    wallet.deduct_funds(amount)
+                    entry = wallet.debit(amount, 'payment', user=request.user, description=service.name)
                     new_transaction = PatientTransactionModel.objects.create(
                         patient=patient,
                         transaction_type='other_payment',
                         transaction_direction='out',
                         other_service=service,
                         amount=amount,
-                        old_balance=old_balance,
-                        new_balance=wallet.amount,
+                        old_balance=entry.balance_before,
+                        new_balance=entry.balance_after,
                         date=timezone.now().date(),
                         received_by=request.user,
                         payment_method='wallet',
@@ -1521,9 +1564,8 @@ def finance_consultation_patient_payment(request, patient_id):
             if wallet.amount < amount_paid:
                 return JsonResponse({'success': False, 'error': 'Insufficient wallet balance.'}, status=400)
 
-            old_balance = wallet.amount
-            wallet.amount -= amount_paid
-            wallet.save()
+            entry = wallet.debit(amount_paid, 'payment', user=request.user, description='Consultation payment')
+            old_balance = entry.balance_before
 
             # 2. Link the fee_structure to the new transaction
             payment = PatientTransactionModel.objects.create(
@@ -1558,6 +1600,8 @@ def finance_consultation_patient_payment(request, patient_id):
 
     except ConsultationFeeModel.DoesNotExist:
         return JsonResponse({'success': False, 'error': 'Invalid fee structure selected.'}, status=400)
+    except InsufficientWalletBalance:
+        return JsonResponse({'success': False, 'error': 'Insufficient wallet balance.'}, status=400)
     except Exception as e:
         return JsonResponse({'success': False, 'error': f'Error processing payment: {str(e)}'}, status=500)
 
@@ -1571,7 +1615,7 @@ def finance_pharmacy_patient_payment(request, patient_id):
     - GET: render list of pending drug orders with claim status
     - POST: process selected orders using approved claims
     """
-    from insurance.claim_helpers import get_orders_with_claim_info, calculate_patient_amount_with_claim
+    from insurance.claim_helpers import get_orders_with_claim_info, calculate_patient_amount_with_claim, resolve_claims
 
     patient = get_object_or_404(PatientModel, id=patient_id)
     thirty_days_ago = timezone.now() - timedelta(days=THIRTY_DAYS)
@@ -1659,6 +1703,7 @@ def finance_pharmacy_patient_payment(request, patient_id):
         order_details = []
 
         # Calculate amounts using claim-based logic
+        claims = resolve_claims(selected_orders)
         for order in selected_orders:
             if getattr(order, 'ordered_at', timezone.now()) < thirty_days_ago:
                 return JsonResponse({
@@ -1673,7 +1718,7 @@ def finance_pharmacy_patient_payment(request, patient_id):
             )
 
             # Use claim-based calculation
-            claim_info = calculate_patient_amount_with_claim(order, base_amount)
+            claim_info = calculate_patient_amount_with_claim(order, base_amount, claims=claims)
             patient_amount = claim_info['patient_amount']
 
             total_amount += _quantize_money(patient_amount)
@@ -1703,9 +1748,8 @@ def finance_pharmacy_patient_payment(request, patient_id):
                     'formatted_shortfall': f'₦{shortfall:,.2f}'
                 }, status=400)
 
-            old_balance = wallet.amount
-            wallet.amount = _quantize_money(wallet.amount - total_amount)
-            wallet.save()
+            entry = wallet.debit(total_amount, 'payment', user=request.user, description='Drug payment')
+            old_balance = entry.balance_before
 
             # Mark orders as paid
             for detail in order_details:
@@ -1925,9 +1969,8 @@ def finance_service_patient_payment(request, patient_id):
                 }, status=400)
 
             # deduct
-            old_balance = wallet.amount
-            wallet.amount = _quantize_money(wallet.amount - total_amount)
-            wallet.save()
+            entry = wallet.debit(total_amount, 'payment', user=request.user, description='Service payment')
+            old_balance = entry.balance_before
 
             # mark transactions as paid
             for t in selected_transactions:
@@ -1977,7 +2020,7 @@ def finance_generic_order_payment(request, patient_id, order_type):
     Generic handler used for lab/scan payments - CLAIM-BASED VERSION
     order_type: 'lab' or 'scan'
     """
-    from insurance.claim_helpers import get_orders_with_claim_info, calculate_patient_amount_with_claim
+    from insurance.claim_helpers import get_orders_with_claim_info, calculate_patient_amount_with_claim, resolve_claims
 
     patient = get_object_or_404(PatientModel, id=patient_id)
     thirty_days_ago = timezone.now() - timedelta(days=THIRTY_DAYS)
@@ -2078,6 +2121,7 @@ def finance_generic_order_payment(request, patient_id, order_type):
         order_details = []
 
         # Calculate amounts using claim-based logic
+        claims = resolve_claims(selected_orders)
         for order in selected_orders:
             if getattr(order, 'ordered_at', timezone.now()) < thirty_days_ago:
                 return JsonResponse({
@@ -2090,7 +2134,7 @@ def finance_generic_order_payment(request, patient_id, order_type):
             )
 
             # Use claim-based calculation
-            claim_info = calculate_patient_amount_with_claim(order, base_amount)
+            claim_info = calculate_patient_amount_with_claim(order, base_amount, claims=claims)
             patient_amount = claim_info['patient_amount']
 
             total_amount += _quantize_money(patient_amount)
@@ -2120,9 +2164,8 @@ def finance_generic_order_payment(request, patient_id, order_type):
                     'formatted_shortfall': f'₦{shortfall:,.2f}'
                 }, status=400)
 
-            old_balance = wallet.amount
-            wallet.amount = _quantize_money(wallet.amount - total_amount)
-            wallet.save()
+            entry = wallet.debit(total_amount, 'payment', user=request.user, description=f'{order_type.title()} payment')
+            old_balance = entry.balance_before
 
             # Mark orders as paid
             for detail in order_details:
@@ -2177,12 +2220,10 @@ def finance_scan_patient_payment(request, patient_id):
     return finance_generic_order_payment(request, patient_id, 'scan')
 
 
-class PatientTransactionListView(LoginRequiredMixin, PermissionRequiredMixin, ListView):
-    model = PatientTransactionModel
+class PatientTransactionListView(LoginRequiredMixin, PermissionRequiredMixin, TemplateView):
+    """Transaction browser page; rows are loaded page by page from transaction_browser_api"""
     template_name = "finance/payment/index.html"
-    context_object_name = "transactions"
     permission_required = "finance.view_patienttransactionmodel"
-    paginate_by = 20
 
     def get(self, request, *args, **kwargs):
         """Override get method to handle Excel download requests"""
@@ -2190,69 +2231,33 @@ class PatientTransactionListView(LoginRequiredMixin, PermissionRequiredMixin, Li
             return self.download_excel()
         return super().get(request, *args, **kwargs)
 
-    def get_queryset(self):
-        """
-        Filters the queryset based on GET parameters from the URL.
-        """
-        # Eager load related models to prevent N+1 query issues
-        qs = PatientTransactionModel.objects.select_related('patient', 'received_by')
-        qs = qs.filter(parent_transaction__isnull=True)
-
-        # Get filter parameters from the request
-        start_date = self.request.GET.get("start_date")
-        end_date = self.request.GET.get("end_date")
-        search = self.request.GET.get("search")
-        transaction_type = self.request.GET.get("transaction_type")
+    def get_filters(self):
+        """Request filters, defaulting to today's transactions when no date range is given"""
+        filters = self.request.GET.dict()
+        if not filters.get('start_date') and not filters.get('end_date'):
+            today = now().date().isoformat()
+            filters['start_date'] = filters['end_date'] = today
+        return filters
 
-        # Default to today's transactions if no date range is provided
-        if not start_date and not end_date:
-            today = now().date()
-            qs = qs.filter(date=today)
-        elif start_date and end_date:
-            qs = qs.filter(date__range=[start_date, end_date])
-
-        # Apply search filter for patient name or transaction ID
-        if search:
-            qs = qs.filter(
-                Q(patient__first_name__icontains=search) |
-                Q(patient__last_name__icontains=search) |
-                Q(patient__card_number__icontains=search) |
-                Q(customer_name__icontains=search) |  # For walk-ins
-                Q(transaction_id__icontains=search)
-            )
-
-        # Apply choice filters
-        if transaction_type:
-            qs = qs.filter(transaction_type=transaction_type)
-
-
-        return qs.order_by("-created_at")
+    def get_queryset(self):
+        return filter_transactions(self.get_filters())
 
     def get_context_data(self, **kwargs):
         """
-        Adds summary data and filter choices to the template context.
+        Adds the filters and filter choices to the template context.
         """
         context = super().get_context_data(**kwargs)
-        queryset = context['object_list']  # Use the paginated queryset from the context
+        filters = self.get_filters()
 
-        # Determine timeframe for the page title
-        start_date = self.request.GET.get("start_date")
-        end_date = self.request.GET.get("end_date")
-
-        if start_date and end_date:
-            context['timeframe'] = f"from {start_date} to {end_date}"
+        if self.request.GET.get("start_date") or self.request.GET.get("end_date"):
+            context['timeframe'] = f"from {filters.get('start_date') or '...'} to {filters.get('end_date') or '...'}"
         else:
             context['timeframe'] = "for Today"
 
-        # Calculate total inflow and outflow using database aggregation for efficiency
-        totals = queryset.aggregate(
-            total_inflow=Sum('amount', filter=Q(transaction_direction='in')),
-        )
-        context['total_inflow'] = totals['total_inflow'] or Decimal('0.00')
-
-        # Pass transaction type choices to the template for the filter dropdown
+        context['filters'] = filters
         context['transaction_types'] = PatientTransactionModel.TRANSACTION_TYPE
-
+        context['status_choices'] = PatientTransactionModel._meta.get_field('status').choices
+        context['page_size'] = DEFAULT_PAGE_SIZE
         return context
 
     def download_excel(self):
@@ -2350,6 +2355,25 @@ class PatientTransactionListView(LoginRequiredMixin, PermissionRequiredMixin, Li
         return response
 
 
+@login_required
+@permission_required('finance.view_patienttransactionmodel', raise_exception=True)
+def transaction_browser_api(request):
+    """Keyset-paginated transaction list as JSON (see finance.transaction_browser)"""
+    try:
+        transactions, next_cursor = get_transaction_page(request.GET)
+    except InvalidCursor as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    except (ValueError, ValidationError):
+        return JsonResponse({'error': 'Invalid filter value'}, status=400)
+
+    return JsonResponse({
+        'results': [serialize_transaction(t) for t in transactions],
+        'count': len(transactions),
+        'has_more': next_cursor is not None,
+        'next_cursor': next_cursor,
+    })
+
+
 class PatientTransactionDetailView(LoginRequiredMixin, PermissionRequiredMixin, DetailView):
     model = PatientTransactionModel
     template_name = "finance/payment/detail.html"
@@ -2991,52 +3015,43 @@ def export_payroll_to_excel(request, year, month):
     # 1. Fetch the relevant salary records
     queryset = SalaryRecord.objects.filter(year=year, month=month).select_related('staff')
 
-    # 2. Create an in-memory Excel workbook
-    workbook = openpyxl.Workbook()
-    worksheet = workbook.active
     month_name = datetime(2000, month, 1).strftime('%B')
-    worksheet.title = f'Payroll_{year}_{month_name}'
 
-    # 3. Define the detailed header row
+    # 2. Define the detailed header row
     headers = [
         'Staff ID', 'Full Name', 'Basic Salary', 'Housing', 'Transport', 'Medical',
         'Other Allowances', 'Bonus', 'Gross Salary', 'Tax (PAYE)', 'Pension',
         'Other Deductions', 'Total Deductions', 'Net Salary', 'Amount Paid', 'Status', 'Notes'
     ]
-    for col_num, header_title in enumerate(headers, 1):
-        cell = worksheet.cell(row=1, column=col_num, value=header_title)
-        cell.font = Font(bold=True)
-
-    # 4. Write data rows for each salary record
-    for row_num, record in enumerate(queryset, 2):
-        worksheet.cell(row=row_num, column=1, value=record.staff.staff_id)
-        worksheet.cell(row=row_num, column=2, value=record.staff.__str__())
-        worksheet.cell(row=row_num, column=3, value=record.basic_salary)
-        worksheet.cell(row=row_num, column=4, value=record.housing_allowance)
-        worksheet.cell(row=row_num, column=5, value=record.transport_allowance)
-        worksheet.cell(row=row_num, column=6, value=record.medical_allowance)
-        worksheet.cell(row=row_num, column=7, value=record.other_allowances)
-        worksheet.cell(row=row_num, column=8, value=record.bonus)
-        worksheet.cell(row=row_num, column=9, value=record.gross_salary)
-        worksheet.cell(row=row_num, column=10, value=record.tax_amount)
-        worksheet.cell(row=row_num, column=11, value=record.pension_amount)
-        worksheet.cell(row=row_num, column=12, value=record.other_deductions)
-        worksheet.cell(row=row_num, column=13, value=record.total_deductions)
-        worksheet.cell(row=row_num, column=14, value=record.net_salary)
-        worksheet.cell(row=row_num, column=15, value=record.amount_paid)
-        worksheet.cell(row=row_num, column=16, value=record.payment_status)
-        worksheet.cell(row=row_num, column=17, value=record.notes)
-
-    # 5. Create the HttpResponse object with the correct headers
-    response = HttpResponse(
-        content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-    )
-    response['Content-Disposition'] = f'attachment; filename="payroll_{year}_{month_name}.xlsx"'
 
-    # Save the workbook to the response
-    workbook.save(response)
-
-    return response
+    # 3. Stream one row per salary record
+    def rows():
+        for record in iterate(queryset):
+            yield [
+                record.staff.staff_id,
+                record.staff.__str__(),
+                record.basic_salary,
+                record.housing_allowance,
+                record.transport_allowance,
+                record.medical_allowance,
+                record.other_allowances,
+                record.bonus,
+                record.gross_salary,
+                record.tax_amount,
+                record.pension_amount,
+                record.other_deductions,
+                record.total_deductions,
+                record.net_salary,
+                record.amount_paid,
+                record.payment_status,
+                record.notes,
+            ]
+
+    sheet = ExportSheet(
+        f'Payroll_{year}_{month_name}', rows(), headers=headers,
+        header_font=Font(bold=True), header_fill=None
+    )
+    return export_response(request, f'payroll_{year}_{month_name}', [sheet])
 
 
 # -------------------------
@@ -3445,27 +3460,25 @@ def finance_dashboard(request):
     today = timezone.now().date()
     current_month_start = today.replace(day=1)
     last_month_start = (current_month_start - timedelta(days=1)).replace(day=1)
-    last_month_end = current_month_start - timedelta(days=1)
-    thirty_days_ago = today - timedelta(days=30)
 
-    # Basic transaction metrics
+    # Totals, KPIs and chart series come from the daily rollup table
     total_transactions = PatientTransactionModel.objects.filter(status='completed')
 
-    # Revenue calculations (all inflow transactions)
-    revenue_transactions = total_transactions.filter(transaction_direction='in')
-    total_revenue = revenue_transactions.aggregate(
-        total=Sum('amount')
-    )['total'] or Decimal('0.00')
+    all_time_totals = get_direction_totals()
+    total_revenue = all_time_totals['in']['total']
+    total_outflow = all_time_totals['out']['total']
+
+    # Last 12 months in one grouped query
+    twelve_months_start = current_month_start
+    for _ in range(11):
+        twelve_months_start = (twelve_months_start - timedelta(days=1)).replace(day=1)
+    monthly_totals = get_monthly_totals(twelve_months_start, today)
 
     # Current month revenue
-    revenue_month = revenue_transactions.filter(
-        date__gte=current_month_start
-    ).aggregate(total=Sum('amount'))['total'] or Decimal('0.00')
+    revenue_month = monthly_totals.get((current_month_start, 'in'), Decimal('0.00'))
 
     # Last month revenue for growth calculation
-    revenue_last_month = revenue_transactions.filter(
-        date__range=[last_month_start, last_month_end]
-    ).aggregate(total=Sum('amount'))['total'] or Decimal('0.00')
+    revenue_last_month = monthly_totals.get((last_month_start, 'in'), Decimal('0.00'))
 
     # Calculate revenue growth
     if revenue_last_month > 0:
@@ -3474,28 +3487,22 @@ def finance_dashboard(request):
     else:
         revenue_growth = 0 if revenue_month == 0 else 100
 
-    # Today's metrics
-    revenue_today = revenue_transactions.filter(
-        date=today
-    ).aggregate(total=Sum('amount'))['total'] or Decimal('0.00')
+    # Last 30 days (including today) in one grouped query
+    daily_totals = get_daily_totals(today - timedelta(days=29), today)
+    empty_day = {'total': Decimal('0.00'), 'count': 0}
 
-    transactions_today_count = total_transactions.filter(date=today).count()
+    # Today's metrics
+    revenue_today = daily_totals.get((today, 'in'), empty_day)['total']
+    outflow_today = daily_totals.get((today, 'out'), empty_day)['total']
+    transactions_today_count = (
+        daily_totals.get((today, 'in'), empty_day)['count'] + daily_totals.get((today, 'out'), empty_day)['count']
+    )
 
     # Total wallet balances (current patient wallet funds)
     total_wallet_balance = PatientWalletModel.objects.aggregate(
         total=Sum('amount')
     )['total'] or Decimal('0.00')
 
-    # Outflow calculations (all outflow transactions - payments made by patients)
-    outflow_transactions = total_transactions.filter(transaction_direction='out')
-    total_outflow = outflow_transactions.aggregate(
-        total=Sum('amount')
-    )['total'] or Decimal('0.00')
-
-    outflow_today = outflow_transactions.filter(
-        date=today
-    ).aggregate(total=Sum('amount'))['total'] or Decimal('0.00')
-
     # Net revenue (inflow - outflow)
     net_revenue = total_revenue - total_outflow
 
@@ -3508,33 +3515,17 @@ def finance_dashboard(request):
     daily_revenue_data = []
     for i in range(30):
         date_point = today - timedelta(days=29 - i)
-        daily_revenue = revenue_transactions.filter(
-            date=date_point
-        ).aggregate(total=Sum('amount'))['total'] or 0
-
         daily_revenue_data.append({
             'date': date_point.strftime('%Y-%m-%d'),
-            'revenue': float(daily_revenue)
+            'revenue': float(daily_totals.get((date_point, 'in'), empty_day)['total'])
         })
 
     # Monthly comparison data (last 12 months)
     monthly_comparison_data = []
+    month_start = current_month_start
     for i in range(12):
-        # Calculate the first day of the month for i months ago
-        target_date = today.replace(day=1) - timedelta(days=i * 30)
-        # Adjust to actual first day of that month
-        month_start = target_date.replace(day=1)
-        # Get last day of the month
-        last_day = calendar.monthrange(month_start.year, month_start.month)[1]
-        month_end = month_start.replace(day=last_day)
-
-        monthly_revenue = revenue_transactions.filter(
-            date__range=[month_start, month_end]
-        ).aggregate(total=Sum('amount'))['total'] or 0
-
-        monthly_outflow = outflow_transactions.filter(
-            date__range=[month_start, month_end]
-        ).aggregate(total=Sum('amount'))['total'] or 0
+        monthly_revenue = monthly_totals.get((month_start, 'in'), Decimal('0.00'))
+        monthly_outflow = monthly_totals.get((month_start, 'out'), Decimal('0.00'))
 
         monthly_comparison_data.insert(0, {
             'month': month_start.strftime('%b %Y'),
@@ -3542,23 +3533,16 @@ def finance_dashboard(request):
             'outflow': float(monthly_outflow),
             'net': float(monthly_revenue - monthly_outflow)
         })
+        month_start = (month_start - timedelta(days=1)).replace(day=1)
 
     # Transaction types analysis (current month)
-    transaction_types = total_transactions.filter(
-        date__gte=current_month_start
-    ).values('transaction_type').annotate(
-        count=Count('id'),
-        total=Sum('amount')
-    ).order_by('-total')[:10]
+    transaction_types = get_breakdown('transaction_type', start_date=current_month_start)
 
     # Payment methods analysis (current month)
-    payment_methods = total_transactions.filter(
-        date__gte=current_month_start,
-        payment_method__isnull=False
-    ).exclude(payment_method='').values('payment_method').annotate(
-        count=Count('id'),
-        total=Sum('amount')
-    ).order_by('-total')[:10]
+    payment_methods = [
+        row for row in get_breakdown('payment_method', start_date=current_month_start, limit=11)
+        if row['payment_method']
+    ][:10]
 
     # Recent large transactions (≥ ₦10,000)
     recent_large_transactions = total_transactions.filter(
@@ -3633,13 +3617,11 @@ def finance_dashboard_print(request):
     today = timezone.now().date()
     start_of_month = today.replace(day=1)
 
-    # Basic statistics
-    total_transactions = PatientTransactionModel.objects.filter(status='completed')
-    revenue_transactions = total_transactions.filter(transaction_direction='in')
-
-    total_revenue = revenue_transactions.aggregate(total=Sum('amount'))['total'] or Decimal('0.00')
-    revenue_month = revenue_transactions.filter(date__gte=start_of_month).aggregate(total=Sum('amount'))[
-                        'total'] or Decimal('0.00')
+    # Basic statistics from the daily rollup table
+    all_time_totals = get_direction_totals()
+    total_revenue = all_time_totals['in']['total']
+    revenue_month = get_direction_totals(start_date=start_of_month)['in']['total']
+    total_transactions_count = all_time_totals['in']['count'] + all_time_totals['out']['count']
 
     total_expenses = Expense.objects.aggregate(total=Sum('amount'))['total'] or Decimal('0.00')
     expenses_month = Expense.objects.filter(date__gte=start_of_month).aggregate(total=Sum('amount'))[
@@ -3670,7 +3652,7 @@ def finance_dashboard_print(request):
         'top_expense_categories': top_expense_categories,
         'top_income_categories': top_income_categories,
         'current_date': today,
-        'total_transactions_count': total_transactions.count(),
+        'total_transactions_count': total_transactions_count,
     }
 
     return render(request, 'finance/dashboard_print.html', context)
@@ -3693,9 +3675,8 @@ def finance_wallet_withdrawal(request, patient_id):
                 return JsonResponse({'success': False, 'error': 'Amount must be positive.'}, status=400)
 
             with transaction.atomic():
-                # Re-fetch and lock wallet
-                wallet_qs = PatientWalletModel.objects.select_for_update().filter(patient=patient)
-                wallet = wallet_qs.first()
+                # Re-fetch wallet; the debit below is atomic, so no row lock is held for the whole request
+                wallet = PatientWalletModel.objects.get(patient=patient)
 
                 if wallet.amount < amount_to_withdraw:
                     shortfall = _quantize_money(amount_to_withdraw - wallet.amount)
@@ -3707,9 +3688,11 @@ def finance_wallet_withdrawal(request, patient_id):
                     }, status=400)
 
                 # Deduct
-                old_balance = wallet.amount
-                wallet.amount = _quantize_money(wallet.amount - amount_to_withdraw)
-                wallet.save()
+                entry = wallet.debit(
+                    amount_to_withdraw, 'withdrawal', user=request.user, description=notes[:255],
+                    idempotency_key=request.POST.get('idempotency_key')
+                )
+                old_balance = entry.balance_before
 
                 # 1. Create OUT transaction (Wallet Deduction)
                 transaction_out = PatientTransactionModel.objects.create(
@@ -3741,17 +3724,23 @@ def finance_wallet_withdrawal(request, patient_id):
                     'redirect_url': reverse('patient_wallet_dashboard', args=[patient.id])
                 })
 
+        except DuplicateWalletEntry as e:
+            return _duplicate_wallet_response(e, reverse('patient_wallet_dashboard', args=[patient.id]))
+        except InsufficientWalletBalance:
+            return JsonResponse({'success': False, 'error': 'Insufficient wallet balance for withdrawal.'}, status=400)
         except Exception as e:
             return JsonResponse({'success': False, 'error': f'Error processing withdrawal: {str(e)}'}, status=500)
 
     context = {
         'patient': patient,
-        'wallet_balance': wallet.amount
+        'wallet_balance': wallet.amount,
+        'idempotency_key': uuid.uuid4().hex,
     }
     return render(request, 'finance/wallet/withdrawal.html', context)
 
 
 REFUNDABLE_STATUSES = ['paid', 'partially_dispensed']
+WALLET_HISTORY_PAGE_SIZE = 50
 
 
 @login_required
@@ -3853,7 +3842,8 @@ def finance_process_refund(request, patient_id):
 
         context = {
             'patient': patient,
-            'items': items_to_display
+            'items': items_to_display,
+            'idempotency_key': uuid.uuid4().hex,
         }
         return render(request, 'finance/wallet/refund.html', context)
 
@@ -3869,8 +3859,7 @@ def finance_process_refund(request, patient_id):
             items_to_update = []
 
             with transaction.atomic():
-                wallet_qs = PatientWalletModel.objects.select_for_update().filter(patient=patient)
-                wallet = wallet_qs.first()
+                wallet = PatientWalletModel.objects.filter(patient=patient).first()
 
                 if not wallet:
                     return JsonResponse({'success': False, 'error': 'Wallet not found.'}, status=404)
@@ -3945,9 +3934,11 @@ def finance_process_refund(request, patient_id):
                         status=400)
 
                 # ... (rest of the transaction logic: update wallet, create transaction, save items)
-                old_balance = wallet.amount
-                wallet.amount += refund_total
-                wallet.save()
+                entry = wallet.credit(
+                    refund_total, 'refund', user=request.user, description=f'Refund of {len(items_to_update)} item(s)',
+                    idempotency_key=request.POST.get('idempotency_key')
+                )
+                old_balance = entry.balance_before
 
                 # Create IN transaction (Refund)
                 PatientTransactionModel.objects.create(
@@ -3974,6 +3965,8 @@ def finance_process_refund(request, patient_id):
                     'redirect_url': reverse('patient_wallet_dashboard', args=[patient.id])
                 })
 
+        except DuplicateWalletEntry as e:
+            return _duplicate_wallet_response(e, reverse('patient_wallet_dashboard', args=[patient.id]))
         except Exception as e:
             return JsonResponse({'success': False, 'error': f'Error processing refund: {type(e).__name__}: {str(e)}'},
                                 status=500)
@@ -3985,17 +3978,31 @@ def finance_process_refund(request, patient_id):
 @login_required
 @permission_required('finance.add_patienttransactionmodel', raise_exception=True)
 def finance_wallet_history(request, patient_id):
-    """Displays a detailed history of all wallet-related transactions."""
+    """
+    Displays the wallet ledger, newest first.
+    Pages are keyset paginated (?before=<entry id>) so older pages cost the same as the first.
+    """
     patient = get_object_or_404(PatientModel, id=patient_id)
+    wallet, created = PatientWalletModel.objects.get_or_create(patient=patient)
+
+    entries = WalletLedgerEntry.objects.filter(wallet=wallet).select_related(
+        'created_by__user_staff_profile__staff'
+    ).order_by('-id')
 
-    # Get all transactions, ordered by date
-    history = PatientTransactionModel.objects.filter(
-        patient=patient
-    ).select_related('received_by').order_by('-created_at')
+    before = request.GET.get('before', '')
+    if before.isdigit():
+        entries = entries.filter(id__lt=int(before))
+
+    page = list(entries[:WALLET_HISTORY_PAGE_SIZE + 1])
+    history = page[:WALLET_HISTORY_PAGE_SIZE]
+    has_older = len(page) > WALLET_HISTORY_PAGE_SIZE
 
     context = {
         'patient': patient,
-        'history': history
+        'wallet': wallet,
+        'history': history,
+        'is_first_page': not before.isdigit(),
+        'older_cursor': history[-1].id if has_older else None,
     }
     return render(request, 'finance/wallet/history.html', context)
 
@@ -4123,12 +4130,12 @@ def process_direct_payment(request):
 
         # --------- Wallet/Direct validation and allocation ----------
         with transaction.atomic():
-            # Lock the wallet row to avoid race conditions
-            wallet_obj, created = PatientWalletModel.objects.get_or_create(
+            # No row lock: the wallet debit below is a conditional UPDATE that fails
+            # if a concurrent payment has drained the balance in the meantime
+            wallet, created = PatientWalletModel.objects.get_or_create(
                 patient=patient,
                 defaults={'amount': Decimal('0.00')}
             )
-            wallet = PatientWalletModel.objects.select_for_update().get(pk=wallet_obj.pk)
 
             old_wallet_balance = _to_decimal(wallet.amount)
 
@@ -4150,16 +4157,18 @@ def process_direct_payment(request):
 
             # Deduct wallet in a single operation (create wallet withdrawal transaction)
             if wallet_amount_to_use > Decimal('0.00'):
-                wallet.amount = (old_wallet_balance - wallet_amount_to_use).quantize(Decimal('0.01'))
-                wallet.save()
+                entry = wallet.debit(
+                    wallet_amount_to_use, 'payment', user=request.user, description='Direct payment (wallet portion)',
+                    idempotency_key=request.POST.get('idempotency_key')
+                )
 
                 wallet_withdrawal_transaction = PatientTransactionModel.objects.create(
                     patient=patient,
                     transaction_type='wallet_withdrawal',
                     transaction_direction='out',
                     amount=wallet_amount_to_use,
-                    old_balance=old_wallet_balance,
-                    new_balance=wallet.amount,
+                    old_balance=entry.balance_before,
+                    new_balance=entry.balance_after,
                     payment_method='wallet',
                     received_by=request.user,
                     status='completed',
@@ -4343,6 +4352,11 @@ def process_direct_payment(request):
 
     except PatientModel.DoesNotExist:
         return JsonResponse({'error': 'Patient not found'}, status=404)
+    except DuplicateWalletEntry as e:
+        return _duplicate_wallet_response(e)
+    except InsufficientWalletBalance:
+        return JsonResponse({'error': 'Wallet balance changed while processing. Please verify the patient again.'},
+                            status=409)
     except ValueError as e:
         return JsonResponse({'error': f'Invalid value: {str(e)}'}, status=400)
     except Exception as e:
@@ -4429,81 +4443,6 @@ def transaction_detail(request, transaction_id):
     return render(request, 'finance/payment/detail.html', context)
 
 
-@login_required
-def transaction_list(request):
-    """
-    List all transactions with support for filtering
-    Shows item count badge for parent transactions
-    EXCLUDES child transactions (they're part of parent payments)
-    """
-    # Only show top-level transactions (no parent)
-    # This includes:
-    # 1. Direct payment (parent of multi-item payments)
-    # 2. Wallet withdrawal (parent of wallet-only multi-item payments)
-    # 3. Standalone transactions (old style single payments)
-    transactions = PatientTransactionModel.objects.filter(
-        parent_transaction__isnull=True  # Only show top-level transactions
-    ).select_related(
-        'patient',
-        'received_by',
-        'received_by__user_staff_profile',
-        'received_by__user_staff_profile__staff',
-    ).prefetch_related(
-        'child_transactions'
-    ).order_by('-created_at')
-
-    # Apply filters if any
-    patient_id = request.GET.get('patient')
-    if patient_id:
-        transactions = transactions.filter(patient_id=patient_id)
-
-    transaction_type = request.GET.get('transaction_type')
-    if transaction_type:
-        transactions = transactions.filter(transaction_type=transaction_type)
-
-    date_from = request.GET.get('date_from')
-    if date_from:
-        transactions = transactions.filter(date__gte=date_from)
-
-    date_to = request.GET.get('date_to')
-    if date_to:
-        transactions = transactions.filter(date__lte=date_to)
-
-    direction = request.GET.get('transaction_direction')
-    if direction:
-        transactions = transactions.filter(transaction_direction=direction)
-
-    # Calculate totals for displayed transactions
-    total_inflow = sum(
-        t.amount for t in transactions if t.transaction_direction == 'in'
-    )
-    total_outflow = sum(
-        t.amount for t in transactions if t.transaction_direction == 'out'
-    )
-
-    # Pagination
-    from django.core.paginator import Paginator
-    paginator = Paginator(transactions, 50)  # 50 transactions per page
-    page_number = request.GET.get('page', 1)
-    page_obj = paginator.get_page(page_number)
-
-    # Get transaction type choices for filter dropdown
-    transaction_types = PatientTransactionModel.TRANSACTION_TYPE
-
-    context = {
-        'transactions': page_obj,
-        'page_obj': page_obj,
-        'is_paginated': page_obj.has_other_pages(),
-        'paginator': paginator,
-        'total_inflow': total_inflow,
-        'total_outflow': total_outflow,
-        'transaction_types': transaction_types,
-        'timeframe': 'All Time',
-    }
-
-    return render(request, 'finance/transaction/index.html', context)
-
-
 @login_required
 def print_receipt(request, transaction_id):
     """
@@ -4579,6 +4518,7 @@ def wallet_funding_only_page(request):
 
     context = {
         'patient': patient,
+        'idempotency_key': uuid.uuid4().hex,
     }
 
     return render(request, 'finance/wallet/wallet_funding_only.html', context)
@@ -4750,8 +4690,8 @@ def ajax_process_consultation_payment(request):
 
             # Deduct from wallet if applicable
             if wallet_used > 0:
-                wallet.amount -= wallet_used
-                wallet.save()
+                entry = wallet.debit(wallet_used, 'payment', user=request.user, description='Consultation payment')
+                old_balance = entry.balance_before
 
             new_balance = wallet.amount
 
@@ -4836,8 +4776,7 @@ def ajax_process_admission_funding(request):
                     }, status=400)
 
         with transaction.atomic():
-            wallet = PatientWalletModel.objects.select_for_update().get_or_create(patient=patient)[0]
-            wallet = PatientWalletModel.objects.select_for_update().get(pk=wallet.pk)
+            wallet = PatientWalletModel.objects.get_or_create(patient=patient)[0]
             old_wallet_balance = _to_decimal(wallet.amount)
 
             wallet_amount_to_use = Decimal('0.00')
@@ -4853,8 +4792,10 @@ def ajax_process_admission_funding(request):
 
             # Deduct wallet
             if wallet_amount_to_use > Decimal('0.00'):
-                wallet.amount = (old_wallet_balance - wallet_amount_to_use).quantize(Decimal('0.01'))
-                wallet.save()
+                entry = wallet.debit(
+                    wallet_amount_to_use, 'payment', user=request.user,
+                    description=transaction_type.replace('_', ' ').capitalize()
+                )
 
                 wallet_withdrawal_transaction = PatientTransactionModel.objects.create(
                     patient=patient,
@@ -4863,8 +4804,8 @@ def ajax_process_admission_funding(request):
                     admission=admission,
                     surgery=surgery,
                     amount=wallet_amount_to_use,
-                    old_balance=old_wallet_balance,
-                    new_balance=wallet.amount,
+                    old_balance=entry.balance_before,
+                    new_balance=entry.balance_after,
                     payment_method='wallet',
                     received_by=request.user,
                     status='completed',
@@ -4948,8 +4889,8 @@ def ajax_process_other_payment(request):
 
             # Deduct from wallet if applicable
             if wallet_used > 0:
-                wallet.amount -= wallet_used
-                wallet.save()
+                entry = wallet.debit(wallet_used, 'payment', user=request.user, description=service.name)
+                old_balance = entry.balance_before
 
             new_balance = wallet.amount
 
@@ -5033,195 +4974,7 @@ def get_staff_collection_data(staff, from_date, to_date):
     Calculate all financial data for a single staff member.
     Returns dictionary with all calculated values.
     """
-    data = {}
-
-    # 1. CARD (Registration) - ALL records
-    data['card_total'] = RegistrationPaymentModel.objects.filter(
-        created_by=staff,
-        date__range=[from_date, to_date], status='confirmed'
-    ).aggregate(total=Sum('amount'))['total'] or Decimal('0.00')
-
-    # 2. CONS (Consultation)
-    data['cons_total'] = PatientTransactionModel.objects.filter(
-        received_by=staff,
-        date__range=[from_date, to_date],
-        transaction_type='consultation_payment',
-        status='completed'
-    ).aggregate(total=Sum('direct_payment_amount'))['total'] or Decimal('0.00')
-
-    # 3. LAB
-    data['lab_total'] = PatientTransactionModel.objects.filter(
-        received_by=staff,
-        date__range=[from_date, to_date],
-        transaction_type='lab_payment',
-        status='completed'
-    ).aggregate(total=Sum('direct_payment_amount'))['total'] or Decimal('0.00')
-
-    # 4. DRUGS
-    data['drugs_total'] = PatientTransactionModel.objects.filter(
-        received_by=staff,
-        date__range=[from_date, to_date],
-        transaction_type='drug_payment',
-        status='completed'
-    ).aggregate(total=Sum('direct_payment_amount'))['total'] or Decimal('0.00')
-
-    # 5. SCAN
-    data['scan_total'] = PatientTransactionModel.objects.filter(
-        received_by=staff,
-        date__range=[from_date, to_date],
-        transaction_type='scan_payment',
-        status='completed'
-    ).aggregate(total=Sum('direct_payment_amount'))['total'] or Decimal('0.00')
-
-    # 6. Service Categories (Dynamic)
-    service_categories = ServiceCategory.objects.filter(
-        show_as_record_column=True,
-        is_active=True
-    ).order_by('name')
-
-    service_breakdown = []
-    services_total = Decimal('0.00')
-
-    for category in service_categories:
-        category_total = PatientTransactionModel.objects.filter(
-            received_by=staff,
-            date__range=[from_date, to_date],
-            transaction_type__in=['service', 'item'],
-            status='completed'
-        ).filter(
-            Q(service__service__category=category) |
-            Q(service__service_item__category=category)
-        ).aggregate(total=Sum('direct_payment_amount'))['total'] or Decimal('0.00')
-
-        if category_total > 0:  # Only include if there are transactions
-            service_breakdown.append({
-                'name': category.name,
-                'amount': category_total
-            })
-            services_total += category_total
-
-    data['service_breakdown'] = service_breakdown
-    data['services_total'] = services_total
-
-    # 7. SURGERY
-    data['surgery_total'] = PatientTransactionModel.objects.filter(
-        received_by=staff,
-        date__range=[from_date, to_date],
-        transaction_type='surgery_payment',
-        status='completed'
-    ).aggregate(total=Sum('direct_payment_amount'))['total'] or Decimal('0.00')
-
-    # 8. Other Payments (Dynamic by service name)
-    other_payments = PatientTransactionModel.objects.filter(
-        received_by=staff,
-        date__range=[from_date, to_date],
-        transaction_type='other_payment',
-        status='completed'
-    ).values('other_service__name').annotate(
-        total=Sum('direct_payment_amount')
-    ).order_by('other_service__name')
-
-    other_breakdown = []
-    other_total = Decimal('0.00')
-
-    for item in other_payments:
-        if item['total']:
-            other_breakdown.append({
-                'name': item['other_service__name'] or 'Other Payment',
-                'amount': item['total']
-            })
-            other_total += item['total']
-
-    data['other_breakdown'] = other_breakdown
-    data['other_total'] = other_total
-
-    # 9. Calculate Total Collections
-    data['total_collections'] = (
-            data['card_total'] +
-            data['cons_total'] +
-            data['lab_total'] +
-            data['drugs_total'] +
-            data['scan_total'] +
-            services_total +
-            data['surgery_total'] +
-            other_total
-    )
-
-    # 10. Cash Expenses (only cash paid expenses)
-    data['cash_expenses'] = Expense.objects.filter(
-        paid_by=staff,
-        date__range=[from_date, to_date],
-        payment_method='cash'
-    ).aggregate(total=Sum('amount'))['total'] or Decimal('0.00')
-
-    # 11. Wallet Withdrawals (Refunds)
-    data['wallet_withdrawals'] = WalletWithdrawalRecord.objects.filter(
-        withdrawn_by=staff,
-        withdrawal_date__date__range=[from_date, to_date]
-    ).aggregate(total=Sum('amount'))['total'] or Decimal('0.00')
-
-    # 12. Total Cash Out
-    data['total_cash_out'] = data['cash_expenses'] + data['wallet_withdrawals']
-
-    # 13. Calculate Cash vs Transfer breakdown
-    # Get all transactions with payment methods
-    all_transactions = PatientTransactionModel.objects.filter(
-        received_by=staff,
-        date__range=[from_date, to_date],
-        status='completed',
-        transaction_type__in=[
-            'consultation_payment', 'drug_payment', 'lab_payment',
-            'scan_payment', 'surgery_payment', 'service', 'item', 'other_payment'
-        ]
-    )
-
-    cash_collections = Decimal('0.00')
-    transfer_collections = Decimal('0.00')
-
-    for trans in all_transactions:
-        if trans.payment_method and 'transfer' in trans.payment_method.lower():
-            transfer_collections += trans.direct_payment_amount
-        else:
-            cash_collections += trans.direct_payment_amount
-
-    # Add registration payments (check payment_method)
-    reg_payments = RegistrationPaymentModel.objects.filter(
-        created_by=staff,
-        date__range=[from_date, to_date], status='confirmed'
-    )
-
-    for reg in reg_payments:
-        if reg.payment_method and 'transfer' in reg.payment_method.lower():
-            transfer_collections += reg.amount
-        else:
-            cash_collections += reg.amount
-
-    data['cash_collections'] = cash_collections
-    data['transfer_collections'] = transfer_collections
-
-    # 14. Previous Cash Remitted (from MoneyRemittance)
-    previous_remittances = MoneyRemittance.objects.filter(
-        remitted_by=staff,
-        created_at__date__range=[from_date, to_date],
-        status='APPROVED'
-    )
-
-    data['previous_cash_remitted'] = previous_remittances.aggregate(
-        total=Sum('amount_remitted_cash')
-    )['total'] or Decimal('0.00')
-
-    # 15. Net Cash to Remit
-    data['net_cash_to_remit'] = (
-            cash_collections -
-            data['cash_expenses'] -
-            data['wallet_withdrawals'] -
-            data['previous_cash_remitted']
-    )
-
-    # Note: Transfer collections don't need remittance (already in bank)
-    data['net_transfer'] = transfer_collections
-
-    return data
+    return get_staff_collection_matrix(from_date, to_date, staff_ids=[staff.id])[staff.id]
 
 
 # ============================================================================
@@ -5295,102 +5048,8 @@ class AllStaffCollectionsView(LoginRequiredMixin, PermissionRequiredMixin, Templ
         # Staff filter (optional)
         staff_filter = self.request.GET.get('staff_filter')
 
-        # Get all staff who have transactions in the period
-        staff_with_transactions = set()
-
-        # From registrations
-        staff_with_transactions.update(
-            RegistrationPaymentModel.objects.filter(
-                date__range=[from_date, to_date], status='confirmed'
-            ).values_list('created_by_id', flat=True)
-        )
-
-        # From patient transactions
-        staff_with_transactions.update(
-            PatientTransactionModel.objects.filter(
-                date__range=[from_date, to_date],
-                status='completed'
-            ).values_list('received_by_id', flat=True)
-        )
-
-        # From expenses
-        staff_with_transactions.update(
-            Expense.objects.filter(
-                date__range=[from_date, to_date],
-                payment_method='cash'
-            ).values_list('paid_by_id', flat=True)
-        )
-
-        # From withdrawals
-        staff_with_transactions.update(
-            WalletWithdrawalRecord.objects.filter(
-                withdrawal_date__date__range=[from_date, to_date]
-            ).values_list('withdrawn_by_id', flat=True)
-        )
-
-        # Remove None values
-        staff_with_transactions.discard(None)
-
-        # Filter staff if requested
-        if staff_filter:
-            staff_list = User.objects.filter(id=staff_filter, is_active=True)
-        else:
-            staff_list = User.objects.filter(
-                id__in=staff_with_transactions,
-                is_active=True
-            ).order_by('username')
-
-        # Build report for each staff
-        staff_reports = []
-        grand_totals = {
-            'card': Decimal('0.00'),
-            'cons': Decimal('0.00'),
-            'lab': Decimal('0.00'),
-            'drugs': Decimal('0.00'),
-            'scan': Decimal('0.00'),
-            'services': Decimal('0.00'),
-            'surgery': Decimal('0.00'),
-            'other': Decimal('0.00'),
-            'collections': Decimal('0.00'),
-            'expenses': Decimal('0.00'),
-            'withdrawals': Decimal('0.00'),
-            'net': Decimal('0.00'),
-        }
-
-        for staff in staff_list:
-            data = get_staff_collection_data(staff, from_date, to_date)
-
-            report = {
-                'staff': staff,
-                'card_total': data['card_total'],
-                'cons_total': data['cons_total'],
-                'lab_total': data['lab_total'],
-                'drugs_total': data['drugs_total'],
-                'scan_total': data['scan_total'],
-                'services_total': data['services_total'],
-                'surgery_total': data['surgery_total'],
-                'other_total': data['other_total'],
-                'total_collections': data['total_collections'],
-                'cash_expenses': data['cash_expenses'],
-                'wallet_withdrawals': data['wallet_withdrawals'],
-                'net_to_remit': data['net_cash_to_remit'],
-            }
-
-            staff_reports.append(report)
-
-            # Update grand totals
-            grand_totals['card'] += data['card_total']
-            grand_totals['cons'] += data['cons_total']
-            grand_totals['lab'] += data['lab_total']
-            grand_totals['drugs'] += data['drugs_total']
-            grand_totals['scan'] += data['scan_total']
-            grand_totals['services'] += data['services_total']
-            grand_totals['surgery'] += data['surgery_total']
-            grand_totals['other'] += data['other_total']
-            grand_totals['collections'] += data['total_collections']
-            grand_totals['expenses'] += data['cash_expenses']
-            grand_totals['withdrawals'] += data['wallet_withdrawals']
-            grand_totals['net'] += data['net_cash_to_remit']
+        # Build the whole staff x category matrix in one pass
+        staff_reports, grand_totals = build_all_staff_collections(from_date, to_date, staff_filter)
 
         context.update({
             'from_date': from_date,
@@ -5540,120 +5199,78 @@ class StaffTransactionHistoryExcelView(LoginRequiredMixin, PermissionRequiredMix
             withdrawal_date__date__range=[from_date, to_date]
         ).select_related('patient').order_by('-withdrawal_date')
 
-        # Create workbook with multiple sheets
-        wb = Workbook()
+        expenses = expenses.select_related('category')
 
-        # Styles
-        header_font = Font(bold=True, size=11, color="FFFFFF")
-        header_fill = PatternFill(start_color="4472C4", end_color="4472C4", fill_type="solid")
-
-        # Sheet 1: Registrations
-        ws1 = wb.active
-        ws1.title = "Registrations"
-
-        ws1.append(['Transaction ID', 'Patient Name', 'Amount', 'Payment Method', 'Date', 'Status'])
-        for col in range(1, 7):
-            ws1.cell(row=1, column=col).font = header_font
-            ws1.cell(row=1, column=col).fill = header_fill
-
-        for reg in registrations:
-            ws1.append([
-                reg.transaction_id,
-                reg.full_name,
-                float(reg.amount),
-                reg.payment_method,
-                reg.date.strftime('%Y-%m-%d') if reg.date else '',
-                reg.registration_status
-            ])
-
-        ws1.column_dimensions['A'].width = 20
-        ws1.column_dimensions['B'].width = 30
-        ws1.column_dimensions['C'].width = 15
-        ws1.column_dimensions['D'].width = 15
-        ws1.column_dimensions['E'].width = 12
-        ws1.column_dimensions['F'].width = 15
-
-        # Sheet 2: Patient Transactions
-        ws2 = wb.create_sheet("Patient Transactions")
-
-        ws2.append(['Transaction ID', 'Patient', 'Type', 'Amount', 'Payment Method', 'Date'])
-        for col in range(1, 7):
-            ws2.cell(row=1, column=col).font = header_font
-            ws2.cell(row=1, column=col).fill = header_fill
-
-        for trans in patient_transactions:
-            patient_name = f"{trans.patient.first_name} {trans.patient.last_name}" if trans.patient else "N/A"
-            ws2.append([
-                trans.transaction_id,
-                patient_name,
-                trans.get_transaction_type_display(),
-                float(trans.direct_payment_amount),
-                trans.payment_method,
-                trans.date.strftime('%Y-%m-%d')
-            ])
+        # Stream each section into its own sheet
+        def registration_rows():
+            for reg in iterate(registrations):
+                yield [
+                    reg.transaction_id,
+                    reg.full_name,
+                    float(reg.amount),
+                    reg.payment_method,
+                    reg.date.strftime('%Y-%m-%d') if reg.date else '',
+                    reg.registration_status
+                ]
+
+        def transaction_rows():
+            for trans in iterate(patient_transactions):
+                patient_name = f"{trans.patient.first_name} {trans.patient.last_name}" if trans.patient else "N/A"
+                yield [
+                    trans.transaction_id,
+                    patient_name,
+                    trans.get_transaction_type_display(),
+                    float(trans.direct_payment_amount),
+                    trans.payment_method,
+                    trans.date.strftime('%Y-%m-%d')
+                ]
 
-        ws2.column_dimensions['A'].width = 20
-        ws2.column_dimensions['B'].width = 30
-        ws2.column_dimensions['C'].width = 25
-        ws2.column_dimensions['D'].width = 15
-        ws2.column_dimensions['E'].width = 15
-        ws2.column_dimensions['F'].width = 12
-
-        # Sheet 3: Expenses
-        ws3 = wb.create_sheet("Expenses")
-
-        ws3.append(['Expense Number', 'Title', 'Category', 'Amount', 'Payment Method', 'Date'])
-        for col in range(1, 7):
-            ws3.cell(row=1, column=col).font = header_font
-            ws3.cell(row=1, column=col).fill = header_fill
-
-        for exp in expenses:
-            ws3.append([
-                exp.expense_number,
-                exp.title,
-                exp.category.name,
-                float(exp.amount),
-                exp.payment_method,
-                exp.date.strftime('%Y-%m-%d')
-            ])
+        def expense_rows():
+            for exp in iterate(expenses):
+                yield [
+                    exp.expense_number,
+                    exp.title,
+                    exp.category.name,
+                    float(exp.amount),
+                    exp.payment_method,
+                    exp.date.strftime('%Y-%m-%d')
+                ]
 
-        ws3.column_dimensions['A'].width = 20
-        ws3.column_dimensions['B'].width = 35
-        ws3.column_dimensions['C'].width = 20
-        ws3.column_dimensions['D'].width = 15
-        ws3.column_dimensions['E'].width = 15
-        ws3.column_dimensions['F'].width = 12
-
-        # Sheet 4: Withdrawals
-        ws4 = wb.create_sheet("Withdrawals")
-
-        ws4.append(['Patient', 'Amount', 'Date', 'Notes'])
-        for col in range(1, 5):
-            ws4.cell(row=1, column=col).font = header_font
-            ws4.cell(row=1, column=col).fill = header_fill
-
-        for withdrawal in withdrawals:
-            patient_name = f"{withdrawal.patient.first_name} {withdrawal.patient.last_name}" if withdrawal.patient else "N/A"
-            ws4.append([
-                patient_name,
-                float(withdrawal.amount),
-                withdrawal.withdrawal_date.strftime('%Y-%m-%d %H:%M'),
-                withdrawal.notes or ''
-            ])
+        def withdrawal_rows():
+            for withdrawal in iterate(withdrawals):
+                patient_name = f"{withdrawal.patient.first_name} {withdrawal.patient.last_name}" if withdrawal.patient else "N/A"
+                yield [
+                    patient_name,
+                    float(withdrawal.amount),
+                    withdrawal.withdrawal_date.strftime('%Y-%m-%d %H:%M'),
+                    withdrawal.notes or ''
+                ]
+
+        sheets = [
+            ExportSheet(
+                "Registrations", registration_rows(),
+                headers=['Transaction ID', 'Patient Name', 'Amount', 'Payment Method', 'Date', 'Status'],
+                column_widths=[20, 30, 15, 15, 12, 15]
+            ),
+            ExportSheet(
+                "Patient Transactions", transaction_rows(),
+                headers=['Transaction ID', 'Patient', 'Type', 'Amount', 'Payment Method', 'Date'],
+                column_widths=[20, 30, 25, 15, 15, 12]
+            ),
+            ExportSheet(
+                "Expenses", expense_rows(),
+                headers=['Expense Number', 'Title', 'Category', 'Amount', 'Payment Method', 'Date'],
+                column_widths=[20, 35, 20, 15, 15, 12]
+            ),
+            ExportSheet(
+                "Withdrawals", withdrawal_rows(),
+                headers=['Patient', 'Amount', 'Date', 'Notes'],
+                column_widths=[30, 15, 20, 40]
+            ),
+        ]
 
-        ws4.column_dimensions['A'].width = 30
-        ws4.column_dimensions['B'].width = 15
-        ws4.column_dimensions['C'].width = 20
-        ws4.column_dimensions['D'].width = 40
-
-        # Response
-        response = HttpResponse(
-            content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
-        )
-        filename = f"transaction_history_{staff.username}_{from_date.strftime('%Y%m%d')}.xlsx"
-        response['Content-Disposition'] = f'attachment; filename="{filename}"'
-        wb.save(response)
-        return response
+        filename = f"transaction_history_{staff.username}_{from_date.strftime('%Y%m%d')}"
+        return export_response(request, filename, sheets)
 
 
 class StaffTransactionHistoryPDFView(LoginRequiredMixin, PermissionRequiredMixin, View):
@@ -6038,165 +5655,67 @@ class PersonalStaffCollectionExcelView(LoginRequiredMixin, PermissionRequiredMix
         # Get data
         data = get_staff_collection_data(staff, from_date, to_date)
 
-        # Create workbook
-        wb = Workbook()
-        ws = wb.active
-        ws.title = "Staff Collection"
-
         # Styles
         header_font = Font(bold=True, size=14)
         section_font = Font(bold=True, size=11, color="FFFFFF")
         section_fill = PatternFill(start_color="4472C4", end_color="4472C4", fill_type="solid")
         total_font = Font(bold=True, size=11)
         total_fill = PatternFill(start_color="E7E6E6", end_color="E7E6E6", fill_type="solid")
-        border = Border(
-            left=Side(style='thin'),
-            right=Side(style='thin'),
-            top=Side(style='thin'),
-            bottom=Side(style='thin')
-        )
-
-        row = 1
-
-        # Header
-        ws.merge_cells(f'A{row}:C{row}')
-        cell = ws[f'A{row}']
-        cell.value = f"Staff Collection Report - {staff.get_full_name() or staff.username}"
-        cell.font = header_font
-        cell.alignment = Alignment(horizontal='center')
-        row += 1
-
-        ws.merge_cells(f'A{row}:C{row}')
-        cell = ws[f'A{row}']
-        cell.value = f"Period: {from_date.strftime('%B %d, %Y')} to {to_date.strftime('%B %d, %Y')}"
-        cell.alignment = Alignment(horizontal='center')
-        row += 2
-
-        # Income section header
-        ws[f'A{row}'] = "INCOME BREAKDOWN"
-        ws[f'A{row}'].font = section_font
-        ws[f'A{row}'].fill = section_fill
-        ws.merge_cells(f'A{row}:B{row}')
-        row += 1
-
-        # Income items
-        income_items = [
-            ('Card (Registration)', data['card_total']),
-            ('Consultation', data['cons_total']),
-            ('Laboratory', data['lab_total']),
-            ('Drugs', data['drugs_total']),
-            ('Scan/Imaging', data['scan_total']),
+        green_fill = PatternFill(start_color="28A745", end_color="28A745", fill_type="solid")
+        net_font = Font(bold=True, color="FFFFFF")
+
+        def section(title):
+            return [Styled(title, font=section_font, fill=section_fill, merge_across=2)]
+
+        def line(label, amount):
+            return [label, money(float(amount))]
+
+        def total(label, amount, font=total_font, fill=total_fill):
+            return [Styled(label, font=font, fill=fill), money(float(amount), font=font, fill=fill)]
+
+        rows = [
+            # Header
+            [Styled(f"Staff Collection Report - {staff.get_full_name() or staff.username}",
+                    font=header_font, alignment=CENTER, merge_across=3)],
+            [Styled(f"Period: {from_date.strftime('%B %d, %Y')} to {to_date.strftime('%B %d, %Y')}",
+                    alignment=CENTER, merge_across=3)],
+            [],
+
+            # Income section
+            section("INCOME BREAKDOWN"),
+            line('Card (Registration)', data['card_total']),
+            line('Consultation', data['cons_total']),
+            line('Laboratory', data['lab_total']),
+            line('Drugs', data['drugs_total']),
+            line('Scan/Imaging', data['scan_total']),
         ]
-
-        for label, amount in income_items:
-            ws.cell(row=row, column=1, value=label)
-            ws.cell(row=row, column=2, value=float(amount))
-            ws.cell(row=row, column=2).number_format = '#,##0.00'
-            ws.cell(row=row, column=2).alignment = Alignment(horizontal='right')
-            row += 1
-
-        # Dynamic service categories
-        for service in data['service_breakdown']:
-            ws.cell(row=row, column=1, value=service['name'])
-            ws.cell(row=row, column=2, value=float(service['amount']))
-            ws.cell(row=row, column=2).number_format = '#,##0.00'
-            ws.cell(row=row, column=2).alignment = Alignment(horizontal='right')
-            row += 1
-
-        # Surgery
-        ws.cell(row=row, column=1, value='Surgery')
-        ws.cell(row=row, column=2, value=float(data['surgery_total']))
-        ws.cell(row=row, column=2).number_format = '#,##0.00'
-        ws.cell(row=row, column=2).alignment = Alignment(horizontal='right')
-        row += 1
-
-        # Dynamic other payments
-        for other in data['other_breakdown']:
-            ws.cell(row=row, column=1, value=other['name'])
-            ws.cell(row=row, column=2, value=float(other['amount']))
-            ws.cell(row=row, column=2).number_format = '#,##0.00'
-            ws.cell(row=row, column=2).alignment = Alignment(horizontal='right')
-            row += 1
-
-        # Total collections
-        ws.cell(row=row, column=1, value="TOTAL COLLECTIONS").font = total_font
-        ws.cell(row=row, column=1).fill = total_fill
-        ws.cell(row=row, column=2, value=float(data['total_collections'])).font = total_font
-        ws.cell(row=row, column=2).fill = total_fill
-        ws.cell(row=row, column=2).number_format = '#,##0.00'
-        ws.cell(row=row, column=2).alignment = Alignment(horizontal='right')
-        row += 2
-
-        # Cash Out section
-        ws[f'A{row}'] = "CASH OUT"
-        ws[f'A{row}'].font = section_font
-        ws[f'A{row}'].fill = section_fill
-        ws.merge_cells(f'A{row}:B{row}')
-        row += 1
-
-        ws.cell(row=row, column=1, value="Expenses (Cash Paid)")
-        ws.cell(row=row, column=2, value=float(data['cash_expenses']))
-        ws.cell(row=row, column=2).number_format = '#,##0.00'
-        ws.cell(row=row, column=2).alignment = Alignment(horizontal='right')
-        row += 1
-
-        ws.cell(row=row, column=1, value="Wallet Withdrawals (Refunds)")
-        ws.cell(row=row, column=2, value=float(data['wallet_withdrawals']))
-        ws.cell(row=row, column=2).number_format = '#,##0.00'
-        ws.cell(row=row, column=2).alignment = Alignment(horizontal='right')
-        row += 1
-
-        ws.cell(row=row, column=1, value="TOTAL CASH OUT").font = total_font
-        ws.cell(row=row, column=1).fill = total_fill
-        ws.cell(row=row, column=2, value=float(data['total_cash_out'])).font = total_font
-        ws.cell(row=row, column=2).fill = total_fill
-        ws.cell(row=row, column=2).number_format = '#,##0.00'
-        ws.cell(row=row, column=2).alignment = Alignment(horizontal='right')
-        row += 2
-
-        # Remittance section
-        ws[f'A{row}'] = "REMITTANCE CALCULATION"
-        ws[f'A{row}'].font = section_font
-        ws[f'A{row}'].fill = section_fill
-        ws.merge_cells(f'A{row}:B{row}')
-        row += 1
-
-        remittance_items = [
-            ('Cash Collections', data['cash_collections']),
-            ('Transfer Collections', data['transfer_collections']),
-            ('Less: Cash Expenses', -data['cash_expenses']),
-            ('Less: Wallet Withdrawals', -data['wallet_withdrawals']),
-            ('Less: Previous Remittances', -data['previous_cash_remitted']),
+        rows += [line(service['name'], service['amount']) for service in data['service_breakdown']]
+        rows.append(line('Surgery', data['surgery_total']))
+        rows += [line(other['name'], other['amount']) for other in data['other_breakdown']]
+        rows += [
+            total("TOTAL COLLECTIONS", data['total_collections']),
+            [],
+
+            # Cash Out section
+            section("CASH OUT"),
+            line("Expenses (Cash Paid)", data['cash_expenses']),
+            line("Wallet Withdrawals (Refunds)", data['wallet_withdrawals']),
+            total("TOTAL CASH OUT", data['total_cash_out']),
+            [],
+
+            # Remittance section
+            section("REMITTANCE CALCULATION"),
+            line('Cash Collections', data['cash_collections']),
+            line('Transfer Collections', data['transfer_collections']),
+            line('Less: Cash Expenses', -data['cash_expenses']),
+            line('Less: Wallet Withdrawals', -data['wallet_withdrawals']),
+            line('Less: Previous Remittances', -data['previous_cash_remitted']),
+            total("NET CASH TO REMIT", data['net_cash_to_remit'], font=net_font, fill=green_fill),
         ]
 
-        for label, amount in remittance_items:
-            ws.cell(row=row, column=1, value=label)
-            ws.cell(row=row, column=2, value=float(amount))
-            ws.cell(row=row, column=2).number_format = '#,##0.00'
-            ws.cell(row=row, column=2).alignment = Alignment(horizontal='right')
-            row += 1
-
-        # Net to remit
-        green_fill = PatternFill(start_color="28A745", end_color="28A745", fill_type="solid")
-        ws.cell(row=row, column=1, value="NET CASH TO REMIT").font = Font(bold=True, color="FFFFFF")
-        ws.cell(row=row, column=1).fill = green_fill
-        ws.cell(row=row, column=2, value=float(data['net_cash_to_remit'])).font = Font(bold=True, color="FFFFFF")
-        ws.cell(row=row, column=2).fill = green_fill
-        ws.cell(row=row, column=2).number_format = '#,##0.00'
-        ws.cell(row=row, column=2).alignment = Alignment(horizontal='right')
-
-        # Column widths
-        ws.column_dimensions['A'].width = 35
-        ws.column_dimensions['B'].width = 18
-
-        # Response
-        response = HttpResponse(
-            content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
-        )
-        filename = f"staff_collection_{staff.username}_{from_date.strftime('%Y%m%d')}.xlsx"
-        response['Content-Disposition'] = f'attachment; filename="{filename}"'
-        wb.save(response)
-        return response
+        sheet = ExportSheet("Staff Collection", rows, column_widths=[35, 18])
+        filename = f"staff_collection_{staff.username}_{from_date.strftime('%Y%m%d')}"
+        return export_response(request, filename, [sheet])
 
 
 class PersonalStaffCollectionPDFView(LoginRequiredMixin, PermissionRequiredMixin, View):
@@ -6397,102 +5916,8 @@ class AllStaffCollectionsExcelView(LoginRequiredMixin, PermissionRequiredMixin,
         else:
             to_date = datetime.strptime(to_date, '%Y-%m-%d').date()
 
-        # Determine staff with transactions in the period
-        staff_with_transactions = set()
-
-        # From registrations
-        staff_with_transactions.update(
-            RegistrationPaymentModel.objects.filter(
-                date__range=[from_date, to_date]
-            ).values_list('created_by_id', flat=True)
-        )
-
-        # From patient transactions
-        staff_with_transactions.update(
-            PatientTransactionModel.objects.filter(
-                date__range=[from_date, to_date],
-                status='completed'
-            ).values_list('received_by_id', flat=True)
-        )
-
-        # From expenses
-        staff_with_transactions.update(
-            Expense.objects.filter(
-                date__range=[from_date, to_date],
-                payment_method='cash'
-            ).values_list('paid_by_id', flat=True)
-        )
-
-        # From withdrawals
-        staff_with_transactions.update(
-            WalletWithdrawalRecord.objects.filter(
-                withdrawal_date__date__range=[from_date, to_date]
-            ).values_list('withdrawn_by_id', flat=True)
-        )
-
-        staff_with_transactions.discard(None)
-
-        # Resolve staff list based on optional filter
-        if staff_filter:
-            staff_list = User.objects.filter(id=staff_filter, is_active=True)
-        else:
-            staff_list = User.objects.filter(
-                id__in=staff_with_transactions,
-                is_active=True
-            ).order_by('username')
-
         # Build report rows and grand totals
-        grand_totals = {
-            'card': Decimal('0.00'),
-            'cons': Decimal('0.00'),
-            'lab': Decimal('0.00'),
-            'drugs': Decimal('0.00'),
-            'scan': Decimal('0.00'),
-            'services': Decimal('0.00'),
-            'surgery': Decimal('0.00'),
-            'other': Decimal('0.00'),
-            'collections': Decimal('0.00'),
-            'expenses': Decimal('0.00'),
-            'withdrawals': Decimal('0.00'),
-            'net': Decimal('0.00'),
-        }
-
-        staff_rows = []
-
-        for staff in staff_list:
-            data = get_staff_collection_data(staff, from_date, to_date)
-
-            row = {
-                'staff': staff,
-                'card_total': data['card_total'],
-                'cons_total': data['cons_total'],
-                'lab_total': data['lab_total'],
-                'drugs_total': data['drugs_total'],
-                'scan_total': data['scan_total'],
-                'services_total': data['services_total'],
-                'surgery_total': data['surgery_total'],
-                'other_total': data['other_total'],
-                'total_collections': data['total_collections'],
-                'cash_expenses': data['cash_expenses'],
-                'wallet_withdrawals': data['wallet_withdrawals'],
-                'net_cash_to_remit': data['net_cash_to_remit'],
-            }
-
-            staff_rows.append(row)
-
-            # Update grand totals
-            grand_totals['card'] += data['card_total']
-            grand_totals['cons'] += data['cons_total']
-            grand_totals['lab'] += data['lab_total']
-            grand_totals['drugs'] += data['drugs_total']
-            grand_totals['scan'] += data['scan_total']
-            grand_totals['services'] += data['services_total']
-            grand_totals['surgery'] += data['surgery_total']
-            grand_totals['other'] += data['other_total']
-            grand_totals['collections'] += data['total_collections']
-            grand_totals['expenses'] += data['cash_expenses']
-            grand_totals['withdrawals'] += data['wallet_withdrawals']
-            grand_totals['net'] += data['net_cash_to_remit']
+        staff_rows, grand_totals = build_all_staff_collections(from_date, to_date, staff_filter)
 
         # Create workbook
         wb = Workbook()
@@ -6603,61 +6028,12 @@ class AllStaffCollectionsPDFView(LoginRequiredMixin, PermissionRequiredMixin, Vi
         else:
             to_date = datetime.strptime(to_date, '%Y-%m-%d').date()
 
-        # Determine staff with transactions in the period
-        staff_with_transactions = set()
-
-        staff_with_transactions.update(
-            RegistrationPaymentModel.objects.filter(
-                date__range=[from_date, to_date]
-            ).values_list('created_by_id', flat=True)
-        )
-
-        staff_with_transactions.update(
-            PatientTransactionModel.objects.filter(
-                date__range=[from_date, to_date],
-                status='completed'
-            ).values_list('received_by_id', flat=True)
-        )
-
-        staff_with_transactions.update(
-            Expense.objects.filter(
-                date__range=[from_date, to_date],
-                payment_method='cash'
-            ).values_list('paid_by_id', flat=True)
-        )
-
-        staff_with_transactions.update(
-            WalletWithdrawalRecord.objects.filter(
-                withdrawal_date__date__range=[from_date, to_date]
-            ).values_list('withdrawn_by_id', flat=True)
-        )
-
-        staff_with_transactions.discard(None)
-
-        if staff_filter:
-            staff_list = User.objects.filter(id=staff_filter, is_active=True)
-        else:
-            staff_list = User.objects.filter(id__in=staff_with_transactions, is_active=True).order_by('username')
-
         # Build data and grand totals
-        financial_rows = []
-        grand_totals = {
-            'card': Decimal('0.00'),
-            'cons': Decimal('0.00'),
-            'lab': Decimal('0.00'),
-            'drugs': Decimal('0.00'),
-            'scan': Decimal('0.00'),
-            'services': Decimal('0.00'),
-            'surgery': Decimal('0.00'),
-            'other': Decimal('0.00'),
-            'collections': Decimal('0.00'),
-            'expenses': Decimal('0.00'),
-            'withdrawals': Decimal('0.00'),
-            'net': Decimal('0.00'),
-        }
+        staff_rows, grand_totals = build_all_staff_collections(from_date, to_date, staff_filter)
 
-        for staff in staff_list:
-            data = get_staff_collection_data(staff, from_date, to_date)
+        financial_rows = []
+        for data in staff_rows:
+            staff = data['staff']
             financial_rows.append([
                 staff.get_full_name() or staff.username,
                 f'₦{data["card_total"]:,.2f}',
@@ -6674,20 +6050,6 @@ class AllStaffCollectionsPDFView(LoginRequiredMixin, PermissionRequiredMixin, Vi
                 f'₦{data["net_cash_to_remit"]:,.2f}',
             ])
 
-            # Update grand totals
-            grand_totals['card'] += data['card_total']
-            grand_totals['cons'] += data['cons_total']
-            grand_totals['lab'] += data['lab_total']
-            grand_totals['drugs'] += data['drugs_total']
-            grand_totals['scan'] += data['scan_total']
-            grand_totals['services'] += data['services_total']
-            grand_totals['surgery'] += data['surgery_total']
-            grand_totals['other'] += data['other_total']
-            grand_totals['collections'] += data['total_collections']
-            grand_totals['expenses'] += data['cash_expenses']
-            grand_totals['withdrawals'] += data['wallet_withdrawals']
-            grand_totals['net'] += data['net_cash_to_remit']
-
         # Build PDF
         buffer = BytesIO()
         doc = SimpleDocTemplate(buffer, pagesize=landscape(A4), rightMargin=20, leftMargin=20, topMargin=20, bottomMargin=20)
@@ -6778,7 +6140,7 @@ def verify_customer_for_sales(request):
             return JsonResponse({'error': 'Card number required'}, status=400)
 
         try:
-            patient = PatientModel.objects.get(card_number__iexact=card_number)
+            patient = get_patient_by_card(card_number)
 
             # Get wallet balance
             wallet, _ = PatientWalletModel.objects.get_or_create(
@@ -7391,8 +6753,8 @@ def process_direct_sales_payment(request):
                 wallet_used = Decimal('0.00')
                 if use_wallet and old_wallet_balance > Decimal('0.00'):
                     wallet_used = min(old_wallet_balance, total_amount)
-                    wallet.amount = old_wallet_balance - wallet_used
-                    wallet.save()
+                    entry = wallet.debit(wallet_used, 'payment', user=request.user, description='Walk-in sale')
+                    old_wallet_balance = entry.balance_before
 
                 remaining = total_amount - wallet_used
 
@@ -7797,3 +7159,46 @@ def process_direct_sales_payment(request):
 
     except Exception as e:
         return JsonResponse({'error': str(e)}, status=500)
+
+
+# ============================================================================
+# MONTH-END CLOSE
+# ============================================================================
+
+FINANCIAL_PERIOD_MONTHS_SHOWN = 12
+
+
+@login_required
+@permission_required('finance.view_financial_reports', raise_exception=True)
+def financial_period_index(request):
+    """The last FINANCIAL_PERIOD_MONTHS_SHOWN ended months and their close status"""
+    month = timezone.localdate().replace(day=1)
+    months = []
+    for _ in range(FINANCIAL_PERIOD_MONTHS_SHOWN):
+        month = (month - timedelta(days=1)).replace(day=1)
+        months.append(month)
+
+    periods = {
+        period.start_date: period
+        for period in FinancialPeriod.objects.filter(start_date__in=months).select_related('closed_by')
+    }
+
+    context = {
+        'months': [{'start_date': month, 'period': periods.get(month)} for month in months],
+        'can_close': request.user.has_perm('finance.close_financialperiod'),
+    }
+    return render(request, 'finance/period/index.html', context)
+
+
+@login_required
+@permission_required('finance.close_financialperiod', raise_exception=True)
+@require_http_methods(["POST"])
+def financial_period_close(request):
+    """Close, or re-close, the month given as YYYY-MM"""
+    try:
+        month = datetime.strptime(request.POST.get('month', ''), '%Y-%m').date()
+        period = close_period(month, user=request.user)
+        messages.success(request, f"{month.strftime('%B %Y')} closed (version {period.version})")
+    except ValueError as e:
+        messages.error(request, f'Could not close period: {e}')
+    return redirect('financial_period_index')
@@ -4,6 +4,7 @@ from django.core.exceptions import ValidationError
 from django.db import models, transaction
 from django.utils import timezone
 from admin_site.model_info import *
+from admin_site.sequences import next_block_value, reserve_row_block, get_block_size
 import logging
 
 logger = logging.getLogger(__name__)
@@ -177,7 +178,10 @@ class StaffModel(models.Model):
     @transaction.atomic
     def generate_unique_staff_id(self):
         """
-        Bulletproof staff ID generation with minimal code
+        Next staff ID from the staff ID sequence, formatted with the prefix settings in HRSettingModel.
+
+        Numbers are reserved from StaffIDGeneratorModel in blocks of
+        STAFF_ID_BLOCK_SIZE (settings, default 10) and handed out from memory.
         """
         setting = HRSettingModel.objects.first()
 
@@ -185,30 +189,17 @@ class StaffModel(models.Model):
         if not setting or not setting.auto_generate_staff_id:
             return self._generate_manual_fallback()
 
-        # Get or create the counter record
-        last_entry, created = StaffIDGeneratorModel.objects.select_for_update().get_or_create(
-            id=1,  # Always use same record
-            defaults={'last_id': 0, 'last_staff_id': '0000'}
-        )
-
         max_attempts = 20
         for attempt in range(max_attempts):
-            # Increment counter
-            last_entry.last_id += 1
-            new_id = str(last_entry.last_id).zfill(4)
+            new_id = str(StaffIDGeneratorModel.next_id()).zfill(4)
 
             # Build full staff ID
             full_id = self._build_staff_id(setting, new_id)
 
             # Check if unique
             if not StaffModel.objects.filter(staff_id=full_id).exists():
-                last_entry.last_staff_id = new_id
-                last_entry.save()
                 return full_id
 
-            # If not unique, continue with next number
-            continue
-
         # Fallback if all attempts failed
         return self._generate_uuid_fallback()
 
@@ -252,11 +243,31 @@ class StaffModel(models.Model):
 
 
 class StaffIDGeneratorModel(models.Model):
+    """
+    High-water mark of the staff ID sequence (row id=1).
+    last_id is the highest number reserved; numbers up to it may still be waiting in a worker's block.
+    """
     id = models.AutoField(primary_key=True)  # Make it explicit
     last_id = models.BigIntegerField(default=0)
     last_staff_id = models.CharField(max_length=100, null=True, blank=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    @classmethod
+    def reserve_block(cls, size):
+        """
+        Reserve size staff numbers and return (first, last). The reservation commits on its own
+        connection, so the row is not locked for the rest of the staff save's transaction
+        (see admin_site.sequences.run_outside_transaction; on SQLite it stays in the caller's).
+        """
+        return reserve_row_block(
+            cls.objects.filter(id=1), 'last_id', size,
+            lambda: cls.objects.create(id=1, last_id=0, last_staff_id='0000')
+        )
+
+    @classmethod
+    def next_id(cls):
+        return next_block_value(('staff_id', ''), cls.reserve_block, get_block_size('STAFF_ID_BLOCK_SIZE', 10))
+
 
 class StaffProfileModel(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE, blank=True, related_name='user_staff_profile')
@@ -34,6 +34,8 @@ from .forms import (
     SurgeryLabForm, SurgeryScanForm, AdmissionTypeForm, AdmissionTaskForm, AdmissionDepositForm, DischargeForm
 )
 from patient.models import PatientModel
+from patient.search import get_patient_by_card
+from admin_site.catalog import search_catalog
 
 logger = logging.getLogger(__name__)
 
@@ -447,7 +449,7 @@ def admission_search_patient(request):
             return render(request, 'inpatient/admission/search_patient.html')
 
         try:
-            patient = PatientModel.objects.get(card_number__iexact=card_number)
+            patient = get_patient_by_card(card_number)
 
             # Check for active admission
             active_admission = Admission.objects.filter(
@@ -938,7 +940,7 @@ def surgery_search_patient(request):
             return render(request, 'inpatient/surgery/search_patient.html')
 
         try:
-            patient = PatientModel.objects.get(card_number__iexact=card_number)
+            patient = get_patient_by_card(card_number)
             return redirect('surgery_create_for_patient', patient_id=patient.id)
 
         except PatientModel.DoesNotExist:
@@ -1495,18 +1497,12 @@ def search_drugs_for_surgery(request):
         return JsonResponse({'results': []})
 
     try:
-        from pharmacy.models import DrugModel
-        drugs_queryset = DrugModel.objects.filter(
-            Q(brand_name__icontains=query) |
-            Q(formulation__generic_drug__generic_name__icontains=query)
-        )[:20]
-
         results = [
             {
-                'id': drug.id,
-                'name': str(drug)
+                'id': entry.object_id,
+                'name': entry.name
             }
-            for drug in drugs_queryset
+            for entry, _ in search_catalog(query, ['drug'], active_only=False, limit=20)
         ]
 
         return JsonResponse({'results': results})
@@ -1524,11 +1520,8 @@ def search_lab_tests_for_surgery(request):
         return JsonResponse({'results': []})
 
     try:
-        from laboratory.models import LabTestTemplateModel
-        lab_tests = LabTestTemplateModel.objects.filter(
-            name__icontains=query
-        ).values('id', 'name')[:20]
-        return JsonResponse({'results': list(lab_tests)})
+        lab_tests = search_catalog(query, ['lab_test'], active_only=False, limit=20)
+        return JsonResponse({'results': [{'id': entry.object_id, 'name': entry.name} for entry, _ in lab_tests]})
     except Exception:
         logger.exception("Error searching lab tests")
         return JsonResponse({'error': 'Search failed'}, status=500)
@@ -1542,11 +1535,8 @@ def search_scans_for_surgery(request):
         return JsonResponse({'results': []})
 
     try:
-        from scan.models import ScanTemplateModel
-        scans = ScanTemplateModel.objects.filter(
-            name__icontains=query
-        ).values('id', 'name')[:20]
-        return JsonResponse({'results': list(scans)})
+        scans = search_catalog(query, ['scan'], active_only=False, limit=20)
+        return JsonResponse({'results': [{'id': entry.object_id, 'name': entry.name} for entry, _ in scans]})
     except Exception:
         logger.exception("Error searching scans")
         return JsonResponse({'error': 'Search failed'}, status=500)
@@ -2,59 +2,104 @@
 """
 Helper functions for claim-based insurance payment processing.
 These utilities check for approved claims and calculate patient amounts accordingly.
+
+Pages that price many orders at once should call resolve_claims() once for all of
+them and pass the result as claims=... to the per-order helpers, instead of letting
+each helper query the claims of its own order.
 """
 
+from collections import defaultdict
 from decimal import Decimal, ROUND_HALF_UP
 from django.contrib.contenttypes.models import ContentType
 from insurance.models import InsuranceClaimModel
 
+APPROVED_CLAIM_STATUSES = ('approved', 'partially_approved', 'paid')
+PENDING_CLAIM_STATUSES = ('pending', 'processing')
+
 
 def _quantize(amount):
     """Safely quantize a decimal amount to 2 decimal places."""
     return Decimal(str(amount)).quantize(Decimal('0.01'), rounding=ROUND_HALF_UP)
 
 
-def get_claim_for_order(order, order_type_hint=None):
+def get_claim_key(order):
+    """(content_type_id, object_id) key of an order in the dict returned by resolve_claims()"""
+    # get_for_model() is served from ContentType's in-process cache after the first call
+    return ContentType.objects.get_for_model(type(order)).id, order.id
+
+
+def resolve_claims(orders):
+    """
+    Load the approved and pending claims of a mixed set of orders.
+
+    Runs one claim query per order type, whatever the number of orders.
+
+    Args:
+        orders: Iterable of order instances of any type (drug, lab, scan, service...)
+
+    Returns:
+        dict keyed by get_claim_key(order) with {'approved': claim or None, 'pending': claim or None}
+        for every order passed in
+    """
+    ids_by_content_type = defaultdict(set)
+    claims = {}
+    for order in orders:
+        content_type_id, object_id = get_claim_key(order)
+        ids_by_content_type[content_type_id].add(object_id)
+        claims[(content_type_id, object_id)] = {'approved': None, 'pending': None}
+
+    for content_type_id, object_ids in ids_by_content_type.items():
+        matches = InsuranceClaimModel.objects.filter(
+            content_type_id=content_type_id,
+            object_id__in=object_ids,
+            status__in=APPROVED_CLAIM_STATUSES + PENDING_CLAIM_STATUSES
+        ).order_by('id')
+
+        for claim in matches:
+            slot = 'approved' if claim.status in APPROVED_CLAIM_STATUSES else 'pending'
+            entry = claims[(content_type_id, claim.object_id)]
+            # Keep the oldest claim, as .first() on the unordered per-order query did
+            if entry[slot] is None:
+                entry[slot] = claim
+
+    return claims
+
+
+def get_claim_for_order(order, order_type_hint=None, claims=None):
     """
     Get the insurance claim associated with an order.
 
     Args:
         order: The order instance (DrugOrderModel, LabTestOrderModel, etc.)
         order_type_hint: Optional hint like 'drug', 'lab', 'scan' for optimization
+        claims: Optional result of resolve_claims() covering this order
 
     Returns:
         InsuranceClaimModel instance or None
     """
     try:
-        content_type = ContentType.objects.get_for_model(type(order))
-
-        # Try to find an approved or partially approved claim
-        claim = InsuranceClaimModel.objects.filter(
-            content_type=content_type,
-            object_id=order.id,
-            status__in=['approved', 'partially_approved', 'paid']
-        ).first()
-
-        return claim
+        if claims is None:
+            claims = resolve_claims([order])
+        return claims[get_claim_key(order)]['approved']
     except Exception:
         return None
 
 
-def get_pending_claim_for_order(order):
+def get_pending_claim_for_order(order, claims=None):
     """
     Check if there's a pending claim for an order.
 
+    Args:
+        order: The order instance
+        claims: Optional result of resolve_claims() covering this order
+
     Returns:
         dict with 'has_pending_claim', 'claim', 'claim_number'
     """
     try:
-        content_type = ContentType.objects.get_for_model(type(order))
-
-        claim = InsuranceClaimModel.objects.filter(
-            content_type=content_type,
-            object_id=order.id,
-            status__in=['pending', 'processing']
-        ).first()
+        if claims is None:
+            claims = resolve_claims([order])
+        claim = claims[get_claim_key(order)]['pending']
 
         return {
             'has_pending_claim': claim is not None,
@@ -71,7 +116,7 @@ def get_pending_claim_for_order(order):
         }
 
 
-def calculate_patient_amount_with_claim(order, base_amount):
+def calculate_patient_amount_with_claim(order, base_amount, claims=None):
     """
     Calculate the patient's payment amount considering approved claims.
 
@@ -83,6 +128,7 @@ def calculate_patient_amount_with_claim(order, base_amount):
     Args:
         order: The order instance
         base_amount: The total cost of the service
+        claims: Optional result of resolve_claims() covering this order
 
     Returns:
         dict with:
@@ -95,7 +141,7 @@ def calculate_patient_amount_with_claim(order, base_amount):
     base_amount = _quantize(base_amount)
 
     # Check for approved claim
-    claim = get_claim_for_order(order)
+    claim = get_claim_for_order(order, claims=claims)
 
     if claim:
         return {
@@ -118,18 +164,22 @@ def calculate_patient_amount_with_claim(order, base_amount):
     }
 
 
-def get_orders_with_claim_info(orders, order_type):
+def get_orders_with_claim_info(orders, order_type, claims=None):
     """
     Bulk process orders and attach claim information.
 
     Args:
         orders: QuerySet or list of order instances
         order_type: 'drug', 'lab', 'scan', 'service'
+        claims: Optional result of resolve_claims() covering these orders; loaded here when omitted
 
     Returns:
         List of dicts with order data and claim info
     """
     results = []
+    orders = list(orders)
+    if claims is None:
+        claims = resolve_claims(orders)
 
     for order in orders:
         # Determine base amount based on order type
@@ -150,10 +200,10 @@ def get_orders_with_claim_info(orders, order_type):
             base_amount = Decimal('0.00')
 
         # Calculate with claim
-        claim_info = calculate_patient_amount_with_claim(order, base_amount)
+        claim_info = calculate_patient_amount_with_claim(order, base_amount, claims=claims)
 
         # Check for pending claim
-        pending_info = get_pending_claim_for_order(order)
+        pending_info = get_pending_claim_for_order(order, claims=claims)
 
         results.append({
             'order': order,
@@ -189,55 +239,34 @@ def bulk_calculate_total_with_claims(order_ids_by_type):
     from laboratory.models import LabTestOrderModel
     from scan.models import ScanOrderModel
 
-    total = Decimal('0.00')
-    breakdown = {}
+    querysets = {
+        'drug': DrugOrderModel.objects.select_related('drug'),
+        'lab': LabTestOrderModel.objects.select_related('template'),
+        'scan': ScanOrderModel.objects.select_related('template'),
+    }
+    orders_by_type = {
+        order_type: list(queryset.filter(id__in=order_ids_by_type[order_type]))
+        for order_type, queryset in querysets.items()
+        if order_ids_by_type.get(order_type)
+    }
 
-    # Process drugs
-    if order_ids_by_type.get('drug'):
-        drug_orders = DrugOrderModel.objects.filter(
-            id__in=order_ids_by_type['drug']
-        ).select_related('drug')
-
-        drug_results = get_orders_with_claim_info(drug_orders, 'drug')
-        drug_total = sum(r['patient_amount'] for r in drug_results)
-        total += drug_total
-        breakdown['drug'] = {
-            'total': drug_total,
-            'count': len(drug_results),
-            'items': drug_results
-        }
+    # One claim lookup for every order of every type
+    claims = resolve_claims(order for orders in orders_by_type.values() for order in orders)
 
-    # Process labs
-    if order_ids_by_type.get('lab'):
-        lab_orders = LabTestOrderModel.objects.filter(
-            id__in=order_ids_by_type['lab']
-        ).select_related('template')
-
-        lab_results = get_orders_with_claim_info(lab_orders, 'lab')
-        lab_total = sum(r['patient_amount'] for r in lab_results)
-        total += lab_total
-        breakdown['lab'] = {
-            'total': lab_total,
-            'count': len(lab_results),
-            'items': lab_results
-        }
+    total = Decimal('0.00')
+    breakdown = {}
 
-    # Process scans
-    if order_ids_by_type.get('scan'):
-        scan_orders = ScanOrderModel.objects.filter(
-            id__in=order_ids_by_type['scan']
-        ).select_related('template')
-
-        scan_results = get_orders_with_claim_info(scan_orders, 'scan')
-        scan_total = sum(r['patient_amount'] for r in scan_results)
-        total += scan_total
-        breakdown['scan'] = {
-            'total': scan_total,
-            'count': len(scan_results),
-            'items': scan_results
+    for order_type, orders in orders_by_type.items():
+        results = get_orders_with_claim_info(orders, order_type, claims=claims)
+        type_total = sum(r['patient_amount'] for r in results)
+        total += type_total
+        breakdown[order_type] = {
+            'total': type_total,
+            'count': len(results),
+            'items': results
         }
 
     return {
         'total_amount': _quantize(total),
         'breakdown': breakdown
-    }
\ No newline at end of file
+    }
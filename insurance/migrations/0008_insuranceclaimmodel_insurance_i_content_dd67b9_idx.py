@@ -0,0 +1,18 @@
+# Generated by Django 5.0 on 2026-10-16 09:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('insurance', '0007_insuranceclaimsummary_and_more'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='insuranceclaimmodel',
+            index=models.Index(fields=['content_type', 'object_id'], name='insurance_i_content_dd67b9_idx'),
+        ),
+    ]
@@ -274,6 +274,12 @@ class InsuranceClaimModel(models.Model):
     created_at = models.DateTimeField(auto_now_add=True, null=True, blank=True)
     updated_at = models.DateTimeField(auto_now=True, null=True, blank=True)
 
+    class Meta:
+        indexes = [
+            # Claim lookups by order (see insurance.claim_helpers.resolve_claims)
+            models.Index(fields=['content_type', 'object_id']),
+        ]
+
     def save(self, *args, **kwargs):
         if not self.claim_number:
             import uuid
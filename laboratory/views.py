@@ -32,10 +32,13 @@ from django.views.generic import (
 )
 from openpyxl.styles import Font, Alignment
 
+from admin_site.exports import ExportSheet, Styled, iterate, export_response, CENTER, HEADER_FONT, HEADER_FILL, \
+    MONEY_FORMAT, THIN_BORDER
 from admin_site.models import SiteInfoModel
 from finance.models import PatientTransactionModel
 from insurance.models import InsuranceClaimModel
 from patient.models import PatientModel, PatientWalletModel
+from patient.search import get_patient_by_card
 from .models import *
 from .forms import *
 from django.db.models import Q, Count, Case, When, IntegerField
@@ -282,7 +285,7 @@ def verify_lab_patient_ajax(request):
         return JsonResponse({'success': False, 'error': 'Please enter a card number'})
 
     try:
-        patient = PatientModel.objects.get(card_number__iexact=card_number, status='active')
+        patient = get_patient_by_card(card_number, PatientModel.objects.filter(status='active'))
 
         # Get internal test counts
         test_counts = {
@@ -664,9 +667,6 @@ def process_lab_payments(request):
                 patient_amount = detail['patient_amount']
                 insurance_covered = detail['insurance_covered']
 
-                # Deduct patient amount from wallet
-                wallet.amount -= patient_amount
-
                 # Update order
                 order.status = 'paid'
                 order.payment_status = True
@@ -683,8 +683,10 @@ def process_lab_payments(request):
                 order.save()
                 updated_count += 1
 
-            # Save wallet
-            wallet.save()
+            # Deduct the patient's share from the wallet
+            if total_patient_amount > 0:
+                wallet.debit(total_patient_amount, 'payment', user=request.user,
+                             description=f'Lab payment ({updated_count} test(s))')
 
             # Prepare response message
             message_parts = [
@@ -1786,168 +1788,95 @@ class LabTestLogExportExcelView(LoginRequiredMixin, PermissionRequiredMixin, Vie
         total_amount = totals['total_amount'] or Decimal('0.00')
         total_patients = totals['total_patients'] or 0
 
-        # === Create Workbook ===
-        wb = Workbook()
-        ws = wb.active
-        ws.title = "Lab Test Log"
-
         # Styles
         header_font = Font(bold=True, size=14)
         title_font = Font(bold=True, size=12)
-        table_header_font = Font(bold=True, size=11, color="FFFFFF")
-        header_fill = PatternFill(start_color="4472C4", end_color="4472C4", fill_type="solid")
         total_font = Font(bold=True, size=11)
-        border = Border(left=Side(style='thin'), right=Side(style='thin'), top=Side(style='thin'),
-                        bottom=Side(style='thin'))
 
         # Get lab and site info (using your existing logic)
         lab_setting = LabSettingModel.objects.first()
         site_info = SiteInfoModel.objects.first()
-        row = 1
-
-        # Header section
-        if lab_setting and lab_setting.lab_name:
-            ws.merge_cells(f'A{row}:F{row}')
-            cell = ws[f'A{row}']
-            cell.value = lab_setting.lab_name
-            cell.font = header_font
-            cell.alignment = Alignment(horizontal='center')
-            row += 1
-        elif site_info:
-            ws.merge_cells(f'A{row}:F{row}')
-            cell = ws[f'A{row}']
-            cell.value = site_info.name
-            cell.font = header_font
-            cell.alignment = Alignment(horizontal='center')
-            row += 1
-        row += 1
-
-        ws.merge_cells(f'A{row}:F{row}')
-        cell = ws[f'A{row}']
-        cell.value = report_title
-        cell.font = title_font
-        cell.alignment = Alignment(horizontal='center')
-        row += 1
-
-        ws.merge_cells(f'A{row}:F{row}')
-        cell = ws[f'A{row}']
-        cell.value = f"Period: {from_date.strftime('%B %d, %Y')} to {to_date.strftime('%B %d, %Y')}"
-        cell.alignment = Alignment(horizontal='center')
-        row += 2
 
         # === Table Headers ===
         headers = ['S/N', 'Date', 'Patient ID', 'Patient Name', 'Test Name']
+        column_widths = [6, 18, 15, 30, 35]
         if show_status:
             headers.append('Status')
+            column_widths.append(15)
         if show_amount:
             headers.append('Amount')
+            column_widths.append(15)
         if show_scientist:
             headers.append('Verified By')
+            column_widths.append(30)
+
+        def bordered(value=None, **style):
+            return Styled(value, border=THIN_BORDER, **style)
+
+        def rows():
+            # Header section
+            if lab_setting and lab_setting.lab_name:
+                yield [Styled(lab_setting.lab_name, font=header_font, alignment=CENTER, merge_across=6)]
+            elif site_info:
+                yield [Styled(site_info.name, font=header_font, alignment=CENTER, merge_across=6)]
+            yield []
+            yield [Styled(report_title, font=title_font, alignment=CENTER, merge_across=6)]
+            yield [Styled(f"Period: {from_date.strftime('%B %d, %Y')} to {to_date.strftime('%B %d, %Y')}",
+                          alignment=CENTER, merge_across=6)]
+            yield []
+            yield [bordered(header, font=HEADER_FONT, fill=HEADER_FILL) for header in headers]
+
+            # === Data Rows ===
+            for idx, order in enumerate(iterate(orders_qs), 1):
+                row = [
+                    bordered(idx),
+                    bordered(order.ordered_at.strftime('%Y-%m-%d %H:%M')),
+                    bordered(order.patient.card_number),
+                    bordered(order.patient.__str__()),
+                    bordered(order.template.name),
+                ]
+
+                # Dynamic columns
+                if show_status:
+                    row.append(bordered(order.get_status_display()))
+                if show_amount:
+                    row.append(bordered(order.amount_charged, number_format=MONEY_FORMAT))
+
+                if show_scientist:
+                    verifier = 'N/A'
+                    # Safe check for related object's existence first
+                    if (hasattr(order, 'result') and
+                            order.result and
+                            order.result.verified_by):
+
+                        user = order.result.verified_by
+
+                        # Safe check for your nested staff profile
+                        if (hasattr(user, 'user_staff_profile') and
+                                user.user_staff_profile and
+                                user.user_staff_profile.staff):
+                            verifier = user.user_staff_profile.staff.__str__()
+                        else:
+                            verifier = user.get_full_name()  # Fallback to full name
 
-        col = 1
-        for header in headers:
-            cell = ws.cell(row=row, column=col)
-            cell.value = header
-            cell.font = table_header_font
-            cell.fill = header_fill
-            cell.border = border
-            col += 1
-        row += 1
+                    row.append(bordered(verifier))
 
-        # === Data Rows ===
-        for idx, order in enumerate(orders_qs, 1):
-            col = 1
+                yield row
 
-            # Static columns
-            ws.cell(row=row, column=col, value=idx).border = border;
-            col += 1
-            ws.cell(row=row, column=col, value=order.ordered_at.strftime('%Y-%m-%d %H:%M')).border = border;
-            col += 1
-            ws.cell(row=row, column=col, value=order.patient.card_number).border = border;
-            col += 1
-            ws.cell(row=row, column=col, value=order.patient.__str__()).border = border;
-            col += 1
-            ws.cell(row=row, column=col, value=order.template.name).border = border;
-            col += 1
-
-            # Dynamic columns
+            # === Total Row ===
+            row = [bordered(), bordered(), bordered(), bordered(), bordered("TOTAL", font=total_font)]
             if show_status:
-                ws.cell(row=row, column=col, value=order.get_status_display()).border = border;
-                col += 1
+                row.append(bordered())
             if show_amount:
-                cell = ws.cell(row=row, column=col, value=order.amount_charged)
-                cell.number_format = '#,##0.00'
-                cell.border = border
-                col += 1
-
+                row.append(bordered(total_amount, font=total_font, number_format=MONEY_FORMAT))
             if show_scientist:
-                verifier = 'N/A'
-
-                # Safe check for related object's existence first
-                if (hasattr(order, 'result') and
-                        order.result and
-                        order.result.verified_by):
-
-                    user = order.result.verified_by
-
-                    # Safe check for your nested staff profile
-                    if (hasattr(user, 'user_staff_profile') and
-                            user.user_staff_profile and
-                            user.user_staff_profile.staff):
-                        verifier = user.user_staff_profile.staff.__str__()
-                    else:
-                        verifier = user.get_full_name()  # Fallback to full name
-
-                ws.cell(row=row, column=col, value=verifier).border = border
-                col += 1
-
-            row += 1
-
-        # === Total Row ===
-        col = 1
-        ws.cell(row=row, column=col).border = border;
-        col += 1
-        ws.cell(row=row, column=col).border = border;
-        col += 1
-        ws.cell(row=row, column=col).border = border;
-        col += 1
-        ws.cell(row=row, column=col).border = border;
-        col += 1
-        ws.cell(row=row, column=col, value="TOTAL").font = total_font;
-        cell.border = border;
-        col += 1
-
-        if show_status:
-            ws.cell(row=row, column=col).border = border;
-            col += 1
-        if show_amount:
-            cell = ws.cell(row=row, column=col, value=total_amount)
-            cell.font = total_font
-            cell.number_format = '#,##0.00'
-            cell.border = border
-            col += 1
-        if show_scientist:
-            cell = ws.cell(row=row, column=col, value=f"{total_patients} Unique Patients")
-            cell.font = total_font
-            cell.border = border
-            col += 1
-
-        # Column widths
-        ws.column_dimensions['A'].width = 6
-        ws.column_dimensions['B'].width = 18
-        ws.column_dimensions['C'].width = 15
-        ws.column_dimensions['D'].width = 30
-        ws.column_dimensions['E'].width = 35
-        if show_status: ws.column_dimensions['F'].width = 15
-        if show_amount: ws.column_dimensions['G'].width = 15
-        if show_scientist: ws.column_dimensions['H'].width = 30
+                row.append(bordered(f"{total_patients} Unique Patients", font=total_font))
+            yield row
 
-        # === Prepare Response ===
-        response = HttpResponse(content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
-        filename = f"lab_test_log_{from_date.strftime('%Y%m%d')}_{to_date.strftime('%Y%m%d')}.xlsx"
-        response['Content-Disposition'] = f'attachment; filename="{filename}"'
-        wb.save(response)
-        return response
+        filename = f"lab_test_log_{from_date.strftime('%Y%m%d')}_{to_date.strftime('%Y%m%d')}"
+        return export_response(request, filename, [
+            ExportSheet("Lab Test Log", rows(), column_widths=column_widths)
+        ])
 
 
 class LabTestLogExportPDFView(LoginRequiredMixin, PermissionRequiredMixin, View):
@@ -0,0 +1,207 @@
+"""
+Patient demographics for the patient dashboard.
+
+Every figure is computed by the database in a few grouped queries: age
+buckets are date-of-birth ranges counted in one aggregate, gender and marital
+splits are GROUP BYs, and registration trends are counted per day and per
+month in one query each. get_demographics() caches the result for
+CACHE_SECONDS, so reloading the dashboard does not recompute it.
+"""
+import datetime
+
+from django.core.cache import cache
+from django.db.models import Count, Q, Sum
+from django.db.models.functions import TruncMonth
+from django.utils import timezone
+
+from admin_site.model_info import GENDER, MARITAL_STATUS
+from patient.models import PatientModel, RegistrationPaymentModel
+
+CACHE_KEY = 'patient:demographics:{}:{}'
+CACHE_SECONDS = 300
+
+# (label, lowest age, highest age); None means no upper limit
+AGE_BUCKETS = [
+    ('0-12', 0, 12),
+    ('13-17', 13, 17),
+    ('18-40', 18, 40),
+    ('41-65', 41, 65),
+    ('66+', 66, None),
+]
+PATIENT_TYPES = ('new', 'old')
+CHART_DAYS = 7
+TREND_MONTHS = 12
+
+
+def years_before(day, years):
+    """The same day `years` earlier (Feb 29 becomes Feb 28)"""
+    try:
+        return day.replace(year=day.year - years)
+    except ValueError:
+        return day.replace(year=day.year - years, day=28)
+
+
+def _age_condition(lowest, highest, today):
+    # Someone is at least N years old when born on or before years_before(today, N)
+    condition = Q(date_of_birth__lte=years_before(today, lowest))
+    if highest is not None:
+        condition &= Q(date_of_birth__gt=years_before(today, highest + 1))
+    return condition
+
+
+def get_age_groups(today):
+    counts = PatientModel.objects.aggregate(**{
+        label: Count('id', filter=_age_condition(lowest, highest, today))
+        for label, lowest, highest in AGE_BUCKETS
+    })
+    return [{'name': label, 'value': counts[label]} for label, _, _ in AGE_BUCKETS]
+
+
+def get_patient_counts(today):
+    month_start = today.replace(day=1)
+    return PatientModel.objects.aggregate(
+        total=Count('id'),
+        active=Count('id', filter=Q(status='active')),
+        new_this_month=Count('id', filter=Q(status='active', registration_date__gte=month_start,
+                                            registration_date__lte=today)),
+    )
+
+
+def get_split(field, choices):
+    """[{'name', 'value'}] for every choice of field, plus 'Not Recorded' when any patient has none"""
+    counts = dict(PatientModel.objects.order_by().values_list(field).annotate(count=Count('id')))
+    split = [{'name': label.title(), 'value': counts.pop(value, 0)} for value, label in choices]
+    unrecorded = sum(counts.values())
+    if unrecorded:
+        split.append({'name': 'Not Recorded', 'value': unrecorded})
+    return split
+
+
+def get_registration_summary(today, confirmed_only=False):
+    """
+    Registration counts per patient type for the usual periods, plus revenue and
+    pending registrations. confirmed_only leaves out reverted registration payments.
+    """
+    week_start = today - datetime.timedelta(days=today.weekday())
+    month_start = today.replace(day=1)
+    last_month_end = month_start - datetime.timedelta(days=1)
+    last_month_start = last_month_end.replace(day=1)
+    periods = {
+        'total': Q(),
+        'today': Q(date=today),
+        'week': Q(date__gte=week_start),
+        'month': Q(date__gte=month_start),
+        'last_month': Q(date__gte=last_month_start, date__lte=last_month_end),
+    }
+
+    aggregates = {}
+    for patient_type in PATIENT_TYPES:
+        for period, condition in periods.items():
+            aggregates[f'{patient_type}_patients_{period}'] = Count(
+                'id', filter=condition & Q(registration_fee__patient_type=patient_type)
+            )
+    completed = Q(registration_status='completed')
+    aggregates.update(
+        pending_registrations=Count('id', filter=Q(registration_status='pending')),
+        total_revenue=Sum('amount', filter=completed),
+        revenue_today=Sum('amount', filter=completed & Q(date=today)),
+        revenue_month=Sum('amount', filter=completed & Q(date__gte=month_start)),
+    )
+
+    payments = RegistrationPaymentModel.objects.order_by()
+    if confirmed_only:
+        payments = payments.filter(status='confirmed')
+    summary = payments.aggregate(**aggregates)
+    for key in ('total_revenue', 'revenue_today', 'revenue_month'):
+        summary[key] = summary[key] or 0
+    return summary
+
+
+def _type_counts(rows, key):
+    """{period: {'new': n, 'old': n}} from rows grouped by period and patient type"""
+    counts = {}
+    for row in rows:
+        if row['registration_fee__patient_type'] in PATIENT_TYPES:
+            counts.setdefault(row[key], {})[row['registration_fee__patient_type']] = row['count']
+    return counts
+
+
+def get_daily_registrations(today, days=CHART_DAYS):
+    """New and old registrations for each of the last `days` days, oldest first"""
+    first_day = today - datetime.timedelta(days=days - 1)
+    rows = RegistrationPaymentModel.objects.filter(
+        date__gte=first_day, date__lte=today
+    ).order_by().values('date', 'registration_fee__patient_type').annotate(count=Count('id'))
+    counts = _type_counts(rows, 'date')
+
+    data = []
+    for offset in range(days):
+        day = first_day + datetime.timedelta(days=offset)
+        day_counts = counts.get(day, {})
+        data.append({
+            'date': day.strftime('%Y-%m-%d'),
+            'new_patients': day_counts.get('new', 0),
+            'old_patients': day_counts.get('old', 0),
+        })
+    return data
+
+
+def _month_starts(today, months):
+    year, month = today.year, today.month
+    starts = []
+    for _ in range(months):
+        starts.append(datetime.date(year, month, 1))
+        year, month = (year, month - 1) if month > 1 else (year - 1, 12)
+    return list(reversed(starts))
+
+
+def get_monthly_registrations(today, months=TREND_MONTHS):
+    """New and old registrations for each of the last `months` months, oldest first"""
+    starts = _month_starts(today, months)
+    rows = RegistrationPaymentModel.objects.filter(
+        date__gte=starts[0], date__lte=today
+    ).order_by().annotate(month=TruncMonth('date')).values(
+        'month', 'registration_fee__patient_type'
+    ).annotate(count=Count('id'))
+    counts = _type_counts(rows, 'month')
+
+    data = []
+    for month_start in starts:
+        month_counts = counts.get(month_start, {})
+        new_count = month_counts.get('new', 0)
+        old_count = month_counts.get('old', 0)
+        data.append({
+            'month': month_start.strftime('%b %Y'),
+            'new_patients': new_count,
+            'old_patients': old_count,
+            'total': new_count + old_count,
+        })
+    return data
+
+
+def compute_demographics(today, confirmed_only=False):
+    counts = get_patient_counts(today)
+    gender_distribution = get_split('gender', GENDER)
+    by_gender = {row['name']: row['value'] for row in gender_distribution}
+    return {
+        **counts,
+        'male': by_gender.get('Male', 0),
+        'female': by_gender.get('Female', 0),
+        'age_groups': get_age_groups(today),
+        'gender_distribution': gender_distribution,
+        'marital_distribution': get_split('marital_status', MARITAL_STATUS),
+        'registrations': get_registration_summary(today, confirmed_only),
+        'daily_registrations': get_daily_registrations(today),
+        'monthly_registrations': get_monthly_registrations(today),
+    }
+
+
+def get_demographics(confirmed_only=False, refresh=False):
+    """Dashboard demographics for today, cached for CACHE_SECONDS (refresh=True recomputes)"""
+    today = timezone.localdate()
+    key = CACHE_KEY.format(today.isoformat(), 'confirmed' if confirmed_only else 'all')
+    demographics = None if refresh else cache.get(key)
+    if demographics is None:
+        demographics = compute_demographics(today, confirmed_only)
+        cache.set(key, demographics, CACHE_SECONDS)
+    return demographics
@@ -0,0 +1,57 @@
+# patient/management/commands/benchmark_patient_search.py
+
+import statistics
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from patient.models import PatientModel, PatientSearchToken
+from patient.search import rank_patients, search_patients, AUTOCOMPLETE_LIMIT
+
+DEFAULT_QUERIES = ['ad', 'ade', 'john', 'oluwa', 'mary jo', '0803', '08031234567', 'pat-0', 'adebayp']
+
+
+class Command(BaseCommand):
+    help = 'Time autocomplete and patient list searches against the patient search index'
+
+    def add_arguments(self, parser):
+        parser.add_argument('queries', nargs='*', help=f'Queries to time (default: {" ".join(DEFAULT_QUERIES)})')
+        parser.add_argument('--repeat', type=int, default=20, help='Runs per query')
+        parser.add_argument('--page-size', type=int, default=20, help='Rows fetched for the list view search')
+        parser.add_argument('--explain', action='store_true', help='Print the query plan of each list view search')
+
+    def handle(self, *args, **options):
+        queries = options['queries'] or DEFAULT_QUERIES
+        repeat = options['repeat']
+        if repeat < 1 or options['page_size'] < 1:
+            raise CommandError('--repeat and --page-size must be positive')
+
+        self.stdout.write(
+            f'{PatientModel.objects.count()} patients, {PatientSearchToken.objects.count()} search tokens'
+        )
+        self.stdout.write(f'{"query":<16}{"matches":>9}{"autocomplete ms":>18}{"list page ms":>15}')
+
+        for query in queries:
+            autocomplete = []
+            listing = []
+            for _ in range(repeat):
+                started = time.perf_counter()
+                matches = rank_patients(query, AUTOCOMPLETE_LIMIT)
+                autocomplete.append((time.perf_counter() - started) * 1000)
+
+                started = time.perf_counter()
+                list(search_patients(query).order_by('first_name', 'last_name')[:options['page_size']])
+                listing.append((time.perf_counter() - started) * 1000)
+
+            self.stdout.write(
+                f'{query:<16}{len(matches):>9}'
+                f'{self._summary(autocomplete):>18}{self._summary(listing):>15}'
+            )
+            if options['explain']:
+                self.stdout.write(search_patients(query).order_by('first_name', 'last_name')[:options['page_size']].explain())
+
+    def _summary(self, timings):
+        """median / p95"""
+        ordered = sorted(timings)
+        p95 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+        return f'{statistics.median(ordered):.1f} / {p95:.1f}'
@@ -0,0 +1,26 @@
+# patient/management/commands/rebuild_clinical_timeline.py
+
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from patient.timeline import rebuild
+
+
+class Command(BaseCommand):
+    help = 'Rewrite the clinical timeline events from consultations, orders, results, vitals, admissions and surgeries'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--patient', type=int, action='append', dest='patients',
+                            help='Only rebuild this patient (repeat for more)')
+        parser.add_argument('--batch-size', type=int, default=2000, help='Records read per query')
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size must be positive')
+
+        started = time.perf_counter()
+        count = rebuild(patient_ids=options['patients'], batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(
+            f'Wrote {count} timeline events in {time.perf_counter() - started:.1f} s'
+        ))
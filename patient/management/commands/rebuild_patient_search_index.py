@@ -0,0 +1,24 @@
+# patient/management/commands/rebuild_patient_search_index.py
+
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from patient.search import rebuild_index
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the search tokens of every patient (needed after loading patients without saving them one by one)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=2000, help='Patients indexed per transaction')
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size must be positive')
+
+        started = time.perf_counter()
+        count = rebuild_index(options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(
+            f'Indexed {count} patients in {time.perf_counter() - started:.1f} s'
+        ))
@@ -0,0 +1,58 @@
+# Generated by Django 5.0 on 2026-10-16 12:05
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def create_opening_balances(apps, schema_editor):
+    """Start every funded wallet's ledger with its current balance"""
+    PatientWalletModel = apps.get_model('patient', 'PatientWalletModel')
+    WalletLedgerEntry = apps.get_model('patient', 'WalletLedgerEntry')
+
+    WalletLedgerEntry.objects.bulk_create(
+        (
+            WalletLedgerEntry(
+                wallet_id=wallet_id,
+                entry_type='opening_balance',
+                direction='in' if amount >= 0 else 'out',
+                amount=abs(amount),
+                balance_after=amount,
+                description='Balance before the wallet ledger was introduced',
+            )
+            for wallet_id, amount in PatientWalletModel.objects.exclude(amount=0).values_list('id', 'amount').iterator()
+        ),
+        batch_size=1000
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('patient', '0006_consultationreporttemplate_and_more'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WalletLedgerEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('entry_type', models.CharField(choices=[('opening_balance', 'OPENING BALANCE'), ('funding', 'WALLET FUNDING'), ('payment', 'PAYMENT'), ('withdrawal', 'WALLET WITHDRAWAL'), ('refund', 'REFUND TO WALLET'), ('correction', 'WALLET CORRECTION')], max_length=20)),
+                ('direction', models.CharField(choices=[('in', 'IN'), ('out', 'OUT')], max_length=5)),
+                ('amount', models.DecimalField(decimal_places=2, max_digits=12)),
+                ('balance_after', models.DecimalField(decimal_places=2, max_digits=12)),
+                ('description', models.CharField(blank=True, default='', max_length=255)),
+                ('reference', models.CharField(blank=True, default='', help_text='e.g. transaction ID', max_length=100)),
+                ('idempotency_key', models.CharField(blank=True, max_length=100, null=True, unique=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('created_by', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='wallet_ledger_entries', to=settings.AUTH_USER_MODEL)),
+                ('wallet', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='ledger_entries', to='patient.patientwalletmodel')),
+            ],
+            options={
+                'ordering': ['-id'],
+                'indexes': [models.Index(fields=['wallet', 'id'], name='patient_wal_wallet__37b749_idx')],
+            },
+        ),
+        migrations.RunPython(create_opening_balances, migrations.RunPython.noop),
+    ]
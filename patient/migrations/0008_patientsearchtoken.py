@@ -0,0 +1,113 @@
+# Generated by Django 5.0 on 2026-10-16 15:00
+
+import re
+import unicodedata
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+# The tokenizer as of this migration (see patient.search), copied so the
+# migration keeps working when the live module changes
+
+NAME = 'n:'
+PHONE = 'p:'
+CARD = 'c:'
+CARD_PART = 'k:'
+EMAIL = 'e:'
+TRIGRAM = 't:'
+
+TOKEN_MAX_LENGTH = 120
+
+INDEXED_FIELDS = ('first_name', 'middle_name', 'last_name', 'card_number', 'mobile', 'email')
+
+
+def normalize_text(value):
+    decomposed = unicodedata.normalize('NFKD', value or '')
+    return ''.join(char for char in decomposed if not unicodedata.combining(char)).lower()
+
+
+def name_words(value):
+    words = []
+    for chunk in normalize_text(value).split():
+        parts = re.findall(r'[a-z0-9]+', chunk)
+        words.extend(parts)
+        if len(parts) > 1:
+            words.append(''.join(parts))
+    return words
+
+
+def normalize_phone(value):
+    digits = re.sub(r'\D', '', value or '')
+    if digits.startswith('234') and len(digits) > 10:
+        digits = '0' + digits[3:]
+    return digits
+
+
+def trigrams(word):
+    if len(word) < 3:
+        return set()
+    padded = f'${word}$'
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def patient_tokens(first_name='', middle_name='', last_name='', card_number='', mobile='', email=''):
+    tokens = set()
+    for name in (first_name, middle_name, last_name):
+        for word in name_words(name):
+            tokens.add(NAME + word)
+            tokens.update(TRIGRAM + gram for gram in trigrams(word))
+
+    card = re.sub(r'\s+', '', normalize_text(card_number))
+    if card:
+        tokens.add(CARD + card)
+        compact = re.sub(r'[^a-z0-9]', '', card)
+        if compact:
+            tokens.add(CARD_PART + compact)
+        trailing_digits = re.search(r'\d+$', compact)
+        if trailing_digits:
+            tokens.add(CARD_PART + trailing_digits.group())
+
+    phone = normalize_phone(mobile)
+    if phone:
+        tokens.add(PHONE + phone)
+
+    if email:
+        tokens.add(EMAIL + normalize_text(email).strip())
+
+    return {token[:TOKEN_MAX_LENGTH] for token in tokens}
+
+
+def build_search_index(apps, schema_editor):
+    """Index every existing patient"""
+    PatientModel = apps.get_model('patient', 'PatientModel')
+    PatientSearchToken = apps.get_model('patient', 'PatientSearchToken')
+
+    batch = []
+    for row in PatientModel.objects.order_by('id').values('id', *INDEXED_FIELDS).iterator(chunk_size=2000):
+        patient_id = row.pop('id')
+        fields = {field: value or '' for field, value in row.items()}
+        batch.extend(PatientSearchToken(patient_id=patient_id, token=token) for token in patient_tokens(**fields))
+        if len(batch) >= 5000:
+            PatientSearchToken.objects.bulk_create(batch)
+            batch = []
+    PatientSearchToken.objects.bulk_create(batch)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('patient', '0007_walletledgerentry'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PatientSearchToken',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('token', models.CharField(db_index=True, max_length=120)),
+                ('patient', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='search_tokens', to='patient.patientmodel')),
+            ],
+        ),
+        migrations.RunPython(build_search_index, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,187 @@
+# Generated by Django 5.0 on 2026-10-16 17:00
+
+from collections import namedtuple
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+# The event sources as of this migration (see patient.timeline), copied so the
+# migration keeps working when the live module changes
+
+# model: (app label, model name)
+# patient / occurred_at: lookups tried in order, the first non-null value is used
+# fields: values read to describe the event
+Source = namedtuple('Source', 'kind model patient occurred_at fields describe')
+
+
+def _first(row, lookups):
+    for lookup in lookups:
+        if row.get(lookup) is not None:
+            return row[lookup]
+    return None
+
+
+def _consultation(row):
+    title = row['primary_diagnosis__name'] or row['diagnosis'] or row['chief_complaint']
+    return title, row['status']
+
+
+def _vitals(row):
+    readings = []
+    if row['blood_pressure_systolic'] and row['blood_pressure_diastolic']:
+        readings.append(f"BP {row['blood_pressure_systolic']}/{row['blood_pressure_diastolic']}")
+    if row['temperature'] is not None:
+        readings.append(f"Temp {row['temperature']}°C")
+    if row['pulse_rate'] is not None:
+        readings.append(f"Pulse {row['pulse_rate']}")
+    if row['oxygen_saturation'] is not None:
+        readings.append(f"SpO2 {row['oxygen_saturation']}%")
+    return ', '.join(readings), ''
+
+
+def _drug_order(row):
+    generic = row['drug__formulation__generic_drug__generic_name'] or ''
+    name = row['drug__brand_name'] or f"{generic.title()} {row['drug__formulation__strength'] or ''}"
+    return name, row['status']
+
+
+def _named(name_field, status_field=None):
+    def describe(row):
+        return row[name_field], row[status_field] if status_field else ''
+    return describe
+
+
+def _service(prefix, status_field):
+    def describe(row):
+        return row[f'{prefix}service__name'] or row[f'{prefix}service_item__name'], row[status_field]
+    return describe
+
+
+def _admission(row):
+    return f"{row['admission_number']} - {row['admission_diagnosis']}", row['status']
+
+
+SOURCES = [
+    Source('consultation', ('consultation', 'ConsultationSessionModel'),
+           ('queue_entry__patient_id', 'admission__patient_id'), ('created_at',),
+           ('primary_diagnosis__name', 'diagnosis', 'chief_complaint', 'status'), _consultation),
+    Source('vitals', ('consultation', 'PatientVitalsModel'),
+           ('queue_entry__patient_id', 'admission__patient_id'), ('recorded_at',),
+           ('blood_pressure_systolic', 'blood_pressure_diastolic', 'temperature', 'pulse_rate',
+            'oxygen_saturation'), _vitals),
+    Source('drug_order', ('pharmacy', 'DrugOrderModel'), ('patient_id',), ('ordered_at',),
+           ('drug__brand_name', 'drug__formulation__generic_drug__generic_name', 'drug__formulation__strength',
+            'status'), _drug_order),
+    Source('external_prescription', ('pharmacy', 'ExternalPrescription'), ('patient_id',), ('ordered_at',),
+           ('drug_name',), _named('drug_name')),
+    Source('lab_order', ('laboratory', 'LabTestOrderModel'), ('patient_id',), ('ordered_at',),
+           ('template__name', 'status'), _named('template__name', 'status')),
+    Source('lab_result', ('laboratory', 'LabTestResultModel'), ('order__patient_id',), ('created_at',),
+           ('order__template__name', 'is_verified'), _named('order__template__name', 'is_verified')),
+    Source('scan_order', ('scan', 'ScanOrderModel'), ('patient_id',), ('ordered_at',),
+           ('template__name', 'status'), _named('template__name', 'status')),
+    Source('scan_result', ('scan', 'ScanResultModel'), ('order__patient_id',), ('performed_at',),
+           ('order__template__name', 'status'), _named('order__template__name', 'status')),
+    Source('service_order', ('service', 'PatientServiceTransaction'), ('patient_id',), ('created_at',),
+           ('service__name', 'service_item__name', 'status'), _service('', 'status')),
+    Source('service_result', ('service', 'ServiceResult'), ('transaction__patient_id',), ('created_at',),
+           ('transaction__service__name', 'transaction__service_item__name', 'is_verified'),
+           _service('transaction__', 'is_verified')),
+    Source('admission', ('inpatient', 'Admission'), ('patient_id',), ('admission_date',),
+           ('admission_number', 'admission_diagnosis', 'status'), _admission),
+    Source('surgery', ('inpatient', 'Surgery'), ('patient_id',), ('actual_start_time', 'scheduled_date'),
+           ('surgery_type__name', 'status'), _named('surgery_type__name', 'status')),
+]
+
+
+def _truncate(value, length):
+    value = ' '.join(str(value or '').split())
+    return value if len(value) <= length else value[:length - 3] + '...'
+
+
+def _status_value(value):
+    # Results only record whether they were verified
+    if isinstance(value, bool):
+        return 'verified' if value else 'unverified'
+    return value or ''
+
+
+def build_events(source, queryset, content_type_id):
+    """Unsaved ClinicalEvent field values for the records of queryset; records without a patient are skipped"""
+    rows = queryset.order_by().values('pk', *source.patient, *source.occurred_at, *source.fields)
+    events = []
+    for row in rows:
+        patient_id = _first(row, source.patient)
+        occurred_at = _first(row, source.occurred_at)
+        if patient_id is None or occurred_at is None:
+            continue
+        title, status = source.describe(row)
+        events.append({
+            'patient_id': patient_id,
+            'kind': source.kind,
+            'occurred_at': occurred_at,
+            'content_type_id': content_type_id,
+            'object_id': row['pk'],
+            'title': _truncate(title, 255),
+            'status': _truncate(_status_value(status), 30),
+        })
+    return events
+
+
+def build_timeline(apps, schema_editor):
+    """Write the events of every existing record"""
+    ClinicalEvent = apps.get_model('patient', 'ClinicalEvent')
+    ContentType = apps.get_model('contenttypes', 'ContentType')
+    for source in SOURCES:
+        model = apps.get_model(*source.model)
+        opts = model._meta
+        content_type_id = ContentType.objects.get_or_create(app_label=opts.app_label, model=opts.model_name)[0].id
+        last_pk = None
+        while True:
+            batch = model.objects.order_by('pk')
+            if last_pk is not None:
+                batch = batch.filter(pk__gt=last_pk)
+            pks = list(batch.values_list('pk', flat=True)[:2000])
+            if not pks:
+                break
+            rows = build_events(source, model.objects.filter(pk__in=pks), content_type_id)
+            ClinicalEvent.objects.bulk_create([ClinicalEvent(**row) for row in rows])
+            last_pk = pks[-1]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('patient', '0008_patientsearchtoken'),
+        ('consultation', '0004_patientvitalsmodel_admission_and_more'),
+        ('inpatient', '0009_alter_admissiontask_task_type'),
+        ('laboratory', '0006_labtestordermodel_customer_name_and_more'),
+        ('pharmacy', '0004_drugordermodel_customer_name_drugordermodel_source_and_more'),
+        ('scan', '0006_alter_scanordermodel_source'),
+        ('service', '0005_alter_patientservicetransaction_admission_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ClinicalEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('consultation', 'CONSULTATION'), ('vitals', 'VITALS'), ('drug_order', 'DRUG ORDER'), ('external_prescription', 'EXTERNAL PRESCRIPTION'), ('lab_order', 'LAB ORDER'), ('lab_result', 'LAB RESULT'), ('scan_order', 'SCAN ORDER'), ('scan_result', 'SCAN RESULT'), ('service_order', 'SERVICE ORDER'), ('service_result', 'SERVICE RESULT'), ('admission', 'ADMISSION'), ('surgery', 'SURGERY')], max_length=30)),
+                ('occurred_at', models.DateTimeField()),
+                ('object_id', models.PositiveBigIntegerField()),
+                ('title', models.CharField(blank=True, default='', max_length=255)),
+                ('status', models.CharField(blank=True, default='', max_length=30)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('content_type', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='contenttypes.contenttype')),
+                ('patient', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='clinical_events', to='patient.patientmodel')),
+            ],
+            options={
+                'ordering': ['-occurred_at', '-id'],
+                'indexes': [models.Index(fields=['patient', 'occurred_at', 'id'], name='patient_cli_patient_217cf2_idx'), models.Index(fields=['patient', 'kind', 'occurred_at', 'id'], name='patient_cli_patient_ed5ad0_idx')],
+                'constraints': [models.UniqueConstraint(fields=('content_type', 'object_id'), name='unique_clinical_event_source')],
+            },
+        ),
+        migrations.RunPython(build_timeline, migrations.RunPython.noop),
+    ]
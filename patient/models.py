@@ -1,10 +1,16 @@
 import os
 import uuid
 from datetime import date
+from decimal import Decimal
 from django.contrib.auth.models import User
+from django.contrib.contenttypes.fields import GenericForeignKey
+from django.contrib.contenttypes.models import ContentType
 from django.core.exceptions import ValidationError
-from django.db import models, transaction
+from django.db import models, transaction, IntegrityError
+from django.db.models import F
+from django.utils import timezone
 from admin_site.model_info import *
+from admin_site.sequences import next_block_value, reserve_row_block, get_block_size
 from consultation.models import ConsultationFeeModel
 
 REGISTRATION_STATUS = (
@@ -168,7 +174,13 @@ class PatientModel(models.Model):
     @transaction.atomic
     def generate_unique_patient_id(self):
         """
-        Bulletproof patient ID generation following HR model pattern
+        Next card number from the patient ID sequence, formatted with the prefix in PatientSettingModel.
+
+        Numbers are reserved from PatientIDGeneratorModel in blocks of
+        PATIENT_ID_BLOCK_SIZE (settings, default 10) and handed out from memory,
+        so registration desks do not queue on the counter row. A block is
+        reserved in a transaction of its own (see reserve_block), not the one
+        the registration runs in.
         """
         try:
             setting = PatientSettingModel.objects.first()
@@ -177,31 +189,17 @@ class PatientModel(models.Model):
             if not setting or not setting.auto_generate_patient_id:
                 return self._generate_manual_fallback()
 
-            # Get or create the counter record
-            last_entry, created = PatientIDGeneratorModel.objects.select_for_update().get_or_create(
-                id=1,  # Always use same record
-                defaults={'last_id': 0, 'last_patient_id': '0000'}
-            )
-
-            max_attempts = 50  # Increased for production
+            max_attempts = 50  # Skip numbers already taken by manually entered card numbers
             for attempt in range(max_attempts):
-                # Increment counter
-                last_entry.last_id += 1
-                new_id = str(last_entry.last_id).zfill(4)
+                new_id = str(PatientIDGeneratorModel.next_id()).zfill(4)
 
                 # Build full patient ID
                 full_id = self._build_patient_id(setting, new_id)
 
                 # Check if unique
                 if not PatientModel.objects.filter(card_number=full_id).exists():
-                    last_entry.last_patient_id = new_id
-                    last_entry.status = 's'  # Success
-                    last_entry.save()
                     return full_id
 
-                # If not unique, continue with next number
-                continue
-
             # Fallback if all attempts failed
             return self._generate_uuid_fallback()
 
@@ -241,7 +239,71 @@ class PatientModel(models.Model):
         return ''
 
 
+class PatientSearchToken(models.Model):
+    """
+    Normalized search keys of a patient, rebuilt by patient.search.index_patient on every save.
+    token is "<kind>:<value>" (see patient.search for the kinds) so one index serves every lookup.
+    """
+    patient = models.ForeignKey(PatientModel, on_delete=models.CASCADE, related_name='search_tokens')
+    token = models.CharField(max_length=120, db_index=True)
+
+    def __str__(self):
+        return f"{self.patient_id}: {self.token}"
+
+
+class ClinicalEvent(models.Model):
+    """
+    One row per clinical record of a patient (consultation, order, result, vitals, admission, surgery),
+    written by patient.timeline whenever the record is saved so history pages read a single indexed table.
+    title and status are a snapshot of the record taken at its last save.
+    """
+    KIND = (
+        ('consultation', 'CONSULTATION'),
+        ('vitals', 'VITALS'),
+        ('drug_order', 'DRUG ORDER'),
+        ('external_prescription', 'EXTERNAL PRESCRIPTION'),
+        ('lab_order', 'LAB ORDER'),
+        ('lab_result', 'LAB RESULT'),
+        ('scan_order', 'SCAN ORDER'),
+        ('scan_result', 'SCAN RESULT'),
+        ('service_order', 'SERVICE ORDER'),
+        ('service_result', 'SERVICE RESULT'),
+        ('admission', 'ADMISSION'),
+        ('surgery', 'SURGERY'),
+    )
+
+    patient = models.ForeignKey(PatientModel, on_delete=models.CASCADE, related_name='clinical_events')
+    kind = models.CharField(max_length=30, choices=KIND)
+    occurred_at = models.DateTimeField()
+
+    # The record this event stands for
+    content_type = models.ForeignKey(ContentType, on_delete=models.CASCADE)
+    object_id = models.PositiveBigIntegerField()
+    content_object = GenericForeignKey('content_type', 'object_id')
+
+    title = models.CharField(max_length=255, blank=True, default='')
+    status = models.CharField(max_length=30, blank=True, default='')
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ['-occurred_at', '-id']
+        constraints = [
+            models.UniqueConstraint(fields=['content_type', 'object_id'], name='unique_clinical_event_source'),
+        ]
+        indexes = [
+            models.Index(fields=['patient', 'occurred_at', 'id']),
+            models.Index(fields=['patient', 'kind', 'occurred_at', 'id']),
+        ]
+
+    def __str__(self):
+        return f"{self.patient_id}: {self.get_kind_display()} {self.occurred_at:%Y-%m-%d %H:%M}"
+
+
 class PatientIDGeneratorModel(models.Model):
+    """
+    High-water mark of the patient card number sequence (row id=1).
+    last_id is the highest number reserved; numbers up to it may still be waiting in a worker's block.
+    """
     id = models.AutoField(primary_key=True)  # Make it explicit
     last_id = models.BigIntegerField(default=0)  # Change to BigIntegerField for consistency
     last_patient_id = models.CharField(max_length=100, null=True, blank=True)
@@ -252,6 +314,22 @@ class PatientIDGeneratorModel(models.Model):
     status = models.CharField(max_length=10, choices=STATUS, blank=True, default='f')
     updated_at = models.DateTimeField(auto_now=True)  # Add timestamp for debugging
 
+    @classmethod
+    def reserve_block(cls, size):
+        """
+        Reserve size card numbers and return (first, last). The reservation commits on its own
+        connection, so the row is not locked for the rest of the registration transaction
+        (see admin_site.sequences.run_outside_transaction; on SQLite it stays in the caller's).
+        """
+        return reserve_row_block(
+            cls.objects.filter(id=1), 'last_id', size,
+            lambda: cls.objects.create(id=1, last_id=0, last_patient_id='0000')
+        )
+
+    @classmethod
+    def next_id(cls):
+        return next_block_value(('patient_id', ''), cls.reserve_block, get_block_size('PATIENT_ID_BLOCK_SIZE', 10))
+
 
 class PatientSettingModel(models.Model):
     """This model handles all setting related to patient"""
@@ -283,8 +361,26 @@ class PatientRegistrationPriceHistoryModel(models.Model):
         return f"{self.old_price} -> {self.new_price} on {self.change_date.date()}"
 
 
+class InsufficientWalletBalance(ValueError):
+    """Raised when a debit would take a wallet below zero"""
+
+    def __init__(self, wallet, amount):
+        self.wallet = wallet
+        self.amount = amount
+        super().__init__(f'Insufficient wallet balance. Available: ₦{wallet.amount:,.2f}, Required: ₦{amount:,.2f}')
+
+
+class DuplicateWalletEntry(ValueError):
+    """Raised when an idempotency key has already been applied; entry is the original ledger entry"""
+
+    def __init__(self, entry):
+        self.entry = entry
+        super().__init__('This wallet operation has already been processed')
+
+
 class PatientWalletModel(models.Model):
     patient = models.OneToOneField(PatientModel, on_delete=models.CASCADE, related_name='wallet')
+    # Balance snapshot, kept in step with the ledger by post_entry()
     amount = models.DecimalField(max_digits=10, decimal_places=2, default=0.00)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
@@ -292,21 +388,135 @@ class PatientWalletModel(models.Model):
     def __str__(self):
         return f"{self.patient} - {self.amount:.2f}"
 
+    def post_entry(self, amount, direction, entry_type, user=None, description='', reference='',
+                   idempotency_key=None):
+        """
+        Apply a credit ('in') or debit ('out') and append it to the wallet ledger.
+
+        The balance is changed with a single conditional UPDATE (amount = amount +/- x), so
+        concurrent cashiers never overwrite each other and a debit can never take the wallet
+        below zero. self.amount is refreshed to the new balance.
+
+        Raises:
+            InsufficientWalletBalance: debit larger than the current balance
+            DuplicateWalletEntry: idempotency_key was already used
+        """
+        amount = Decimal(str(amount)).quantize(Decimal('0.01'))
+        if amount <= 0:
+            raise ValueError('Amount must be greater than 0')
+
+        if idempotency_key:
+            existing = WalletLedgerEntry.objects.filter(idempotency_key=idempotency_key).first()
+            if existing:
+                raise DuplicateWalletEntry(existing)
+
+        wallets = PatientWalletModel.objects.filter(pk=self.pk)
+        try:
+            with transaction.atomic():
+                if direction == 'in':
+                    wallets.update(amount=F('amount') + amount, updated_at=timezone.now())
+                elif not wallets.filter(amount__gte=amount).update(amount=F('amount') - amount,
+                                                                   updated_at=timezone.now()):
+                    self.refresh_from_db(fields=['amount'])
+                    raise InsufficientWalletBalance(self, amount)
+
+                balance = wallets.values_list('amount', flat=True).get()
+                entry = WalletLedgerEntry.objects.create(
+                    wallet=self,
+                    entry_type=entry_type,
+                    direction=direction,
+                    amount=amount,
+                    balance_after=balance,
+                    description=description,
+                    reference=reference,
+                    idempotency_key=idempotency_key or None,
+                    created_by=user,
+                )
+        except IntegrityError:
+            # A concurrent request with the same key won the race
+            existing = WalletLedgerEntry.objects.filter(idempotency_key=idempotency_key).first() \
+                if idempotency_key else None
+            if existing:
+                raise DuplicateWalletEntry(existing)
+            raise
+
+        self.amount = balance
+        return entry
+
+    def credit(self, amount, entry_type='funding', **kwargs):
+        return self.post_entry(amount, 'in', entry_type, **kwargs)
+
+    def debit(self, amount, entry_type='payment', **kwargs):
+        return self.post_entry(amount, 'out', entry_type, **kwargs)
+
     def add_funds(self, amount):
         """Safely add funds to wallet"""
         if amount > 0:
-            self.amount += amount
-            self.save()
+            self.credit(amount)
 
     def deduct_funds(self, amount):
         """Safely deduct funds from wallet"""
-        if amount > 0 and self.amount >= amount:
-            self.amount -= amount
-            self.save()
-            return True
+        if amount > 0:
+            try:
+                self.debit(amount)
+                return True
+            except InsufficientWalletBalance:
+                pass
         return False
 
 
+class WalletLedgerEntry(models.Model):
+    """
+    Append-only journal of wallet balance changes.
+    PatientWalletModel.amount is the running balance; balance_after records it after each entry.
+    """
+    ENTRY_TYPE = (
+        ('opening_balance', 'OPENING BALANCE'),
+        ('funding', 'WALLET FUNDING'),
+        ('payment', 'PAYMENT'),
+        ('withdrawal', 'WALLET WITHDRAWAL'),
+        ('refund', 'REFUND TO WALLET'),
+        ('correction', 'WALLET CORRECTION'),
+    )
+
+    wallet = models.ForeignKey(PatientWalletModel, on_delete=models.CASCADE, related_name='ledger_entries')
+    entry_type = models.CharField(max_length=20, choices=ENTRY_TYPE)
+    direction = models.CharField(max_length=5, choices=(('in', 'IN'), ('out', 'OUT')))
+    amount = models.DecimalField(max_digits=12, decimal_places=2)
+    balance_after = models.DecimalField(max_digits=12, decimal_places=2)
+    description = models.CharField(max_length=255, blank=True, default='')
+    reference = models.CharField(max_length=100, blank=True, default='', help_text="e.g. transaction ID")
+    idempotency_key = models.CharField(max_length=100, unique=True, null=True, blank=True)
+    created_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True,
+                                   related_name='wallet_ledger_entries')
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['-id']
+        indexes = [
+            models.Index(fields=['wallet', 'id']),
+        ]
+
+    def __str__(self):
+        return f"{self.wallet.patient} - {self.get_entry_type_display()} {self.signed_amount:,.2f}"
+
+    @property
+    def signed_amount(self):
+        return self.amount if self.direction == 'in' else -self.amount
+
+    @property
+    def balance_before(self):
+        return self.balance_after - self.signed_amount
+
+    def save(self, *args, **kwargs):
+        if not self._state.adding:
+            raise ValueError('Wallet ledger entries cannot be changed; post a correction instead')
+        super().save(*args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        raise ValueError('Wallet ledger entries cannot be deleted; post a correction instead')
+
+
 def consultation_document_path(instance, filename):
     """Generate file path for consultation documents"""
     return f'consultation_docs/{instance.patient.id}/{filename}'
@@ -378,36 +588,8 @@ class RegistrationReportTemplate(models.Model):
 
     def get_patient_count(self, from_date, to_date):
         """Calculate patient count for this template within date range"""
-        from datetime import date
-
-        queryset = PatientModel.objects.filter(
-            created_at__date__range=[from_date, to_date],
-            status='active'
-        )
-
-        # Apply age filters
-        if self.age_min is not None or self.age_max is not None:
-            today = date.today()
-
-            if self.age_min is not None:
-                # Max birth date for minimum age (older patients born earlier)
-                max_birth_date = date(today.year - self.age_min, today.month, today.day)
-                queryset = queryset.filter(date_of_birth__lte=max_birth_date)
-
-            if self.age_max is not None:
-                # Min birth date for maximum age (younger patients born later)
-                min_birth_date = date(today.year - self.age_max - 1, today.month, today.day)
-                queryset = queryset.filter(date_of_birth__gte=min_birth_date)
-
-        # Apply gender filter
-        if self.gender:
-            queryset = queryset.filter(gender=self.gender)
-
-        # Apply marital status filter
-        if self.marital_status:
-            queryset = queryset.filter(marital_status=self.marital_status)
-
-        return queryset.count()
+        from patient.report_templates import count_registrations
+        return count_registrations([self], from_date, to_date)[self.id]
 
 
 class ConsultationReportTemplate(models.Model):
@@ -450,34 +632,5 @@ class ConsultationReportTemplate(models.Model):
 
     def get_consultation_count(self, from_date, to_date):
         """Calculate consultation count for this template within date range"""
-        from datetime import date
-        from consultation.models import ConsultationSessionModel
-
-        queryset = ConsultationSessionModel.objects.filter(
-            created_at__date__range=[from_date, to_date],
-            status='completed',
-            primary_diagnosis=self.diagnosis
-        )
-
-        # Apply age filters if specified
-        if self.age_min is not None or self.age_max is not None:
-            patient_ids = []
-            today = date.today()
-
-            for consultation in queryset.select_related('queue_entry__patient'):
-                patient = consultation.queue_entry.patient
-                if patient.date_of_birth:
-                    age = today.year - patient.date_of_birth.year - (
-                            (today.month, today.day) < (patient.date_of_birth.month, patient.date_of_birth.day)
-                    )
-
-                    if self.age_min is not None and age < self.age_min:
-                        continue
-                    if self.age_max is not None and age > self.age_max:
-                        continue
-
-                    patient_ids.append(consultation.id)
-
-            queryset = queryset.filter(id__in=patient_ids)
-
-        return queryset.count()
+        from patient.report_templates import count_consultations
+        return count_consultations([self], from_date, to_date)[self.id]
@@ -0,0 +1,93 @@
+"""
+Batch evaluation of registration and consultation report templates.
+
+Instead of one query per template, the records in the date range are grouped
+once by the attributes templates filter on (age in years, gender, marital
+status, diagnosis) and every template's count is summed from those groups.
+Ages are computed by the database from date_of_birth, so no patient rows are
+loaded into Python.
+"""
+from django.db.models import Case, Count, IntegerField, Q, Value, When
+from django.db.models.functions import ExtractYear
+from django.utils import timezone
+
+from consultation.models import ConsultationSessionModel
+from patient.models import PatientModel
+
+
+def age_expression(date_of_birth_field, today):
+    """Age in whole years on today of the date of birth in date_of_birth_field (NULL when unknown)"""
+    birth_year = ExtractYear(date_of_birth_field)
+    birthday_not_reached = Q(**{f'{date_of_birth_field}__month__gt': today.month}) | Q(
+        **{f'{date_of_birth_field}__month': today.month, f'{date_of_birth_field}__day__gt': today.day}
+    )
+    return Case(
+        When(**{f'{date_of_birth_field}__isnull': True}, then=Value(None)),
+        When(birthday_not_reached, then=Value(today.year - 1) - birth_year),
+        default=Value(today.year) - birth_year,
+        output_field=IntegerField(),
+    )
+
+
+def age_matches(template, age):
+    """Whether an age passes the template's age range; unknown ages only pass templates without one"""
+    if template.age_min is None and template.age_max is None:
+        return True
+    if age is None:
+        return False
+    if template.age_min is not None and age < template.age_min:
+        return False
+    if template.age_max is not None and age > template.age_max:
+        return False
+    return True
+
+
+def count_registrations(templates, from_date, to_date, today=None):
+    """{template id: active patients registered in the range matching the template}"""
+    today = today or timezone.localdate()
+    groups = PatientModel.objects.filter(
+        created_at__date__range=[from_date, to_date],
+        status='active',
+    ).order_by().annotate(
+        age=age_expression('date_of_birth', today)
+    ).values('age', 'gender', 'marital_status').annotate(count=Count('id'))
+    groups = list(groups)
+
+    counts = {}
+    for template in templates:
+        counts[template.id] = sum(
+            group['count'] for group in groups
+            if age_matches(template, group['age'])
+            and (not template.gender or group['gender'] == template.gender)
+            and (not template.marital_status or group['marital_status'] == template.marital_status)
+        )
+    return counts
+
+
+def count_consultations(templates, from_date, to_date, today=None):
+    """{template id: completed consultations in the range with the template's primary diagnosis}"""
+    templates = list(templates)
+    today = today or timezone.localdate()
+    diagnosis_ids = {template.diagnosis_id for template in templates}
+    if not diagnosis_ids:
+        return {}
+
+    groups = ConsultationSessionModel.objects.filter(
+        created_at__date__range=[from_date, to_date],
+        status='completed',
+        primary_diagnosis_id__in=diagnosis_ids,
+    ).order_by().annotate(
+        age=age_expression('queue_entry__patient__date_of_birth', today),
+    ).values('primary_diagnosis_id', 'age').annotate(count=Count('id'))
+
+    by_diagnosis = {}
+    for group in groups:
+        by_diagnosis.setdefault(group['primary_diagnosis_id'], []).append(group)
+
+    return {
+        template.id: sum(
+            group['count'] for group in by_diagnosis.get(template.diagnosis_id, [])
+            if age_matches(template, group['age'])
+        )
+        for template in templates
+    }
@@ -0,0 +1,330 @@
+"""
+Patient search index.
+
+Every patient has a set of PatientSearchToken rows, one per normalized search
+key, stored as "<kind>:<value>" in a single indexed column:
+
+    n:  name word, lowercased and accent-stripped ("adébáyọ̀" -> "n:adebayo")
+    p:  mobile number, digits only with +234 folded to 0 ("p:08031234567")
+    c:  card number, lowercased ("c:pat-0001")
+    k:  card number parts: alphanumerics only and the trailing digits ("k:pat0001", "k:0001")
+    e:  email, lowercased
+    t:  name trigram, for typo-tolerant matching ("t:$ad", "t:ade", ...)
+
+A search term matches a patient when one of the patient's tokens starts with
+the term (in the kinds that apply to it), which the token index answers as a
+range scan instead of scanning every patient row. Multi-word queries must
+match every word. When nothing matches, names sharing enough trigrams with
+the query are returned instead.
+
+Tokens are rebuilt when a patient is saved (see patient.signals); run
+manage.py rebuild_patient_search_index after loading patients any other way.
+"""
+import re
+import unicodedata
+
+from django.db import transaction
+from django.db.models import Q, Count
+
+from patient.models import PatientModel, PatientSearchToken
+
+NAME = 'n:'
+PHONE = 'p:'
+CARD = 'c:'
+CARD_PART = 'k:'
+EMAIL = 'e:'
+TRIGRAM = 't:'
+
+# Score of a term matching a token of each kind; an exact match counts double
+KIND_WEIGHTS = {
+    CARD: 100,
+    PHONE: 60,
+    CARD_PART: 50,
+    NAME: 30,
+    EMAIL: 10,
+}
+# Highest score of a fuzzy (trigram) match, kept below any prefix match
+FUZZY_WEIGHT = 20
+# Share of the query's trigrams a name must contain to be a fuzzy match
+FUZZY_MIN_SIMILARITY = 0.4
+
+AUTOCOMPLETE_LIMIT = 10
+MAX_AUTOCOMPLETE_LIMIT = 20
+# Shortest query the autocomplete answers
+MIN_QUERY_LENGTH = 2
+# Most patients ranked per autocomplete request
+CANDIDATE_LIMIT = 200
+
+TOKEN_MAX_LENGTH = PatientSearchToken._meta.get_field('token').max_length
+
+
+# ---------------------------------------------------------------------------
+# Normalization
+# ---------------------------------------------------------------------------
+
+def normalize_text(value):
+    """Lowercase and strip accents"""
+    decomposed = unicodedata.normalize('NFKD', value or '')
+    return ''.join(char for char in decomposed if not unicodedata.combining(char)).lower()
+
+
+def name_words(value):
+    """
+    Searchable words of a name: each alphanumeric run, plus the joined form of
+    hyphenated or apostrophed words ("Ade-Bayo" -> ade, bayo, adebayo).
+    """
+    words = []
+    for chunk in normalize_text(value).split():
+        parts = re.findall(r'[a-z0-9]+', chunk)
+        words.extend(parts)
+        if len(parts) > 1:
+            words.append(''.join(parts))
+    return words
+
+
+def normalize_phone(value):
+    digits = re.sub(r'\D', '', value or '')
+    if digits.startswith('234') and len(digits) > 10:
+        digits = '0' + digits[3:]
+    return digits
+
+
+def normalize_card(value):
+    return re.sub(r'\s+', '', normalize_text(value))
+
+
+def trigrams(word):
+    if len(word) < 3:
+        return set()
+    padded = f'${word}$'
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def patient_tokens(first_name='', middle_name='', last_name='', card_number='', mobile='', email=''):
+    """The set of search tokens for a patient's fields"""
+    tokens = set()
+    for name in (first_name, middle_name, last_name):
+        for word in name_words(name):
+            tokens.add(NAME + word)
+            tokens.update(TRIGRAM + gram for gram in trigrams(word))
+
+    card = normalize_card(card_number)
+    if card:
+        tokens.add(CARD + card)
+        compact = re.sub(r'[^a-z0-9]', '', card)
+        if compact:
+            tokens.add(CARD_PART + compact)
+        trailing_digits = re.search(r'\d+$', compact)
+        if trailing_digits:
+            tokens.add(CARD_PART + trailing_digits.group())
+
+    phone = normalize_phone(mobile)
+    if phone:
+        tokens.add(PHONE + phone)
+
+    if email:
+        tokens.add(EMAIL + normalize_text(email).strip())
+
+    return {token[:TOKEN_MAX_LENGTH] for token in tokens}
+
+
+# ---------------------------------------------------------------------------
+# Indexing
+# ---------------------------------------------------------------------------
+
+INDEXED_FIELDS = ('first_name', 'middle_name', 'last_name', 'card_number', 'mobile', 'email')
+
+
+def tokens_for(patient):
+    return patient_tokens(**{field: getattr(patient, field) or '' for field in INDEXED_FIELDS})
+
+
+@transaction.atomic
+def index_patient(patient):
+    """Replace the patient's search tokens with ones built from its current fields"""
+    tokens = tokens_for(patient)
+    existing = set(PatientSearchToken.objects.filter(patient=patient).values_list('token', flat=True))
+    if existing == tokens:
+        return
+    PatientSearchToken.objects.filter(patient=patient).exclude(token__in=tokens).delete()
+    PatientSearchToken.objects.bulk_create(
+        [PatientSearchToken(patient=patient, token=token) for token in tokens - existing]
+    )
+
+
+def rebuild_index(batch_size=2000):
+    """Rebuild the search tokens of every patient; returns the number of patients indexed"""
+    count = 0
+    last_id = 0
+    while True:
+        batch = list(
+            PatientModel.objects.filter(id__gt=last_id).order_by('id').only('id', *INDEXED_FIELDS)[:batch_size]
+        )
+        if not batch:
+            return count
+        with transaction.atomic():
+            PatientSearchToken.objects.filter(patient_id__in=[patient.id for patient in batch]).delete()
+            PatientSearchToken.objects.bulk_create(
+                [PatientSearchToken(patient_id=patient.id, token=token) for patient in batch
+                 for token in tokens_for(patient)],
+                batch_size=5000,
+            )
+        count += len(batch)
+        last_id = batch[-1].id
+
+
+# ---------------------------------------------------------------------------
+# Searching
+# ---------------------------------------------------------------------------
+
+def parse_query(query):
+    """
+    Split a query into terms, each the list of token prefixes it may match.
+
+    A query made only of digits and phone punctuation is one term matched
+    against mobile numbers and card number parts.
+    """
+    query = (query or '').strip()
+    compact = re.sub(r'[\s\-+().]', '', query)
+    if compact.isdigit():
+        return [[PHONE + normalize_phone(compact), CARD_PART + compact]]
+
+    terms = []
+    for word in query.split():
+        card = normalize_card(word)
+        alphanumeric = re.sub(r'[^a-z0-9]', '', card)
+        prefixes = [CARD + card, EMAIL + card]
+        if alphanumeric:
+            prefixes.extend([NAME + alphanumeric, CARD_PART + alphanumeric])
+        terms.append(prefixes)
+    return terms
+
+
+def _starts_with_any(prefixes):
+    condition = Q()
+    for prefix in prefixes:
+        condition |= Q(token__startswith=prefix)
+    return condition
+
+
+def _filter_terms(queryset, terms, exact=False):
+    for prefixes in terms:
+        condition = Q(token__in=prefixes) if exact else _starts_with_any(prefixes)
+        queryset = queryset.filter(id__in=PatientSearchToken.objects.filter(condition).values('patient_id'))
+    return queryset
+
+
+def _fuzzy_scores(query, queryset, limit):
+    """{patient id: similarity} of patients whose names share enough trigrams with the query"""
+    grams = set()
+    for word in name_words(query):
+        grams.update(trigrams(word))
+    if not grams:
+        return {}
+
+    min_hits = max(1, round(len(grams) * FUZZY_MIN_SIMILARITY))
+    rows = PatientSearchToken.objects.filter(
+        token__in=[TRIGRAM + gram for gram in grams],
+        patient_id__in=queryset.values('id'),
+    ).values('patient_id').annotate(hits=Count('id')).filter(hits__gte=min_hits).order_by('-hits')[:limit]
+    return {row['patient_id']: row['hits'] / len(grams) for row in rows}
+
+
+def search_patients(query, queryset=None):
+    """
+    Patients of queryset (active patients by default) matching every word of
+    the query, falling back to names similar to the query when none match.
+    """
+    if queryset is None:
+        queryset = PatientModel.objects.filter(status='active')
+    terms = parse_query(query)
+    if not terms:
+        return queryset
+
+    matches = _filter_terms(queryset, terms)
+    if matches.exists():
+        return matches
+    return queryset.filter(id__in=list(_fuzzy_scores(query, queryset, CANDIDATE_LIMIT)))
+
+
+def _term_score(prefixes, tokens):
+    best = 0
+    for prefix in prefixes:
+        weight = KIND_WEIGHTS[prefix[:2]]
+        for token in tokens:
+            if token == prefix:
+                best = max(best, weight * 2)
+            elif token.startswith(prefix):
+                best = max(best, weight)
+    return best
+
+
+def rank_patients(query, limit=AUTOCOMPLETE_LIMIT, queryset=None):
+    """
+    Best matches for the query as a list of (patient, score), highest score first.
+
+    Patients matching every word exactly are gathered before prefix matches so
+    they are ranked even when a short prefix matches thousands of patients.
+    """
+    if queryset is None:
+        queryset = PatientModel.objects.filter(status='active')
+    terms = parse_query(query)
+    if not terms:
+        return []
+
+    candidates = list(_filter_terms(queryset, terms, exact=True).values_list('id', flat=True)[:CANDIDATE_LIMIT])
+    if len(candidates) < CANDIDATE_LIMIT:
+        prefix_matches = _filter_terms(queryset, terms).exclude(id__in=candidates)
+        candidates.extend(prefix_matches.values_list('id', flat=True)[:CANDIDATE_LIMIT - len(candidates)])
+
+    scores = {}
+    if candidates:
+        tokens = {}
+        rows = PatientSearchToken.objects.filter(patient_id__in=candidates).exclude(token__startswith=TRIGRAM)
+        for patient_id, token in rows.values_list('patient_id', 'token'):
+            tokens.setdefault(patient_id, []).append(token)
+        for patient_id in candidates:
+            scores[patient_id] = sum(_term_score(prefixes, tokens.get(patient_id, [])) for prefixes in terms)
+    else:
+        scores = {
+            patient_id: similarity * FUZZY_WEIGHT
+            for patient_id, similarity in _fuzzy_scores(query, queryset, limit).items()
+        }
+
+    patients = PatientModel.objects.in_bulk(list(scores))
+    ranked = sorted(
+        (patient for patient in patients.values()),
+        key=lambda patient: (-scores[patient.id], patient.first_name.lower(), patient.last_name.lower(), patient.id)
+    )
+    return [(patient, scores[patient.id]) for patient in ranked[:limit]]
+
+
+def get_patient_by_card(card_number, queryset=None):
+    """
+    The patient with this card number, ignoring case, accents and spaces.
+
+    Raises PatientModel.DoesNotExist (or MultipleObjectsReturned) like QuerySet.get().
+    """
+    if queryset is None:
+        queryset = PatientModel.objects.all()
+    card_number = (card_number or '').strip()
+    if not card_number:
+        raise PatientModel.DoesNotExist('Card number is required')
+    exact = queryset.filter(card_number=card_number).first()
+    if exact:
+        return exact
+    return queryset.filter(
+        id__in=PatientSearchToken.objects.filter(token=CARD + normalize_card(card_number)).values('patient_id')
+    ).get()
+
+
+def serialize_patient(patient, score=None):
+    return {
+        'id': patient.pk,
+        'full_name': str(patient),
+        'card_number': patient.card_number,
+        'mobile': patient.mobile,
+        'gender': patient.gender,
+        'age': patient.age(),
+        'score': score,
+    }
@@ -12,6 +12,8 @@ from admin_site.models import ActivityLogModel
 from consultation.models import PatientQueueModel
 from finance.models import PatientTransactionModel
 from patient.models import RegistrationFeeModel, PatientModel, PatientWalletModel, RegistrationPaymentModel
+from patient.search import index_patient, INDEXED_FIELDS
+from patient import timeline
 
 logger = logging.getLogger(__name__)
 
@@ -102,6 +104,18 @@ def create_patient_wallet(sender, instance, created, **kwargs):
         PatientWalletModel.objects.get_or_create(patient=instance)
 
 
+@receiver(post_save, sender=PatientModel)
+def update_patient_search_index(sender, instance, created, update_fields=None, **kwargs):
+    """Keep the patient's search tokens in step with its name, card number, mobile and email"""
+    if update_fields and not set(update_fields) & set(INDEXED_FIELDS):
+        return
+    index_patient(instance)
+
+
+# Timeline events of consultations, orders, results, vitals, admissions and surgeries
+timeline.connect()
+
+
 # --- Delete log ---
 @receiver(post_delete, sender=RegistrationFeeModel)
 def log_registration_fee_delete(sender, instance, **kwargs):
@@ -1,3 +1,120 @@
-from django.test import TestCase
+import threading
+from decimal import Decimal
+from unittest import skipIf
 
-# Create your tests here.
+from django.db import connection, transaction
+from django.db.models import Sum
+from django.test import TransactionTestCase, override_settings
+
+from admin_site import sequences
+from patient.models import PatientModel, PatientSettingModel, PatientWalletModel, InsufficientWalletBalance
+
+
+@override_settings(PATIENT_ID_BLOCK_SIZE=5)
+class PatientCardNumberTests(TransactionTestCase):
+    """Card numbers handed out from reserved blocks (see PatientIDGeneratorModel.next_id)"""
+
+    def setUp(self):
+        PatientSettingModel.objects.create(auto_generate_patient_id=True, patient_id_prefix='PAT')
+        # Blocks cached by earlier tests belong to a counter row that has since been flushed
+        with sequences._block_cache_lock:
+            sequences._block_cache.clear()
+
+    def register(self, count):
+        card_numbers = []
+        for _ in range(count):
+            with transaction.atomic():
+                card_numbers.append(PatientModel.objects.create(
+                    first_name='Test', last_name='Patient', gender='male'
+                ).card_number)
+        return card_numbers
+
+    def assertFromSequence(self, card_numbers):
+        # A failed allocation falls back to a random PAT-XXXXXXXX id, which would hide a duplicate
+        for card_number in card_numbers:
+            self.assertRegex(card_number, r'^PAT\d{4,}$')
+
+    def test_card_numbers_follow_on_across_blocks(self):
+        card_numbers = self.register(12)
+
+        self.assertFromSequence(card_numbers)
+        self.assertEqual(card_numbers, [f'PAT{number:04d}' for number in range(1, 13)])
+
+    @skipIf(connection.vendor == 'sqlite', 'SQLite allows a single writer at a time')
+    def test_card_numbers_are_unique_under_parallel_registration(self):
+        writers, per_writer = 8, 15
+        results = [[] for _ in range(writers)]
+        errors = []
+        start_gate = threading.Barrier(writers)
+
+        def desk(index):
+            try:
+                start_gate.wait()
+                results[index] = self.register(per_writer)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=desk, args=(i,)) for i in range(writers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        card_numbers = [card_number for desk_numbers in results for card_number in desk_numbers]
+        self.assertEqual(len(card_numbers), writers * per_writer)
+        self.assertFromSequence(card_numbers)
+        self.assertEqual(len(set(card_numbers)), len(card_numbers))
+        self.assertEqual(PatientModel.objects.values('card_number').distinct().count(), writers * per_writer)
+
+
+@skipIf(connection.vendor == 'sqlite', 'SQLite allows a single writer at a time')
+class WalletLedgerTests(TransactionTestCase):
+    """Concurrent credits and debits through PatientWalletModel.post_entry"""
+
+    def test_balance_matches_ledger_under_parallel_postings(self):
+        writers, per_writer, amount = 8, 25, Decimal('10.00')
+        patient = PatientModel.objects.create(first_name='Test', last_name='Wallet', gender='male')
+        wallet, _ = PatientWalletModel.objects.get_or_create(patient=patient)
+        wallet.credit(Decimal('50.00'), 'opening_balance')
+
+        posted = [0] * writers
+        errors = []
+        start_gate = threading.Barrier(writers)
+
+        def cashier(index):
+            try:
+                own_wallet = PatientWalletModel.objects.get(pk=wallet.pk)
+                start_gate.wait()
+                for i in range(per_writer):
+                    # Alternate funding and deduction, offset per cashier so both run at once
+                    if (index + i) % 2 == 0:
+                        own_wallet.credit(amount)
+                    else:
+                        try:
+                            own_wallet.debit(amount)
+                        except InsufficientWalletBalance:
+                            continue
+                    posted[index] += 1
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=cashier, args=(i,)) for i in range(writers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        wallet.refresh_from_db()
+        entries = wallet.ledger_entries.all()
+        ledger_in = entries.filter(direction='in').aggregate(total=Sum('amount'))['total'] or 0
+        ledger_out = entries.filter(direction='out').aggregate(total=Sum('amount'))['total'] or 0
+        self.assertEqual(wallet.amount, ledger_in - ledger_out)
+        self.assertGreaterEqual(wallet.amount, 0)
+        self.assertEqual(entries.count(), sum(posted) + 1)
+        self.assertEqual(entries.order_by('-id').values_list('balance_after', flat=True).first(), wallet.amount)
@@ -0,0 +1,338 @@
+"""
+Patient clinical timeline.
+
+Every consultation, vitals reading, drug/lab/scan/service order, result,
+admission and surgery of a patient has one ClinicalEvent row, written by a
+post_save receiver when the record is saved and removed when it is deleted.
+History pages read a patient's events from the (patient, occurred_at, id)
+index newest first with keyset (cursor) pagination, then load only the
+records on the page, so a patient with years of ward rounds costs the same
+as one with a single visit.
+
+Records changed with QuerySet.update() or loaded outside the ORM do not fire
+signals; pass their ids to refresh_events(), or run
+manage.py rebuild_clinical_timeline after such changes.
+
+JSON contract of patient_timeline_ajax (patient/<id>/timeline/):
+
+    {
+        "results": [<event>, ...],   # see serialize_event()
+        "has_more": <bool>,
+        "next_cursor": <opaque string or null>
+    }
+"""
+import base64
+from collections import namedtuple
+from datetime import datetime
+
+from django.apps import apps as global_apps
+from django.db import transaction
+from django.db.models import Q
+from django.db.models.signals import post_save, post_delete
+
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+# model: (app label, model name)
+# patient / occurred_at: lookups tried in order, the first non-null value is used
+# fields: values read to describe the event
+Source = namedtuple('Source', 'kind model patient occurred_at fields describe')
+
+
+def _first(row, lookups):
+    for lookup in lookups:
+        if row.get(lookup) is not None:
+            return row[lookup]
+    return None
+
+
+def _consultation(row):
+    title = row['primary_diagnosis__name'] or row['diagnosis'] or row['chief_complaint']
+    return title, row['status']
+
+
+def _vitals(row):
+    readings = []
+    if row['blood_pressure_systolic'] and row['blood_pressure_diastolic']:
+        readings.append(f"BP {row['blood_pressure_systolic']}/{row['blood_pressure_diastolic']}")
+    if row['temperature'] is not None:
+        readings.append(f"Temp {row['temperature']}°C")
+    if row['pulse_rate'] is not None:
+        readings.append(f"Pulse {row['pulse_rate']}")
+    if row['oxygen_saturation'] is not None:
+        readings.append(f"SpO2 {row['oxygen_saturation']}%")
+    return ', '.join(readings), ''
+
+
+def _drug_order(row):
+    generic = row['drug__formulation__generic_drug__generic_name'] or ''
+    name = row['drug__brand_name'] or f"{generic.title()} {row['drug__formulation__strength'] or ''}"
+    return name, row['status']
+
+
+def _named(name_field, status_field=None):
+    def describe(row):
+        return row[name_field], row[status_field] if status_field else ''
+    return describe
+
+
+def _service(prefix, status_field):
+    def describe(row):
+        return row[f'{prefix}service__name'] or row[f'{prefix}service_item__name'], row[status_field]
+    return describe
+
+
+def _admission(row):
+    return f"{row['admission_number']} - {row['admission_diagnosis']}", row['status']
+
+
+SOURCES = [
+    Source('consultation', ('consultation', 'ConsultationSessionModel'),
+           ('queue_entry__patient_id', 'admission__patient_id'), ('created_at',),
+           ('primary_diagnosis__name', 'diagnosis', 'chief_complaint', 'status'), _consultation),
+    Source('vitals', ('consultation', 'PatientVitalsModel'),
+           ('queue_entry__patient_id', 'admission__patient_id'), ('recorded_at',),
+           ('blood_pressure_systolic', 'blood_pressure_diastolic', 'temperature', 'pulse_rate',
+            'oxygen_saturation'), _vitals),
+    Source('drug_order', ('pharmacy', 'DrugOrderModel'), ('patient_id',), ('ordered_at',),
+           ('drug__brand_name', 'drug__formulation__generic_drug__generic_name', 'drug__formulation__strength',
+            'status'), _drug_order),
+    Source('external_prescription', ('pharmacy', 'ExternalPrescription'), ('patient_id',), ('ordered_at',),
+           ('drug_name',), _named('drug_name')),
+    Source('lab_order', ('laboratory', 'LabTestOrderModel'), ('patient_id',), ('ordered_at',),
+           ('template__name', 'status'), _named('template__name', 'status')),
+    Source('lab_result', ('laboratory', 'LabTestResultModel'), ('order__patient_id',), ('created_at',),
+           ('order__template__name', 'is_verified'), _named('order__template__name', 'is_verified')),
+    Source('scan_order', ('scan', 'ScanOrderModel'), ('patient_id',), ('ordered_at',),
+           ('template__name', 'status'), _named('template__name', 'status')),
+    Source('scan_result', ('scan', 'ScanResultModel'), ('order__patient_id',), ('performed_at',),
+           ('order__template__name', 'status'), _named('order__template__name', 'status')),
+    Source('service_order', ('service', 'PatientServiceTransaction'), ('patient_id',), ('created_at',),
+           ('service__name', 'service_item__name', 'status'), _service('', 'status')),
+    Source('service_result', ('service', 'ServiceResult'), ('transaction__patient_id',), ('created_at',),
+           ('transaction__service__name', 'transaction__service_item__name', 'is_verified'),
+           _service('transaction__', 'is_verified')),
+    Source('admission', ('inpatient', 'Admission'), ('patient_id',), ('admission_date',),
+           ('admission_number', 'admission_diagnosis', 'status'), _admission),
+    Source('surgery', ('inpatient', 'Surgery'), ('patient_id',), ('actual_start_time', 'scheduled_date'),
+           ('surgery_type__name', 'status'), _named('surgery_type__name', 'status')),
+]
+
+SOURCES_BY_KIND = {source.kind: source for source in SOURCES}
+
+
+# ---------------------------------------------------------------------------
+# Building events
+# ---------------------------------------------------------------------------
+
+def _truncate(value, length):
+    value = ' '.join(str(value or '').split())
+    return value if len(value) <= length else value[:length - 3] + '...'
+
+
+def _status_value(value):
+    # Results only record whether they were verified
+    if isinstance(value, bool):
+        return 'verified' if value else 'unverified'
+    return value or ''
+
+
+def build_events(source, queryset, content_type_id):
+    """Unsaved ClinicalEvent field values for the records of queryset; records without a patient are skipped"""
+    rows = queryset.order_by().values('pk', *source.patient, *source.occurred_at, *source.fields)
+    events = []
+    for row in rows:
+        patient_id = _first(row, source.patient)
+        occurred_at = _first(row, source.occurred_at)
+        if patient_id is None or occurred_at is None:
+            continue
+        title, status = source.describe(row)
+        events.append({
+            'patient_id': patient_id,
+            'kind': source.kind,
+            'occurred_at': occurred_at,
+            'content_type_id': content_type_id,
+            'object_id': row['pk'],
+            'title': _truncate(title, 255),
+            'status': _truncate(_status_value(status), 30),
+        })
+    return events
+
+
+def _content_type_id(apps, model):
+    ContentType = apps.get_model('contenttypes', 'ContentType')
+    if apps is global_apps:
+        return ContentType.objects.get_for_model(model).id
+    opts = model._meta
+    return ContentType.objects.get_or_create(app_label=opts.app_label, model=opts.model_name)[0].id
+
+
+def _patient_filter(source, patient_ids):
+    condition = Q()
+    for lookup in source.patient:
+        condition |= Q(**{f'{lookup.removesuffix("_id")}__in': patient_ids})
+    return condition
+
+
+def rebuild(apps=global_apps, patient_ids=None, batch_size=2000):
+    """
+    Rewrite the timeline from the source records, for every patient or only
+    patient_ids. Returns the number of events written. Pass the migration's
+    apps registry to run it from a data migration.
+    """
+    ClinicalEvent = apps.get_model('patient', 'ClinicalEvent')
+    written = 0
+    for source in SOURCES:
+        model = apps.get_model(*source.model)
+        content_type_id = _content_type_id(apps, model)
+        records = model.objects.all()
+        events = ClinicalEvent.objects.filter(content_type_id=content_type_id)
+        if patient_ids is not None:
+            records = records.filter(_patient_filter(source, patient_ids))
+            events = events.filter(patient_id__in=patient_ids)
+
+        with transaction.atomic():
+            events.delete()
+            last_pk = None
+            while True:
+                batch = records.order_by('pk')
+                if last_pk is not None:
+                    batch = batch.filter(pk__gt=last_pk)
+                pks = list(batch.values_list('pk', flat=True)[:batch_size])
+                if not pks:
+                    break
+                rows = build_events(source, model.objects.filter(pk__in=pks), content_type_id)
+                ClinicalEvent.objects.bulk_create([ClinicalEvent(**row) for row in rows])
+                written += len(rows)
+                last_pk = pks[-1]
+    return written
+
+
+# ---------------------------------------------------------------------------
+# Keeping events in step with their records
+# ---------------------------------------------------------------------------
+
+def _source_for(model):
+    return _SOURCES_BY_MODEL.get(model._meta.label_lower)
+
+
+def record_event(sender, instance, raw=False, **kwargs):
+    """Create or refresh the event of a saved record (post_save receiver)"""
+    source = _source_for(sender)
+    if raw or source is None:
+        return
+    from patient.models import ClinicalEvent
+
+    content_type_id = _content_type_id(global_apps, sender)
+    rows = build_events(source, sender.objects.filter(pk=instance.pk), content_type_id)
+    if not rows:
+        ClinicalEvent.objects.filter(content_type_id=content_type_id, object_id=instance.pk).delete()
+        return
+    row = rows[0]
+    ClinicalEvent.objects.update_or_create(
+        content_type_id=content_type_id, object_id=row.pop('object_id'), defaults=row
+    )
+
+
+@transaction.atomic
+def refresh_events(kind, pks):
+    """Rewrite the events of records of a kind changed without signals (QuerySet.update(), bulk_update())"""
+    from patient.models import ClinicalEvent
+
+    source = SOURCES_BY_KIND[kind]
+    model = global_apps.get_model(*source.model)
+    content_type_id = _content_type_id(global_apps, model)
+    ClinicalEvent.objects.filter(content_type_id=content_type_id, object_id__in=pks).delete()
+    rows = build_events(source, model.objects.filter(pk__in=pks), content_type_id)
+    ClinicalEvent.objects.bulk_create([ClinicalEvent(**row) for row in rows])
+
+
+def forget_event(sender, instance, **kwargs):
+    """Remove the event of a deleted record (post_delete receiver)"""
+    from patient.models import ClinicalEvent
+
+    ClinicalEvent.objects.filter(
+        content_type_id=_content_type_id(global_apps, sender), object_id=instance.pk
+    ).delete()
+
+
+_SOURCES_BY_MODEL = {}
+
+
+def connect():
+    """Register the timeline receivers for every source model (called from patient.signals)"""
+    for source in SOURCES:
+        model = global_apps.get_model(*source.model)
+        _SOURCES_BY_MODEL[model._meta.label_lower] = source
+        post_save.connect(record_event, sender=model, dispatch_uid=f'clinical_timeline_save_{source.kind}')
+        post_delete.connect(forget_event, sender=model, dispatch_uid=f'clinical_timeline_delete_{source.kind}')
+
+
+# ---------------------------------------------------------------------------
+# Reading
+# ---------------------------------------------------------------------------
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(event):
+    value = f'{event.occurred_at.isoformat()}|{event.id}'
+    return base64.urlsafe_b64encode(value.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Return the (occurred_at, id) position encoded in a cursor"""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        occurred_at, pk = base64.urlsafe_b64decode(padded.encode()).decode().split('|')
+        return datetime.fromisoformat(occurred_at), int(pk)
+    except (ValueError, UnicodeDecodeError):
+        raise InvalidCursor('Invalid cursor')
+
+
+def get_events(patient, kinds=None, cursor=None, limit=DEFAULT_PAGE_SIZE, records=None):
+    """
+    One page of the patient's events newest first, optionally only of the given
+    kinds. Returns (events, next_cursor); next_cursor is None on the last page.
+
+    records, a queryset of a single source model, keeps only the events of its
+    records, so a filter on the records is applied before the page is cut.
+
+    Raises InvalidCursor for a cursor that was not made by encode_cursor().
+    """
+    from patient.models import ClinicalEvent
+
+    events = ClinicalEvent.objects.filter(patient=patient).order_by('-occurred_at', '-id')
+    if kinds:
+        events = events.filter(kind__in=kinds)
+    if records is not None:
+        events = events.filter(
+            content_type_id=_content_type_id(global_apps, records.model),
+            object_id__in=records.order_by().values('pk'),
+        )
+    if cursor:
+        occurred_at, event_id = decode_cursor(cursor)
+        events = events.filter(Q(occurred_at__lt=occurred_at) | Q(occurred_at=occurred_at, id__lt=event_id))
+
+    page = list(events[:limit + 1])
+    next_cursor = encode_cursor(page[limit - 1]) if len(page) > limit else None
+    return page[:limit], next_cursor
+
+
+def records_for(events, queryset):
+    """The records of the events from queryset, in event order; events whose record is not in queryset are skipped"""
+    records = queryset.in_bulk([event.object_id for event in events])
+    return [records[event.object_id] for event in events if event.object_id in records]
+
+
+def serialize_event(event):
+    return {
+        'id': event.id,
+        'kind': event.kind,
+        'kind_display': event.get_kind_display(),
+        'occurred_at': event.occurred_at.isoformat(),
+        'title': event.title,
+        'status': event.status,
+        'object_id': event.object_id,
+    }
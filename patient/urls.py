@@ -21,6 +21,8 @@ urlpatterns = [
     path('<int:pk>/edit', PatientUpdateView.as_view(), name='patient_edit'),
     path('<int:pk>/delete', PatientDeleteView.as_view(), name='patient_delete'),
     path('get-detail-with-card-number', get_patient_with_card, name='get_patient_with_card'),
+    path('autocomplete/', patient_autocomplete, name='patient_autocomplete'),
+    path('<int:patient_id>/timeline/', patient_timeline_ajax, name='patient_timeline_ajax'),
 
     path('dashboard/', patient_dashboard, name='patient_dashboard'),
     path('dashboard/print/', patient_dashboard_print, name='patient_dashboard_print'),
@@ -1,9 +1,7 @@
 import json
 import logging
 from datetime import datetime, date, timedelta
-import openpyxl
 from django.views import View
-from openpyxl.styles import Font, Alignment, PatternFill
 from io import BytesIO
 from django.http import HttpResponse
 from datetime import date, timedelta
@@ -29,6 +27,7 @@ from django.utils import timezone
 from django.views.decorators.http import require_http_methods
 from django.views.generic import TemplateView, CreateView, UpdateView, DeleteView, ListView, DetailView
 
+from admin_site.exports import ExportSheet, iterate, export_response, CENTER
 from admin_site.models import SiteInfoModel
 from patient.models import PatientModel, PatientSettingModel, PatientWalletModel, RegistrationFeeModel, \
     RegistrationPaymentModel, ConsultationDocument, RegistrationReportTemplate, ConsultationReportTemplate
@@ -36,6 +35,12 @@ from patient.forms import PatientForm, PatientEditForm, PatientSettingForm, Pati
     RegistrationFeeForm, ConsultationDocumentForm, BiodataReportFilterForm, RegistrationReportTemplateForm, \
     ConsultationReportTemplateForm
 from admin_site.utility import state_list
+from patient.demographics import get_demographics
+from patient.report_templates import count_registrations, count_consultations
+from patient.search import search_patients, rank_patients, get_patient_by_card, serialize_patient, \
+    AUTOCOMPLETE_LIMIT, MAX_AUTOCOMPLETE_LIMIT, MIN_QUERY_LENGTH
+from patient.timeline import get_events, serialize_event, InvalidCursor, SOURCES_BY_KIND, DEFAULT_PAGE_SIZE, \
+    MAX_PAGE_SIZE
 
 # Set up logging
 logger = logging.getLogger(__name__)
@@ -393,14 +398,7 @@ class PatientListView(LoginRequiredMixin, PermissionRequiredMixin, ListView):
             date_to = search_form.cleaned_data.get('date_to')
 
             if search_query:
-                queryset = queryset.filter(
-                    Q(first_name__icontains=search_query) |
-                    Q(middle_name__icontains=search_query) |
-                    Q(last_name__icontains=search_query) |
-                    Q(card_number__icontains=search_query) |
-                    Q(mobile__icontains=search_query) |
-                    Q(email__icontains=search_query)
-                )
+                queryset = search_patients(search_query, queryset)
 
             if gender:
                 queryset = queryset.filter(gender=gender)
@@ -607,139 +605,39 @@ class PatientDeleteView(LoginRequiredMixin, PermissionRequiredMixin, SuccessMess
             return redirect('patient_detail', pk=self.object.pk)
 
 
+def build_dashboard_context(demographics):
+    """Template context of the patient dashboards from patient.demographics.get_demographics()"""
+    registrations = demographics['registrations']
+    context = {
+        'total_patients': demographics['total'],
+        'male_patients': demographics['male'],
+        'female_patients': demographics['female'],
+        'pending_registrations': registrations['pending_registrations'],
+        'age_groups': demographics['age_groups'],
+        'registration_chart_data': json.dumps(demographics['daily_registrations']),
+        'monthly_trends': json.dumps(demographics['monthly_registrations']),
+        'gender_distribution': json.dumps(demographics['gender_distribution']),
+        'marital_distribution': json.dumps(demographics['marital_distribution']),
+        'total_revenue': registrations['total_revenue'],
+        'revenue_today': registrations['revenue_today'],
+        'revenue_month': registrations['revenue_month'],
+    }
+    for patient_type in ('old', 'new'):
+        for period in ('total', 'today', 'week', 'month'):
+            key = f'{patient_type}_patients_{period}'
+            context[key] = registrations[key]
+        # Growth compares this month to last month
+        context[f'{patient_type}_patients_growth'] = calculate_growth_percentage(
+            registrations[f'{patient_type}_patients_month'], registrations[f'{patient_type}_patients_last_month']
+        )
+    return context
+
+
 def get_patient_dashboard_context(request):
     """
     Get the context data for patient dashboard
     """
-    # Get current date and time periods
-    today = timezone.now().date()
-    week_start = today - timedelta(days=today.weekday())
-    month_start = today.replace(day=1)
-    year_start = today.replace(month=1, day=1)
-
-    # Basic patient statistics
-    total_patients = PatientModel.objects.count()
-    male_patients = PatientModel.objects.filter(gender='male').count()
-    female_patients = PatientModel.objects.filter(gender='female').count()
-
-    # Registration status statistics
-    pending_registrations = RegistrationPaymentModel.objects.filter(
-        registration_status='pending'
-    ).count()
-
-    # Old vs New patients (based on registration fee type)
-    old_patients_total = RegistrationPaymentModel.objects.filter(
-        registration_fee__patient_type='old'
-    ).count()
-    new_patients_total = RegistrationPaymentModel.objects.filter(
-        registration_fee__patient_type='new'
-    ).count()
-
-    # Time-based statistics for old patients
-    old_patients_today = RegistrationPaymentModel.objects.filter(
-        registration_fee__patient_type='old',
-        date=today
-    ).count()
-
-    old_patients_week = RegistrationPaymentModel.objects.filter(
-        registration_fee__patient_type='old',
-        date__gte=week_start
-    ).count()
-
-    old_patients_month = RegistrationPaymentModel.objects.filter(
-        registration_fee__patient_type='old',
-        date__gte=month_start
-    ).count()
-
-    # Time-based statistics for new patients
-    new_patients_today = RegistrationPaymentModel.objects.filter(
-        registration_fee__patient_type='new',
-        date=today
-    ).count()
-
-    new_patients_week = RegistrationPaymentModel.objects.filter(
-        registration_fee__patient_type='new',
-        date__gte=week_start
-    ).count()
-
-    new_patients_month = RegistrationPaymentModel.objects.filter(
-        registration_fee__patient_type='new',
-        date__gte=month_start
-    ).count()
-
-    # Calculate growth percentages (comparing this month to last month)
-    last_month_start = (month_start - timedelta(days=1)).replace(day=1)
-    last_month_end = month_start - timedelta(days=1)
-
-    old_patients_last_month = RegistrationPaymentModel.objects.filter(
-        registration_fee__patient_type='old',
-        date__gte=last_month_start,
-        date__lte=last_month_end
-    ).count()
-
-    new_patients_last_month = RegistrationPaymentModel.objects.filter(
-        registration_fee__patient_type='new',
-        date__gte=last_month_start,
-        date__lte=last_month_end
-    ).count()
-
-    # Calculate growth percentages
-    old_patients_growth = calculate_growth_percentage(old_patients_month, old_patients_last_month)
-    new_patients_growth = calculate_growth_percentage(new_patients_month, new_patients_last_month)
-
-    # Age group statistics
-    age_groups = calculate_age_groups()
-
-    # Recent registrations for chart data (last 7 days)
-    registration_chart_data = get_registration_chart_data()
-
-    # Monthly registration trends (last 12 months)
-    monthly_trends = get_monthly_trends()
-
-    # Gender distribution for pie chart
-    gender_distribution = [
-        {'name': 'Male', 'value': male_patients},
-        {'name': 'Female', 'value': female_patients}
-    ]
-
-    # Revenue statistics
-    total_revenue = RegistrationPaymentModel.objects.filter(
-        registration_status='completed'
-    ).aggregate(Sum('amount'))['amount__sum'] or 0
-
-    revenue_today = RegistrationPaymentModel.objects.filter(
-        registration_status='completed',
-        date=today
-    ).aggregate(Sum('amount'))['amount__sum'] or 0
-
-    revenue_month = RegistrationPaymentModel.objects.filter(
-        registration_status='completed',
-        date__gte=month_start
-    ).aggregate(Sum('amount'))['amount__sum'] or 0
-
-    return {
-        'total_patients': total_patients,
-        'male_patients': male_patients,
-        'female_patients': female_patients,
-        'pending_registrations': pending_registrations,
-        'old_patients_total': old_patients_total,
-        'new_patients_total': new_patients_total,
-        'old_patients_today': old_patients_today,
-        'old_patients_week': old_patients_week,
-        'old_patients_month': old_patients_month,
-        'new_patients_today': new_patients_today,
-        'new_patients_week': new_patients_week,
-        'new_patients_month': new_patients_month,
-        'old_patients_growth': old_patients_growth,
-        'new_patients_growth': new_patients_growth,
-        'age_groups': age_groups,
-        'registration_chart_data': json.dumps(registration_chart_data),
-        'monthly_trends': json.dumps(monthly_trends),
-        'gender_distribution': json.dumps(gender_distribution),
-        'total_revenue': total_revenue,
-        'revenue_today': revenue_today,
-        'revenue_month': revenue_month,
-    }
+    return build_dashboard_context(get_demographics())
 
 
 @login_required
@@ -777,104 +675,6 @@ def calculate_growth_percentage(current, previous):
     return round(((current - previous) / previous) * 100, 1)
 
 
-def calculate_age_groups():
-    """Calculate patient count by age groups"""
-    from datetime import date
-
-    age_groups = {
-        '0-12': 0,
-        '13-17': 0,
-        '18-40': 0,
-        '41-65': 0,
-        '66+': 0
-    }
-
-    patients_with_dob = PatientModel.objects.exclude(date_of_birth__isnull=True)
-
-    for patient in patients_with_dob:
-        age = patient.age()
-        if isinstance(age, int):
-            if 0 <= age <= 12:
-                age_groups['0-12'] += 1
-            elif 13 <= age <= 17:
-                age_groups['13-17'] += 1
-            elif 18 <= age <= 40:
-                age_groups['18-40'] += 1
-            elif 41 <= age <= 65:
-                age_groups['41-65'] += 1
-            elif age >= 66:
-                age_groups['66+'] += 1
-
-    return [{'name': k, 'value': v} for k, v in age_groups.items()]
-
-
-def get_registration_chart_data():
-    """Get registration data for the last 7 days"""
-    today = timezone.now().date()
-    data = []
-
-    for i in range(6, -1, -1):  # Last 7 days
-        date = today - timedelta(days=i)
-        new_count = RegistrationPaymentModel.objects.filter(
-            registration_fee__patient_type='new',
-            date=date
-        ).count()
-        old_count = RegistrationPaymentModel.objects.filter(
-            registration_fee__patient_type='old',
-            date=date
-        ).count()
-
-        data.append({
-            'date': date.strftime('%Y-%m-%d'),
-            'new_patients': new_count,
-            'old_patients': old_count
-        })
-
-    return data
-
-
-def get_monthly_trends():
-    """Get monthly registration trends for the last 12 months"""
-    today = timezone.now().date()
-    data = []
-
-    for i in range(11, -1, -1):  # Last 12 months
-        # Calculate month start
-        if today.month - i > 0:
-            month = today.month - i
-            year = today.year
-        else:
-            month = 12 + (today.month - i)
-            year = today.year - 1
-
-        month_start = date(year, month, 1)
-        if month == 12:
-            month_end = date(year + 1, 1, 1) - timedelta(days=1)
-        else:
-            month_end = date(year, month + 1, 1) - timedelta(days=1)
-
-        new_count = RegistrationPaymentModel.objects.filter(
-            registration_fee__patient_type='new',
-            date__gte=month_start,
-            date__lte=month_end
-        ).count()
-
-        old_count = RegistrationPaymentModel.objects.filter(
-            registration_fee__patient_type='old',
-            date__gte=month_start,
-            date__lte=month_end
-        ).count()
-
-        data.append({
-            'month': month_start.strftime('%b %Y'),
-            'new_patients': new_count,
-            'old_patients': old_count,
-            'total': new_count + old_count
-        })
-
-    return data
-
-
 class PatientPendingListView(LoginRequiredMixin, PermissionRequiredMixin, ListView):
     """List pending patient registrations (paid but not registered)"""
     model = RegistrationPaymentModel
@@ -909,7 +709,7 @@ def get_patient_with_card(request):
         })
 
     try:
-        patient = PatientModel.objects.get(card_number=card_number, status='active')
+        patient = get_patient_by_card(card_number, PatientModel.objects.filter(status='active'))
 
         # Return JSON response for AJAX calls
         if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
@@ -963,6 +763,60 @@ def get_patient_with_card(request):
         return render(request, 'patient/patient/get_detail_from_card.html', context)
 
 
+@login_required
+@permission_required('patient.view_patientmodel', raise_exception=True)
+@require_http_methods(["GET"])
+def patient_autocomplete(request):
+    """Ranked patient matches by name, card number, mobile or email (AJAX endpoint)"""
+    query = request.GET.get('q', '').strip()
+    try:
+        limit = int(request.GET.get('limit') or AUTOCOMPLETE_LIMIT)
+    except ValueError:
+        limit = AUTOCOMPLETE_LIMIT
+    limit = max(1, min(limit, MAX_AUTOCOMPLETE_LIMIT))
+
+    if len(query) < MIN_QUERY_LENGTH:
+        return JsonResponse({'results': []})
+
+    results = []
+    for patient, score in rank_patients(query, limit):
+        row = serialize_patient(patient, score)
+        row['detail_url'] = reverse('patient_detail', args=[patient.pk])
+        results.append(row)
+    return JsonResponse({'results': results})
+
+
+@login_required
+@permission_required('consultation.add_consultationsessionmodel', raise_exception=True)
+@require_http_methods(["GET"])
+def patient_timeline_ajax(request, patient_id):
+    """
+    A page of the patient's clinical timeline, newest first (AJAX endpoint).
+    ?kind= (repeatable) limits the event kinds, ?cursor= continues from the previous page.
+    """
+    patient = get_object_or_404(PatientModel, pk=patient_id)
+    kinds = request.GET.getlist('kind')
+    unknown = [kind for kind in kinds if kind not in SOURCES_BY_KIND]
+    if unknown:
+        return JsonResponse({'error': f"Unknown event kind: {', '.join(unknown)}"}, status=400)
+    try:
+        limit = int(request.GET.get('limit') or DEFAULT_PAGE_SIZE)
+    except ValueError:
+        limit = DEFAULT_PAGE_SIZE
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+
+    try:
+        events, next_cursor = get_events(patient, kinds, request.GET.get('cursor') or None, limit)
+    except InvalidCursor as e:
+        return JsonResponse({'error': str(e)}, status=400)
+
+    return JsonResponse({
+        'results': [serialize_event(event) for event in events],
+        'has_more': next_cursor is not None,
+        'next_cursor': next_cursor,
+    })
+
+
 @login_required
 @require_http_methods(["POST"])
 def patient_wallet_topup(request, patient_id):
@@ -979,7 +833,8 @@ def patient_wallet_topup(request, patient_id):
 
                 # Get or create wallet
                 wallet, created = PatientWalletModel.objects.get_or_create(patient=patient)
-                wallet.add_funds(amount)
+                wallet.credit(amount, 'funding', user=request.user, reference=reference or '',
+                              description=f'Wallet top-up ({payment_method})')
 
                 # Log the transaction (you might want to create a transaction model)
                 logger.info(f"Wallet top-up: {amount} added to patient {patient.card_number} by {request.user}")
@@ -1001,19 +856,17 @@ def patient_wallet_topup(request, patient_id):
 def patient_statistics(request):
     """Get patient statistics for dashboard"""
     try:
+        demographics = get_demographics()
         stats = {
-            'total_patients': PatientModel.objects.filter(status='active').count(),
-            'new_this_month': PatientModel.objects.filter(
-                status='active',
-                registration_date__month=timezone.now().month,
-                registration_date__year=timezone.now().year
-            ).count(),
-            'pending_registrations': RegistrationPaymentModel.objects.filter(
-                registration_status='pending'
-            ).count(),
+            'total_patients': demographics['active'],
+            'new_this_month': demographics['new_this_month'],
+            'pending_registrations': demographics['registrations']['pending_registrations'],
             'total_wallet_balance': PatientWalletModel.objects.aggregate(
                 total=Sum('amount')
             )['total'] or 0,
+            'age_groups': demographics['age_groups'],
+            'gender_distribution': demographics['gender_distribution'],
+            'marital_distribution': demographics['marital_distribution'],
         }
 
         return JsonResponse({
@@ -1232,103 +1085,33 @@ class BiodataReportExportView(LoginRequiredMixin, PermissionRequiredMixin, View)
         if not export_fields:
             export_fields = ['full_name', 'card_number', 'mobile', 'address']
 
-        # Create workbook
-        wb = openpyxl.Workbook()
-        ws = wb.active
-        ws.title = "Patient Bio Data"
-
-        # Styles
-        header_font = Font(bold=True, color="FFFFFF", size=11)
-        header_fill = PatternFill(start_color="4472C4", end_color="4472C4", fill_type="solid")
-
-        # Build headers
-        headers = []
-        if 'full_name' in export_fields:
-            headers.append('Full Name')
-        if 'card_number' in export_fields:
-            headers.append('Card Number')
-        if 'mobile' in export_fields:
-            headers.append('Phone')
-        if 'email' in export_fields:
-            headers.append('Email')
-        if 'address' in export_fields:
-            headers.append('Address')
-        if 'gender' in export_fields:
-            headers.append('Gender')
-        if 'age' in export_fields:
-            headers.append('Age')
-        if 'marital_status' in export_fields:
-            headers.append('Marital Status')
-        if 'religion' in export_fields:
-            headers.append('Religion')
-        if 'state' in export_fields:
-            headers.append('State')
-        if 'lga' in export_fields:
-            headers.append('LGA')
-
-        # Write headers
-        for col, header in enumerate(headers, 1):
-            cell = ws.cell(row=1, column=col)
-            cell.value = header
-            cell.font = header_font
-            cell.fill = header_fill
-            cell.alignment = Alignment(horizontal='center')
-
-        # Write data
-        row = 2
-        for patient in queryset:
-            col = 1
-
-            if 'full_name' in export_fields:
-                ws.cell(row=row, column=col, value=str(patient))
-                col += 1
-            if 'card_number' in export_fields:
-                ws.cell(row=row, column=col, value=patient.card_number)
-                col += 1
-            if 'mobile' in export_fields:
-                ws.cell(row=row, column=col, value=patient.mobile or '')
-                col += 1
-            if 'email' in export_fields:
-                ws.cell(row=row, column=col, value=patient.email or '')
-                col += 1
-            if 'address' in export_fields:
-                ws.cell(row=row, column=col, value=patient.address or '')
-                col += 1
-            if 'gender' in export_fields:
-                ws.cell(row=row, column=col, value=patient.get_gender_display() if patient.gender else '')
-                col += 1
-            if 'age' in export_fields:
-                ws.cell(row=row, column=col, value=patient.age() or '')
-                col += 1
-            if 'marital_status' in export_fields:
-                ws.cell(row=row, column=col,
-                        value=patient.get_marital_status_display() if patient.marital_status else '')
-                col += 1
-            if 'religion' in export_fields:
-                ws.cell(row=row, column=col, value=patient.get_religion_display() if patient.religion else '')
-                col += 1
-            if 'state' in export_fields:
-                ws.cell(row=row, column=col, value=patient.state or '')
-                col += 1
-            if 'lga' in export_fields:
-                ws.cell(row=row, column=col, value=patient.lga or '')
-                col += 1
-
-            row += 1
-
-        # Adjust column widths
-        for col in range(1, len(headers) + 1):
-            ws.column_dimensions[openpyxl.utils.get_column_letter(col)].width = 20
-
-        # Prepare response
-        response = HttpResponse(
-            content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+        # Selected columns in display order: (field, header, value getter)
+        columns = [
+            ('full_name', 'Full Name', lambda p: str(p)),
+            ('card_number', 'Card Number', lambda p: p.card_number),
+            ('mobile', 'Phone', lambda p: p.mobile or ''),
+            ('email', 'Email', lambda p: p.email or ''),
+            ('address', 'Address', lambda p: p.address or ''),
+            ('gender', 'Gender', lambda p: p.get_gender_display() if p.gender else ''),
+            ('age', 'Age', lambda p: p.age() or ''),
+            ('marital_status', 'Marital Status', lambda p: p.get_marital_status_display() if p.marital_status else ''),
+            ('religion', 'Religion', lambda p: p.get_religion_display() if p.religion else ''),
+            ('state', 'State', lambda p: p.state or ''),
+            ('lga', 'LGA', lambda p: p.lga or ''),
+        ]
+        columns = [column for column in columns if column[0] in export_fields]
+
+        def rows():
+            for patient in iterate(queryset):
+                yield [getter(patient) for _, _, getter in columns]
+
+        sheet = ExportSheet(
+            "Patient Bio Data", rows(),
+            headers=[header for _, header, _ in columns],
+            header_alignment=CENTER,
+            column_widths=[20] * len(columns)
         )
-        filename = f"patient_biodata_{date.today().strftime('%Y%m%d')}.xlsx"
-        response['Content-Disposition'] = f'attachment; filename="{filename}"'
-
-        wb.save(response)
-        return response
+        return export_response(request, f"patient_biodata_{date.today().strftime('%Y%m%d')}", [sheet])
 
 
 # ========================= REGISTRATION REPORT =========================
@@ -1364,13 +1147,14 @@ class RegistrationReportView(LoginRequiredMixin, PermissionRequiredMixin, ListVi
         context['from_date'] = from_date
         context['to_date'] = to_date
 
-        # Calculate counts for each template
+        # Calculate counts for all templates at once
+        templates = list(self.get_queryset())
+        counts = count_registrations(templates, from_date, to_date)
         template_data = []
-        for template in self.get_queryset():
-            count = template.get_patient_count(from_date, to_date)
+        for template in templates:
             template_data.append({
                 'template': template,
-                'count': count
+                'count': counts[template.id]
             })
 
         context['template_data'] = template_data
@@ -1453,8 +1237,9 @@ class RegistrationReportExportPDFView(LoginRequiredMixin, PermissionRequiredMixi
         template_data = []
         total_patients = 0
 
+        counts = count_registrations(templates, from_date, to_date)
         for template in templates:
-            count = template.get_patient_count(from_date, to_date)
+            count = counts[template.id]
             template_data.append({
                 'title': template.title,
                 'count': count
@@ -1562,8 +1347,10 @@ class ConsultationTemplateListView(LoginRequiredMixin, PermissionRequiredMixin,
         template_data = []
         total_cases = 0
 
-        for template in self.get_queryset():
-            count = template.get_consultation_count(from_date, to_date)
+        templates = list(self.get_queryset().select_related('diagnosis'))
+        counts = count_consultations(templates, from_date, to_date)
+        for template in templates:
+            count = counts[template.id]
             template_data.append({
                 'template': template,
                 'count': count
@@ -1646,8 +1433,9 @@ class ConsultationTemplateExportPDFView(LoginRequiredMixin, PermissionRequiredMi
         template_data = []
         total_cases = 0
 
+        counts = count_consultations(templates, from_date, to_date)
         for template in templates:
-            count = template.get_consultation_count(from_date, to_date)
+            count = counts[template.id]
             template_data.append({
                 'title': template.title,
                 'count': count
@@ -0,0 +1,291 @@
+"""
+Pharmacy analytics for the pharmacy dashboard.
+
+Every figure is computed by the database in a few grouped queries: the
+drugs are aggregated per category in one pass that yields the category
+distribution, the inventory value and the drug counts together; sales are
+summed per day with TruncDate and per month with TruncMonth in one query
+each, and the stock entry, order and transfer counters are one filtered
+aggregate apiece.
+
+Expired and soon expiring stock is read from the expiry buckets kept by
+pharmacy.expiry.
+
+get_analytics() caches the result for the day (at most CACHE_SECONDS).
+Saving or deleting a stock out, stock entry, transfer, drug, drug order,
+category or manufacturer calls invalidate() (see pharmacy.signals), as do
+the bulk writes that send no signals (pharmacy.dispensing, expiry,
+reconciliation, drug_import and variants), so the dashboard never shows
+figures older than the last change they are computed from.
+"""
+import datetime
+
+from django.core.cache import cache
+from django.db.models import Count, DateField, DecimalField, ExpressionWrapper, F, Q, Sum
+from django.db.models.functions import Cast, TruncDate, TruncMonth
+from django.utils import timezone
+
+from pharmacy import expiry
+from pharmacy.models import (
+    DrugCategoryModel, DrugModel, DrugOrderModel, DrugStockModel, DrugStockOutModel, DrugTransferModel,
+    ManufacturerModel,
+)
+
+CACHE_KEY = 'pharmacy:analytics:{}'
+CACHE_SECONDS = 900
+
+CHART_DAYS = 7
+TREND_MONTHS = 12
+TOP_SELLING_DAYS = 30
+TOP_SELLING_LIMIT = 10
+NEAR_EXPIRY_DAYS = 30
+LISTING_LIMIT = 10
+
+MONEY = DecimalField(max_digits=18, decimal_places=2)
+
+
+def _value(quantity_field):
+    """Worth of a drug's quantity at its selling price"""
+    return ExpressionWrapper(Cast(F(quantity_field), output_field=MONEY) * F('selling_price'), output_field=MONEY)
+
+
+def low_stock_condition():
+    """Drugs at or below their minimum level in the store or the pharmacy"""
+    return Q(store_quantity__lte=F('minimum_stock_level')) | Q(pharmacy_quantity__lte=F('minimum_stock_level'))
+
+
+def growth_percentage(current, previous):
+    if previous == 0:
+        return 100 if current > 0 else 0
+    return round(((current - previous) / previous) * 100, 1)
+
+
+# ---------------------------------------------------------------------------
+# Inventory
+# ---------------------------------------------------------------------------
+
+def get_inventory():
+    """
+    Drug counts, inventory value (active drugs, at selling price) and the
+    category distribution from one query grouped by category.
+    """
+    active = Q(is_active=True)
+    rows = DrugModel.objects.order_by().values(
+        'formulation__generic_drug__category_id', 'formulation__generic_drug__category__name'
+    ).annotate(
+        drug_count=Count('id'),
+        active_count=Count('id', filter=active),
+        low_stock_count=Count('id', filter=low_stock_condition()),
+        total_stock=Sum('store_quantity') + Sum('pharmacy_quantity'),
+        store_value=Sum(_value('store_quantity'), filter=active),
+        pharmacy_value=Sum(_value('pharmacy_quantity'), filter=active),
+    )
+
+    inventory = {
+        'total_drugs': 0,
+        'low_stock_count': 0,
+        'store_value': 0.0,
+        'pharmacy_value': 0.0,
+        'category_distribution': [],
+    }
+    for row in rows:
+        inventory['total_drugs'] += row['active_count']
+        inventory['low_stock_count'] += row['low_stock_count']
+        inventory['store_value'] += float(row['store_value'] or 0)
+        inventory['pharmacy_value'] += float(row['pharmacy_value'] or 0)
+        if row['formulation__generic_drug__category_id'] is not None:
+            inventory['category_distribution'].append({
+                'name': row['formulation__generic_drug__category__name'],
+                'value': row['drug_count'],
+                'stock': float(row['total_stock'] or 0),
+            })
+    inventory['category_distribution'].sort(key=lambda category: category['name'])
+    inventory['total_value'] = inventory['store_value'] + inventory['pharmacy_value']
+    return inventory
+
+
+def get_stock_counts():
+    """Active entries, plus expired and soon expiring ones from the expiry buckets (see pharmacy.expiry)"""
+    return DrugStockModel.objects.aggregate(
+        total_stock_items=Count('id', filter=Q(status='active')),
+        expired_count=Count('id', filter=Q(expiry__bucket=expiry.EXPIRED)),
+        near_expiry_count=Count('id', filter=Q(
+            expiry__bucket=expiry.WITHIN_30_DAYS, status='active', quantity_left__gt=0
+        )),
+    )
+
+
+# ---------------------------------------------------------------------------
+# Sales
+# ---------------------------------------------------------------------------
+
+def get_sales_summary(today):
+    """Quantity and revenue sold today, this week, this month and last month, from one aggregate"""
+    week_start = today - datetime.timedelta(days=today.weekday())
+    month_start = today.replace(day=1)
+    last_month_end = month_start - datetime.timedelta(days=1)
+    last_month_start = last_month_end.replace(day=1)
+    periods = {
+        'today': Q(created_at__date=today),
+        'week': Q(created_at__date__gte=week_start),
+        'month': Q(created_at__date__gte=month_start),
+        'last_month': Q(created_at__date__gte=last_month_start, created_at__date__lte=last_month_end),
+    }
+    aggregates = {}
+    for period, condition in periods.items():
+        aggregates[f'{period}_quantity'] = Sum('quantity', filter=condition)
+        aggregates[f'{period}_revenue'] = Sum('worth', filter=condition)
+    totals = DrugStockOutModel.objects.filter(
+        reason='sale', created_at__date__gte=min(week_start, last_month_start)
+    ).aggregate(**aggregates)
+    return {key: float(value or 0) for key, value in totals.items()}
+
+
+def get_daily_sales(today, days=CHART_DAYS):
+    """Sales and completed orders for each of the last `days` days, oldest first"""
+    first_day = today - datetime.timedelta(days=days - 1)
+    sales = {
+        row['day']: row for row in DrugStockOutModel.objects.filter(
+            reason='sale', created_at__date__gte=first_day, created_at__date__lte=today
+        ).order_by().annotate(day=TruncDate('created_at')).values('day').annotate(
+            total_quantity=Sum('quantity'), total_worth=Sum('worth')
+        )
+    }
+    orders = dict(
+        DrugOrderModel.objects.filter(
+            status='dispensed', dispensed_at__date__gte=first_day, dispensed_at__date__lte=today
+        ).order_by().annotate(day=TruncDate('dispensed_at')).values_list('day').annotate(count=Count('id'))
+    )
+
+    data = []
+    for offset in range(days):
+        day = first_day + datetime.timedelta(days=offset)
+        day_sales = sales.get(day, {})
+        data.append({
+            'date': day.strftime('%Y-%m-%d'),
+            'sales_quantity': float(day_sales.get('total_quantity') or 0),
+            'sales_worth': float(day_sales.get('total_worth') or 0),
+            'orders_completed': orders.get(day, 0),
+        })
+    return data
+
+
+def _month_starts(today, months):
+    year, month = today.year, today.month
+    starts = []
+    for _ in range(months):
+        starts.append(datetime.date(year, month, 1))
+        year, month = (year, month - 1) if month > 1 else (year - 1, 12)
+    return list(reversed(starts))
+
+
+def get_monthly_trends(today, months=TREND_MONTHS):
+    """Sales and stock added for each of the last `months` months, oldest first"""
+    starts = _month_starts(today, months)
+    sales = {
+        row['month']: row for row in DrugStockOutModel.objects.filter(
+            reason='sale', created_at__date__gte=starts[0], created_at__date__lte=today
+        ).order_by().annotate(month=TruncMonth('created_at', output_field=DateField())).values('month').annotate(
+            total_quantity=Sum('quantity'), total_revenue=Sum('worth')
+        )
+    }
+    additions = dict(
+        DrugStockModel.objects.filter(
+            date_added__gte=starts[0], date_added__lte=today
+        ).order_by().annotate(month=TruncMonth('date_added')).values_list('month').annotate(
+            total_added=Sum('quantity_bought')
+        )
+    )
+
+    data = []
+    for month_start in starts:
+        month_sales = sales.get(month_start, {})
+        data.append({
+            'month': month_start.strftime('%b %Y'),
+            'sales_quantity': float(month_sales.get('total_quantity') or 0),
+            'sales_revenue': float(month_sales.get('total_revenue') or 0),
+            'stock_added': float(additions.get(month_start) or 0),
+        })
+    return data
+
+
+def get_top_selling_drugs(today, days=TOP_SELLING_DAYS, limit=TOP_SELLING_LIMIT):
+    return list(DrugStockOutModel.objects.filter(
+        reason='sale', created_at__date__gt=today - datetime.timedelta(days=days)
+    ).values(
+        'drug__formulation__generic_drug__generic_name',
+        'drug__brand_name'
+    ).annotate(
+        total_sold=Sum('quantity'),
+        total_revenue=Sum('worth')
+    ).order_by('-total_sold')[:limit])
+
+
+# ---------------------------------------------------------------------------
+# Orders, transfers and listings
+# ---------------------------------------------------------------------------
+
+def get_activity(today):
+    week_start = today - datetime.timedelta(days=today.weekday())
+    orders = DrugOrderModel.objects.aggregate(
+        pending_orders=Count('id', filter=Q(status='pending')),
+        today_orders_completed=Count('id', filter=Q(status='dispensed', dispensed_at__date=today)),
+    )
+    transferred = DrugTransferModel.objects.filter(
+        transferred_at__date__gte=week_start
+    ).aggregate(total=Sum('quantity'))['total']
+    return {**orders, 'recent_transfers_quantity': float(transferred or 0)}
+
+
+def get_listings(today, limit=LISTING_LIMIT):
+    week_start = today - datetime.timedelta(days=today.weekday())
+    stocks = DrugStockModel.objects.select_related('drug__formulation__generic_drug')
+    return {
+        'low_stock_drugs': list(DrugModel.objects.filter(low_stock_condition()).select_related(
+            'formulation__generic_drug', 'manufacturer'
+        )[:limit]),
+        'expired_drugs': list(expiry.expired_stock().select_related(
+            'drug__formulation__generic_drug', 'expiry'
+        ).order_by('-expiry__expiry_date')[:limit]),
+        'near_expiry_drugs': list(expiry.expiring_stock(NEAR_EXPIRY_DAYS, today).select_related(
+            'drug__formulation__generic_drug'
+        ).order_by('expiry__expiry_date')[:limit]),
+        'recent_stock_additions': list(stocks.filter(date_added__gte=week_start).order_by('-created_at')[:5]),
+    }
+
+
+# ---------------------------------------------------------------------------
+# Cached entry point
+# ---------------------------------------------------------------------------
+
+def compute_analytics(today):
+    sales = get_sales_summary(today)
+    return {
+        **get_inventory(),
+        **get_stock_counts(),
+        **get_activity(today),
+        **get_listings(today),
+        'total_categories': DrugCategoryModel.objects.count(),
+        'total_manufacturers': ManufacturerModel.objects.count(),
+        'sales': sales,
+        'revenue_growth': growth_percentage(sales['month_revenue'], sales['last_month_revenue']),
+        'daily_sales': get_daily_sales(today),
+        'monthly_trends': get_monthly_trends(today),
+        'top_selling_drugs': get_top_selling_drugs(today),
+    }
+
+
+def get_analytics(refresh=False):
+    """Dashboard analytics for today, cached until the next stock movement (refresh=True recomputes)"""
+    today = timezone.localdate()
+    key = CACHE_KEY.format(today.isoformat())
+    analytics = None if refresh else cache.get(key)
+    if analytics is None:
+        analytics = compute_analytics(today)
+        cache.set(key, analytics, CACHE_SECONDS)
+    return analytics
+
+
+def invalidate():
+    """Drop today's cached analytics"""
+    cache.delete(CACHE_KEY.format(timezone.localdate().isoformat()))
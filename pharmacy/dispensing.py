@@ -0,0 +1,131 @@
+"""
+FIFO stock reduction.
+
+Dispensing and stock out take units from a drug's active stock entries,
+oldest first, record a DrugStockOutModel for every entry drawn from and
+lower the drug's store or pharmacy quantity. reduce_stock() does this for
+any number of lines at once:
+
+    stock_outs = reduce_stock([
+        StockLine(drug_id=4, quantity=10, remark='Dispensed to ...'),
+        StockLine(drug_id=9, quantity=2, location='store', reason='damaged'),
+    ], user=request.user)   # one list of DrugStockOutModel per line
+
+Inside a transaction it locks the rows of the drugs involved (in id order,
+so two dispensers never wait on each other in a cycle) and their candidate
+stock entries. The drug locks already serialize dispensers of a drug, so the
+entry lock only waits for other writers of an entry (a stock edit or
+transfer) and never skips it, which would break FIFO order. The allocation
+is planned in memory and only written once every line is covered: one
+bulk_create for the stock outs, one bulk_update for the stock entries and
+one F() decrement per drug and location, after which the expiry buckets of
+the changed entries are refreshed. A line that cannot be filled raises
+InsufficientStock before anything is written.
+"""
+from collections import defaultdict, namedtuple
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from admin_site.catalog import index_items
+from pharmacy import analytics
+from pharmacy.models import DrugModel, DrugStockModel, DrugStockOutModel
+
+StockLine = namedtuple('StockLine', 'drug_id quantity location reason remark', defaults=('pharmacy', 'sale', ''))
+
+LOCATION_FIELDS = {
+    'store': 'store_quantity',
+    'pharmacy': 'pharmacy_quantity',
+}
+
+
+class InsufficientStock(ValueError):
+    """A drug has fewer units in a location, or in its active stock entries, than requested"""
+
+    def __init__(self, drug_id, location, requested, available):
+        self.drug_id = drug_id
+        self.location = location
+        self.requested = requested
+        self.available = available
+        super().__init__(f'Requested: {requested}, Available: {available}')
+
+
+def reduce_stock(lines, user=None):
+    """
+    Take the quantity of every StockLine from its drug's stock, oldest entries
+    first. Returns the DrugStockOutModel objects created, one list per line.
+    """
+    lines = list(lines)
+    for line in lines:
+        if line.location not in LOCATION_FIELDS:
+            raise ValueError(f'Unknown stock location {line.location!r}')
+        if line.quantity <= 0:
+            raise ValueError('Quantity to reduce must be greater than zero')
+    if not lines:
+        return []
+
+    drug_ids = sorted({line.drug_id for line in lines})
+    with transaction.atomic():
+        drugs = DrugModel.objects.select_for_update().filter(pk__in=drug_ids).order_by('pk').in_bulk()
+
+        requested = defaultdict(float)
+        for line in lines:
+            requested[line.drug_id, line.location] += line.quantity
+        for (drug_id, location), quantity in requested.items():
+            drug = drugs.get(drug_id)
+            available = getattr(drug, LOCATION_FIELDS[location]) if drug else 0
+            if quantity > available:
+                raise InsufficientStock(drug_id, location, quantity, available)
+
+        entries = defaultdict(list)
+        candidates = DrugStockModel.objects.select_for_update().filter(
+            drug_id__in=drug_ids, status='active', quantity_left__gt=0
+        ).order_by('drug_id', 'date_added', 'pk')
+        for stock in candidates:
+            entries[stock.drug_id].append(stock)
+
+        stock_outs = []
+        changed = {}
+        for line in lines:
+            remaining = line.quantity
+            drawn = []
+            for stock in entries[line.drug_id]:
+                if remaining <= 0:
+                    break
+                if stock.quantity_left <= 0:
+                    continue
+                quantity = min(remaining, stock.quantity_left)
+                drawn.append(DrugStockOutModel(
+                    stock=stock,
+                    drug_id=line.drug_id,
+                    quantity=quantity,
+                    reason=line.reason,
+                    location_reduced_from=line.location,
+                    worth=stock.selling_price * Decimal(str(quantity)),
+                    remark=line.remark,
+                    created_by=user,
+                ))
+                stock.quantity_left -= quantity
+                stock.current_worth = Decimal(str(stock.quantity_left)) * stock.selling_price
+                changed[stock.pk] = stock
+                remaining -= quantity
+            if remaining > 0:
+                raise InsufficientStock(line.drug_id, line.location, line.quantity, line.quantity - remaining)
+            stock_outs.append(drawn)
+
+        DrugStockOutModel.objects.bulk_create([stock_out for drawn in stock_outs for stock_out in drawn])
+        DrugStockModel.objects.bulk_update(changed.values(), ['quantity_left', 'current_worth'])
+        updated_at = timezone.now()
+        for (drug_id, location), quantity in requested.items():
+            field = LOCATION_FIELDS[location]
+            DrugModel.objects.filter(pk=drug_id).update(**{field: F(field) - quantity, 'updated_at': updated_at})
+        # QuerySet.update() sends no post_save, so refresh the drugs' catalog entries here
+        index_items('drug', drug_ids)
+        # Nor does bulk_update, so reclassify the expiry buckets of the entries drawn from
+        from pharmacy.expiry import refresh_stocks
+        refresh_stocks(changed.values())
+        # Nor does bulk_create, so drop the cached dashboard analytics too
+        transaction.on_commit(analytics.invalidate)
+    return stock_outs
@@ -0,0 +1,431 @@
+"""
+Bulk drug import.
+
+run_import() reads the CSV or XLSX file of a DrugImportLogModel row by row
+(the csv module, or openpyxl in read-only mode, so the whole file is never
+held in memory) and creates or updates one DrugModel per row. The first row
+names the columns; headers are matched without case and with the ALIASES
+below:
+
+    generic_name   required   GenericDrugModel, created when missing
+    form_type      required   tablet, capsule, injection, syrup, cream, drops
+    strength       required   DrugFormulationModel, created when missing
+    selling_price  required
+    brand_name, sku, manufacturer, country, category, atc_code,
+    minimum_stock_level, pack_size, is_active
+
+A row updates the drug with the same SKU, or else the same formulation,
+brand name and manufacturer; otherwise it adds a drug. Categories, generic
+drugs and manufacturers are only created from a row, never changed.
+
+Every lookup goes through maps loaded once at the start, and rows are
+written CHUNK_SIZE at a time: missing categories, generic drugs,
+manufacturers and formulations with bulk_create, then the drugs with
+bulk_create / bulk_update (only the fields a row actually changes), in one
+transaction per chunk. Rows that fail validation are skipped and reported in
+the log's error_log ("Row 12: ..."); the log's counters are saved after
+every chunk, so the import page shows progress while a large file is
+loading. The drugs written are reindexed in the catalog at the end.
+
+The import page does not run the import itself: it queues run_import_job()
+as a task of the report worker (see admin_site.report_jobs) and polls the
+log's counters. manage.py import_drugs runs an import directly.
+"""
+import csv
+import io
+import os
+import re
+from decimal import Decimal, InvalidOperation
+
+from django.db import transaction
+from django.utils import timezone
+
+from admin_site.catalog import reindex_items
+from pharmacy import analytics
+from pharmacy.models import (
+    DrugCategoryModel, DrugFormulationModel, DrugImportLogModel, DrugModel, GenericDrugModel, ManufacturerModel,
+)
+
+CHUNK_SIZE = 1000
+# error_log keeps at most this many row errors
+MAX_LOGGED_ERRORS = 1000
+
+ALIASES = {
+    'generic': 'generic_name',
+    'generic_drug': 'generic_name',
+    'drug_name': 'generic_name',
+    'form': 'form_type',
+    'dosage_form': 'form_type',
+    'brand': 'brand_name',
+    'price': 'selling_price',
+    'unit_price': 'selling_price',
+    'manufacturer_name': 'manufacturer',
+    'supplier': 'manufacturer',
+    'category_name': 'category',
+    'atc': 'atc_code',
+    'minimum_stock': 'minimum_stock_level',
+    'reorder_level': 'minimum_stock_level',
+    'active': 'is_active',
+}
+REQUIRED_COLUMNS = ('generic_name', 'form_type', 'strength', 'selling_price')
+
+FORM_TYPES = {}
+for _value, _label in DrugFormulationModel.FORM_CHOICES:
+    FORM_TYPES[_value] = _value
+    FORM_TYPES[_label.lower()] = _value
+    FORM_TYPES[_value.rstrip('s') + 's'] = _value
+
+# Largest value the integer columns (minimum_stock_level, pack_size) hold
+MAX_WHOLE_NUMBER = 2147483647
+
+TRUE_VALUES = ('1', 'yes', 'y', 'true', 'active')
+FALSE_VALUES = ('0', 'no', 'n', 'false', 'inactive')
+
+
+class ImportFileError(Exception):
+    """The file cannot be read as a drug list at all"""
+
+
+class RowError(ValueError):
+    """A row that cannot be imported; the message is logged against its row number"""
+
+
+# ---------------------------------------------------------------------------
+# Reading
+# ---------------------------------------------------------------------------
+
+def normalize_header(header):
+    key = re.sub(r'[^a-z0-9]+', '_', str(header or '').strip().lower()).strip('_')
+    return ALIASES.get(key, key)
+
+
+def _text(value):
+    if value is None:
+        return ''
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return str(value).strip()
+
+
+def read_rows(file, name):
+    """Yield (row number, {column: text}) for every non-empty data row of a .csv or .xlsx file"""
+    extension = os.path.splitext(name)[1].lower()
+    if extension == '.csv':
+        reader = csv.reader(io.TextIOWrapper(file, encoding='utf-8-sig', newline=''))
+        rows = enumerate(reader, start=1)
+    elif extension == '.xlsx':
+        import openpyxl
+
+        try:
+            workbook = openpyxl.load_workbook(file, read_only=True, data_only=True)
+        except Exception as e:
+            raise ImportFileError(f'Cannot open the workbook: {e}')
+        rows = enumerate(workbook.active.iter_rows(values_only=True), start=1)
+    else:
+        raise ImportFileError(f'{extension or "Files without an extension"} is not supported; save the file as .csv or .xlsx')
+
+    headers = None
+    for number, values in rows:
+        values = [_text(value) for value in values]
+        if not any(values):
+            continue
+        if headers is None:
+            headers = [normalize_header(value) for value in values]
+            missing = [column for column in REQUIRED_COLUMNS if column not in headers]
+            if missing:
+                raise ImportFileError(f'Missing column(s): {", ".join(missing)}')
+            continue
+        yield number, {header: value for header, value in zip(headers, values) if header}
+    if headers is None:
+        raise ImportFileError('The file is empty')
+
+
+# ---------------------------------------------------------------------------
+# Validation
+# ---------------------------------------------------------------------------
+
+def _limited(row, column, max_length, required=False):
+    value = row.get(column, '')
+    if required and not value:
+        raise RowError(f'{column} is required')
+    if len(value) > max_length:
+        raise RowError(f'{column} is longer than {max_length} characters')
+    return value
+
+
+def _number(row, column, minimum=0):
+    value = row.get(column, '')
+    if not value:
+        return None
+    try:
+        decimal = Decimal(value.replace(',', ''))
+        if not decimal.is_finite():
+            raise ValueError(value)
+        number = int(decimal)
+    except (InvalidOperation, ValueError, OverflowError):
+        raise RowError(f'{column} "{value}" is not a whole number')
+    if number < minimum:
+        raise RowError(f'{column} must be at least {minimum}')
+    if number > MAX_WHOLE_NUMBER:
+        raise RowError(f'{column} is out of range')
+    return number
+
+
+def parse_row(row):
+    """The cleaned values of a row; raises RowError"""
+    form_type = FORM_TYPES.get(row.get('form_type', '').lower())
+    if form_type is None:
+        raise RowError(f'form_type "{row.get("form_type", "")}" is not one of {", ".join(dict(DrugFormulationModel.FORM_CHOICES))}')
+
+    price = re.sub(r'[^0-9.\-]', '', row.get('selling_price', ''))
+    try:
+        selling_price = Decimal(price).quantize(Decimal('0.01'))
+    except InvalidOperation:
+        raise RowError(f'selling_price "{row.get("selling_price", "")}" is not a number')
+    if selling_price < 0 or selling_price >= Decimal('100000000'):
+        raise RowError('selling_price is out of range')
+
+    is_active = row.get('is_active', '').lower()
+    if is_active and is_active not in TRUE_VALUES + FALSE_VALUES:
+        raise RowError(f'is_active "{row["is_active"]}" is not yes or no')
+
+    return {
+        'generic_name': _limited(row, 'generic_name', 200, required=True),
+        'form_type': form_type,
+        'strength': _limited(row, 'strength', 50, required=True),
+        'selling_price': selling_price,
+        'brand_name': _limited(row, 'brand_name', 200),
+        'sku': _limited(row, 'sku', 100),
+        'manufacturer': _limited(row, 'manufacturer', 200),
+        'country': _limited(row, 'country', 100),
+        'category': _limited(row, 'category', 100),
+        'atc_code': _limited(row, 'atc_code', 10),
+        'minimum_stock_level': _number(row, 'minimum_stock_level'),
+        'pack_size': _number(row, 'pack_size', minimum=1),
+        'is_active': None if not is_active else is_active in TRUE_VALUES,
+    }
+
+
+# ---------------------------------------------------------------------------
+# Writing
+# ---------------------------------------------------------------------------
+
+DRUG_FIELDS = (
+    'formulation_id', 'manufacturer_id', 'brand_name', 'selling_price', 'sku', 'minimum_stock_level', 'pack_size',
+    'is_active',
+)
+
+
+class Lookups:
+    """In-memory maps from names and keys to ids, loaded once per import"""
+
+    def __init__(self):
+        self.categories = {name.lower(): pk for pk, name in DrugCategoryModel.objects.values_list('pk', 'name')}
+        self.generics = {name.lower(): pk for pk, name in GenericDrugModel.objects.values_list('pk', 'generic_name')}
+        self.manufacturers = {name.lower(): pk for pk, name in ManufacturerModel.objects.values_list('pk', 'name')}
+        self.formulations = {
+            (generic_id, form_type, strength.lower()): pk
+            for pk, generic_id, form_type, strength in DrugFormulationModel.objects.values_list(
+                'pk', 'generic_drug_id', 'form_type', 'strength'
+            )
+        }
+        self.drugs_by_sku = {}
+        self.drugs_by_key = {}
+        # Current values of every drug, so rows that change nothing are not written
+        self.drugs = {}
+        for row in DrugModel.objects.order_by('pk').values('pk', *DRUG_FIELDS):
+            self.add_drug(row.pop('pk'), row)
+
+    def add_drug(self, pk, values):
+        self.drugs[pk] = values
+        if values['sku']:
+            self.drugs_by_sku.setdefault(values['sku'].lower(), pk)
+        self.drugs_by_key.setdefault(
+            (values['formulation_id'], values['brand_name'].lower(), values['manufacturer_id']), pk
+        )
+
+
+def _create_named(model, field, names, lookup, defaults):
+    """bulk_create the named rows missing from lookup and add their ids to it"""
+    missing = {name.lower(): name for name in names if name and name.lower() not in lookup}
+    if not missing:
+        return
+    model.objects.bulk_create(
+        [model(**{field: name}, **defaults.get(key, {})) for key, name in missing.items()], ignore_conflicts=True
+    )
+    for pk, name in model.objects.filter(**{f'{field}__in': missing.values()}).values_list('pk', field):
+        lookup.setdefault(name.lower(), pk)
+
+
+def write_chunk(rows, lookups):
+    """
+    Create or update the drugs of a chunk of parsed (row number, values).
+    Returns the ids of the drugs created or changed.
+    """
+    _create_named(DrugCategoryModel, 'name', [values['category'] for _, values in rows], lookups.categories, {})
+    _create_named(
+        GenericDrugModel, 'generic_name', [values['generic_name'] for _, values in rows], lookups.generics,
+        {
+            values['generic_name'].lower(): {
+                'category_id': lookups.categories.get(values['category'].lower()),
+                'atc_code': values['atc_code'],
+            }
+            for _, values in rows
+        },
+    )
+    _create_named(
+        ManufacturerModel, 'name', [values['manufacturer'] for _, values in rows], lookups.manufacturers,
+        {values['manufacturer'].lower(): {'country': values['country']} for _, values in rows},
+    )
+
+    missing = {}
+    for _, values in rows:
+        key = (lookups.generics[values['generic_name'].lower()], values['form_type'], values['strength'].lower())
+        if key not in lookups.formulations:
+            missing.setdefault(key, values['strength'])
+    if missing:
+        DrugFormulationModel.objects.bulk_create([
+            DrugFormulationModel(generic_drug_id=generic_id, form_type=form_type, strength=strength)
+            for (generic_id, form_type, _), strength in missing.items()
+        ], ignore_conflicts=True)
+        for pk, generic_id, form_type, strength in DrugFormulationModel.objects.filter(
+            generic_drug_id__in={generic_id for generic_id, _, _ in missing}
+        ).values_list('pk', 'generic_drug_id', 'form_type', 'strength'):
+            lookups.formulations.setdefault((generic_id, form_type, strength.lower()), pk)
+
+    # Rows for the same drug within a chunk: the last one wins
+    updates = {}
+    creates = {}
+    for _, values in rows:
+        formulation_id = lookups.formulations[
+            (lookups.generics[values['generic_name'].lower()], values['form_type'], values['strength'].lower())
+        ]
+        manufacturer_id = lookups.manufacturers.get(values['manufacturer'].lower()) if values['manufacturer'] else None
+        key = (formulation_id, values['brand_name'].lower(), manufacturer_id)
+        pk = lookups.drugs_by_sku.get(values['sku'].lower()) if values['sku'] else None
+        pk = pk or lookups.drugs_by_key.get(key)
+
+        fields = {
+            'formulation_id': formulation_id,
+            'manufacturer_id': manufacturer_id,
+            'brand_name': values['brand_name'],
+            'selling_price': values['selling_price'],
+        }
+        for optional in ('sku', 'minimum_stock_level', 'pack_size', 'is_active'):
+            if values[optional] not in (None, ''):
+                fields[optional] = values[optional]
+        if pk:
+            updates.setdefault(pk, {}).update(fields)
+        else:
+            creates.setdefault(key, {}).update(fields)
+
+    written = []
+    if creates:
+        drugs = DrugModel.objects.bulk_create([DrugModel(**fields) for fields in creates.values()])
+        if any(drug.pk is None for drug in drugs):
+            # The backend does not return ids from bulk_create: read them back
+            drugs = DrugModel.objects.filter(
+                pk__gt=max(lookups.drugs, default=0),
+                formulation_id__in={fields['formulation_id'] for fields in creates.values()},
+            )
+        for drug in drugs:
+            lookups.add_drug(drug.pk, {field: getattr(drug, field) for field in DRUG_FIELDS})
+            written.append(drug.pk)
+
+    # bulk_update writes the same fields for every object, so group the drugs by the fields that changed
+    by_fields = {}
+    updated_at = timezone.now()
+    for pk, fields in updates.items():
+        current = lookups.drugs[pk]
+        changed = {field: value for field, value in fields.items() if current[field] != value}
+        if changed:
+            current.update(changed)
+            by_fields.setdefault(tuple(sorted(changed)), []).append(DrugModel(pk=pk, updated_at=updated_at, **changed))
+            written.append(pk)
+    for fields, drugs in by_fields.items():
+        DrugModel.objects.bulk_update(drugs, fields + ('updated_at',))
+    return written
+
+
+def run_import(log, chunk_size=CHUNK_SIZE):
+    """
+    Import the log's file, saving its counters after every chunk. Returns
+    the log, with status 'completed', or 'failed' when the file could not be
+    read or no row was imported.
+    """
+    total = successful = failed = 0
+    errors = []
+
+    def save_progress(status='processing'):
+        error_log = '\n'.join(errors)
+        if failed > len(errors):
+            error_log += f'\n... and {failed - len(errors)} more'
+        DrugImportLogModel.objects.filter(pk=log.pk).update(
+            total_records=total, successful_records=successful, failed_records=failed,
+            error_log=error_log, status=status,
+        )
+
+    def record_error(number, message):
+        nonlocal failed
+        failed += 1
+        if len(errors) < MAX_LOGGED_ERRORS:
+            errors.append(f'Row {number}: {message}')
+
+    def flush(chunk):
+        nonlocal successful, lookups
+        if not chunk:
+            return
+        try:
+            with transaction.atomic():
+                written.extend(write_chunk(chunk, lookups))
+        except Exception as e:
+            # The maps may hold ids the rolled back transaction created
+            lookups = Lookups()
+            for number, _ in chunk:
+                record_error(number, f'Could not be saved: {e}')
+        else:
+            successful += len(chunk)
+        save_progress()
+
+    lookups = Lookups()
+    written = []
+    chunk = []
+    try:
+        with log.import_file.open('rb') as file:
+            for number, row in read_rows(file, log.import_file.name):
+                total += 1
+                try:
+                    chunk.append((number, parse_row(row)))
+                except RowError as e:
+                    record_error(number, e)
+                if len(chunk) >= chunk_size:
+                    flush(chunk)
+                    chunk = []
+            flush(chunk)
+    except ImportFileError as e:
+        errors.insert(0, str(e))
+        save_progress('failed')
+    else:
+        save_progress('completed' if successful or not total else 'failed')
+
+    if written:
+        # The bulk writes send no signals, so refresh the drugs' catalog entries and the dashboard here
+        reindex_items('drug', written)
+        analytics.invalidate()
+    log.refresh_from_db()
+    return log
+
+
+def run_import_job(log_id):
+    """Report worker task: import a log queued by the import page; raises when the import failed"""
+    log = DrugImportLogModel.objects.get(pk=log_id)
+    try:
+        log = run_import(log)
+    except Exception as e:
+        # Keep the row errors logged before the import stopped
+        log.refresh_from_db()
+        error_log = '\n'.join(filter(None, [f'Import stopped: {e}', log.error_log]))
+        DrugImportLogModel.objects.filter(pk=log.pk).update(status='failed', error_log=error_log)
+        raise
+    if log.status == 'failed':
+        raise ValueError(f'Import {log.pk} failed, see its error log')
@@ -0,0 +1,238 @@
+"""
+Stock expiry.
+
+The sweep_expired_stock command (run nightly) calls sweep(), which in one
+transaction writes off every active stock entry whose expiry date has come:
+the entry is marked expired with nothing left, a DrugStockOutModel with
+reason 'expired' records what was written off, and the drug's store or
+pharmacy quantity is lowered with an F() decrement. The entries and drug
+rows are locked in the same order as pharmacy.dispensing, so a sweep and a
+dispense never deadlock.
+
+The sweep then rewrites DrugStockExpiryModel, which sorts stock entries
+into buckets:
+
+    expired   past their expiry date: waiting for the sweep with units left,
+              or written off within the last EXPIRED_DAYS days (entries
+              dispensed to nothing before they expired are left out)
+    30_days   expire within 30 days
+    90_days   expire in 31 to 90 days
+
+Expiry listings and counts read that table (expired_stock(),
+expiring_stock()) instead of scanning every stock entry by expiry date.
+Saving a stock entry reclassifies it (see pharmacy.signals), and
+pharmacy.dispensing reclassifies the entries it draws from, so the buckets
+follow the day's stock changes before the next sweep.
+"""
+import datetime
+from collections import defaultdict
+from decimal import Decimal
+
+from django.apps import apps as global_apps
+from django.db import transaction
+from django.db.models import F, FloatField, Q, Sum, Value
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from admin_site.catalog import index_items
+from pharmacy import analytics
+from pharmacy.dispensing import LOCATION_FIELDS
+from pharmacy.models import DrugModel, DrugStockExpiryModel, DrugStockModel, DrugStockOutModel
+
+EXPIRED = 'expired'
+WITHIN_30_DAYS = '30_days'
+WITHIN_90_DAYS = '90_days'
+
+# Written off entries stay in the expired bucket this long after their expiry date
+EXPIRED_DAYS = 30
+
+BUCKET_BATCH_SIZE = 1000
+
+
+def classify(expiry_date, status, quantity_left, today, written_off=0):
+    """Bucket of a stock entry, or None when it belongs in none; written_off is what the sweep wrote off"""
+    if expiry_date is None:
+        return None
+    if status == 'active':
+        if quantity_left <= 0:
+            return None
+        if expiry_date <= today:
+            return EXPIRED
+        if expiry_date <= today + datetime.timedelta(days=30):
+            return WITHIN_30_DAYS
+        if expiry_date <= today + datetime.timedelta(days=90):
+            return WITHIN_90_DAYS
+        return None
+    if status == 'expired' and written_off > 0 and \
+            today - datetime.timedelta(days=EXPIRED_DAYS) <= expiry_date <= today:
+        return EXPIRED
+    return None
+
+
+# ---------------------------------------------------------------------------
+# Buckets
+# ---------------------------------------------------------------------------
+
+def refresh_buckets(apps=global_apps, today=None):
+    """
+    Rewrite the expiry bucket of every stock entry. Returns the number of
+    entries in a bucket. Pass the migration's apps registry to run it from a
+    data migration.
+    """
+    stock_model = apps.get_model('pharmacy', 'DrugStockModel')
+    expiry_model = apps.get_model('pharmacy', 'DrugStockExpiryModel')
+    today = today or timezone.localdate()
+
+    candidates = stock_model.objects.filter(
+        expiry_date__lte=today + datetime.timedelta(days=90)
+    ).filter(
+        Q(status='active', quantity_left__gt=0)
+        | Q(status='expired', expiry_date__gte=today - datetime.timedelta(days=EXPIRED_DAYS))
+    ).order_by().annotate(
+        written_off=Coalesce(
+            Sum('stock_outs__quantity', filter=Q(stock_outs__reason='expired')), Value(0.0), output_field=FloatField()
+        )
+    ).values_list('pk', 'expiry_date', 'status', 'quantity_left', 'written_off')
+
+    rows = []
+    for pk, expiry_date, status, quantity_left, written_off in candidates:
+        bucket = classify(expiry_date, status, quantity_left, today, written_off)
+        if bucket is not None:
+            quantity = written_off if status == 'expired' else quantity_left
+            rows.append(expiry_model(
+                stock_id=pk, bucket=bucket, expiry_date=expiry_date, quantity=quantity, computed_on=today
+            ))
+
+    with transaction.atomic():
+        expiry_model.objects.all().delete()
+        expiry_model.objects.bulk_create(rows, batch_size=BUCKET_BATCH_SIZE)
+    return len(rows)
+
+
+def refresh_stocks(stocks, today=None):
+    """Rewrite the buckets of the given stock entries (changed with or without signals)"""
+    stocks = list(stocks)
+    if not stocks:
+        return
+    today = today or timezone.localdate()
+    written_off = dict(
+        DrugStockOutModel.objects.filter(
+            stock_id__in=[stock.pk for stock in stocks if stock.status == 'expired'], reason='expired'
+        ).order_by().values('stock_id').annotate(total=Sum('quantity')).values_list('stock_id', 'total')
+    )
+
+    rows = []
+    for stock in stocks:
+        stock_written_off = written_off.get(stock.pk) or 0
+        bucket = classify(stock.expiry_date, stock.status, stock.quantity_left, today, stock_written_off)
+        if bucket is not None:
+            quantity = stock_written_off if stock.status == 'expired' else stock.quantity_left
+            rows.append(DrugStockExpiryModel(
+                stock=stock, bucket=bucket, expiry_date=stock.expiry_date, quantity=quantity, computed_on=today
+            ))
+
+    with transaction.atomic():
+        DrugStockExpiryModel.objects.filter(stock__in=stocks).delete()
+        DrugStockExpiryModel.objects.bulk_create(rows)
+
+
+def refresh_stock(stock, today=None):
+    """Rewrite the bucket of one stock entry (post_save receiver helper)"""
+    refresh_stocks([stock], today)
+
+
+def expired_stock():
+    """Stock entries in the expired bucket"""
+    return DrugStockModel.objects.filter(expiry__bucket=EXPIRED)
+
+
+def expiring_stock(days=30, today=None):
+    """Stock entries expiring within `days` days (at most 90) that still have units left"""
+    today = today or timezone.localdate()
+    return DrugStockModel.objects.filter(
+        expiry__bucket__in=[WITHIN_30_DAYS, WITHIN_90_DAYS],
+        expiry__expiry_date__lte=today + datetime.timedelta(days=days),
+        status='active',
+        quantity_left__gt=0,
+    )
+
+
+# ---------------------------------------------------------------------------
+# Sweep
+# ---------------------------------------------------------------------------
+
+def _allocate(quantity, counters, preferred):
+    """
+    [(location, quantity)] to write quantity off from: the entry's own location
+    first, then the other one, within what the drug's counters hold. Whatever
+    the counters cannot cover is taken from the entry's location.
+    """
+    allocation = []
+    remaining = quantity
+    for location in [preferred] + [other for other in LOCATION_FIELDS if other != preferred]:
+        taken = min(remaining, max(counters[location], 0))
+        if taken > 0:
+            allocation.append((location, taken))
+            counters[location] -= taken
+            remaining -= taken
+    if remaining > 0:
+        allocation.append((preferred, remaining))
+        counters[preferred] -= remaining
+    return allocation
+
+
+def due_for_sweep(today=None):
+    """Active stock entries whose expiry date has come"""
+    today = today or timezone.localdate()
+    return DrugStockModel.objects.filter(status='active', expiry_date__lte=today)
+
+
+def sweep(today=None, user=None):
+    """
+    Write off the expired stock entries and refresh the expiry buckets.
+    Returns (entries expired, quantity written off, entries in a bucket).
+    """
+    today = today or timezone.localdate()
+    with transaction.atomic():
+        drug_ids = sorted(set(due_for_sweep(today).values_list('drug_id', flat=True)))
+        drugs = DrugModel.objects.select_for_update().filter(pk__in=drug_ids).order_by('pk')
+        counters = {
+            drug.pk: {location: getattr(drug, field) for location, field in LOCATION_FIELDS.items()}
+            for drug in drugs
+        }
+        stocks = list(due_for_sweep(today).select_for_update(skip_locked=True).filter(
+            drug_id__in=drug_ids
+        ).order_by('drug_id', 'expiry_date', 'pk'))
+
+        stock_outs = []
+        written_off = defaultdict(float)
+        for stock in stocks:
+            if stock.quantity_left > 0:
+                for location, quantity in _allocate(stock.quantity_left, counters[stock.drug_id], stock.location):
+                    stock_outs.append(DrugStockOutModel(
+                        stock=stock,
+                        drug_id=stock.drug_id,
+                        quantity=quantity,
+                        reason='expired',
+                        location_reduced_from=location,
+                        worth=stock.selling_price * Decimal(str(quantity)),
+                        remark=f'Expired on {stock.expiry_date:%Y-%m-%d}',
+                        created_by=user,
+                    ))
+                    written_off[stock.drug_id, location] += quantity
+            stock.status = 'expired'
+            stock.quantity_left = 0
+            stock.current_worth = 0
+
+        DrugStockOutModel.objects.bulk_create(stock_outs)
+        DrugStockModel.objects.bulk_update(stocks, ['status', 'quantity_left', 'current_worth'], batch_size=1000)
+        updated_at = timezone.now()
+        for (drug_id, location), quantity in written_off.items():
+            field = LOCATION_FIELDS[location]
+            DrugModel.objects.filter(pk=drug_id).update(**{field: F(field) - quantity, 'updated_at': updated_at})
+        # The bulk writes send no signals: refresh the catalog and dashboard figures here
+        index_items('drug', {drug_id for drug_id, _ in written_off})
+        transaction.on_commit(analytics.invalidate)
+
+        bucketed = refresh_buckets(today=today)
+    return len(stocks), sum(written_off.values()), bucketed
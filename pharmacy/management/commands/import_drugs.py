@@ -0,0 +1,55 @@
+# pharmacy/management/commands/import_drugs.py
+
+import os
+import time
+
+from django.contrib.auth.models import User
+from django.core.files import File
+from django.core.management.base import BaseCommand, CommandError
+
+from pharmacy.drug_import import CHUNK_SIZE, run_import
+from pharmacy.models import DrugImportLogModel
+
+
+class Command(BaseCommand):
+    help = 'Import drugs from a .csv or .xlsx file (or re-run an uploaded import log)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', nargs='?', help='File to import')
+        parser.add_argument('--log', type=int, help='Re-run the import log with this id')
+        parser.add_argument('--user', help='Username to record as the importer')
+        parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE,
+                            help=f'Rows written per transaction (default {CHUNK_SIZE})')
+
+    def handle(self, *args, **options):
+        if bool(options['path']) == bool(options['log']):
+            raise CommandError('Give either a file path or --log')
+
+        if options['log']:
+            try:
+                log = DrugImportLogModel.objects.get(pk=options['log'])
+            except DrugImportLogModel.DoesNotExist:
+                raise CommandError(f'Import log {options["log"]} does not exist')
+        else:
+            path = options['path']
+            if not os.path.isfile(path):
+                raise CommandError(f'{path} does not exist')
+            user = None
+            if options['user']:
+                user = User.objects.filter(username=options['user']).first()
+                if user is None:
+                    raise CommandError(f'User {options["user"]} does not exist')
+            with open(path, 'rb') as file:
+                log = DrugImportLogModel.objects.create(
+                    import_file=File(file, name=os.path.basename(path)), imported_by=user
+                )
+
+        started = time.perf_counter()
+        log = run_import(log, chunk_size=options['chunk_size'])
+        style = self.style.SUCCESS if log.status == 'completed' else self.style.ERROR
+        self.stdout.write(style(
+            f'Import {log.pk} {log.status}: {log.successful_records} of {log.total_records} rows imported, '
+            f'{log.failed_records} failed ({time.perf_counter() - started:.1f} s)'
+        ))
+        if log.error_log:
+            self.stdout.write('\n'.join(log.error_log.split('\n')[:20]))
@@ -0,0 +1,49 @@
+# pharmacy/management/commands/reconcile_drug_stock.py
+
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from pharmacy.models import DrugModel
+from pharmacy.reconciliation import TOLERANCE, find_drift, repair
+
+
+class Command(BaseCommand):
+    help = 'Compare drug store/pharmacy quantities with their stock records and optionally repair them'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repair', action='store_true', help='Set drifted quantities to the expected ones')
+        parser.add_argument('--drug', type=int, action='append', dest='drug_ids',
+                            help='Only reconcile the drug with this id (repeat for more)')
+        parser.add_argument('--tolerance', type=float, default=TOLERANCE,
+                            help='Differences up to this are ignored')
+
+    def handle(self, *args, **options):
+        if options['tolerance'] < 0:
+            raise CommandError('--tolerance cannot be negative')
+
+        started = time.perf_counter()
+        if options['repair']:
+            drifts = repair(options['drug_ids'], options['tolerance'])
+        else:
+            drugs = DrugModel.objects.all()
+            if options['drug_ids']:
+                drugs = drugs.filter(pk__in=options['drug_ids'])
+            drifts = find_drift(drugs, options['tolerance'])
+
+        for drift in drifts:
+            self.stdout.write(
+                f'{drift.drug.pk:>6}  {str(drift.drug)[:40]:<40}  '
+                f'store {drift.store_quantity:g} -> {drift.expected_store:g} ({drift.store_drift:+g})  '
+                f'pharmacy {drift.pharmacy_quantity:g} -> {drift.expected_pharmacy:g} ({drift.pharmacy_drift:+g})'
+            )
+
+        elapsed = time.perf_counter() - started
+        if not drifts:
+            self.stdout.write(self.style.SUCCESS(f'No stock drift found ({elapsed:.1f} s)'))
+        elif options['repair']:
+            self.stdout.write(self.style.SUCCESS(f'Repaired {len(drifts)} drugs ({elapsed:.1f} s)'))
+        else:
+            self.stdout.write(self.style.WARNING(
+                f'{len(drifts)} drugs have drifted ({elapsed:.1f} s); run with --repair to fix them'
+            ))
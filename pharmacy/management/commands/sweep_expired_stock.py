@@ -0,0 +1,32 @@
+# pharmacy/management/commands/sweep_expired_stock.py
+
+import time
+
+from django.core.management.base import BaseCommand
+from django.db.models import Count, Sum
+
+from pharmacy.expiry import due_for_sweep, sweep
+
+
+class Command(BaseCommand):
+    help = 'Write off expired drug stock and refresh the expiry buckets (run nightly)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Show what would be written off without changing anything')
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        if options['dry_run']:
+            due = due_for_sweep().aggregate(entries=Count('id'), quantity=Sum('quantity_left'))
+            self.stdout.write(self.style.WARNING(
+                f'DRY RUN - {due["entries"]} stock entries would be marked expired, '
+                f'writing off {due["quantity"] or 0:g} units'
+            ))
+            return
+
+        expired, quantity, bucketed = sweep()
+        self.stdout.write(self.style.SUCCESS(
+            f'Marked {expired} stock entries expired, wrote off {quantity:g} units; '
+            f'{bucketed} entries in expiry buckets ({time.perf_counter() - started:.1f} s)'
+        ))
@@ -0,0 +1,92 @@
+# Generated by Django 5.0 on 2026-10-16 19:00
+
+import datetime
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import FloatField, Q, Sum, Value
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+
+# The bucket rules as of this migration (see pharmacy.expiry), copied so the
+# migration keeps working when the live module changes
+
+EXPIRED = 'expired'
+WITHIN_30_DAYS = '30_days'
+WITHIN_90_DAYS = '90_days'
+
+EXPIRED_DAYS = 30
+
+
+def classify(expiry_date, status, quantity_left, today):
+    if expiry_date is None:
+        return None
+    if status == 'active':
+        if quantity_left <= 0:
+            return None
+        if expiry_date <= today:
+            return EXPIRED
+        if expiry_date <= today + datetime.timedelta(days=30):
+            return WITHIN_30_DAYS
+        if expiry_date <= today + datetime.timedelta(days=90):
+            return WITHIN_90_DAYS
+        return None
+    if status == 'expired' and today - datetime.timedelta(days=EXPIRED_DAYS) <= expiry_date <= today:
+        return EXPIRED
+    return None
+
+
+def build_buckets(apps, schema_editor):
+    """Sort the existing stock entries into expiry buckets"""
+    DrugStockModel = apps.get_model('pharmacy', 'DrugStockModel')
+    DrugStockExpiryModel = apps.get_model('pharmacy', 'DrugStockExpiryModel')
+    today = timezone.localdate()
+
+    candidates = DrugStockModel.objects.filter(
+        expiry_date__lte=today + datetime.timedelta(days=90)
+    ).filter(
+        Q(status='active', quantity_left__gt=0)
+        | Q(status='expired', expiry_date__gte=today - datetime.timedelta(days=EXPIRED_DAYS))
+    ).order_by().annotate(
+        written_off=Coalesce(
+            Sum('stock_outs__quantity', filter=Q(stock_outs__reason='expired')), Value(0.0), output_field=FloatField()
+        )
+    ).values_list('pk', 'expiry_date', 'status', 'quantity_left', 'written_off')
+
+    rows = []
+    for pk, expiry_date, status, quantity_left, written_off in candidates:
+        bucket = classify(expiry_date, status, quantity_left, today)
+        if bucket is not None:
+            quantity = written_off if status == 'expired' else quantity_left
+            rows.append(DrugStockExpiryModel(
+                stock_id=pk, bucket=bucket, expiry_date=expiry_date, quantity=quantity, computed_on=today
+            ))
+    DrugStockExpiryModel.objects.bulk_create(rows, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pharmacy', '0004_drugordermodel_customer_name_drugordermodel_source_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DrugStockExpiryModel',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('bucket', models.CharField(choices=[('expired', 'Expired'), ('30_days', 'Expires Within 30 Days'), ('90_days', 'Expires Within 90 Days')], max_length=10)),
+                ('expiry_date', models.DateField()),
+                ('quantity', models.FloatField(help_text='Quantity written off (expired) or left (expiring)')),
+                ('computed_on', models.DateField()),
+                ('stock', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='expiry', to='pharmacy.drugstockmodel')),
+            ],
+            options={
+                'db_table': 'drug_stock_expiry',
+                'ordering': ['expiry_date'],
+                'indexes': [models.Index(fields=['bucket', 'expiry_date'], name='drug_stock__bucket_ef2e81_idx')],
+            },
+        ),
+        migrations.RunPython(build_buckets, migrations.RunPython.noop),
+    ]
@@ -4,6 +4,8 @@ from django.contrib.auth.models import User
 from datetime import date
 from decimal import Decimal
 
+from admin_site.sequences import next_sequence_value, max_sequence_suffix
+
 
 # 1. SIMPLIFIED DRUG CATEGORIES
 class DrugCategoryModel(models.Model):
@@ -205,36 +207,11 @@ class DrugBatchModel(models.Model):
 
     def save(self, *args, **kwargs):
         if not self.name:
-            # Get the highest existing batch number
-            last_batch = DrugBatchModel.objects.filter(
-                name__startswith='batch-'
-            ).order_by('name').last()
-
-            if last_batch and last_batch.name.startswith('batch-'):
-                try:
-                    # Extract number from batch-0001 format
-                    last_number = int(last_batch.name.split('-')[1])
-                    next_id = last_number + 1
-                except (IndexError, ValueError):
-                    next_id = 1
-            else:
-                next_id = 1
-
-            # Generate unique batch name (with safety limit)
-            max_attempts = 100
-            attempts = 0
-            while attempts < max_attempts:
-                batch_name = f'batch-{str(next_id).rjust(4, "0")}'
-                if not DrugBatchModel.objects.filter(name=batch_name).exists():
-                    self.name = batch_name
-                    break
-                next_id += 1
-                attempts += 1
-
-            # Fallback if somehow we hit max attempts
-            if not self.name:
-                import uuid
-                self.name = f'batch-{uuid.uuid4().hex[:8]}'
+            next_id = next_sequence_value(
+                'batch-',
+                seed=lambda: max_sequence_suffix(DrugBatchModel.objects, 'name', 'batch-')
+            )
+            self.name = f'batch-{str(next_id).rjust(4, "0")}'
 
         if not self.date:
             self.date = date.today()
@@ -399,6 +376,30 @@ class DrugStockOutModel(models.Model):
         super().save(*args, **kwargs)
 
 
+# 7b. STOCK EXPIRY BUCKETS (Precomputed by the sweep_expired_stock command)
+class DrugStockExpiryModel(models.Model):
+    """Which expiry bucket a stock entry is in; rewritten nightly and when the entry is saved"""
+    BUCKET_CHOICES = [
+        ('expired', 'Expired'),
+        ('30_days', 'Expires Within 30 Days'),
+        ('90_days', 'Expires Within 90 Days'),
+    ]
+
+    stock = models.OneToOneField(DrugStockModel, on_delete=models.CASCADE, related_name='expiry')
+    bucket = models.CharField(max_length=10, choices=BUCKET_CHOICES)
+    expiry_date = models.DateField()
+    quantity = models.FloatField(help_text="Quantity written off (expired) or left (expiring)")
+    computed_on = models.DateField()
+
+    class Meta:
+        db_table = 'drug_stock_expiry'
+        ordering = ['expiry_date']
+        indexes = [models.Index(fields=['bucket', 'expiry_date'])]
+
+    def __str__(self):
+        return f"{self.stock} - {self.get_bucket_display()}"
+
+
 # 8. DRUG TRANSFER MODEL (Store to Pharmacy transfers)
 class DrugTransferModel(models.Model):
     """Track transfers from store to pharmacy"""
@@ -790,82 +791,30 @@ class DrugTemplateModel(models.Model):
         Create actual drug variants from specific combinations
         selected_indices: List of indices to process (if None, processes all)
         """
-        from django.utils import timezone
+        from pharmacy.variants import create_variants, plan_variants
 
         if self.is_processed:
             return {"error": "Template already processed"}
 
-        created_drugs = []
-        errors = []
-
         try:
-            # Get or create generic drug
-            generic_drug, _ = GenericDrugModel.objects.get_or_create(
-                generic_name=self.generic_name,
-                defaults={
-                    'category': self.category,
-                    'is_prescription_only': self.is_prescription
-                }
-            )
-
-            # Process specific combinations
-            combinations_to_process = (
-                [self.drug_combinations[i] for i in selected_indices]
-                if selected_indices
-                else self.drug_combinations
-            )
-
-            for combo in combinations_to_process:
-                try:
-                    # Get or create manufacturer
-                    manufacturer, _ = ManufacturerModel.objects.get_or_create(
-                        name=combo['manufacturer']
-                    )
-
-                    # Create formulation
-                    formulation, _ = DrugFormulationModel.objects.get_or_create(
-                        generic_drug=generic_drug,
-                        form_type=combo['form'],
-                        strength=combo['strength']
-                    )
-
-                    # Generate unique SKU
-                    sku_base = f"{generic_drug.generic_name[:3].upper()}-{combo['strength']}-{combo['form'][:3].upper()}-{manufacturer.name[:3].upper()}"
-                    sku = sku_base
-                    counter = 1
-                    while DrugModel.objects.filter(sku=sku).exists():
-                        sku = f"{sku_base}-{counter}"
-                        counter += 1
-
-                    # Create drug variant
-                    drug, created = DrugModel.objects.get_or_create(
-                        formulation=formulation,
-                        manufacturer=manufacturer,
-                        defaults={'sku': sku}
-                    )
-
-                    if created:
-                        created_drugs.append(drug)
-
-                except Exception as e:
-                    errors.append(f"Error creating {combo}: {str(e)}")
-
-            # Mark as processed
-            self.is_processed = True
-            self.drugs_created_count = len(created_drugs)
-            self.processed_at = timezone.now()
-            self.save()
-
+            plan = plan_variants(self, selected_indices)
+            created_drugs = create_variants(plan)
             return {
                 "success": True,
                 "created_count": len(created_drugs),
                 "created_drugs": created_drugs,
-                "errors": errors
+                "errors": plan.errors
             }
 
         except Exception as e:
             return {"error": f"Template processing failed: {str(e)}"}
 
+    def plan_drug_variants(self, selected_indices=None):
+        """Preview of what create_drug_variants() would do, without writing anything"""
+        from pharmacy.variants import plan_variants
+
+        return plan_variants(self, selected_indices)
+
     @property
     def preview_combinations(self):
         """Preview what will be created"""
@@ -0,0 +1,107 @@
+"""
+Drug stock reconciliation.
+
+DrugModel.store_quantity and pharmacy_quantity are running counters kept up
+to date by the code that changes stock; this module recomputes them from the
+records themselves and reports the drugs whose counters have drifted:
+
+    total     = sum of quantity_left over the drug's stock entries
+    pharmacy  = bought into the pharmacy + transferred in - taken out of the
+                pharmacy (clamped to 0..total)
+    store     = total - pharmacy
+
+Stock entries keep the location they were bought into when they are
+transferred, so the split between the locations follows the bought /
+transferred / stock out ledger while the total always matches the entries.
+
+All expected quantities come from one query over the drugs, with one grouped
+subquery per ledger, so a whole formulary is reconciled in a single round
+trip. repair() rewrites the drifted counters with bulk_update while holding
+the drug rows locked, like pharmacy.dispensing.
+"""
+from collections import namedtuple
+
+from django.db import transaction
+from django.db.models import FloatField, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from admin_site.catalog import index_items
+from pharmacy import analytics
+from pharmacy.models import DrugModel, DrugStockModel, DrugStockOutModel, DrugTransferModel
+
+# Differences below this are float noise, not drift
+TOLERANCE = 0.001
+
+
+class StockDrift(namedtuple('StockDrift', 'drug store_quantity pharmacy_quantity expected_store expected_pharmacy')):
+    """A drug whose counters (as found) differ from the quantities its records add up to"""
+
+    @property
+    def store_drift(self):
+        return self.store_quantity - self.expected_store
+
+    @property
+    def pharmacy_drift(self):
+        return self.pharmacy_quantity - self.expected_pharmacy
+
+
+def _ledger_sum(queryset, field):
+    """Correlated subquery summing field over the queryset's rows of the outer drug, or 0"""
+    total = queryset.filter(drug=OuterRef('pk')).order_by().values('drug').annotate(total=Sum(field)).values('total')
+    return Coalesce(Subquery(total, output_field=FloatField()), Value(0.0), output_field=FloatField())
+
+
+def with_ledger(drugs):
+    """The drugs annotated with stock_left, bought_pharmacy, transferred and out_pharmacy"""
+    return drugs.annotate(
+        stock_left=_ledger_sum(DrugStockModel.objects.all(), 'quantity_left'),
+        bought_pharmacy=_ledger_sum(DrugStockModel.objects.filter(location='pharmacy'), 'quantity_bought'),
+        transferred=_ledger_sum(DrugTransferModel.objects.all(), 'quantity'),
+        out_pharmacy=_ledger_sum(DrugStockOutModel.objects.filter(location_reduced_from='pharmacy'), 'quantity'),
+    )
+
+
+def expected_quantities(drug):
+    """(store, pharmacy) a drug annotated by with_ledger() should have"""
+    total = max(drug.stock_left, 0)
+    pharmacy = min(max(drug.bought_pharmacy + drug.transferred - drug.out_pharmacy, 0), total)
+    return total - pharmacy, pharmacy
+
+
+def find_drift(drugs=None, tolerance=TOLERANCE):
+    """StockDrift for every drug (of the given queryset) whose counters are off by more than tolerance"""
+    if drugs is None:
+        drugs = DrugModel.objects.all()
+    drifts = []
+    for drug in with_ledger(drugs.select_related('formulation__generic_drug')).order_by('pk'):
+        store, pharmacy = expected_quantities(drug)
+        if abs(drug.store_quantity - store) > tolerance or abs(drug.pharmacy_quantity - pharmacy) > tolerance:
+            drifts.append(StockDrift(drug, drug.store_quantity, drug.pharmacy_quantity, store, pharmacy))
+    return drifts
+
+
+def repair(drug_ids=None, tolerance=TOLERANCE):
+    """
+    Set the counters of the drifted drugs (all, or those with the given ids)
+    to their expected quantities. Returns the StockDrift list that was fixed.
+    """
+    drugs = DrugModel.objects.all()
+    if drug_ids is not None:
+        drugs = drugs.filter(pk__in=drug_ids)
+    with transaction.atomic():
+        # Lock first so no dispense changes the counters between reading and writing them
+        list(drugs.select_for_update().order_by('pk').values_list('pk', flat=True))
+        drifts = find_drift(drugs, tolerance)
+        updated_at = timezone.now()
+        for drift in drifts:
+            drift.drug.store_quantity = drift.expected_store
+            drift.drug.pharmacy_quantity = drift.expected_pharmacy
+            drift.drug.updated_at = updated_at
+        DrugModel.objects.bulk_update(
+            [drift.drug for drift in drifts], ['store_quantity', 'pharmacy_quantity', 'updated_at'], batch_size=1000
+        )
+        # bulk_update sends no post_save, so refresh the drugs' catalog entries here
+        index_items('drug', [drift.drug.pk for drift in drifts])
+        transaction.on_commit(analytics.invalidate)
+    return drifts
@@ -1,6 +1,11 @@
-from django.db.models.signals import post_save
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
-from pharmacy.models import DrugStockModel
+from pharmacy import analytics, expiry
+from pharmacy.models import (
+    DrugCategoryModel, DrugModel, DrugOrderModel, DrugStockModel, DrugStockOutModel, DrugTransferModel,
+    ManufacturerModel,
+)
 
 
 @receiver(post_save, sender=DrugStockModel)
@@ -25,3 +30,30 @@ def update_drug_selling_price_on_stock_creation(sender, instance, created, **kwa
             # Use update_fields to be more efficient and to avoid triggering
             # other potential signals on the DrugModel unnecessarily.
             drug.save(update_fields=['selling_price'])
+
+
+@receiver(post_save, sender=DrugStockOutModel)
+@receiver(post_delete, sender=DrugStockOutModel)
+@receiver(post_save, sender=DrugStockModel)
+@receiver(post_delete, sender=DrugStockModel)
+@receiver(post_save, sender=DrugTransferModel)
+@receiver(post_delete, sender=DrugTransferModel)
+@receiver(post_save, sender=DrugModel)
+@receiver(post_delete, sender=DrugModel)
+@receiver(post_save, sender=DrugOrderModel)
+@receiver(post_delete, sender=DrugOrderModel)
+@receiver(post_save, sender=DrugCategoryModel)
+@receiver(post_delete, sender=DrugCategoryModel)
+@receiver(post_save, sender=ManufacturerModel)
+@receiver(post_delete, sender=ManufacturerModel)
+def invalidate_pharmacy_analytics(sender, **kwargs):
+    """Recompute the dashboard analytics once a stock movement, drug, order, category or manufacturer change is committed"""
+    transaction.on_commit(analytics.invalidate)
+
+
+@receiver(post_save, sender=DrugStockModel)
+def refresh_stock_expiry(sender, instance, raw=False, **kwargs):
+    """Keep the entry's expiry bucket current until the next nightly sweep"""
+    if raw:
+        return
+    expiry.refresh_stock(instance)
@@ -73,11 +73,13 @@ urlpatterns = [
     path('import/create', DrugImportLogCreateView.as_view(), name='drug_import_log_create'),
     path('import/index', DrugImportLogListView.as_view(), name='drug_import_log_index'),
     path('import/<int:pk>/detail', DrugImportLogDetailView.as_view(), name='drug_import_log_detail'),
+    path('import/<int:pk>/status', drug_import_log_status_view, name='drug_import_log_status'),
 
     # 13: Dashboard and Reports URLs
     path('dashboard/', pharmacy_dashboard, name='pharmacy_dashboard'),
     path('dashboard/print/', pharmacy_dashboard_print, name='pharmacy_dashboard_print'),
     path('reports/stock/', StockReportView.as_view(), name='stock_report'),
+    path('reports/stock-drift/', StockDriftReportView.as_view(), name='drug_stock_drift'),
 
     # 14: AJAX and API URLs
     path('ajax/quick-transfer/', quick_transfer_view, name='quick_transfer'),
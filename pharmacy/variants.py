@@ -0,0 +1,205 @@
+"""
+Drug template variants.
+
+A DrugTemplateModel lists manufacturer / strength / form combinations of one
+generic drug. plan_variants() works out, without writing anything, what
+processing the template would do to every combination:
+
+    new       a drug is created (with its manufacturer and formulation when
+              those do not exist yet)
+    exists    the formulation already has a drug from that manufacturer
+    duplicate an earlier combination of the template makes the same drug
+    invalid   the combination is incomplete or names an unknown form
+
+Existing manufacturers, formulations, drugs and SKUs are read once into
+maps and sets, so the plan costs a handful of queries however many
+combinations the template has; SKUs are made unique against that set
+instead of probing the database per candidate. The process page shows the
+plan as a preview, and create_variants() writes the new rows of a plan with
+one bulk_create per model.
+"""
+from collections import namedtuple
+
+from django.db import transaction
+from django.utils import timezone
+
+from admin_site.catalog import reindex_items
+from pharmacy import analytics
+from pharmacy.models import DrugFormulationModel, DrugModel, GenericDrugModel, ManufacturerModel
+
+NEW = 'new'
+EXISTS = 'exists'
+DUPLICATE = 'duplicate'
+INVALID = 'invalid'
+
+FORM_TYPES = dict(DrugFormulationModel.FORM_CHOICES)
+
+# index: position in the template's drug_combinations
+# new_manufacturer / new_formulation: the row is created along with the drug
+Variant = namedtuple(
+    'Variant', 'index combination status manufacturer form strength sku new_manufacturer new_formulation error'
+)
+
+
+class VariantPlan(namedtuple('VariantPlan', 'template generic_drug variants')):
+    """What processing a template would create; generic_drug is None when it would be created too"""
+
+    def with_status(self, status):
+        return [variant for variant in self.variants if variant.status == status]
+
+    @property
+    def new(self):
+        return self.with_status(NEW)
+
+    @property
+    def errors(self):
+        return [f'Combination {variant.index + 1}: {variant.error}' for variant in self.with_status(INVALID)]
+
+    @property
+    def summary(self):
+        return {
+            'new': len(self.new),
+            'exists': len(self.with_status(EXISTS)),
+            'duplicate': len(self.with_status(DUPLICATE)),
+            'invalid': len(self.with_status(INVALID)),
+            'new_manufacturers': len({variant.manufacturer.lower() for variant in self.new if variant.new_manufacturer}),
+            'new_formulations': len({
+                (variant.form, variant.strength.lower()) for variant in self.new if variant.new_formulation
+            }),
+        }
+
+
+def _text(value):
+    return ' '.join(str(value or '').split())
+
+
+def sku_base(generic_name, strength, form, manufacturer):
+    return f"{generic_name[:3].upper()}-{strength}-{form[:3].upper()}-{manufacturer[:3].upper()}"
+
+
+def plan_variants(template, selected_indices=None):
+    """VariantPlan for the template's combinations (only the selected indices when given)"""
+    combinations = template.drug_combinations or []
+    indices = range(len(combinations)) if not selected_indices else selected_indices
+
+    generic_drug = GenericDrugModel.objects.filter(generic_name__iexact=template.generic_name).first()
+    manufacturers = {name.lower(): pk for pk, name in ManufacturerModel.objects.values_list('pk', 'name')}
+    formulations = {}
+    drugs = set()
+    if generic_drug:
+        formulations = {
+            (form_type, strength.lower()): pk
+            for pk, form_type, strength in generic_drug.formulations.values_list('pk', 'form_type', 'strength')
+        }
+        drugs = set(DrugModel.objects.filter(formulation__generic_drug=generic_drug).values_list(
+            'formulation_id', 'manufacturer_id'
+        ))
+    # Every generated SKU starts with the first three letters of the generic name
+    skus = set(DrugModel.objects.filter(
+        sku__istartswith=f'{template.generic_name[:3]}-'
+    ).values_list('sku', flat=True))
+
+    variants = []
+    planned = set()
+    for index in indices:
+        if not 0 <= index < len(combinations):
+            variants.append(Variant(index, None, INVALID, '', '', '', '', False, False, 'No such combination'))
+            continue
+        combination = combinations[index]
+        values = combination if isinstance(combination, dict) else {}
+        manufacturer = _text(values.get('manufacturer'))
+        form = _text(values.get('form')).lower()
+        strength = _text(values.get('strength'))
+
+        error = ''
+        if not (manufacturer and form and strength):
+            error = 'needs a manufacturer, form and strength'
+        elif form not in FORM_TYPES:
+            error = f'unknown form "{form}"'
+        if error:
+            variants.append(Variant(index, combination, INVALID, manufacturer, form, strength, '', False, False, error))
+            continue
+
+        manufacturer_id = manufacturers.get(manufacturer.lower())
+        formulation_id = formulations.get((form, strength.lower()))
+        key = (manufacturer.lower(), form, strength.lower())
+        if key in planned:
+            status = DUPLICATE
+        elif manufacturer_id and formulation_id and (formulation_id, manufacturer_id) in drugs:
+            status = EXISTS
+        else:
+            status = NEW
+        planned.add(key)
+
+        sku = ''
+        if status == NEW:
+            base = sku_base(template.generic_name, strength, form, manufacturer)
+            sku, counter = base, 1
+            while sku in skus:
+                sku = f'{base}-{counter}'
+                counter += 1
+            skus.add(sku)
+        variants.append(Variant(
+            index, combination, status, manufacturer, form, strength, sku,
+            manufacturer_id is None, formulation_id is None, '',
+        ))
+    return VariantPlan(template, generic_drug, variants)
+
+
+def create_variants(plan):
+    """
+    Create the drugs (and missing generic drug, manufacturers and
+    formulations) of a plan's new variants and mark its template processed.
+    Returns the drugs created.
+    """
+    template = plan.template
+    new = plan.new
+    with transaction.atomic():
+        generic_drug = plan.generic_drug
+        if generic_drug is None:
+            generic_drug, _ = GenericDrugModel.objects.get_or_create(
+                generic_name=template.generic_name,
+                defaults={'category': template.category, 'is_prescription_only': template.is_prescription},
+            )
+
+        names = {variant.manufacturer.lower(): variant.manufacturer for variant in new if variant.new_manufacturer}
+        ManufacturerModel.objects.bulk_create(
+            [ManufacturerModel(name=name) for name in names.values()], ignore_conflicts=True
+        )
+        # Matched without case, like plan_variants(): "pfizer" in the template is the existing "Pfizer"
+        manufacturers = {name.lower(): pk for pk, name in ManufacturerModel.objects.values_list('pk', 'name')}
+
+        strengths = {(variant.form, variant.strength.lower()): variant.strength for variant in new}
+        DrugFormulationModel.objects.bulk_create([
+            DrugFormulationModel(generic_drug=generic_drug, form_type=form, strength=strength)
+            for (form, _), strength in strengths.items()
+        ], ignore_conflicts=True)
+        formulations = {
+            (form_type, strength.lower()): pk
+            for pk, form_type, strength in generic_drug.formulations.values_list('pk', 'form_type', 'strength')
+        }
+
+        DrugModel.objects.bulk_create([
+            DrugModel(
+                formulation_id=formulations[variant.form, variant.strength.lower()],
+                manufacturer_id=manufacturers[variant.manufacturer.lower()],
+                sku=variant.sku,
+                # the model has no default price; the pharmacist sets it after creation
+                selling_price=0,
+            )
+            for variant in new
+        ], ignore_conflicts=True)
+        # ignore_conflicts leaves the objects without ids: read the drugs back by their SKUs
+        created = list(DrugModel.objects.filter(
+            formulation__generic_drug=generic_drug, sku__in=[variant.sku for variant in new]
+        ).select_related('formulation__generic_drug', 'manufacturer'))
+
+        template.is_processed = True
+        template.drugs_created_count = len(created)
+        template.processed_at = timezone.now()
+        template.save(update_fields=['is_processed', 'drugs_created_count', 'processed_at'])
+
+        # bulk_create sends no post_save, so add the drugs to the catalog and refresh the dashboard here
+        reindex_items('drug', [drug.pk for drug in created])
+        transaction.on_commit(analytics.invalidate)
+    return created
@@ -1,7 +1,8 @@
 import logging
 import json
+from collections import defaultdict
 from decimal import Decimal
-from datetime import date, datetime, timedelta
+from datetime import date, datetime
 from types import SimpleNamespace
 
 from django import forms
@@ -9,10 +10,11 @@ from django.contrib import messages
 from django.contrib.auth.decorators import login_required, permission_required
 from django.contrib.auth.mixins import LoginRequiredMixin, PermissionRequiredMixin
 from django.contrib.auth.models import User
+from django.core.exceptions import PermissionDenied
 from django.core.paginator import Paginator
 from django.db import IntegrityError, transaction
-from django.db.models import Q, Sum, F, Count, ExpressionWrapper, DecimalField
-from django.db.models.functions import Lower, Cast
+from django.db.models import Q, Sum, F, Count
+from django.db.models.functions import Lower
 from django.forms import modelformset_factory
 from django.http import JsonResponse, HttpResponse, Http404, HttpResponseRedirect
 from django.shortcuts import render, redirect, get_object_or_404
@@ -25,11 +27,19 @@ from django.views.generic import (
     CreateView, ListView, UpdateView, DeleteView, DetailView, TemplateView
 )
 
+from admin_site.catalog import reindex_items
+from admin_site.report_jobs import queue_task
 from finance.models import PatientTransactionModel
 from finance.views import _quantize_money
 from insurance.claim_helpers import get_orders_with_claim_info
 from insurance.models import PatientInsuranceModel
 from patient.models import PatientModel, PatientWalletModel
+from patient.search import get_patient_by_card
+from pharmacy import analytics
+from pharmacy.analytics import get_analytics
+from pharmacy.dispensing import InsufficientStock, StockLine, reduce_stock
+from pharmacy.expiry import expired_stock, expiring_stock
+from pharmacy.reconciliation import find_drift, repair
 from pharmacy.forms import (
     DrugCategoryForm, GenericDrugForm, DrugFormulationForm, ManufacturerForm,
     DrugForm, DrugBatchForm, DrugStockForm, DrugStockOutForm, DrugTransferForm,
@@ -66,23 +76,13 @@ def get_low_stock_drugs():
 
 
 def get_expired_stock():
-    """Get expired stock entries"""
-    return DrugStockModel.objects.filter(
-        expiry_date__lte=date.today(),
-        status='active',
-        quantity_left__gt=0
-    )
+    """Get expired stock entries (from the precomputed expiry buckets)"""
+    return expired_stock()
 
 
 def get_near_expiry_stock(days=30):
-    """Get stock entries expiring within specified days"""
-    future_date = date.today() + timedelta(days=days)
-    return DrugStockModel.objects.filter(
-        expiry_date__lte=future_date,
-        expiry_date__gt=date.today(),
-        status='active',
-        quantity_left__gt=0
-    )
+    """Get stock entries expiring within specified days (from the precomputed expiry buckets)"""
+    return expiring_stock(days)
 
 
 # -------------------------
@@ -1015,73 +1015,13 @@ class DrugStockOutView(LoginRequiredMixin, PermissionRequiredMixin, View):
 
         # Perform FIFO stock reduction
         try:
-            with transaction.atomic():
-                self.process_stock_reduction(drug, quantity_to_reduce, location, reason, remark, request.user)
-                messages.success(request, self.success_message)
+            reduce_stock([StockLine(drug.pk, quantity_to_reduce, location, reason, remark)], user=request.user)
+            messages.success(request, self.success_message)
         except Exception as e:
             messages.error(request, f"Error processing stock reduction: {str(e)}")
 
         return self.redirect_back(drug)
 
-    def process_stock_reduction(self, drug, quantity_to_reduce, location, reason, remark, user):
-        """Process stock reduction using FIFO logic"""
-        remaining_to_reduce = quantity_to_reduce
-
-        # Get active stocks for this drug in FIFO order (oldest first)
-        active_stocks = DrugStockModel.objects.filter(
-            drug=drug,
-            status='active',
-            quantity_left__gt=0
-        ).order_by('date_added')
-
-        if not active_stocks.exists():
-            raise ValueError("No active stocks found for this drug")
-
-        stock_outs_created = []
-
-        # Process each stock in FIFO order
-        for stock in active_stocks:
-            if remaining_to_reduce <= 0:
-                break
-
-            # Calculate how much to deduct from this stock
-            quantity_from_this_stock = min(remaining_to_reduce, stock.quantity_left)
-
-            # Create stock out record
-            stock_out = DrugStockOutModel.objects.create(
-                stock=stock,
-                drug=drug,
-                quantity=quantity_from_this_stock,
-                reason=reason,
-                location_reduced_from=location,
-                worth=stock.selling_price * Decimal(str(quantity_from_this_stock)),
-                remark=remark,
-                created_by=user
-            )
-            stock_outs_created.append(stock_out)
-
-            # Update stock quantity and worth
-            stock.quantity_left -= quantity_from_this_stock
-            stock.current_worth = Decimal(str(stock.quantity_left)) * stock.selling_price
-            stock.save()
-
-            # Update remaining quantity to reduce
-            remaining_to_reduce -= quantity_from_this_stock
-
-        # Update drug quantities based on location
-        if location == 'store':
-            drug.store_quantity -= quantity_to_reduce
-        else:
-            drug.pharmacy_quantity -= quantity_to_reduce
-
-        drug.save()
-
-        # If we couldn't fulfill the entire request (shouldn't happen due to validation)
-        if remaining_to_reduce > 0:
-            raise ValueError(f"Could not fulfill complete request. {remaining_to_reduce} units remaining.")
-
-        return stock_outs_created
-
     def redirect_back(self, drug):
         """Redirect back to appropriate page"""
         # You can customize this based on where you want to redirect
@@ -1329,7 +1269,11 @@ class DrugImportLogCreateView(
             form.instance.imported_by = getattr(self.request, 'user', None)
         except Exception:
             logger.exception("Failed to set imported_by on import form_valid")
-        return super().form_valid(form)
+        response = super().form_valid(form)
+        # Large files take minutes: the report worker runs the import and the detail page polls its counters
+        queue_task('drug_import', {'log_id': self.object.pk}, self.request.user)
+        messages.success(self.request, self.success_message)
+        return response
 
 
 class DrugImportLogListView(LoginRequiredMixin, PermissionRequiredMixin, PharmacyContextMixin, ListView):
@@ -1366,6 +1310,23 @@ class DrugImportLogDetailView(LoginRequiredMixin, PermissionRequiredMixin, Pharm
         return context
 
 
+@login_required
+@permission_required('pharmacy.view_drugimportlogmodel', raise_exception=True)
+def drug_import_log_status_view(request, pk):
+    """Progress of an import, polled by the detail page while the report worker runs it"""
+    import_log = get_object_or_404(DrugImportLogModel, pk=pk)
+    return JsonResponse({
+        'status': import_log.status,
+        'total_records': import_log.total_records,
+        'successful_records': import_log.successful_records,
+        'failed_records': import_log.failed_records,
+        'success_rate': round(
+            import_log.successful_records / import_log.total_records * 100, 1
+        ) if import_log.total_records > 0 else 0,
+        'error_lines': import_log.error_log.split('\n') if import_log.error_log else [],
+    })
+
+
 # -------------------------
 # Dashboard and Reports Views
 # -------------------------
@@ -1455,23 +1416,11 @@ class StockReportView(LoginRequiredMixin, PermissionRequiredMixin, PharmacyConte
                 context['report_title'] = 'Low Stock Report'
 
             elif report_type == 'expired':
-                expired_stock_ids = DrugStockModel.objects.filter(
-                    expiry_date__lte=date.today(),
-                    status='active',
-                    quantity_left__gt=0
-                ).values_list('drug_id', flat=True)
-                queryset = queryset.filter(id__in=expired_stock_ids)
+                queryset = queryset.filter(id__in=get_expired_stock().values('drug_id'))
                 context['report_title'] = 'Expired Stock Report'
 
             elif report_type == 'near_expiry':
-                future_date = date.today() + timedelta(days=30)
-                near_expiry_stock_ids = DrugStockModel.objects.filter(
-                    expiry_date__lte=future_date,
-                    expiry_date__gt=date.today(),
-                    status='active',
-                    quantity_left__gt=0
-                ).values_list('drug_id', flat=True)
-                queryset = queryset.filter(id__in=near_expiry_stock_ids)
+                queryset = queryset.filter(id__in=get_near_expiry_stock().values('drug_id'))
                 context['report_title'] = 'Near Expiry Stock Report'
 
             elif report_type == 'inventory_value':
@@ -1488,6 +1437,36 @@ class StockReportView(LoginRequiredMixin, PermissionRequiredMixin, PharmacyConte
         return context
 
 
+class StockDriftReportView(LoginRequiredMixin, PermissionRequiredMixin, PharmacyContextMixin, TemplateView):
+    """Drugs whose store/pharmacy quantities differ from their stock records, with a repair action"""
+    permission_required = 'pharmacy.view_drugstockmodel'
+    template_name = 'pharmacy/stock/drift.html'
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        drifts = find_drift()
+        context.update({
+            'title': 'Stock Drift Report',
+            'drifts': drifts,
+            'total_store_drift': sum(drift.store_drift for drift in drifts),
+            'total_pharmacy_drift': sum(drift.pharmacy_drift for drift in drifts),
+        })
+        return context
+
+    def post(self, request):
+        if not request.user.has_perm('pharmacy.change_drugmodel'):
+            raise PermissionDenied
+        drug_ids = request.POST.getlist('drug_ids') or None
+        try:
+            repaired = repair(drug_ids)
+        except Exception as e:
+            logger.exception("Error repairing drug stock quantities.")
+            messages.error(request, f"Error repairing stock quantities: {str(e)}")
+        else:
+            messages.success(request, f"Repaired the stock quantities of {len(repaired)} drug(s).")
+        return redirect('drug_stock_drift')
+
+
 # -------------------------
 # AJAX and API Views
 # -------------------------
@@ -1580,15 +1559,19 @@ def process_drug_template_view(request, pk):
     """Process a drug template to create drug variants"""
     template = get_object_or_404(DrugTemplateModel, pk=pk)
 
-    if request.method == 'POST':
+    selected_indices = request.POST.getlist('selected_combinations') or request.GET.getlist('selected_combinations')
+    try:
+        selected_indices = [int(i) for i in selected_indices]
+    except ValueError:
+        messages.error(request, 'Invalid combination selection.')
+        return redirect('drug_template_detail', pk=pk)
+
+    # A preview (GET, or POST with "preview") shows what would be created without writing anything
+    if request.method == 'POST' and 'preview' not in request.POST:
         if template.is_processed:
             messages.error(request, 'This template has already been processed.')
             return redirect('drug_template_detail', pk=pk)
 
-        selected_indices = request.POST.getlist('selected_combinations')
-        if selected_indices:
-            selected_indices = [int(i) for i in selected_indices]
-
         result = template.create_drug_variants(selected_indices)
 
         if result.get('success'):
@@ -1604,10 +1587,12 @@ def process_drug_template_view(request, pk):
 
         return redirect('drug_template_detail', pk=pk)
 
+    plan = template.plan_drug_variants(selected_indices)
     context = {
         'template': template,
-        'combinations': template.drug_combinations,
-        'preview_combinations': template.preview_combinations,
+        'variants': plan.variants,
+        'variant_summary': plan.summary,
+        'generic_drug_exists': plan.generic_drug is not None,
     }
     return render(request, 'pharmacy/template/process.html', context)
 
@@ -1624,7 +1609,12 @@ def bulk_drug_status_update_view(request):
                 new_status = form.cleaned_data['status']
 
                 drugs = DrugModel.objects.filter(id__in=drug_ids)
-                updated_count = drugs.update(is_active=new_status)
+                with transaction.atomic():
+                    updated_ids = list(drugs.values_list('pk', flat=True))
+                    updated_count = drugs.update(is_active=new_status)
+                    # update() sends no post_save: refresh the drugs' catalog entries and the dashboard here
+                    reindex_items('drug', updated_ids)
+                    transaction.on_commit(analytics.invalidate)
 
                 status_text = 'active' if new_status else 'inactive'
                 messages.success(
@@ -1697,23 +1687,22 @@ def export_stock_report_view(request):
     def generate_csv():
         yield 'Drug Name,SKU,Form,Strength,Manufacturer,Batch,Quantity Left,Unit Cost,Selling Price,Current Worth,Location,Expiry Date,Status\n'
 
-        queryset = DrugStockModel.objects.select_related(
+        if report_type == 'expired':
+            # Written off entries have nothing left but are still listed
+            queryset = get_expired_stock()
+        elif report_type == 'near_expiry':
+            queryset = get_near_expiry_stock()
+        else:
+            queryset = DrugStockModel.objects.filter(status='active', quantity_left__gt=0)
+        queryset = queryset.select_related(
             'drug__formulation__generic_drug',
             'drug__manufacturer',
             'batch'
-        ).filter(status='active', quantity_left__gt=0)
+        )
 
         if report_type == 'low_stock':
             drug_ids = get_low_stock_drugs().values_list('id', flat=True)
             queryset = queryset.filter(drug_id__in=drug_ids)
-        elif report_type == 'expired':
-            queryset = queryset.filter(expiry_date__lte=date.today())
-        elif report_type == 'near_expiry':
-            future_date = date.today() + timedelta(days=30)
-            queryset = queryset.filter(
-                expiry_date__lte=future_date,
-                expiry_date__gt=date.today()
-            )
 
         for stock in queryset.order_by('drug__formulation__generic_drug__generic_name'):
             row = [
@@ -1758,7 +1747,7 @@ def verify_patient_pharmacy_ajax(request):
         return JsonResponse({'error': 'Card number required'}, status=400)
 
     try:
-        patient = PatientModel.objects.get(card_number__iexact=card_number)
+        patient = get_patient_by_card(card_number)
 
         # Get or create wallet
         wallet, created = PatientWalletModel.objects.get_or_create(
@@ -1884,7 +1873,7 @@ def verify_patient_pharmacy_ajax(request):
 @transaction.atomic
 def process_dispense_ajax(request):
     """Process drug dispensing and/or payments with pharmacy stock management - CLAIM-BASED VERSION"""
-    from insurance.claim_helpers import calculate_patient_amount_with_claim
+    from insurance.claim_helpers import calculate_patient_amount_with_claim, resolve_claims
 
     if request.method != 'POST':
         return JsonResponse({'error': 'Method not allowed'}, status=405)
@@ -1919,13 +1908,14 @@ def process_dispense_ajax(request):
                 status='pending'
             ).select_related('drug')
 
+            claims = resolve_claims(payment_orders)
             order_details = []
             for order in payment_orders:
                 # Calculate base amount
                 base_amount = Decimal(order.drug.selling_price) * Decimal(order.quantity_ordered)
 
                 # Use claim-based calculation
-                claim_info = calculate_patient_amount_with_claim(order, base_amount)
+                claim_info = calculate_patient_amount_with_claim(order, base_amount, claims=claims)
                 patient_amount = claim_info['patient_amount']
 
                 total_payment += _quantize_money(patient_amount)
@@ -1946,15 +1936,16 @@ def process_dispense_ajax(request):
                     'shortfall': float(shortfall)
                 }, status=400)
 
-            old_balance = wallet.amount
-
             # Process payments
             for detail in order_details:
                 order = detail['order']
                 patient_amount = detail['patient_amount']
 
                 # Deduct from wallet
-                wallet.amount -= patient_amount
+                old_balance = wallet.amount
+                if patient_amount > 0:
+                    entry = wallet.debit(patient_amount, 'payment', user=request.user, description='Drug payment')
+                    old_balance = entry.balance_before
 
                 # Update order status
                 order.status = 'paid'
@@ -1977,87 +1968,19 @@ def process_dispense_ajax(request):
                     payment_method='wallet',
                     status='completed',
                 )
-                old_balance = wallet.amount  # Update for next iteration
-
-            wallet.save()
 
             # Count claims applied
             claims_count = sum(1 for d in order_details if d['has_claim'])
 
-        # Process dispensing with pharmacy stock management (unchanged)
+        # Process dispensing with pharmacy stock management
         if dispense_items:
-            for item in dispense_items:
-                order_id = item.get('order_id')
-                dispense_quantity = Decimal(str(item.get('quantity', 0)))
-
-                try:
-                    order = DrugOrderModel.objects.get(
-                        id=order_id,
-                        patient=patient,
-                        status__in=['paid', 'partially_dispensed']
-                    )
-
-                    remaining_quantity = order.remaining_to_dispense
-
-                    if dispense_quantity <= 0:
-                        continue
-
-                    if dispense_quantity > remaining_quantity:
-                        return JsonResponse({
-                            'error': f'Cannot dispense {dispense_quantity} of {order.drug.brand_name or order.drug.generic_name}. Only {remaining_quantity} remaining.'
-                        }, status=400)
-
-                    # Check if sufficient quantity in pharmacy
-                    if order.drug.pharmacy_quantity < float(dispense_quantity):
-                        return JsonResponse({
-                            'error': f'Insufficient stock in pharmacy for {order.drug.brand_name or order.drug.generic_name}. '
-                                     f'Requested: {dispense_quantity}, Available: {order.drug.pharmacy_quantity}'
-                        }, status=400)
-
-                    # Process FIFO stock reduction
-                    try:
-                        stock_outs_created = process_fifo_stock_reduction(
-                            drug=order.drug,
-                            quantity_to_reduce=float(dispense_quantity),
-                            location='pharmacy',
-                            reason='sale',
-                            remark=f'Dispensed to patient {patient.__str__() or patient.registration_id}',
-                            user=request.user
-                        )
-                    except ValueError as e:
-                        return JsonResponse({
-                            'error': f'Stock allocation error for {order.drug.brand_name or order.drug.generic_name}: {str(e)}'
-                        }, status=400)
-
-                    # Create dispense record
-                    dispense_record = DispenseRecord.objects.create(
-                        order=order,
-                        dispensed_by=request.user,
-                        dispensed_qty=dispense_quantity,
-                        notes=f'Dispensed by {request.user.__str__() or request.user.username}. '
-                              f'Stock reduced from {len(stock_outs_created)} stock entries.'
-                    )
-
-                    # Update order quantities
-                    order.quantity_dispensed += float(dispense_quantity)
-
-                    # Update dispensed_at timestamp
-                    order.dispensed_at = timezone.now()
-                    order.dispensed_by = request.user
-
-                    # Update status based on dispensing completion
-                    if order.quantity_dispensed >= order.quantity_ordered:
-                        order.status = 'dispensed'
-                    else:
-                        order.status = 'partially_dispensed'
-
-                    order.save()
-                    dispensed_count += 1
-
-                except DrugOrderModel.DoesNotExist:
-                    return JsonResponse({
-                        'error': f'Drug order {order_id} not found or not eligible for dispensing'
-                    }, status=404)
+            dispensed_count = _dispense_orders(
+                dispense_items,
+                DrugOrderModel.objects.filter(patient=patient, status__in=['paid', 'partially_dispensed']),
+                request.user,
+                remark=lambda order: f'Dispensed to patient {patient.__str__() or patient.registration_id}',
+                notes_prefix='Dispensed by',
+            )
 
         # Build success message
         messages = []
@@ -2076,71 +1999,91 @@ def process_dispense_ajax(request):
             'formatted_balance': f'₦{wallet.amount:,.2f}'
         })
 
+    except DispenseError as e:
+        return JsonResponse({'error': str(e)}, status=e.status)
     except Exception as e:
         return JsonResponse({
             'error': f'Error processing request: {str(e)}'
         }, status=500)
 
 
-def process_fifo_stock_reduction(drug, quantity_to_reduce, location, reason, remark, user):
-    """
-    Process FIFO stock reduction logic for dispensing
-    Returns list of DrugStockOutModel objects created
-    """
-    from decimal import Decimal
-
-    remaining_to_reduce = quantity_to_reduce
-
-    # Get active stocks for this drug in FIFO order (oldest first)
-    active_stocks = DrugStockModel.objects.filter(
-        drug=drug,
-        status='active',
-        quantity_left__gt=0
-    ).order_by('date_added')
+class DispenseError(Exception):
+    """A dispense request that cannot be carried out; the message is shown to the user"""
 
-    if not active_stocks.exists():
-        raise ValueError("No active stocks available for this drug")
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
 
-    stock_outs_created = []
 
-    # Process each stock in FIFO order
-    for stock in active_stocks:
-        if remaining_to_reduce <= 0:
-            break
+def _dispense_orders(dispense_items, orders, user, remark, notes_prefix):
+    """
+    Dispense the {'order_id', 'quantity'} items from pharmacy stock. Orders
+    are looked up in the given queryset (the eligible ones) with one query,
+    every item is checked first and the stock of all the drugs is then reduced
+    in a single FIFO pass (pharmacy.dispensing), so an item that cannot be
+    filled leaves the others undispensed. remark(order) is recorded on the
+    stock outs. Returns the number of items dispensed; raises DispenseError.
+    """
+    orders = {
+        str(order.pk): order
+        for order in orders.filter(pk__in=[item.get('order_id') for item in dispense_items]).select_related('drug')
+    }
 
-        # Calculate how much to deduct from this stock
-        quantity_from_this_stock = min(remaining_to_reduce, stock.quantity_left)
+    items = []
+    pending = defaultdict(Decimal)
+    for item in dispense_items:
+        order_id = item.get('order_id')
+        order = orders.get(str(order_id))
+        if order is None:
+            raise DispenseError(f'Drug order {order_id} not found or not eligible for dispensing', status=404)
+
+        dispense_quantity = Decimal(str(item.get('quantity', 0)))
+        if dispense_quantity <= 0:
+            continue
+
+        drug_name = order.drug.brand_name or order.drug.generic_name
+        remaining_quantity = Decimal(str(order.remaining_to_dispense)) - pending[order.pk]
+        if dispense_quantity > remaining_quantity:
+            raise DispenseError(
+                f'Cannot dispense {dispense_quantity} of {drug_name}. Only {remaining_quantity} remaining.'
+            )
+        pending[order.pk] += dispense_quantity
+        items.append((order, dispense_quantity))
 
-        # Create stock out record
-        stock_out = DrugStockOutModel.objects.create(
-            stock=stock,
-            drug=drug,
-            quantity=quantity_from_this_stock,
-            reason=reason,
-            location_reduced_from=location,
-            worth=stock.selling_price * Decimal(str(quantity_from_this_stock)),
-            remark=remark,
-            created_by=user
+    try:
+        stock_outs = reduce_stock(
+            [StockLine(order.drug_id, float(quantity), 'pharmacy', 'sale', remark(order)) for order, quantity in items],
+            user=user,
+        )
+    except InsufficientStock as e:
+        drug = next(order.drug for order, _ in items if order.drug_id == e.drug_id)
+        raise DispenseError(
+            f'Insufficient stock in pharmacy for {drug.brand_name or drug.generic_name}. '
+            f'Requested: {e.requested}, Available: {e.available}'
         )
-        stock_outs_created.append(stock_out)
-
-        # Update stock quantity and worth
-        stock.quantity_left -= quantity_from_this_stock
-        stock.current_worth = Decimal(str(stock.quantity_left)) * stock.selling_price
-        stock.save()
-
-        # Update remaining quantity to reduce
-        remaining_to_reduce -= quantity_from_this_stock
 
-    # Update drug pharmacy quantity
-    drug.pharmacy_quantity -= quantity_to_reduce
-    drug.save()
+    dispensed_at = timezone.now()
+    for (order, dispense_quantity), drawn in zip(items, stock_outs):
+        DispenseRecord.objects.create(
+            order=order,
+            dispensed_by=user,
+            dispensed_qty=dispense_quantity,
+            notes=f'{notes_prefix} {user.__str__() or user.username}. '
+                  f'Stock reduced from {len(drawn)} stock entries.'
+        )
 
-    # If we couldn't fulfill the entire request (shouldn't happen due to validation)
-    if remaining_to_reduce > 0:
-        raise ValueError(f"Could not fulfill complete request. {remaining_to_reduce} units remaining.")
+        # Update order quantities, timestamp and status
+        order.quantity_dispensed += float(dispense_quantity)
+        order.dispensed_at = dispensed_at
+        order.dispensed_by = user
+        if order.quantity_dispensed >= order.quantity_ordered:
+            order.status = 'dispensed'
+        else:
+            order.status = 'partially_dispensed'
 
-    return stock_outs_created
+    for order in {order.pk: order for order, _ in items}.values():
+        order.save()
+    return len(items)
 
 
 @login_required
@@ -2288,318 +2231,53 @@ def patient_dispense_view(request, patient_id):
     return render(request, "pharmacy/dispense/patient_index.html", context)
 
 
-def calculate_growth_percentage(current, previous):
-    """Calculate growth percentage between two values"""
-    if previous == 0:
-        return 100 if current > 0 else 0
-    return round(((current - previous) / previous) * 100, 1)
-
-
-def get_low_stock_alerts():
-    """Get drugs that are below minimum stock level"""
-    return DrugModel.objects.filter(
-        Q(store_quantity__lte=F('minimum_stock_level')) |
-        Q(pharmacy_quantity__lte=F('minimum_stock_level'))
-    ).select_related('formulation__generic_drug', 'manufacturer')
-
-
-def get_expired_drugs():
-    """Get expired drug stocks"""
-    today = timezone.now().date()
-    return DrugStockModel.objects.filter(
-        expiry_date__lte=today,
-        status='active',
-        quantity_left__gt=0
-    ).select_related('drug__formulation__generic_drug')
-
-
-def get_near_expiry_drugs(days=30):
-    """Get drugs expiring within specified days"""
-    near_expiry_date = timezone.now().date() + timedelta(days=days)
-    return DrugStockModel.objects.filter(
-        expiry_date__lte=near_expiry_date,
-        expiry_date__gt=timezone.now().date(),
-        status='active',
-        quantity_left__gt=0
-    ).select_related('drug__formulation__generic_drug')
-
-
-def get_sales_chart_data(days=7):
-    """Get daily sales data for the last N days"""
-    end_date = timezone.now().date()
-    start_date = end_date - timedelta(days=days - 1)
-
-    sales_data = []
-    for i in range(days):
-        current_date = start_date + timedelta(days=i)
-
-        # Sales (stock outs with reason='sale')
-        daily_sales = DrugStockOutModel.objects.filter(
-            created_at__date=current_date,
-            reason='sale'
-        ).aggregate(
-            total_quantity=Sum('quantity'),
-            total_worth=Sum('worth')
-        )
-
-        # Orders completed
-        daily_orders = DrugOrderModel.objects.filter(
-            dispensed_at__date=current_date,
-            status='dispensed'
-        ).count()
-
-        sales_data.append({
-            'date': current_date.strftime('%Y-%m-%d'),
-            'sales_quantity': float(daily_sales['total_quantity'] or 0),
-            'sales_worth': float(daily_sales['total_worth'] or 0),
-            'orders_completed': daily_orders
-        })
-
-    return sales_data
-
-
-def get_category_distribution():
-    """Get drug distribution by category"""
-    categories = DrugCategoryModel.objects.annotate(
-        drug_count=Count('generic_drugs__formulations__products'),
-        total_stock=Sum('generic_drugs__formulations__products__store_quantity') +
-                    Sum('generic_drugs__formulations__products__pharmacy_quantity')
-    ).filter(drug_count__gt=0)
-
-    return [
-        {
-            'name': category.name,
-            'value': category.drug_count,
-            'stock': float(category.total_stock or 0)
-        }
-        for category in categories
-    ]
-
-
-def get_top_selling_drugs(limit=10):
-    """Get top selling drugs by quantity"""
-    return DrugStockOutModel.objects.filter(
-        reason='sale',
-        created_at__gte=timezone.now() - timedelta(days=30)
-    ).values(
-        'drug__formulation__generic_drug__generic_name',
-        'drug__brand_name'
-    ).annotate(
-        total_sold=Sum('quantity'),
-        total_revenue=Sum('worth')
-    ).order_by('-total_sold')[:limit]
-
-
-def get_inventory_value():
-    """Calculate total inventory value from DrugModel aggregated quantities."""
-
-    # choose precision that fits your data; adjust if you expect larger totals or more decimals
-    DECIMAL_MAX_DIGITS = 18
-    DECIMAL_DECIMAL_PLACES = 2
-    DECIMAL_OUTPUT = DecimalField(max_digits=DECIMAL_MAX_DIGITS, decimal_places=DECIMAL_DECIMAL_PLACES)
-
-    # Cast the float quantity to Decimal and multiply by the Decimal selling_price
-    store_price_expr = ExpressionWrapper(
-        Cast(F('store_quantity'), output_field=DECIMAL_OUTPUT) * F('selling_price'),
-        output_field=DECIMAL_OUTPUT
-    )
-
-    pharmacy_price_expr = ExpressionWrapper(
-        Cast(F('pharmacy_quantity'), output_field=DECIMAL_OUTPUT) * F('selling_price'),
-        output_field=DECIMAL_OUTPUT
-    )
-
-    qs = DrugModel.objects.filter(is_active=True)
-
-    store_value = qs.aggregate(total=Sum(store_price_expr))['total'] or Decimal('0.00')
-    pharmacy_value = qs.aggregate(total=Sum(pharmacy_price_expr))['total'] or Decimal('0.00')
-
-    total_value = store_value + pharmacy_value
-
-    # return floats for compatibility with existing code; keep Decimal if you prefer precision
-    return {
-        'store_value': float(store_value),
-        'pharmacy_value': float(pharmacy_value),
-        'total_value': float(total_value)
-    }
-
-
-def get_monthly_trends(months=12):
-    """Get monthly trends for sales and stock movements"""
-    end_date = timezone.now().date()
-    start_date = end_date.replace(day=1) - timedelta(days=30 * (months - 1))
-
-    monthly_data = []
-    current_date = start_date
-
-    while current_date <= end_date:
-        month_start = current_date.replace(day=1)
-        if month_start.month == 12:
-            month_end = month_start.replace(year=month_start.year + 1, month=1, day=1) - timedelta(days=1)
-        else:
-            month_end = month_start.replace(month=month_start.month + 1, day=1) - timedelta(days=1)
-
-        # Sales data
-        monthly_sales = DrugStockOutModel.objects.filter(
-            created_at__date__gte=month_start,
-            created_at__date__lte=month_end,
-            reason='sale'
-        ).aggregate(
-            total_quantity=Sum('quantity'),
-            total_revenue=Sum('worth')
-        )
-
-        # Stock additions
-        monthly_additions = DrugStockModel.objects.filter(
-            date_added__gte=month_start,
-            date_added__lte=month_end
-        ).aggregate(
-            total_added=Sum('quantity_bought')
-        )
-
-        monthly_data.append({
-            'month': month_start.strftime('%b %Y'),
-            'sales_quantity': float(monthly_sales['total_quantity'] or 0),
-            'sales_revenue': float(monthly_sales['total_revenue'] or 0),
-            'stock_added': float(monthly_additions['total_added'] or 0)
-        })
-
-        # Move to next month
-        if current_date.month == 12:
-            current_date = current_date.replace(year=current_date.year + 1, month=1)
-        else:
-            current_date = current_date.replace(month=current_date.month + 1)
-
-    return monthly_data
-
-
 def get_pharmacy_dashboard_context(request):
-    """Get comprehensive pharmacy dashboard context"""
-    today = timezone.now().date()
-    week_start = today - timedelta(days=today.weekday())
-    month_start = today.replace(day=1)
-
-    # Basic inventory statistics
-    total_drugs = DrugModel.objects.filter(is_active=True).count()
-    total_categories = DrugCategoryModel.objects.count()
-    total_manufacturers = ManufacturerModel.objects.count()
-
-    # Stock statistics
-    total_stock_items = DrugStockModel.objects.filter(status='active').count()
-    low_stock_count = get_low_stock_alerts().count()
-    expired_count = get_expired_drugs().count()
-    near_expiry_count = get_near_expiry_drugs().count()
-
-    # Inventory values
-    inventory_values = get_inventory_value()
-
-    # Sales statistics
-    today_sales = DrugStockOutModel.objects.filter(
-        created_at__date=today,
-        reason='sale'
-    ).aggregate(
-        quantity=Sum('quantity'),
-        revenue=Sum('worth')
-    )
-
-    week_sales = DrugStockOutModel.objects.filter(
-        created_at__date__gte=week_start,
-        reason='sale'
-    ).aggregate(
-        quantity=Sum('quantity'),
-        revenue=Sum('worth')
-    )
-
-    month_sales = DrugStockOutModel.objects.filter(
-        created_at__date__gte=month_start,
-        reason='sale'
-    ).aggregate(
-        quantity=Sum('quantity'),
-        revenue=Sum('worth')
-    )
-
-    # Order statistics
-    pending_orders = DrugOrderModel.objects.filter(status='pending').count()
-    today_orders_completed = DrugOrderModel.objects.filter(
-        dispensed_at__date=today,
-        status='dispensed'
-    ).count()
-
-    # Recent transfers
-    recent_transfers = DrugTransferModel.objects.filter(
-        transferred_at__gte=week_start
-    ).aggregate(
-        total_quantity=Sum('quantity')
-    )['total_quantity'] or 0
-
-    # Growth calculations (compare with last month)
-    last_month_start = (month_start - timedelta(days=1)).replace(day=1)
-    last_month_end = month_start - timedelta(days=1)
-
-    last_month_sales = DrugStockOutModel.objects.filter(
-        created_at__date__gte=last_month_start,
-        created_at__date__lte=last_month_end,
-        reason='sale'
-    ).aggregate(revenue=Sum('worth'))['revenue'] or 0
-
-    revenue_growth = calculate_growth_percentage(
-        float(month_sales['revenue'] or 0),
-        float(last_month_sales)
-    )
-
-    # Chart data
-    sales_chart_data = get_sales_chart_data()
-    category_distribution = get_category_distribution()
-    monthly_trends = get_monthly_trends()
-    top_selling_drugs = list(get_top_selling_drugs())
-
-    # Recent activity
-    recent_stock_additions = DrugStockModel.objects.filter(
-        date_added__gte=week_start
-    ).select_related('drug__formulation__generic_drug').order_by('-created_at')[:5]
+    """Pharmacy dashboard context from the cached pharmacy.analytics figures"""
+    data = get_analytics()
+    sales = data['sales']
 
     return {
         # Basic counts
-        'total_drugs': total_drugs,
-        'total_categories': total_categories,
-        'total_manufacturers': total_manufacturers,
-        'total_stock_items': total_stock_items,
+        'total_drugs': data['total_drugs'],
+        'total_categories': data['total_categories'],
+        'total_manufacturers': data['total_manufacturers'],
+        'total_stock_items': data['total_stock_items'],
 
         # Alerts
-        'low_stock_count': low_stock_count,
-        'expired_count': expired_count,
-        'near_expiry_count': near_expiry_count,
-        'pending_orders': pending_orders,
+        'low_stock_count': data['low_stock_count'],
+        'expired_count': data['expired_count'],
+        'near_expiry_count': data['near_expiry_count'],
+        'pending_orders': data['pending_orders'],
 
         # Inventory values
-        'store_inventory_value': inventory_values['store_value'],
-        'pharmacy_inventory_value': inventory_values['pharmacy_value'],
-        'total_inventory_value': inventory_values['total_value'],
+        'store_inventory_value': data['store_value'],
+        'pharmacy_inventory_value': data['pharmacy_value'],
+        'total_inventory_value': data['total_value'],
 
         # Sales data
-        'today_sales_quantity': float(today_sales['quantity'] or 0),
-        'today_sales_revenue': float(today_sales['revenue'] or 0),
-        'week_sales_quantity': float(week_sales['quantity'] or 0),
-        'week_sales_revenue': float(week_sales['revenue'] or 0),
-        'month_sales_quantity': float(month_sales['quantity'] or 0),
-        'month_sales_revenue': float(month_sales['revenue'] or 0),
-        'revenue_growth': revenue_growth,
+        'today_sales_quantity': sales['today_quantity'],
+        'today_sales_revenue': sales['today_revenue'],
+        'week_sales_quantity': sales['week_quantity'],
+        'week_sales_revenue': sales['week_revenue'],
+        'month_sales_quantity': sales['month_quantity'],
+        'month_sales_revenue': sales['month_revenue'],
+        'revenue_growth': data['revenue_growth'],
 
         # Orders
-        'today_orders_completed': today_orders_completed,
-        'recent_transfers_quantity': float(recent_transfers),
+        'today_orders_completed': data['today_orders_completed'],
+        'recent_transfers_quantity': data['recent_transfers_quantity'],
 
         # Chart data (JSON serialized)
-        'sales_chart_data': json.dumps(sales_chart_data),
-        'category_distribution': json.dumps(category_distribution),
-        'monthly_trends': json.dumps(monthly_trends),
-        'top_selling_drugs': top_selling_drugs,
+        'sales_chart_data': json.dumps(data['daily_sales']),
+        'category_distribution': json.dumps(data['category_distribution']),
+        'monthly_trends': json.dumps(data['monthly_trends']),
+        'top_selling_drugs': data['top_selling_drugs'],
 
         # Recent activity
-        'recent_stock_additions': recent_stock_additions,
-        'low_stock_drugs': get_low_stock_alerts()[:10],  # Show top 10
-        'expired_drugs': get_expired_drugs()[:10],
-        'near_expiry_drugs': get_near_expiry_drugs()[:10],
+        'recent_stock_additions': data['recent_stock_additions'],
+        'low_stock_drugs': data['low_stock_drugs'],
+        'expired_drugs': data['expired_drugs'],
+        'near_expiry_drugs': data['near_expiry_drugs'],
     }
 
 
@@ -2844,85 +2522,14 @@ def process_walkin_dispense_ajax(request):
         if not dispense_items:
             return JsonResponse({'error': 'No items to dispense'}, status=400)
 
-        dispensed_count = 0
-
-        for item in dispense_items:
-            order_id = item.get('order_id')
-            dispense_quantity = Decimal(str(item.get('quantity', 0)))
-
-            try:
-                # Get the order (no patient check needed for walk-ins)
-                order = DrugOrderModel.objects.get(
-                    id=order_id,
-                    source='walkin',
-                    status__in=['paid', 'partially_dispensed']
-                )
-
-                remaining_quantity = order.remaining_to_dispense
-
-                if dispense_quantity <= 0:
-                    continue
-
-                if dispense_quantity > remaining_quantity:
-                    return JsonResponse({
-                        'error': f'Cannot dispense {dispense_quantity} of {order.drug.brand_name or order.drug.generic_name}. Only {remaining_quantity} remaining.'
-                    }, status=400)
-
-                # Check if sufficient quantity in pharmacy
-                if order.drug.pharmacy_quantity < float(dispense_quantity):
-                    return JsonResponse({
-                        'error': f'Insufficient stock in pharmacy for {order.drug.brand_name or order.drug.generic_name}. '
-                                 f'Requested: {dispense_quantity}, Available: {order.drug.pharmacy_quantity}'
-                    }, status=400)
-
-                # Process FIFO stock reduction
-                try:
-                    from pharmacy.views import process_fifo_stock_reduction  # Import from your existing code
-
-                    customer_name = order.customer_display
-
-                    stock_outs_created = process_fifo_stock_reduction(
-                        drug=order.drug,
-                        quantity_to_reduce=float(dispense_quantity),
-                        location='pharmacy',
-                        reason='sale',
-                        remark=f'Dispensed to walk-in customer: {customer_name}',
-                        user=request.user
-                    )
-                except ValueError as e:
-                    return JsonResponse({
-                        'error': f'Stock allocation error for {order.drug.brand_name or order.drug.generic_name}: {str(e)}'
-                    }, status=400)
-
-                # Create dispense record
-                dispense_record = DispenseRecord.objects.create(
-                    order=order,
-                    dispensed_by=request.user,
-                    dispensed_qty=dispense_quantity,
-                    notes=f'Walk-in dispense by {request.user.__str__() or request.user.username}. '
-                          f'Stock reduced from {len(stock_outs_created)} stock entries.'
-                )
-
-                # Update order quantities
-                order.quantity_dispensed += float(dispense_quantity)
-
-                # Update dispensed_at timestamp
-                order.dispensed_at = timezone.now()
-                order.dispensed_by = request.user
-
-                # Update status based on dispensing completion
-                if order.quantity_dispensed >= order.quantity_ordered:
-                    order.status = 'dispensed'
-                else:
-                    order.status = 'partially_dispensed'
-
-                order.save()
-                dispensed_count += 1
-
-            except DrugOrderModel.DoesNotExist:
-                return JsonResponse({
-                    'error': f'Drug order {order_id} not found or not eligible for dispensing'
-                }, status=404)
+        # No patient check needed for walk-ins
+        dispensed_count = _dispense_orders(
+            dispense_items,
+            DrugOrderModel.objects.filter(source='walkin', status__in=['paid', 'partially_dispensed']),
+            request.user,
+            remark=lambda order: f'Dispensed to walk-in customer: {order.customer_display}',
+            notes_prefix='Walk-in dispense by',
+        )
 
         return JsonResponse({
             'success': True,
@@ -2930,6 +2537,8 @@ def process_walkin_dispense_ajax(request):
             'dispensed_count': dispensed_count
         })
 
+    except DispenseError as e:
+        return JsonResponse({'error': str(e)}, status=e.status)
     except Exception as e:
         import traceback
         traceback.print_exc()
@@ -4,6 +4,8 @@ from django.core.validators import MinValueValidator
 from decimal import Decimal
 from datetime import date
 
+from admin_site.sequences import next_sequence_value, max_sequence_suffix
+
 
 # 1. SCAN CATEGORIES (Simple grouping)
 class ScanCategoryModel(models.Model):
@@ -348,18 +350,10 @@ class ScanOrderModel(models.Model):
             # Auto-generate order number
             today = date.today()
             date_str = today.strftime('%Y%m%d')
-            last_order = ScanOrderModel.objects.filter(
-                order_number__startswith=f'SCN{date_str}'
-            ).order_by('-order_number').first()
-
-            if last_order:
-                try:
-                    last_num = int(last_order.order_number[-3:])
-                    next_num = last_num + 1
-                except ValueError:
-                    next_num = 1
-            else:
-                next_num = 1
+            next_num = next_sequence_value(
+                'SCN', date_str,
+                seed=lambda: max_sequence_suffix(ScanOrderModel.objects, 'order_number', f'SCN{date_str}')
+            )
 
             self.order_number = f'SCN{date_str}{str(next_num).zfill(3)}'
 
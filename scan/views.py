@@ -30,10 +30,13 @@ from django.views.generic import (
     CreateView, ListView, UpdateView, DeleteView, DetailView, TemplateView
 )
 
+from admin_site.exports import ExportSheet, Styled, iterate, export_response, CENTER, HEADER_FONT, HEADER_FILL, \
+    MONEY_FORMAT, THIN_BORDER
 from admin_site.models import SiteInfoModel
 from finance.models import PatientTransactionModel
 from insurance.models import InsuranceClaimModel
 from patient.models import PatientModel, PatientWalletModel
+from patient.search import get_patient_by_card
 from .models import *
 from .forms import *
 from django.utils.text import slugify
@@ -240,7 +243,7 @@ def verify_scan_patient_ajax(request):
         return JsonResponse({'success': False, 'error': 'Please enter a card number'})
 
     try:
-        patient = PatientModel.objects.get(card_number__iexact=card_number, status='active')
+        patient = get_patient_by_card(card_number, PatientModel.objects.filter(status='active'))
 
         # Get scan counts
         scan_counts = {
@@ -728,9 +731,6 @@ def process_scan_payments(request):
                 order = detail['order']
                 patient_amount = detail['patient_amount']
 
-                # Deduct patient amount from wallet
-                wallet.amount -= patient_amount
-
                 # Update order
                 order.status = 'paid'
                 order.payment_status = True
@@ -747,8 +747,10 @@ def process_scan_payments(request):
                 order.save()
                 updated_count += 1
 
-            # Save wallet
-            wallet.save()
+            # Deduct the patient's share from the wallet
+            if total_patient_amount > 0:
+                wallet.debit(total_patient_amount, 'payment', user=request.user,
+                             description=f'Scan payment ({updated_count} scan(s))')
 
             # Prepare response message
             message_parts = [
@@ -3569,133 +3571,78 @@ class ScanLogExportExcelView(LoginRequiredMixin, PermissionRequiredMixin, View):
         total_amount = totals['total_amount'] or Decimal('0.00')
         total_patients = totals['total_patients'] or 0
 
-        wb = Workbook()
-        ws = wb.active
-        ws.title = "Scan Log"
-
         # Styles
         header_font = Font(bold=True, size=14)
         title_font = Font(bold=True, size=12)
-        table_header_font = Font(bold=True, size=11, color="FFFFFF")
-        header_fill = PatternFill(start_color="4472C4", end_color="4472C4", fill_type="solid")
         total_font = Font(bold=True, size=11)
-        border = Border(left=Side(style='thin'), right=Side(style='thin'), top=Side(style='thin'),
-                        bottom=Side(style='thin'))
 
         # Header section adapted for Scan/Site info
         scan_setting = ScanSettingModel.objects.first()
         site_info = SiteInfoModel.objects.first()
-        row = 1
-        if scan_setting and scan_setting.scan_name:
-            ws.merge_cells(f'A{row}:H{row}');
-            cell = ws[f'A{row}'];
-            cell.value = scan_setting.scan_name;
-            cell.font = header_font;
-            cell.alignment = Alignment(horizontal='center');
-            row += 1
-        elif site_info:
-            ws.merge_cells(f'A{row}:H{row}');
-            cell = ws[f'A{row}'];
-            cell.value = site_info.name;
-            cell.font = header_font;
-            cell.alignment = Alignment(horizontal='center');
-            row += 1
-        row += 1
-
-        ws.merge_cells(f'A{row}:H{row}');
-        cell = ws[f'A{row}'];
-        cell.value = report_title;
-        cell.font = title_font;
-        cell.alignment = Alignment(horizontal='center');
-        row += 1
-        ws.merge_cells(f'A{row}:H{row}');
-        cell = ws[f'A{row}'];
-        cell.value = f"Period: {from_date.strftime('%B %d, %Y')} to {to_date.strftime('%B %d, %Y')}";
-        cell.alignment = Alignment(horizontal='center');
-        row += 2
 
         # Table Headers
         headers = ['S/N', 'Date', 'Patient ID', 'Patient Name', 'Scan Name']
-        if show_status: headers.append('Status')
-        if show_amount: headers.append('Amount')
-        if show_scientist: headers.append('Verified By')
-
-        for col_num, header in enumerate(headers, 1):
-            cell = ws.cell(row=row, column=col_num, value=header)
-            cell.font = table_header_font;
-            cell.fill = header_fill;
-            cell.border = border
-        row += 1
-
-        # Data Rows
-        for idx, order in enumerate(orders_qs, 1):
-            col = 1
-            ws.cell(row=row, column=col, value=idx).border = border;
-            col += 1
-            ws.cell(row=row, column=col, value=order.ordered_at.strftime('%Y-%m-%d %H:%M')).border = border;
-            col += 1
-            ws.cell(row=row, column=col, value=order.patient.card_number).border = border;
-            col += 1
-            ws.cell(row=row, column=col, value=order.patient.__str__()).border = border;
-            col += 1
-            ws.cell(row=row, column=col, value=order.template.name).border = border;
-            col += 1
-
+        column_widths = [6, 18, 15, 30, 35]
+        if show_status: headers.append('Status'); column_widths.append(15)
+        if show_amount: headers.append('Amount'); column_widths.append(15)
+        if show_scientist: headers.append('Verified By'); column_widths.append(30)
+
+        def bordered(value=None, **style):
+            return Styled(value, border=THIN_BORDER, **style)
+
+        def rows():
+            if scan_setting and scan_setting.scan_name:
+                yield [Styled(scan_setting.scan_name, font=header_font, alignment=CENTER, merge_across=8)]
+            elif site_info:
+                yield [Styled(site_info.name, font=header_font, alignment=CENTER, merge_across=8)]
+            yield []
+            yield [Styled(report_title, font=title_font, alignment=CENTER, merge_across=8)]
+            yield [Styled(f"Period: {from_date.strftime('%B %d, %Y')} to {to_date.strftime('%B %d, %Y')}",
+                          alignment=CENTER, merge_across=8)]
+            yield []
+            yield [bordered(header, font=HEADER_FONT, fill=HEADER_FILL) for header in headers]
+
+            # Data Rows
+            for idx, order in enumerate(iterate(orders_qs), 1):
+                row = [
+                    bordered(idx),
+                    bordered(order.ordered_at.strftime('%Y-%m-%d %H:%M')),
+                    bordered(order.patient.card_number),
+                    bordered(order.patient.__str__()),
+                    bordered(order.template.name),
+                ]
+
+                if show_status:
+                    row.append(bordered(order.get_status_display()))
+                if show_amount:
+                    row.append(bordered(order.amount_charged, number_format=MONEY_FORMAT))
+
+                if show_scientist:
+                    verifier = 'N/A'
+                    if hasattr(order, 'result') and order.result and order.result.verified_by:
+                        user = order.result.verified_by
+                        if hasattr(user,
+                                   'user_staff_profile') and user.user_staff_profile and user.user_staff_profile.staff:
+                            verifier = user.user_staff_profile.staff.__str__()
+                        else:
+                            verifier = user.get_full_name()
+                    row.append(bordered(verifier))
+                yield row
+
+            # Total Row
+            row = [None, None, None, None, bordered("TOTAL", font=total_font)]
             if show_status:
-                ws.cell(row=row, column=col, value=order.get_status_display()).border = border;
-                col += 1
+                row.append(bordered())
             if show_amount:
-                cell = ws.cell(row=row, column=col, value=order.amount_charged);
-                cell.number_format = '#,##0.00';
-                cell.border = border;
-                col += 1
-
+                row.append(bordered(total_amount, font=total_font, number_format=MONEY_FORMAT))
             if show_scientist:
-                verifier = 'N/A'
-                if hasattr(order, 'result') and order.result and order.result.verified_by:
-                    user = order.result.verified_by
-                    if hasattr(user,
-                               'user_staff_profile') and user.user_staff_profile and user.user_staff_profile.staff:
-                        verifier = user.user_staff_profile.staff.__str__()
-                    else:
-                        verifier = user.get_full_name()
-                ws.cell(row=row, column=col, value=verifier).border = border;
-                col += 1
-            row += 1
+                row.append(bordered(f"{total_patients} Unique Patients", font=total_font))
+            yield row
 
-        # Total Row
-        ws.cell(row=row, column=5, value="TOTAL").font = total_font
-        ws.cell(row=row, column=5).border = border
-
-        col_offset = 6
-        if show_status:
-            ws.cell(row=row, column=col_offset).border = border;
-            col_offset += 1
-        if show_amount:
-            cell = ws.cell(row=row, column=col_offset, value=total_amount);
-            cell.font = total_font;
-            cell.number_format = '#,##0.00';
-            cell.border = border;
-            col_offset += 1
-        if show_scientist:
-            cell = ws.cell(row=row, column=col_offset, value=f"{total_patients} Unique Patients");
-            cell.font = total_font;
-            cell.border = border
-
-        ws.column_dimensions['A'].width = 6;
-        ws.column_dimensions['B'].width = 18;
-        ws.column_dimensions['C'].width = 15;
-        ws.column_dimensions['D'].width = 30;
-        ws.column_dimensions['E'].width = 35
-        if show_status: ws.column_dimensions['F'].width = 15
-        if show_amount: ws.column_dimensions['G'].width = 15
-        if show_scientist: ws.column_dimensions['H'].width = 30
-
-        response = HttpResponse(content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
-        filename = f"scan_log_{from_date.strftime('%Y%m%d')}_{to_date.strftime('%Y%m%d')}.xlsx"
-        response['Content-Disposition'] = f'attachment; filename="{filename}"'
-        wb.save(response)
-        return response
+        filename = f"scan_log_{from_date.strftime('%Y%m%d')}_{to_date.strftime('%Y%m%d')}"
+        return export_response(request, filename, [
+            ExportSheet("Scan Log", rows(), column_widths=column_widths)
+        ])
 
 
 class ScanLogExportPDFView(LoginRequiredMixin, PermissionRequiredMixin, View):
@@ -27,8 +27,9 @@ from .models import (
     ServiceCategory, Service, ServiceItem, ServiceItemStockMovement,
     PatientServiceTransaction, ServiceResult, ServiceItemBatch
 )
-from patient.models import PatientModel, PatientWalletModel
+from patient.models import PatientModel, PatientWalletModel, InsufficientWalletBalance
 from finance.models import PatientTransactionModel
+from admin_site.catalog import search_catalog
 
 logger = logging.getLogger(__name__)
 
@@ -738,7 +739,7 @@ def process_patient_payment(request, patient_id, transaction_id):
 
             with transaction.atomic():
                 # Deduct from wallet
-                wallet.deduct_funds(amount_to_pay)
+                wallet.debit(amount_to_pay, 'payment', user=request.user, description='Service payment')
 
                 # Update service transaction amount paid
                 service_transaction.amount_paid += amount_to_pay
@@ -770,6 +771,8 @@ def process_patient_payment(request, patient_id, transaction_id):
 
                 messages.success(request, f"Payment of ₦{amount_to_pay:,.2f} processed successfully.")
 
+        except InsufficientWalletBalance as e:
+            messages.error(request, str(e))
         except ValueError:
             messages.error(request, "Invalid payment amount format.")
         except Exception as e:
@@ -1284,8 +1287,8 @@ def process_bulk_payments_ajax(request):
 
     try:
         with transaction.atomic():
-            old_balance = wallet.amount
-            wallet.deduct_funds(total_due)
+            entry = wallet.debit(total_due, 'payment', user=request.user, description='Service payment')
+            old_balance = entry.balance_before
 
             for tx in transactions_to_pay:
                 amount_to_pay_for_tx = tx.balance_due
@@ -1362,18 +1365,13 @@ def ajax_search_services_and_items(request):
     if len(query) < 2:
         return JsonResponse({'results': []})
 
-    services = Service.objects.filter(
-        Q(name__icontains=query) | Q(description__icontains=query), is_active=True
-    ).values('id', 'name', 'price')[:5]
-
-    items = ServiceItem.objects.filter(
-        Q(name__icontains=query) | Q(description__icontains=query), is_active=True, stock_quantity__gt=0
-    ).values('id', 'name', 'price', 'stock_quantity')[:5]
+    services = search_catalog(query, ['service'], limit=5)
+    items = search_catalog(query, ['service_item'], in_stock=True, limit=5)
 
     results = []
-    for s in services:
-        results.append({'id': s['id'], 'name': s['name'], 'price': s['price'], 'type': 'service', 'stock': 'N/A'})
-    for i in items:
-        results.append({'id': i['id'], 'name': i['name'], 'price': i['price'], 'type': 'item', 'stock': i['stock_quantity']})
+    for s, _ in services:
+        results.append({'id': s.object_id, 'name': s.name, 'price': s.price, 'type': 'service', 'stock': 'N/A'})
+    for i, _ in items:
+        results.append({'id': i.object_id, 'name': i.name, 'price': i.price, 'type': 'item', 'stock': int(i.stock)})
 
     return JsonResponse({'results': results})
\ No newline at end of file